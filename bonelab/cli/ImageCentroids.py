@@ -3,31 +3,48 @@ import argparse
 import os
 import vtk
 import math
+import weakref
 import numpy as np
 
 from vtk.util.numpy_support import vtk_to_numpy
 
 from bonelab.util.echo_arguments import echo_arguments
 from bonelab.io.vtk_helpers import get_vtk_reader
+from bonelab.util.label_statistics import compute_label_statistics
+
+# the statistics of the last image passed to `get_label_statistics`, as (weak reference to the image, modification
+# time, statistics), so that calling `get_centroid` for every label only goes through the image once
+_last_label_statistics = None
+
+def get_label_statistics(image):
+  '''Counts, volumes, centroids and bounding boxes of all labels, in one pass'''
+  global _last_label_statistics
+  scalars = image.GetPointData().GetScalars()
+  mtime = max(image.GetMTime(), scalars.GetMTime())
+  if _last_label_statistics is not None:
+    image_ref, last_mtime, stats = _last_label_statistics
+    if image_ref() is image and last_mtime == mtime:
+      return stats
 
-def get_centroid(image,label):
-  
-  if label == 0:
-    return (0,0,0)
-    
-  origin = image.GetOrigin()
-  spacing = image.GetSpacing()
   dim = image.GetDimensions()
+  img = vtk_to_numpy(scalars)
 
-  img = vtk_to_numpy(image.GetPointData().GetScalars())
-  
   # vtk arrays are slice (z), row (y), column (x)
   img = img.reshape([dim[2],dim[1],dim[0]]).transpose() # remove the transpose if necessary
-  matches = np.transpose((img == label).nonzero())
-  centroid = np.mean(matches, axis=0) # measured in voxels
-  centroid = [m*x+b for m,x,b in zip(centroid,spacing,origin)] # measured in global coordinates
+  stats = compute_label_statistics(img, image.GetSpacing(), image.GetOrigin()) # measured in global coordinates
+  _last_label_statistics = (weakref.ref(image), mtime, stats)
+  return stats
+
+def get_centroid(image,label):
   
-  return centroid
+  if label == 0:
+    return (0,0,0)
+    
+  stats = get_label_statistics(image)
+  index = stats.index(label)
+  if index is None:
+    return [np.nan, np.nan, np.nan]
+  return list(stats.centroids[index])
   
 def ImageCentroids(input_filename,rapidprototyping,scantype):
 
@@ -100,7 +117,8 @@ def ImageCentroids(input_filename,rapidprototyping,scantype):
         print(formatter_float.format(measure, outcome, unit))
     print(guard)
     
-    labels = np.unique(array)
+    stats = get_label_statistics(img)
+    labels = stats.labels
     print(formatter_int.format('!> N Labels  =',len(labels),'[1]'))
     for label in labels:
       print(formatter_int.format('!> Label  ',label,''))
@@ -109,12 +127,17 @@ def ImageCentroids(input_filename,rapidprototyping,scantype):
     centroid_dict = {} # dictionary
     
     print('!> Centroids')
-    for label in labels:
+    for label, centroid in zip(labels, stats.centroids):
       #if label != 0 and (label ==10 or label==9):
       if label != 0:
-        centroid = get_centroid(img,label)
         print('!> Label {:3d}: {:8.4f} {:8.4f} {:8.4f}'.format(label,centroid[0],centroid[1],centroid[2]))
-        centroid_dict[label] = centroid
+        centroid_dict[label] = list(centroid)
+    print(guard)
+    
+    print('!> Volumes [mm^3] and bounding boxes [voxels]')
+    for label, volume, box in zip(labels, stats.volumes, stats.bounding_boxes):
+      if label != 0:
+        print('!> Label {:3d}: {:12.4f}  x {:>5d} {:>5d}  y {:>5d} {:>5d}  z {:>5d} {:>5d}'.format(label,volume,*box.ravel()))
     print(guard)
     
     if rapidprototyping:
@@ -177,8 +200,8 @@ def main():
     # Setup description
     description='''Calculate centroids of segmented components
 
-Reads in a segmented file and outputs the centroid of each label
-in the image.
+Reads in a segmented file and outputs the centroid, volume and
+bounding box of each label in the image.
 '''
 
     # Setup argument parsing
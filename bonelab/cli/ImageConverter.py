@@ -7,6 +7,23 @@ import vtkbone
 from bonelab.util.echo_arguments import echo_arguments
 from bonelab.io.vtk_helpers import get_vtk_reader, get_vtk_writer, handle_filetype_writing_special_cases
 
+def write_image(image, output_filename, processing_log=''):
+    # Create writer
+    writer = get_vtk_writer(output_filename)
+    if writer is None:
+        os.sys.exit('[ERROR] Cannot find writer for file \"{}\"'.format(output_filename))
+    writer.SetInputData(image)
+    writer.SetFileName(output_filename)
+
+    # Handle edge cases for each output file type
+    handle_filetype_writing_special_cases(
+        writer,
+        processing_log=processing_log
+    )
+
+    print('Saving image ' + output_filename)
+    writer.Update()
+
 def ImageConverter(input_filename, output_filename, processing_log='', overwrite=False):
     # Python 2/3 compatible input
     from six.moves import input
@@ -30,13 +47,6 @@ def ImageConverter(input_filename, output_filename, processing_log='', overwrite
     reader.SetFileName(input_filename)
     reader.Update()
 
-    # Create writer
-    writer = get_vtk_writer(output_filename)
-    if writer is None:
-        os.sys.exit('[ERROR] Cannot find writer for file \"{}\"'.format(output_filename))
-    writer.SetInputConnection(reader.GetOutputPort())
-    writer.SetFileName(output_filename)
-
     # Setup processing log
     final_processing_log = ''
     if len(processing_log) > 0 and type(reader) == type(vtkbone.vtkboneAIMReader):
@@ -46,14 +56,7 @@ def ImageConverter(input_filename, output_filename, processing_log='', overwrite
     elif len(processing_log) > 0:
         final_processing_log = processing_log
 
-    # Handle edge cases for each output file type
-    handle_filetype_writing_special_cases(
-        writer,
-        processing_log=final_processing_log
-    )
-
-    print('Saving image ' + output_filename)
-    writer.Update()
+    write_image(reader.GetOutput(), output_filename, final_processing_log)
 
 def main():
     # Setup description
@@ -8,31 +8,19 @@ import numpy as np
 import math
 
 from bonelab.util.echo_arguments import echo_arguments
+from bonelab.util.image_statistics import ImageStatistics, histogram_range
 from vtk.util.numpy_support import vtk_to_numpy
 
 def histogram(image):
-    array = vtk_to_numpy(image.GetPointData().GetScalars()).ravel()
+    stats = ImageStatistics(vtk_to_numpy(image.GetPointData().GetScalars()))
     guard = '!-------------------------------------------------------------------------------'
 
-    if (array.min() < -128):
-      range_min = -32768
-    elif (array.min() < 0):
-      range_min = -128
-    else:
-      range_min = 0
-    
-    if (array.max() > 255):
-      range_max = 32767
-    elif (array.max() > 127):
-      range_max = 255
-    else:
-      range_max = 127
-
+    range_min, range_max = histogram_range(stats)
     nRange = [range_min, range_max]
     nBins = 128
     
     # https://numpy.org/doc/stable/reference/generated/numpy.histogram.html
-    hist,bin_edges = np.histogram(array,nBins,nRange,None,None,False)
+    hist,bin_edges = stats.histogram(nBins,nRange)
     nValues = sum(hist)
 
     print(guard)
@@ -8,7 +8,69 @@ import numpy as np
 import math
 
 from bonelab.util.echo_arguments import echo_arguments
-from vtk.util.numpy_support import vtk_to_numpy
+from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
+
+def extent_to_numpy(data, extent):
+  '''Get the voxels of an extent of image data as an array indexed [z,y,x] (plus components).'''
+  data_extent = data.GetExtent()
+  shape = [data_extent[5]-data_extent[4]+1, data_extent[3]-data_extent[2]+1, data_extent[1]-data_extent[0]+1]
+  if data.GetNumberOfScalarComponents() > 1:
+    shape.append(data.GetNumberOfScalarComponents())
+  array = vtk_to_numpy(data.GetPointData().GetScalars()).reshape(shape)
+  return array[
+    extent[4]-data_extent[4]:extent[5]-data_extent[4]+1,
+    extent[2]-data_extent[2]:extent[3]-data_extent[2]+1,
+    extent[0]-data_extent[0]:extent[1]-data_extent[0]+1
+  ]
+
+def read_extent(reader, extent):
+  '''Read only the voxels of an extent with a streaming reader, as an array indexed [z,y,x] (plus components).'''
+  reader.UpdateExtent(extent)
+  return extent_to_numpy(reader.GetOutput(), extent)
+
+def scan_mask(reader, extent, slab_slices=16):
+  '''Find the range of a mask and the bounding extent of its non-zero voxels, reading slabs of slices.
+
+  Returns the minimum, the maximum and the bounding extent, which is None if the mask is all zero.'''
+  range_min, range_max = np.inf, -np.inf
+  bounds = None
+  for z0 in range(extent[4], extent[5]+1, slab_slices):
+    z1 = min(z0+slab_slices-1, extent[5])
+    slab = read_extent(reader, [extent[0], extent[1], extent[2], extent[3], z0, z1])
+    range_min = min(range_min, slab.min())
+    range_max = max(range_max, slab.max())
+    nonzero = slab != 0
+    if slab.ndim > 3:
+      nonzero = nonzero.any(axis=3)
+    if not nonzero.any():
+      continue
+    # axes of the slab are z, y, x
+    slab_bounds = []
+    for axis, offset in [(2, extent[0]), (1, extent[2]), (0, z0)]:
+      indices = np.flatnonzero(nonzero.any(axis=tuple(a for a in range(3) if a != axis)))
+      slab_bounds.append([offset+indices[0], offset+indices[-1]])
+    if bounds is None:
+      bounds = slab_bounds
+    else:
+      bounds = [[min(b[0], s[0]), max(b[1], s[1])] for b, s in zip(bounds, slab_bounds)]
+  if bounds is not None:
+    bounds = [int(x) for b in bounds for x in b]
+  return float(range_min), float(range_max), bounds
+
+def grow_extent(extent, below, above, limits):
+  '''Grow an extent by a number of voxels below and above along each axis, clipped to the limits.'''
+  grown = []
+  for i in range(3):
+    grown.append(max(extent[2*i]-below[i], limits[2*i]))
+    grown.append(min(extent[2*i+1]+above[i], limits[2*i+1]))
+  return grown
+
+def kernel_reach(kernel):
+  '''The number of voxels vtkImageDilateErode3D spreads the dilate value below and above along each axis.'''
+  # an output voxel looks at input offsets -(k//2) to k-1-k//2, so the dilate value spreads the other way
+  below = [k-1-k//2 for k in kernel]
+  above = [k//2 for k in kernel]
+  return below, above
 
 def ImageMask(input_image, input_mask, output_image, kernel, overwrite):
 
@@ -42,17 +104,15 @@ def ImageMask(input_image, input_mask, output_image, kernel, overwrite):
   print('{:20s} = {:s}'.format('!> Input Mask:',input_mask))
   print('{:20s} = {:s}'.format('!> Output image:',output_image))
   
-  print('Reading input image ' + input_image)
+  # Only the header is read here, the data is streamed below
   img_reader.SetFileName(input_image)
-  img_reader.Update()
-
-  print('Reading input mask ' + input_mask)
+  img_reader.UpdateInformation()
   mask_reader.SetFileName(input_mask)
-  mask_reader.Update()
+  mask_reader.UpdateInformation()
 
   # Check that extents are equal
-  img_extent = img_reader.GetOutput().GetExtent()
-  mask_extent = mask_reader.GetOutput().GetExtent()
+  img_extent = img_reader.GetDataExtent()
+  mask_extent = mask_reader.GetDataExtent()
   
   print('{:20s} = '.format('!> Image extent:')+' '.join('{:3d}'.format(x) for x in img_extent))
   print('{:20s} = '.format('!> Mask extent:')+' '.join('{:3d}'.format(x) for x in mask_extent))
@@ -61,8 +121,15 @@ def ImageMask(input_image, input_mask, output_image, kernel, overwrite):
     if img_extent[i] != mask_extent[i]:
       os.sys.exit('[ERROR] Image and mask must have same extents.')
 
-  # Find range of input mask
-  [imdata_range_min,imdata_range_max] = mask_reader.GetOutput().GetPointData().GetScalars().GetRange()
+  # Find range of input mask and the extent of its non-zero voxels. A gzipped mask cannot be read from the middle,
+  # every slab would decompress it again from the start, so it is read whole instead. The reader then keeps it,
+  # and the output extent and the dilation below are taken from it without reading the file again
+  print('Reading input mask ' + input_mask)
+  if input_mask.lower().endswith('.nii.gz'):
+    slab_slices = mask_extent[5]-mask_extent[4]+1
+  else:
+    slab_slices = 16
+  [imdata_range_min,imdata_range_max,mask_bounds] = scan_mask(mask_reader, mask_extent, slab_slices)
   print('{:20s} = {:.1f}'.format('!> Mask value min',imdata_range_min))
   print('{:20s} = {:.1f}'.format('!> Mask value max',imdata_range_max))
 
@@ -76,23 +143,64 @@ def ImageMask(input_image, input_mask, output_image, kernel, overwrite):
       os.sys.exit('[ERROR] Kernel values must be positive integers.')
   print('{:20s} = {}'.format('!> Perform dilation',perform_dilation))
 
-  if perform_dilation:
-    dilate = vtk.vtkImageDilateErode3D()
-    dilate.SetInputConnection(mask_reader.GetOutputPort())
-    dilate.SetDilateValue(imdata_range_max) # dilation occurs at border of dilate/erode; dilate value is mask
-    dilate.SetErodeValue(imdata_range_min) # erode value is background
-    dilate.SetKernelSize(kernel[0],kernel[1],kernel[2]) # amount of dilation
-    dilate.Update()
-
-  # Apply the mask to the image
-  mask = vtk.vtkImageMask()
-  mask.SetImageInputData(img_reader.GetOutput())
-  if perform_dilation:
-    mask.SetMaskInputData(dilate.GetOutput())
+  # Everything outside of the (dilated) mask is zero, so only the voxels within the bounding box of the
+  # mask, grown by the reach of the kernel, are read from the image and masked
+  if mask_bounds is None:
+    print('{:20s} = {}'.format('!> Mask bounds','empty'))
+    output_extent = None
   else:
-    mask.SetMaskInputData(mask_reader.GetOutput())
-  mask.SetMaskedOutputValue(0.0)
-  mask.Update()
+    output_extent = mask_bounds
+    if perform_dilation:
+      spread_below, spread_above = kernel_reach(kernel)
+      output_extent = grow_extent(mask_bounds, spread_below, spread_above, img_extent)
+    print('{:20s} = '.format('!> Mask bounds:')+' '.join('{:3d}'.format(x) for x in output_extent))
+
+  print('Reading input image ' + input_image)
+  if output_extent is None:
+    # read a single voxel to get the scalar type and geometry of the image
+    image_block = read_extent(img_reader, [img_extent[0], img_extent[0], img_extent[2], img_extent[2], img_extent[4], img_extent[4]])
+  else:
+    image_block = read_extent(img_reader, output_extent)
+  img_data = img_reader.GetOutput()
+  n_components = img_data.GetNumberOfScalarComponents()
+  shape = [img_extent[5]-img_extent[4]+1, img_extent[3]-img_extent[2]+1, img_extent[1]-img_extent[0]+1]
+  if n_components > 1:
+    shape.append(n_components)
+  output_array = np.zeros(shape, dtype=image_block.dtype)
+
+  if output_extent is not None:
+    if perform_dilation:
+      # dilate within the output extent only, the pipeline asks the reader for the mask around it that the kernel needs
+      dilate = vtk.vtkImageDilateErode3D()
+      dilate.SetInputConnection(mask_reader.GetOutputPort())
+      dilate.SetDilateValue(imdata_range_max) # dilation occurs at border of dilate/erode; dilate value is mask
+      dilate.SetErodeValue(imdata_range_min) # erode value is background
+      dilate.SetKernelSize(kernel[0],kernel[1],kernel[2]) # amount of dilation
+      dilate.UpdateExtent(output_extent)
+      mask_block = extent_to_numpy(dilate.GetOutput(), output_extent)
+    else:
+      mask_reader.UpdateExtent(output_extent)
+      mask_block = extent_to_numpy(mask_reader.GetOutput(), output_extent)
+    inside = (mask_block.reshape(mask_block.shape[:3] + (-1,)) != 0).any(axis=3)
+    if image_block.ndim > 3:
+      inside = inside[..., np.newaxis]
+
+    # Apply the mask to the image, writing straight into the output
+    output_block = output_array[
+      output_extent[4]-img_extent[4]:output_extent[5]-img_extent[4]+1,
+      output_extent[2]-img_extent[2]:output_extent[3]-img_extent[2]+1,
+      output_extent[0]-img_extent[0]:output_extent[1]-img_extent[0]+1
+    ]
+    np.copyto(output_block, image_block, where=inside)
+
+  masked = vtk.vtkImageData()
+  masked.SetExtent(img_extent)
+  masked.SetSpacing(img_data.GetSpacing())
+  masked.SetOrigin(img_data.GetOrigin())
+  masked.SetDirectionMatrix(img_data.GetDirectionMatrix())
+  scalars = numpy_to_vtk(output_array.reshape(-1, n_components), deep=True, array_type=img_data.GetScalarType())
+  scalars.SetName(img_data.GetPointData().GetScalars().GetName())
+  masked.GetPointData().SetScalars(scalars)
 
   # Write result
   if output_image.lower().endswith('.nii'):
@@ -103,7 +211,7 @@ def ImageMask(input_image, input_mask, output_image, kernel, overwrite):
       os.sys.exit('[ERROR] Cannot find writer for file \"{}\"'.format(output_image))
       
   # writer.SetInputConnection(mask.GetOutputPort())
-  writer.SetInputData(mask.GetOutput())
+  writer.SetInputData(masked)
   writer.SetFileName(output_image)
   writer.SetTimeDimension(img_reader.GetTimeDimension())
   writer.SetTimeSpacing(img_reader.GetTimeSpacing())
@@ -8,11 +8,14 @@ import vtkbone
 import copy
 import numpy as np
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from bonelab.util.echo_arguments import echo_arguments
 from bonelab.util.aim_calibration_header import get_aim_density_equation
-from bonelab.util.write_csv import write_csv
-from .ImageConverter import ImageConverter
+from bonelab.util.write_csv import write_csv, write_csv_rows
+from bonelab.util.vtk_util import vtkImageData_to_sitk
+from bonelab.io.vtk_helpers import get_vtk_writer
+from .ImageConverter import write_image
 
 
 def segment_bone(image, threshold):
@@ -20,7 +23,25 @@ def segment_bone(image, threshold):
     largest = sitk.RelabelComponent(sitk.ConnectedComponent(soft_tissue))==1
     return largest<1
 
-def Muscle(input_filename, converted_filename, segmentation_filename, bone_threshold, smoothing_iterations, segmentation_iterations, segmentation_multiplier, initial_neighborhood_radius, closing_radius, csv_filename='', tiff_filename='', histogram_filename=''):
+def bone_region(stat_filter, labels, image, padding):
+    '''Bounding box of the labels, padded by `padding` [mm] and clipped to the image
+
+    Returns the index and size of the region, in voxels.
+    '''
+    lower = list(image.GetSize())
+    upper = [0 for i in range(image.GetDimension())]
+    for label in labels:
+        box = stat_filter.GetBoundingBox(label)
+        for i in range(len(lower)):
+            lower[i] = min(lower[i], box[i])
+            upper[i] = max(upper[i], box[i] + box[i+len(lower)])
+    pad = [int(np.ceil(padding/s)) for s in image.GetSpacing()]
+    index = [max(0, l-p) for l, p in zip(lower, pad)]
+    upper = [min(n, u+p) for n, u, p in zip(image.GetSize(), upper, pad)]
+    size = [u-l for l, u in zip(index, upper)]
+    return index, size
+
+def Muscle(input_filename, converted_filename, segmentation_filename, bone_threshold, smoothing_iterations, segmentation_iterations, segmentation_multiplier, initial_neighborhood_radius, closing_radius, csv_filename='', tiff_filename='', histogram_filename='', roi_padding=None):
     # Python 2/3 compatible input
     from six.moves import input
 
@@ -32,30 +53,39 @@ def Muscle(input_filename, converted_filename, segmentation_filename, bone_thres
     if not os.path.isfile(input_filename):
         os.sys.exit('[ERROR] Cannot find file \"{}\"'.format(input_filename))
 
+    # Converted image is optional
+    if len(converted_filename)>0 and get_vtk_writer(converted_filename) is None:
+        os.sys.exit('[ERROR] Cannot find writer for file \"{}\"'.format(converted_filename))
+
     # Internal constants
     bone_label = 1
     muscle_label = 2
 
-    # Compute calibration constants
-    print('Computing calibration constants')
+    # Read input and compute calibration constants
+    print('Reading input image and computing calibration constants')
     reader = vtkbone.vtkboneAIMReader()
     reader.SetFileName(input_filename)
     reader.DataOnCellsOff()
     reader.Update()
     m,b = get_aim_density_equation(reader.GetProcessingLog())
-    del reader
     print('  m: {}'.format(m))
     print('  b: {}'.format(b))
     print('')
 
-    # Converting image
-    print('Converting {} to {}'.format(input_filename, converted_filename))
-    ImageConverter(input_filename, converted_filename, overwrite=True)
+    # Write the converted image in the background, while the rest runs on the
+    # image in memory
+    conversion = None
+    if len(converted_filename)>0:
+        print('Converting {} to {} in the background'.format(input_filename, converted_filename))
+        executor = ThreadPoolExecutor(max_workers=1)
+        conversion = executor.submit(write_image, reader.GetOutput(), converted_filename, reader.GetProcessingLog())
+        executor.shutdown(wait=False)
+        print('')
+
+    print('Converting image to SimpleITK in memory')
+    image = vtkImageData_to_sitk(reader.GetOutput())
     print('')
 
-    print('Reading in converted image')
-    image = sitk.ReadImage(converted_filename)
-
     # Segment bone
     print('Segmenting bone')
     seg_bone = segment_bone(image, (bone_threshold - b)/m)
@@ -80,11 +110,27 @@ def Muscle(input_filename, converted_filename, segmentation_filename, bone_thres
     print('  Seed (index):    {}'.format(seed_index))
     print('')
 
+    # The muscle is found around the bones, so the expensive steps can be
+    # restricted to a region around them
+    if roi_padding is not None:
+        print('Restricting muscle segmentation to the two largest bones')
+        roi_index, roi_size = bone_region(stat_filter, [1, 2], image, roi_padding)
+        roi_image = sitk.RegionOfInterest(image, roi_size, roi_index)
+        roi_bone = sitk.RegionOfInterest(seg_bone, roi_size, roi_index)
+        seed_index = [s-i for s, i in zip(seed_index, roi_index)]
+        print('  Padding [mm]:      {}'.format(roi_padding))
+        print('  ROI index [vox]:   {}'.format(roi_index))
+        print('  ROI size [vox]:    {}'.format(roi_size))
+        print('')
+    else:
+        roi_image = image
+        roi_bone = seg_bone
+
     # Smooth image
     print('Performing anisotropic smoothing')
     timeStep = image.GetSpacing()[0] / 2.0**4
     smooth_image = sitk.GradientAnisotropicDiffusion(
-        sitk.Cast(image, sitk.sitkFloat32),
+        sitk.Cast(roi_image, sitk.sitkFloat32),
         timeStep=timeStep,
         numberOfIterations=smoothing_iterations
     )
@@ -112,12 +158,25 @@ def Muscle(input_filename, converted_filename, segmentation_filename, bone_thres
     vector_radius = [int(max(1, closing_radius//s)) for s in image.GetSpacing()]
     print('  Closing radius [mm]:    {}'.format(closing_radius))
     print('  Vector radius [voxels]: {}'.format(vector_radius))
-    seg = (seg_bone+seg_muscle)>0
+    seg = (roi_bone+seg_muscle)>0
+    if roi_padding is not None:
+        # Surround the region by background where it is inside the image, so
+        # the background outside of the region stays connected
+        lower_border = [r+1 if i>0 else 0 for r, i in zip(vector_radius, roi_index)]
+        upper_border = [r+1 if i+n<N else 0 for r, i, n, N in zip(vector_radius, roi_index, roi_size, image.GetSize())]
+        seg = sitk.ConstantPad(seg, lower_border, upper_border, 0)
     seg = sitk.BinaryDilate(seg, vector_radius)
     background = sitk.RelabelComponent(sitk.ConnectedComponent(seg<1))==1
     seg_muscle = sitk.BinaryErode(background<1, vector_radius)*muscle_label
     print('')
 
+    # Paste the region back into the full image
+    if roi_padding is not None:
+        seg_muscle = sitk.Crop(seg_muscle, lower_border, upper_border)
+        full_muscle = sitk.Image(image.GetSize(), seg_muscle.GetPixelID())
+        full_muscle.CopyInformation(image)
+        seg_muscle = sitk.Paste(full_muscle, seg_muscle, seg_muscle.GetSize(), [0, 0, 0], roi_index)
+
     # Join segmentation
     seg_muscle = sitk.Mask(seg_muscle, 1-(seg_bone>0))
     seg = seg_bone + seg_muscle
@@ -206,6 +265,126 @@ def Muscle(input_filename, converted_filename, segmentation_filename, bone_thres
         plt.pause(0.1)
         plt.savefig(histogram_filename)
 
+    # Make sure the converted image has been written
+    if conversion is not None:
+        conversion.result()
+        print('Finished writing ' + converted_filename)
+
+    return entry
+
+def _failed_entry(input_filename, error):
+    '''CSV row for a scan that failed'''
+    entry = OrderedDict()
+    entry['Filename'] = input_filename
+    entry['Status'] = 'failed'
+    # The CSV is not quoted, so the message must stay in one cell
+    entry['Error'] = ' '.join('{}: {}'.format(type(error).__name__, error).replace(',', ';').split())
+    return entry
+
+def _muscle_batch_job(input_filename, output_directory, write_converted, write_tiff, threads, parameters):
+    '''Run Muscle on one AIM of a batch, returning its CSV row'''
+    if threads > 0:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+
+    base = os.path.splitext(os.path.basename(input_filename))[0]
+    try:
+        entry = Muscle(
+            input_filename,
+            os.path.join(output_directory, base + '.nii') if write_converted else '',
+            os.path.join(output_directory, base + '_SEG.nii'),
+            tiff_filename=os.path.join(output_directory, base + '_MUSCLE.tif') if write_tiff else '',
+            **parameters
+        )
+        entry['Status'] = 'done'
+    # Muscle exits on bad input, which should only fail this scan
+    except (Exception, SystemExit) as e:
+        entry = _failed_entry(input_filename, e)
+    return entry
+
+def MuscleBatch(input_filenames, output_directory, csv_filename, workers=1, write_converted=False, write_tiff=False, **parameters):
+    '''Run Muscle on many AIMs and aggregate the results in one CSV file
+
+    Scans are processed by a pool of `workers` processes. The rows are
+    collected in this process and written to `csv_filename` atomically once
+    all scans are finished, so concurrent runs cannot corrupt the file. A scan
+    that fails is recorded in the CSV with its error instead of stopping the
+    batch.
+
+    Outputs for scan `<base>.AIM` are written to `output_directory` as
+    `<base>_SEG.nii` and, if requested, `<base>.nii` and `<base>_MUSCLE.tif`,
+    so the inputs must have distinct basenames.
+
+    Returns the list of CSV rows, in the order of `input_filenames`.
+    '''
+    # Outputs are named by basename, so e.g. `a/scan.AIM` and `b/scan.AIM`
+    # would overwrite each other's outputs
+    bases = [os.path.splitext(os.path.basename(fn))[0] for fn in input_filenames]
+    duplicates = sorted(set(fn for fn, base in zip(input_filenames, bases) if bases.count(base) > 1))
+    if duplicates:
+        raise ValueError('Inputs with the same basename would be written to the same outputs: {}'.format(
+            ', '.join(duplicates)))
+
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+
+    # Share the cores between the workers
+    workers = max(1, min(workers, len(input_filenames)))
+    threads = max(1, (os.cpu_count() or 1) // workers) if workers > 1 else 0
+
+    jobs = [(fn, output_directory, write_converted, write_tiff, threads, parameters) for fn in input_filenames]
+    if workers > 1:
+        print('Processing {} scans with {} workers'.format(len(input_filenames), workers))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_muscle_batch_job, *job) for job in jobs]
+            rows = []
+            for fn, future in zip(input_filenames, futures):
+                try:
+                    rows.append(future.result())
+                # For instance, a worker that crashed
+                except Exception as e:
+                    rows.append(_failed_entry(fn, e))
+    else:
+        rows = [_muscle_batch_job(*job) for job in jobs]
+
+    # Keep the outcomes in front of the status columns
+    for entry in rows:
+        for k in ['Status', 'Error']:
+            entry[k] = entry.pop(k, '')
+
+    print('Writing {} rows to csv file {}'.format(len(rows), csv_filename))
+    write_csv_rows(rows, csv_filename)
+
+    failed = [entry for entry in rows if entry['Status'] != 'done']
+    for entry in failed:
+        print('  [FAILED] {}: {}'.format(entry['Filename'], entry['Error']))
+    print('Finished {} scans, {} failed'.format(len(rows), len(failed)))
+
+    return rows
+
+def add_muscle_parameters(parser):
+    '''Add the segmentation parameters shared by blMuscle and blMuscleBatch'''
+    parser.add_argument('--bone_threshold',
+                        default=800.0, type=float,
+                        help='Threshold for selecting bone (default: %(default)s mg HA/cc)')
+    parser.add_argument('--smoothing_iterations',
+                        default=10, type=int,
+                        help='Number of iterations of Perona-Malik anisotropic filtering (default: %(default)s)')
+    parser.add_argument('--segmentation_iterations',
+                        default=2, type=int,
+                        help='Number of iterations in confidence connected thresholding (default: %(default)s)')
+    parser.add_argument('--segmentation_multiplier',
+                        default=2.0, type=float,
+                        help='Multiplier in confidence connected thresholding (default: %(default)s)')
+    parser.add_argument('--initial_neighborhood_radius',
+                        default=1.0, type=float,
+                        help='Initial neighborhood radius in confidence connected thresholding (default: %(default)s [mm])')
+    parser.add_argument('--closing_radius',
+                        default=0.5, type=float,
+                        help='Morphological closing radius for cleaning up image (default: %(default)s [mm]) ')
+    parser.add_argument('--roi_padding',
+                        default=None, type=float,
+                        help='Only smooth and segment muscle in the bounding box of the two largest bones,\npadded by this distance (default: whole image) [mm]')
+
 def main():
     # Setup description
     description='''Muscle segmentation and quantification
@@ -224,6 +403,13 @@ values before averaging.
 
 Finally, it is assumed that the image voxels are isotropic.
 
+Smoothing dominates the runtime. With `--roi_padding`, smoothing and
+muscle segmentation only run in the bounding box of the two largest bones
+padded by the given distance. The padding must be large enough to hold the
+whole muscle, otherwise the muscle is cut at the box. The smoothing strength
+depends on the mean gradient of the image it runs on, so the segmentation can
+differ slightly from the default at the muscle boundary.
+
 Output TIFFs have been window/leveled to have display range (0, `bone_threshold`).
 
 To compute the real density and cross sectional area, use the following formulas:
@@ -244,7 +430,7 @@ density and fat could be provided.
         description=description
     )
     parser.add_argument('input_filename', help='Input image')
-    parser.add_argument('converted_filename', help='Output converted image (typically .nii)')
+    parser.add_argument('converted_filename', help='Output converted image (typically .nii, empty string causes no write)')
     parser.add_argument('segmentation_filename', help='Input image (typically .nii)')
     parser.add_argument('--csv_filename', '-o',
                         default='', type=str,
@@ -252,24 +438,7 @@ density and fat could be provided.
     parser.add_argument('--tiff_filename', '-i',
                         default='', type=str,
                         help='Write one slice to a TIFF image (empty string causes no write)')
-    parser.add_argument('--bone_threshold',
-                        default=800.0, type=float,
-                        help='Threshold for selecting bone (default: %(default)s mg HA/cc)')
-    parser.add_argument('--smoothing_iterations',
-                        default=10, type=int,
-                        help='Number of iterations of Perona-Malik anisotropic filtering (default: %(default)s)')
-    parser.add_argument('--segmentation_iterations',
-                        default=2, type=int,
-                        help='Number of iterations in confidence connected thresholding (default: %(default)s)')
-    parser.add_argument('--segmentation_multiplier',
-                        default=2.0, type=float,
-                        help='Multiplier in confidence connected thresholding (default: %(default)s)')
-    parser.add_argument('--initial_neighborhood_radius',
-                        default=1.0, type=float,
-                        help='Initial neighborhood radius in confidence connected thresholding (default: %(default)s [mm])')
-    parser.add_argument('--closing_radius',
-                        default=0.5, type=float,
-                        help='Morphological closing radius for cleaning up image (default: %(default)s [mm]) ')
+    add_muscle_parameters(parser)
     parser.add_argument('--histogram_filename',
                         default='', type=str,
                         help='Create a histogram and save to the defined file (typically, a TIFF or PDF)')
@@ -281,5 +450,59 @@ density and fat could be provided.
     # Run program
     Muscle(**vars(args))
 
+def main_batch():
+    # Setup description
+    description='''Muscle segmentation and quantification of many scans
+
+Example usage:
+    blMuscleBatch ~/.bldata/*.AIM --output_directory muscle --csv_filename muscle.csv --workers 4
+
+Runs blMuscle on every input AIM in a pool of worker processes. For
+`<base>.AIM`, the segmentation is written to `<base>_SEG.nii` in the
+output directory, with optional `<base>.nii` converted images and
+`<base>_MUSCLE.tif` slices.
+
+The results are collected and written to one CSV file once all scans are
+finished, replacing the file if it exists. A scan that fails does not stop
+the batch. It is recorded in the CSV with Status `failed` and the error,
+and the program exits with an error after writing the CSV.
+
+See `blMuscle -h` for the assumptions and the outcomes in the CSV.
+'''
+
+    # Setup argument parsing
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        prog="blMuscleBatch",
+        description=description
+    )
+    parser.add_argument('input_filenames', nargs='+', help='Input AIMs')
+    parser.add_argument('--output_directory', '-d',
+                        default='.', type=str,
+                        help='Directory to write the images to (default: %(default)s)')
+    parser.add_argument('--csv_filename', '-o',
+                        default='muscle.csv', type=str,
+                        help='CSV file to write the results of all scans to (default: %(default)s)')
+    parser.add_argument('--workers', '-w',
+                        default=1, type=int,
+                        help='Number of scans to process in parallel (default: %(default)s)')
+    parser.add_argument('--write_converted', '-c',
+                        action='store_true',
+                        help='Also write the converted images')
+    parser.add_argument('--write_tiff', '-i',
+                        action='store_true',
+                        help='Also write one slice of each segmentation to a TIFF image')
+    add_muscle_parameters(parser)
+
+    # Parse and display
+    args = parser.parse_args()
+    print(echo_arguments('MuscleBatch', vars(args)))
+
+    # Run program
+    rows = MuscleBatch(**vars(args))
+    failed = sum(entry['Status'] != 'done' for entry in rows)
+    if failed > 0:
+        os.sys.exit('[ERROR] {} of {} scans failed, see {}'.format(failed, len(rows), args.csv_filename))
+
 if __name__ == '__main__':
     main()
@@ -9,6 +9,8 @@ import numpy as np
 import pydicom
 import SimpleITK as sitk
 import glob
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 #from pydicom.filereader import read_dicomdir
 
 #from pydicom.filereader import read_dicomdir
@@ -65,7 +67,154 @@ def message(msg, *additionalLines):
         print(" " * 9 + line)
 start_time = time.time()
 
-def PseudoCT(input_directory, output_directory, expression, overwrite=False, verbose=False):
+def inverted_log(data, img_range, data_log_max, data_log_range):
+    """Inverted log of the data, cast to uint16.
+    """
+    data_log = np.log(data+1)
+    data_inv = -(img_range/data_log_range) * ((data_log - data_log_max))
+    return data_inv.astype(dtype=np.uint16)
+
+def write_pseudoct_slice(fname, data, output_directory, study_instance_uid, series_instance_uid,
+                         window_center, window_width, verbose=False):
+    """Write one pseudo CT slice, using the DICOM header of the input slice.
+    """
+    ds = pydicom.dcmread(fname,force=True)
+    if ds.file_meta.TransferSyntaxUID.is_compressed is True:
+      ds.decompress()
+
+    # Update meta data in dicom slice
+    ds.StudyInstanceUID = study_instance_uid
+    ds.SeriesInstanceUID = series_instance_uid
+    ds.PatientID = ds.PatientID + ' pseudoCT'
+    ds.PatientName = str(ds.PatientName) + " pseudoCT"
+    ds.WindowCenter = window_center
+    ds.WindowWidth = window_width
+
+    if verbose:
+      print('--- {0:s} ---'.format(fname))
+      print('    StudyInstanceUID:  {0:s}'.format(ds.StudyInstanceUID))
+      print('    SeriesInstanceUID: {0:s}'.format(ds.SeriesInstanceUID))
+      print('    PatientName:       {0}'.format(ds.PatientName))
+      print('    PatientID:         {0:s}'.format(ds.PatientID))
+      print('    Window Center:         {0:12.4f}'.format(ds.WindowCenter))
+      print('    Window Width:         {0:12.4f}'.format(ds.WindowWidth))
+
+    ds.PixelData = data.tobytes()
+
+    dcm_fn_output = os.path.join(output_directory,os.path.split(fname)[1])
+
+    pydicom.dcmwrite(dcm_fn_output,ds,True)
+
+def read_slice(fname):
+    """Read one slice as a 2D numpy array.
+    """
+    data = sitk.GetArrayFromImage( sitk.ReadImage(fname) )
+    return data.reshape(data.shape[-2:])
+
+def stream_slices(filenames, lt, ut, kernelRadius, chunk_slices=16):
+    """Yield the index, data and mask of each slice in turn.
+
+    The mask is the same as when thresholding and closing the whole volume.
+    The closing at a slice only depends on the slices up to 2*kernelRadius
+    away, so it is computed on chunks of `chunk_slices` slices plus
+    2*kernelRadius slices on either side, and only those are kept in memory.
+    """
+    reach = 2*kernelRadius
+
+    CloseFilter = sitk.BinaryMorphologicalClosingImageFilter()
+    CloseFilter.SetForegroundValue( 1 )
+    CloseFilter.SetKernelRadius( kernelRadius )
+
+    slab = deque() # (data, rough mask) of slices first, first+1, ...
+    first = 0
+    for chunk_start in range(0, len(filenames), chunk_slices):
+      chunk_end = min(chunk_start+chunk_slices, len(filenames))
+      while first+len(slab) < min(chunk_end+reach, len(filenames)):
+        data = read_slice(filenames[first+len(slab)])
+        slab.append((data, ((data<lt) | (data>ut)).astype(np.uint8)))
+      while first < chunk_start-reach:
+        slab.popleft()
+        first += 1
+
+      mask_img_rough = sitk.GetImageFromArray( np.stack([rough for data, rough in slab]) )
+      mask_array = sitk.GetArrayFromImage( CloseFilter.Execute( mask_img_rough ) )
+      for idx in range(chunk_start, chunk_end):
+        yield idx, slab[idx-first][0], mask_array[idx-first]
+
+def stream_pseudoct(filenames, output_directory, threads=4, verbose=False):
+    """Pseudo CT keeping only a few slices in memory.
+
+    Gives the same slices as reading the whole volume. Pass 1 gathers the
+    data range, the log range and a histogram of the data under the mask,
+    from which the window of the output follows. Pass 2 transforms, masks and
+    writes each slice, with the writes running in a thread pool.
+    """
+    lt = 0
+    ut = 1
+    kernelRadius = 1
+
+    # Pass 1
+    message('Gathering the data range of {} slices.'.format(len(filenames)))
+    img_min = img_max = data_log_min = data_log_max = None
+    histogram = np.zeros(0, dtype=np.int64)
+    n_voxels = 0
+    n_masked = 0
+    for idx, data, mask in stream_slices(filenames, lt, ut, kernelRadius):
+      if not np.issubdtype(data.dtype, np.integer):
+        os.sys.exit('[ERROR] Streaming needs integer pixels, found {}'.format(data.dtype))
+      if (np.min(data) < 0):
+        message('ERROR: Input data array cannot contain negative values.')
+        exit(1)
+
+      img_min = np.min(data) if img_min is None else min(img_min, np.min(data))
+      img_max = np.max(data) if img_max is None else max(img_max, np.max(data))
+      data_log = np.log(data+1)
+      data_log_min = np.min(data_log) if data_log_min is None else min(data_log_min, np.min(data_log))
+      data_log_max = np.max(data_log) if data_log_max is None else max(data_log_max, np.max(data_log))
+
+      counts = np.bincount(data[mask!=0])
+      if len(counts) > len(histogram):
+        histogram = np.pad(histogram, (0, len(counts)-len(histogram)))
+      histogram[:len(counts)] += counts
+      n_voxels += data.size
+      n_masked += data.size - np.count_nonzero(mask)
+
+    img_range = (img_max - img_min).astype(dtype=np.float32)
+    data_log_range = data_log_max - data_log_min
+    message('{0}: {1} to {2} ({3}).'.format("Input image data range",img_min,img_max,img_range))
+
+    # The output of every data value under the mask. The sum is exact, so
+    # the mean is the same as that of the whole output volume.
+    values = inverted_log(np.arange(len(histogram), dtype=data.dtype), img_range, data_log_max, data_log_range)
+    present = values[histogram>0]
+    if n_masked > 0:
+      present = np.append(present, np.uint16(0))
+    window_center = np.float64(int(np.dot(histogram, values.astype(np.int64)))) / n_voxels
+    window_width = (np.max(present)-np.min(present))*0.75
+
+    # Pass 2
+    message("Writing output DICOM slices using {} threads.".format(threads))
+    study_instance_uid = pydicom.uid.generate_uid()
+    series_instance_uid = pydicom.uid.generate_uid()
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+      for idx, data, mask in stream_slices(filenames, lt, ut, kernelRadius):
+        data_array = inverted_log(data, img_range, data_log_max, data_log_range)
+        data_array[mask==0] = 0
+
+        # Bound the number of slices waiting to be written
+        if len(pending) >= 2*threads:
+          pending.popleft().result()
+        pending.append(executor.submit(
+          write_pseudoct_slice, filenames[idx], data_array, output_directory,
+          study_instance_uid, series_instance_uid, window_center, window_width,
+          verbose and idx<10
+        ))
+      for future in pending:
+        future.result()
+
+def PseudoCT(input_directory, output_directory, expression, overwrite=False, verbose=False, streaming=False, threads=4):
     # Python 2/3 compatible input
     from six.moves import input
 
@@ -119,6 +268,11 @@ def PseudoCT(input_directory, output_directory, expression, overwrite=False, ver
           idx += 1
         print('')
 
+    if streaming:
+        stream_pseudoct(filenames, output_directory, threads, verbose)
+        message("Finished.")
+        return
+
     message('Reading in {} slices.'.format(len(filenames)))
     image = sitk.ReadImage(filenames)
 
@@ -198,42 +352,10 @@ def PseudoCT(input_directory, output_directory, expression, overwrite=False, ver
     #message("Created new Study Instance UID:","{}".format(study_instance_uid))
     #message("Created new Series Instance UID:","{}".format(series_instance_uid))
     
-    PrintSample = 0
-    idx=0
-    for fname in filenames:
-      ds = pydicom.dcmread(fname,force=True)
-      if ds.file_meta.TransferSyntaxUID.is_compressed is True:
-        ds.decompress()
-      
-      # Update meta data in dicom slice
-      ds.StudyInstanceUID = study_instance_uid
-      ds.SeriesInstanceUID = series_instance_uid
-      ds.PatientID = ds.PatientID + ' pseudoCT'
-      ds.PatientName = str(ds.PatientName) + " pseudoCT"
-      ds.WindowCenter = window_center
-      ds.WindowWidth = window_width
-      
-      #ds.PatientName = patient_name
-      #ds.PatientID = patient_id
-
-      if (verbose and PrintSample<10):
-        print('--- {0:s} ---'.format(fname))
-        print('    StudyInstanceUID:  {0:s}'.format(ds.StudyInstanceUID))
-        print('    SeriesInstanceUID: {0:s}'.format(ds.SeriesInstanceUID))
-        print('    PatientName:       {0}'.format(ds.PatientName))
-        print('    PatientID:         {0:s}'.format(ds.PatientID))
-        print('    Window Center:         {0:12.4f}'.format(ds.WindowCenter))
-        print('    Window Width:         {0:12.4f}'.format(ds.WindowWidth))
-        #print(ds)
-        PrintSample += 1
-
-      ds.PixelData = (data_array[idx,:,:]).tobytes()
-      idx += 1
-      
-      dcm_fn_output = os.path.join(output_directory,os.path.split(fname)[1])
-
-      pydicom.dcmwrite(dcm_fn_output,ds,True)
-      del ds
+    for idx, fname in enumerate(filenames):
+      write_pseudoct_slice(fname, data_array[idx,:,:], output_directory,
+                           study_instance_uid, series_instance_uid, window_center, window_width,
+                           verbose and idx<10)
         
     message("Finished.")
 
@@ -258,6 +380,10 @@ Stacking of slices will be determined by GDCM if the input is a DICOM
 series, otherwise an alpha-numeric sort.
 
 The output will be a DICOM file.
+
+With --streaming, only a few slices are held in memory at a time. The
+slices are read twice, first to find the data range and then to convert
+and write them. The output is the same.
 '''
 
     # Setup argument parsing
@@ -272,6 +398,10 @@ The output will be a DICOM file.
                         help='An expression for matching files (default: %(default)s)')
     parser.add_argument('-o', '--overwrite', action='store_true', help='Overwrite output without asking')
     parser.add_argument('-v', '--verbose', action='store_true', help='Verbose output')
+    parser.add_argument('-s', '--streaming', action='store_true',
+                        help='Read two passes over the slices instead of the whole series at once,\nso that memory does not grow with the number of slices')
+    parser.add_argument('-t', '--threads', default=4, type=int,
+                        help='Number of threads writing slices in streaming mode (default: %(default)s)')
 
     # Parse and display
     args = parser.parse_args()
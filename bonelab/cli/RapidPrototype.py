@@ -12,6 +12,7 @@ import numpy as np
 from skimage.morphology import skeletonize, dilation, ball
 
 from bonelab.util.echo_arguments import echo_arguments
+from bonelab.util.image_statistics import ImageStatistics, histogram_range
 from bonelab.util.time_stamp import message
 from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
 from bonelab.io.vtk_helpers import get_vtk_reader, get_vtk_writer, handle_filetype_writing_special_cases
@@ -77,28 +78,15 @@ def diagonal(x, y, z):
     return math.sqrt(math.pow(x,2)+math.pow(y,2)+math.pow(z,2))
 
 def histogram(image):
-    array = vtk_to_numpy(image.GetPointData().GetScalars()).ravel()
+    stats = ImageStatistics(vtk_to_numpy(image.GetPointData().GetScalars()))
     guard = '!-------------------------------------------------------------------------------'
 
-    if (array.min() < -128):
-      range_min = -32768
-    elif (array.min() < 0):
-      range_min = -128
-    else:
-      range_min = 0
-    
-    if (array.max() > 255):
-      range_max = 32767
-    elif (array.max() > 127):
-      range_max = 255
-    else:
-      range_max = 127
-
+    range_min, range_max = histogram_range(stats)
     nRange = [range_min, range_max]
     nBins = 128
     
     # https://numpy.org/doc/stable/reference/generated/numpy.histogram.html
-    hist,bin_edges = np.histogram(array,nBins,nRange)
+    hist,bin_edges = stats.histogram(nBins,nRange)
     nValues = sum(hist)
 
     print(guard)
@@ -6,11 +6,14 @@ import SimpleITK as sitk
 from vtkbone import vtkboneAIMReader, vtkboneAIMWriter
 from vtk import VTK_CHAR
 import os
+import tempfile
 import numpy as np
+from functools import partial
 from scipy import ndimage
 from skimage.filters import gaussian
 from skimage.morphology import ball, cube, remove_small_objects
 from datetime import datetime
+from typing import Optional, Tuple
 
 # internal imports
 from bonelab.util.registration_util import message_s
@@ -18,6 +21,8 @@ from bonelab.util.echo_arguments import echo_arguments
 from bonelab.util.registration_util import create_file_extension_checker
 from bonelab.util.vtk_util import vtkImageData_to_numpy, numpy_to_vtkImageData
 from bonelab.util.aim_calibration_header import get_aim_density_equation
+from bonelab.util.mean_filter import mean_filter, first_axis_halo
+from bonelab.util.slab_processing import mask_in_slabs
 from bonelab.io.vtk_helpers import handle_filetype_writing_special_cases
 
 
@@ -49,7 +54,13 @@ def compute_minmax_threshold_image(density: np.ndarray, footprint: np.ndarray, s
     return (min_image + max_image) / 2
 
 
-def compute_mean_threshold_image(density: np.ndarray, footprint: np.ndarray, silent: bool) -> np.ndarray:
+def compute_mean_threshold_image(
+        density: np.ndarray,
+        footprint: np.ndarray,
+        silent: bool,
+        mean_filter_method: str = "integral",
+        first_axis_offset: int = 0
+) -> np.ndarray:
     """
     Calculate the mean threshold image.
 
@@ -64,27 +75,41 @@ def compute_mean_threshold_image(density: np.ndarray, footprint: np.ndarray, sil
     silent : bool
         Whether to suppress terminal output.
 
+    mean_filter_method : str
+        How to compute the local mean. `integral` uses running sums in single precision (see
+        `bonelab.util.mean_filter`), `convolution` convolves with the dense normalized footprint.
+
+    first_axis_offset : int
+        The index along the first axis of the full image of the first voxel of `density`, if it is a slab of it.
+
     Returns
     -------
     np.ndarray
         The mean threshold image.
     """
-    message_s("Calculating mean image...", silent)
-    return ndimage.filters.convolve(density, footprint / footprint.sum())
+    message_s(f"Calculating mean image using method: {mean_filter_method}...", silent)
+    if mean_filter_method == "integral":
+        return mean_filter(density, footprint, first_axis_offset)
+    elif mean_filter_method == "convolution":
+        return ndimage.filters.convolve(density, footprint / footprint.sum())
+    else:
+        raise ValueError(f"`mean_filter_method` must be one of `integral` or `convolution`, "
+                         f"received {mean_filter_method}.")
 
 
-def compute_adaptive_local_threshold_segmentation(
+def compute_adaptive_local_threshold_mask(
         density: np.ndarray,
         low_threshold: float,
         high_threshold: float,
         footprint: np.ndarray,
         mode: str,
         sigma: float,
-        min_size: int,
-        silent: bool
+        silent: bool,
+        mean_filter_method: str = "integral",
+        first_axis_offset: int = 0
 ) -> np.ndarray:
     """
-    Perform local adaptive thresholding on a density image.
+    Threshold a density image against its local thresholds, without removing small structures.
 
     Parameters
     ----------
@@ -106,12 +131,15 @@ def compute_adaptive_local_threshold_segmentation(
     sigma : float
         The sigma to use for the gaussian filter.
 
-    min_size : int
-        The minimum size of structures to keep in the segmentation.
-
     silent : bool
         Whether to suppress terminal output.
 
+    mean_filter_method : str
+        How to compute the local mean for the `mean` and `both` modes. Can be `integral` or `convolution`.
+
+    first_axis_offset : int
+        The index along the first axis of the full image of the first voxel of `density`, if it is a slab of it.
+
     Returns
     -------
     np.ndarray
@@ -119,69 +147,333 @@ def compute_adaptive_local_threshold_segmentation(
     """
     message_s(f"Calculating threshold image using mode: {mode}", silent)
     if mode == "mean":
-        threshold_image = compute_mean_threshold_image(density, footprint, silent)
+        threshold_image = compute_mean_threshold_image(
+            density, footprint, silent, mean_filter_method, first_axis_offset
+        )
     elif mode == "minmax":
         threshold_image = compute_minmax_threshold_image(density, footprint, silent)
     elif mode == "both":
         threshold_image = np.minimum(
-            compute_mean_threshold_image(density, footprint, silent),
+            compute_mean_threshold_image(density, footprint, silent, mean_filter_method, first_axis_offset),
             compute_minmax_threshold_image(density, footprint, silent)
         )
     else:
         raise ValueError(f"`mode` must be one of `mean`, `minmax`, or `both`, received {mode}.")
     density = gaussian(density, sigma=sigma)
+    return ((density > low_threshold) & (density > threshold_image)) | (density > high_threshold)
+
+
+def compute_adaptive_local_threshold_segmentation(
+        density: np.ndarray,
+        low_threshold: float,
+        high_threshold: float,
+        footprint: np.ndarray,
+        mode: str,
+        sigma: float,
+        min_size: int,
+        silent: bool,
+        mean_filter_method: str = "integral"
+) -> np.ndarray:
+    """
+    Perform local adaptive thresholding on a density image.
+
+    Parameters
+    ----------
+    density : np.ndarray
+        The density image to be thresholded.
+
+    low_threshold : float
+        The lower threshold for the density image.
+
+    high_threshold : float
+        The upper threshold for the density image.
+
+    footprint : np.ndarray
+        The footprint to use for identifying local thresholds.
+
+    mode : str
+        The mode to use for identifying local thresholds. Can be `mean`, `minmax`, or `both`.
+
+    sigma : float
+        The sigma to use for the gaussian filter.
+
+    min_size : int
+        The minimum size of structures to keep in the segmentation.
+
+    silent : bool
+        Whether to suppress terminal output.
+
+    mean_filter_method : str
+        How to compute the local mean for the `mean` and `both` modes. Can be `integral` or `convolution`.
+
+    Returns
+    -------
+    np.ndarray
+        The thresholded image.
+    """
     return remove_small_objects(
-        ((density > low_threshold) & (density > threshold_image)) | (density > high_threshold),
+        compute_adaptive_local_threshold_mask(
+            density, low_threshold, high_threshold, footprint, mode, sigma, silent, mean_filter_method
+        ),
         min_size=min_size
     )
 
 
-def adaptive_local_thresholding(args: Namespace):
-    print(echo_arguments("Adaptive Local Thresholding", vars(args)))
-    if not os.path.exists(args.input):
-        raise FileNotFoundError(f"Input file {args.input} does not exist.")
-    if os.path.exists(args.output) and not args.overwrite:
-        raise FileExistsError(f"Output file {args.output} already exists. Use the --overwrite flag to overwrite.")
-    message_s(f"Reading input image from {args.input}", args.silent)
-    if args.aims:
-        reader = vtkboneAIMReader()
-        reader.DataOnCellsOff()
-        reader.SetFileName(args.input)
-        reader.Update()
-        image = vtkImageData_to_numpy(reader.GetOutput())
-        if args.convert_to_density:
-            m, b = get_aim_density_equation(reader.GetProcessingLog())
-            image = m * image + b
-    else:
-        image_sitk = sitk.ReadImage(args.input)
-        image = sitk.GetArrayFromImage(image_sitk)
-    message_s("Generating bone segmentation", args.silent)
-    if args.structuring_element_shape == "ball":
-        footprint = ball(args.structuring_element_size)
-    elif args.structuring_element_shape == "cube":
-        footprint = cube(args.structuring_element_size)
-    else:
-        raise ValueError("Invalid structuring element shape.")
-    segmentation = compute_adaptive_local_threshold_segmentation(
-        image,
-        args.lower_threshold,
-        args.upper_threshold,
-        footprint,
-        args.local_threshold_method,
-        args.sigma,
-        args.minimum_structure_size,
-        args.silent
+def compute_adaptive_local_threshold_slab(
+        image: np.ndarray,
+        offset: int,
+        density_equation: Optional[Tuple[float, float]],
+        **kwargs
+) -> np.ndarray:
+    """
+    Convert a slab of the image to density, if required, and threshold it. Used by the tiled execution mode.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The slab of the image, including its halo.
+
+    offset : int
+        The index along the first axis of the full image of the first voxel of the slab.
+
+    density_equation : Optional[Tuple[float, float]]
+        The slope and intercept to convert the image to density with, or `None` if the image is already in the
+        units the thresholds are given in.
+
+    **kwargs
+        Keyword arguments passed to `compute_adaptive_local_threshold_mask`.
+
+    Returns
+    -------
+    np.ndarray
+        The thresholded slab.
+    """
+    if density_equation is not None:
+        m, b = density_equation
+        image = m * image + b
+    return compute_adaptive_local_threshold_mask(image, first_axis_offset=offset, **kwargs)
+
+
+def compute_halo(footprint: np.ndarray, sigma: float, truncate: float = 4.0) -> int:
+    """
+    Compute how many voxels a slab needs on either side so that thresholding it gives the same result as thresholding
+    the whole image.
+
+    Parameters
+    ----------
+    footprint : np.ndarray
+        The footprint used for identifying local thresholds.
+
+    sigma : float
+        The sigma used for the gaussian filter.
+
+    truncate : float
+        The number of sigmas at which the gaussian kernel is truncated. The default matches `skimage.filters.gaussian`.
+
+    Returns
+    -------
+    int
+        The halo size.
+    """
+    return max(first_axis_halo(footprint), int(truncate * sigma + 0.5))
+
+
+def stream_image_to_scratch(fn: str, scratch_fn: str, slab_thickness: int, silent: bool) -> sitk.ImageFileReader:
+    """
+    Copy an image file into a scratch `.npy` file one slab at a time, so that the whole image is never held in memory.
+
+    Parameters
+    ----------
+    fn : str
+        The image filename, in a format SimpleITK can read regions of.
+
+    scratch_fn : str
+        The `.npy` file to write the image to.
+
+    slab_thickness : int
+        The number of planes along the first array axis (the last image axis) to read at a time.
+
+    silent : bool
+        Whether to suppress terminal output.
+
+    Returns
+    -------
+    sitk.ImageFileReader
+        The reader, with the size, origin, spacing and direction of the image.
+    """
+    message_s(f"Copying image to scratch file {scratch_fn}", silent)
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(fn)
+    reader.ReadImageInformation()
+    size = list(reader.GetSize())
+    stored = None
+    for start in range(0, size[-1], slab_thickness):
+        thickness = min(slab_thickness, size[-1] - start)
+        reader.SetExtractIndex([0] * (len(size) - 1) + [start])
+        reader.SetExtractSize(size[:-1] + [thickness])
+        slab = reader.Execute()
+        slab_array = sitk.GetArrayViewFromImage(slab)
+        if stored is None:
+            stored = np.lib.format.open_memmap(scratch_fn, mode="w+", dtype=slab_array.dtype, shape=tuple(size[::-1]))
+        stored[start:start + thickness] = slab_array
+        del slab_array, slab
+    stored.flush()
+    del stored
+    return reader
+
+
+def compute_adaptive_local_threshold_segmentation_tiled(
+        input_fn: str,
+        output_fn: str,
+        density_equation: Optional[Tuple[float, float]],
+        low_threshold: float,
+        high_threshold: float,
+        footprint: np.ndarray,
+        mode: str,
+        sigma: float,
+        min_size: int,
+        silent: bool,
+        mean_filter_method: str,
+        slab_thickness: int,
+        workers: int
+) -> None:
+    """
+    Perform local adaptive thresholding slab by slab along the first axis of an image stored in a `.npy` file, writing
+    the segmentation to another `.npy` file. Both files are memory-mapped, so only the slabs being processed are held
+    in memory, in their working precision. Small structures are removed across slab boundaries, so the result is
+    identical to `compute_adaptive_local_threshold_segmentation` applied to the whole (converted) image.
+
+    Parameters
+    ----------
+    input_fn : str
+        The `.npy` file with the image to be thresholded, in its stored units.
+
+    output_fn : str
+        The `.npy` file to write the boolean segmentation to.
+
+    density_equation : Optional[Tuple[float, float]]
+        The slope and intercept to convert the image to density with, or `None` to threshold the image as is.
+
+    low_threshold : float
+        The lower threshold for the density image.
+
+    high_threshold : float
+        The upper threshold for the density image.
+
+    footprint : np.ndarray
+        The footprint to use for identifying local thresholds.
+
+    mode : str
+        The mode to use for identifying local thresholds. Can be `mean`, `minmax`, or `both`.
+
+    sigma : float
+        The sigma to use for the gaussian filter.
+
+    min_size : int
+        The minimum size of structures to keep in the segmentation.
+
+    silent : bool
+        Whether to suppress terminal output.
+
+    mean_filter_method : str
+        How to compute the local mean for the `mean` and `both` modes. Can be `integral` or `convolution`.
+
+    slab_thickness : int
+        The thickness of each slab along the first axis, not counting the halo.
+
+    workers : int
+        The number of worker processes to use.
+
+    Returns
+    -------
+    None
+    """
+    mask_in_slabs(
+        input_fn,
+        output_fn,
+        partial(
+            compute_adaptive_local_threshold_slab,
+            density_equation=density_equation,
+            low_threshold=low_threshold,
+            high_threshold=high_threshold,
+            footprint=footprint,
+            mode=mode,
+            sigma=sigma,
+            silent=True,
+            mean_filter_method=mean_filter_method
+        ),
+        compute_halo(footprint, sigma),
+        slab_thickness,
+        min_size,
+        workers,
+        silent
     )
+
+
+def read_aim(fn: str, convert_to_density: bool) -> Tuple[vtkboneAIMReader, np.ndarray, Optional[Tuple[float, float]]]:
+    """
+    Read an AIM.
+
+    Parameters
+    ----------
+    fn : str
+        The AIM filename.
+
+    convert_to_density : bool
+        Whether to get the equation converting the AIM to density from its processing log.
+
+    Returns
+    -------
+    Tuple[vtkboneAIMReader, np.ndarray, Optional[Tuple[float, float]]]
+        The reader, the image and the slope and intercept of the density equation, or `None`.
+    """
+    reader = vtkboneAIMReader()
+    reader.DataOnCellsOff()
+    reader.SetFileName(fn)
+    reader.Update()
+    image = vtkImageData_to_numpy(reader.GetOutput())
+    density_equation = get_aim_density_equation(reader.GetProcessingLog()) if convert_to_density else None
+    return reader, image, density_equation
+
+
+def write_segmentation(
+        segmentation: np.ndarray,
+        args: Namespace,
+        aim_reader: Optional[vtkboneAIMReader],
+        reference
+) -> None:
+    """
+    Write the segmentation in the format of the input.
+
+    Parameters
+    ----------
+    segmentation : np.ndarray
+        The boolean segmentation.
+
+    args : Namespace
+        The parsed command line arguments.
+
+    aim_reader : Optional[vtkboneAIMReader]
+        The reader of the input AIM, for its spacing, origin and processing log, or `None` if the input is not an AIM.
+
+    reference
+        A `sitk.Image` or `sitk.ImageFileReader` with the origin, spacing and direction of the input, if it is not an
+        AIM.
+
+    Returns
+    -------
+    None
+    """
     message_s(f"Writing bone segmentation to {args.output}", args.silent)
-    if args.aims:
+    if aim_reader is not None:
         segmentation_vtk = numpy_to_vtkImageData(
             127 * (segmentation > 0),
-            spacing=reader.GetOutput().GetSpacing(),
-            origin=reader.GetOutput().GetOrigin(),
+            spacing=aim_reader.GetOutput().GetSpacing(),
+            origin=aim_reader.GetOutput().GetOrigin(),
             array_type=VTK_CHAR
         )
         processing_log = (
-            reader.GetProcessingLog() + os.linesep +
+            aim_reader.GetProcessingLog() + os.linesep +
             f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}]" +
             echo_arguments("Bone segmentation created by Adaptive Local Thresholding", vars(args))
         )
@@ -195,10 +487,84 @@ def adaptive_local_thresholding(args: Namespace):
         writer.Update()
     else:
         segmentation_sitk = sitk.GetImageFromArray(segmentation.astype(int))
-        segmentation_sitk.CopyInformation(image_sitk)
+        segmentation_sitk.SetOrigin(reference.GetOrigin())
+        segmentation_sitk.SetSpacing(reference.GetSpacing())
+        segmentation_sitk.SetDirection(reference.GetDirection())
         sitk.WriteImage(segmentation_sitk, args.output)
 
 
+def adaptive_local_thresholding(args: Namespace):
+    print(echo_arguments("Adaptive Local Thresholding", vars(args)))
+    if not os.path.exists(args.input):
+        raise FileNotFoundError(f"Input file {args.input} does not exist.")
+    if os.path.exists(args.output) and not args.overwrite:
+        raise FileExistsError(f"Output file {args.output} already exists. Use the --overwrite flag to overwrite.")
+    if args.structuring_element_shape == "ball":
+        footprint = ball(args.structuring_element_size)
+    elif args.structuring_element_shape == "cube":
+        footprint = cube(args.structuring_element_size)
+    else:
+        raise ValueError("Invalid structuring element shape.")
+    message_s(f"Reading input image from {args.input}", args.silent)
+    density_equation = None
+    reader = None
+    reference = None
+    if args.slab_thickness is None:
+        if args.aims:
+            reader, image, density_equation = read_aim(args.input, args.convert_to_density)
+        else:
+            reference = sitk.ReadImage(args.input)
+            image = sitk.GetArrayFromImage(reference)
+        message_s("Generating bone segmentation", args.silent)
+        if density_equation is not None:
+            m, b = density_equation
+            image = m * image + b
+        segmentation = compute_adaptive_local_threshold_segmentation(
+            image,
+            args.lower_threshold,
+            args.upper_threshold,
+            footprint,
+            args.local_threshold_method,
+            args.sigma,
+            args.minimum_structure_size,
+            args.silent,
+            args.mean_filter_method
+        )
+        write_segmentation(segmentation, args, reader, reference)
+        return
+    with tempfile.TemporaryDirectory() as scratch:
+        input_fn = os.path.join(scratch, "image.npy")
+        output_fn = os.path.join(scratch, "segmentation.npy")
+        if args.aims:
+            # the AIM reader cannot read part of a file, so the AIM is read whole, copied and released
+            reader, image, density_equation = read_aim(args.input, args.convert_to_density)
+            message_s(f"Copying image to scratch file {input_fn}", args.silent)
+            stored = np.lib.format.open_memmap(input_fn, mode="w+", dtype=image.dtype, shape=image.shape)
+            stored[...] = image
+            stored.flush()
+            del stored, image
+            reader.GetOutput().ReleaseData()
+        else:
+            reference = stream_image_to_scratch(args.input, input_fn, args.slab_thickness, args.silent)
+        message_s("Generating bone segmentation", args.silent)
+        compute_adaptive_local_threshold_segmentation_tiled(
+            input_fn,
+            output_fn,
+            density_equation,
+            args.lower_threshold,
+            args.upper_threshold,
+            footprint,
+            args.local_threshold_method,
+            args.sigma,
+            args.minimum_structure_size,
+            args.silent,
+            args.mean_filter_method,
+            args.slab_thickness,
+            args.workers
+        )
+        write_segmentation(np.load(output_fn, mmap_mode="r"), args, reader, reference)
+
+
 def create_parser() -> ArgumentParser:
     parser = ArgumentParser(
         description="Perform adaptive local thresholding on an image to segment bone. You provide an input image "
@@ -273,6 +639,36 @@ def create_parser() -> ArgumentParser:
         help="Method for determining local thresholds. `mean` uses the mean of local voxels. `minmax` uses the "
              "average of the min and max of local voxels. `both` uses the minimum of both methods."
     )
+    parser.add_argument(
+        "--mean-filter-method", "-mfm",
+        type=str,
+        default="integral",
+        choices=["integral", "convolution"],
+        help="How to compute the local mean for the `mean` and `both` local threshold methods. `integral` uses "
+             "running sums in single precision, so the cost does not grow with the size of the structuring element. "
+             "`convolution` convolves with the full structuring element in double precision, which is much slower "
+             "for large structuring elements."
+    )
+    parser.add_argument(
+        "--slab-thickness", "-st",
+        type=int,
+        default=None,
+        help="Enable tiled execution by giving the thickness (in voxels) of the slabs along the first image axis "
+             "(z for NIfTI inputs) to process at a time. Each slab is processed with a halo sized from the structuring "
+             "element and sigma, the image and segmentation are kept in memory-mapped scratch files, and small "
+             "structures are removed across slab boundaries, so the result is identical to processing the whole "
+             "image at once. NIfTI inputs are read into the scratch file a slab at a time, while AIM inputs are read "
+             "whole and released once copied. This bounds the memory of the filtering by the slabs in flight, but "
+             "the segmentation is still assembled in memory to be written. "
+             "The scratch files are written to the default temporary directory (set `TMPDIR` to change it). If not "
+             "given, the whole image is processed in memory."
+    )
+    parser.add_argument(
+        "--workers", "-w",
+        type=int,
+        default=1,
+        help="Number of worker processes to use for tiled execution. Only used if `--slab-thickness` is given."
+    )
     parser.add_argument(
         "--convert-to-density", "-cd",
         default=False,
@@ -5,6 +5,7 @@ import os
 import vtkbone
 from vtk.util.numpy_support import vtk_to_numpy
 from bonelab.io.vtk_helpers import get_vtk_reader
+from bonelab.util.image_statistics import ImageStatistics
 import numpy as np
 import re
 import math
@@ -127,14 +128,17 @@ def aix(infile, log, stat, histo, verbose, meta):
         print('\n',end='')
         #print('\"{0}\" \"{1}\" \"{2}\" \"{3}\"'.format(meta_list[0],meta_list[1],meta_list[2],meta_list[3]))
 
+    # One pass over the data for both the statistics and the histogram
+    if stat or histo:
+        stats = ImageStatistics(vtk_to_numpy(image.GetPointData().GetScalars()))
+
     # Print Stat
     if stat:
-        array = vtk_to_numpy(image.GetPointData().GetScalars()).ravel()
         data = {
-            '!> Max       =':      array.max(),
-            '!> Min       =':      array.min(),
-            '!> Mean      =':      array.mean(),
-            '!> SD        =':      array.std(),
+            '!> Max       =':      stats.max,
+            '!> Min       =':      stats.min,
+            '!> Mean      =':      stats.mean,
+            '!> SD        =':      stats.std,
             '!> TV        =':      n_image_voxels*voxel_volume
         }
 
@@ -152,8 +156,6 @@ def aix(infile, log, stat, histo, verbose, meta):
 
     # Print Histogram
     if histo:
-        array = vtk_to_numpy(image.GetPointData().GetScalars()).ravel()
-
         # The range of values and number of bins are hard-coded. If fewer bins
         # or a different range (i.e. 0 to 127 for char) are wanted then simply 
         # adjust these settings
@@ -167,7 +169,7 @@ def aix(infile, log, stat, histo, verbose, meta):
           print('!- Unknown data type: {}'.format(image.GetScalarTypeAsString()))
       
         # https://numpy.org/doc/stable/reference/generated/numpy.histogram.html
-        hist,bin_edges = np.histogram(array,nBins,nRange,None,None,False)
+        hist,bin_edges = stats.histogram(nBins,nRange)
         nValues = sum(hist)
 
         print('!>  {:4s} ({:.3s}) : Showing {:d} histogram bins over range of {:d} to {:d}.'.format('IND','QTY',nBins,*nRange))
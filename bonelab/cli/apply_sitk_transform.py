@@ -2,17 +2,136 @@ from __future__ import annotations
 
 # external imports
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace, ArgumentTypeError
+import hashlib
+import os
+import tempfile
 import SimpleITK as sitk
+from typing import List, Optional, Tuple
 
 # internal imports
 from bonelab.util.time_stamp import message
 from bonelab.io.vtk_helpers import get_vtk_writer
 from bonelab.util.registration_util import create_file_extension_checker, create_string_argument_checker, INTERPOLATORS, \
-    INPUT_EXTENSIONS, TRANSFORM_EXTENSIONS, check_inputs_exist, check_for_output_overwrite, read_image
+    INPUT_EXTENSIONS, TRANSFORM_EXTENSIONS, check_inputs_exist, check_for_output_overwrite, read_image, \
+    resample_by_axis_permutation
 from bonelab.util.demons_registration_util import IMAGE_EXTENSIONS
 
 
-def read_transform(fn: str, invert: bool, silent: bool) -> sitk.Transform:
+# the number of bytes of a displacement field file hashed at a time
+FINGERPRINT_CHUNK_SIZE = 2 ** 20
+
+
+def read_displacement_field(fn: str) -> sitk.Image:
+    """
+    Read a displacement field in the pixel type `sitk.DisplacementFieldTransform` needs.
+
+    Parameters
+    ----------
+    fn : str
+        The displacement field filename.
+
+    Returns
+    -------
+    sitk.Image
+        The displacement field, cast to 64-bit floats if it was written with a smaller pixel type.
+    """
+    field = sitk.ReadImage(fn)
+    if field.GetPixelID() != sitk.sitkVectorFloat64:
+        field = sitk.Cast(field, sitk.sitkVectorFloat64)
+    return field
+
+
+def field_fingerprint(fn: str) -> str:
+    """
+    Hash the contents of a displacement field file, identifying its inverse in the cache directory.
+
+    Parameters
+    ----------
+    fn : str
+        The displacement field filename.
+
+    Returns
+    -------
+    str
+        The hash, as a hexadecimal string.
+    """
+    h = hashlib.sha1()
+    with open(fn, "rb") as f:
+        for chunk in iter(lambda: f.read(FINGERPRINT_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def inverse_field_filename(fn: str, cache_directory: str) -> str:
+    """
+    Get the filename the inverse of a displacement field is cached under on disk.
+
+    Parameters
+    ----------
+    fn : str
+        The displacement field filename.
+
+    cache_directory : str
+        The directory inverse displacement fields are cached in.
+
+    Returns
+    -------
+    str
+        The filename.
+    """
+    return os.path.join(cache_directory, f"{field_fingerprint(fn)}_inverse.mha")
+
+
+def read_inverse_displacement_field(fn: str, cache_directory: Optional[str], silent: bool) -> sitk.Image:
+    """
+    Read a displacement field and invert it, or read its inverse from the cache directory if it was inverted before.
+
+    Parameters
+    ----------
+    fn : str
+        The displacement field filename.
+
+    cache_directory : Optional[str]
+        The directory inverse displacement fields are cached in, or `None` to always invert the field.
+
+    silent : bool
+        Whether to suppress messages.
+
+    Returns
+    -------
+    sitk.Image
+        The inverse displacement field.
+    """
+    cached_fn = inverse_field_filename(fn, cache_directory) if cache_directory is not None else None
+    if cached_fn is not None and os.path.isfile(cached_fn):
+        if not silent:
+            message(f"Reading cached inverse displacement field from {cached_fn}.")
+        return sitk.ReadImage(cached_fn)
+    # invert on the grid of the field itself
+    inverse_field = sitk.InvertDisplacementField(read_displacement_field(fn))
+    if cached_fn is not None:
+        if not silent:
+            message(f"Caching inverse displacement field in {cached_fn}.")
+        # write to a temporary file and move it into place, so that concurrent runs never read a partial file
+        os.makedirs(cache_directory, exist_ok=True)
+        handle, tmp_fn = tempfile.mkstemp(suffix=".mha", dir=cache_directory)
+        os.close(handle)
+        try:
+            sitk.WriteImage(inverse_field, tmp_fn)
+            os.replace(tmp_fn, cached_fn)
+        except BaseException:
+            if os.path.exists(tmp_fn):
+                os.remove(tmp_fn)
+            raise
+    return inverse_field
+
+
+def read_transform(
+        fn: str,
+        invert: bool,
+        silent: bool,
+        inverse_cache_directory: Optional[str] = None
+) -> sitk.Transform:
     if not silent:
         message(f"Reading transform from {fn}.")
     for ext in TRANSFORM_EXTENSIONS:
@@ -24,44 +143,264 @@ def read_transform(fn: str, invert: bool, silent: bool) -> sitk.Transform:
                 return transform
     for ext in IMAGE_EXTENSIONS:
         if fn.lower().endswith(ext):
-            field = sitk.ReadImage(fn)
             if invert:
-                return sitk.DisplacementFieldTransform(sitk.InverseDisplacementField(field))
+                return sitk.DisplacementFieldTransform(
+                    read_inverse_displacement_field(fn, inverse_cache_directory, silent)
+                )
             else:
-                return sitk.DisplacementFieldTransform(field)
+                return sitk.DisplacementFieldTransform(read_displacement_field(fn))
     raise ValueError("`transform` has invalid extension and was not caught")
 
 
+def read_transform_chain(
+        fns: List[str],
+        invert_items: List[int],
+        invert_chain: bool,
+        silent: bool,
+        inverse_cache_directory: Optional[str] = None
+) -> List[sitk.Transform]:
+    """
+    Read a chain of transforms, inverting the ones asked for.
+
+    Parameters
+    ----------
+    fns : List[str]
+        The transform and displacement field filenames, in the order the registrations that produced them were run,
+        e.g. a rigid transform followed by the displacement field of a demons registration that was initialized with
+        it and run with `--exclude-initial-transform`. By default, `blRegistrationDemons` adds its initial transform
+        into the field, so such a field must be applied on its own, not chained after its initial transform.
+
+    invert_items : List[int]
+        The positions in `fns` of the transforms to invert on their own.
+
+    invert_chain : bool
+        Whether to invert the whole chain, which reverses the order of the transforms and inverts each of them.
+
+    silent : bool
+        Whether to suppress messages.
+
+    inverse_cache_directory : Optional[str]
+        The directory to cache the inverses of displacement fields in, if any.
+
+    Returns
+    -------
+    List[sitk.Transform]
+        The transforms, in the order they should be added to a `sitk.CompositeTransform`.
+    """
+    for i in invert_items:
+        if not 0 <= i < len(fns):
+            raise ValueError(f"cannot invert transform {i}, there are only {len(fns)} transforms in the chain")
+    # an item inverted twice is not inverted at all
+    invert = [(i in invert_items) != invert_chain for i in range(len(fns))]
+    transforms = [read_transform(fn, inv, silent, inverse_cache_directory) for fn, inv in zip(fns, invert)]
+    if invert_chain:
+        transforms.reverse()
+    return transforms
+
+
+def compose_transforms(transforms: List[sitk.Transform]) -> sitk.Transform:
+    """
+    Compose a chain of transforms into one transform, so that an image is only resampled once.
+
+    Parameters
+    ----------
+    transforms : List[sitk.Transform]
+        The transforms. As in a `sitk.CompositeTransform`, the last one is applied to a point first.
+
+    Returns
+    -------
+    sitk.Transform
+        The only transform if there is one, otherwise a `sitk.CompositeTransform` of all of them.
+    """
+    if len(transforms) == 1:
+        return transforms[0]
+    return sitk.CompositeTransform(transforms)
+
+
+def compose_displacement_field(
+        transform: sitk.Transform,
+        reference: sitk.Image,
+        silent: bool
+) -> sitk.Image:
+    """
+    Pre-compose a transform into a single displacement field on the grid of a reference image.
+
+    Evaluating a chain that holds several displacement fields costs one field lookup per field at every voxel. The
+    pre-composed field costs one lookup whatever the length of the chain, so it is cheaper to write it once and apply
+    it whenever the same chain is applied to several images.
+
+    Parameters
+    ----------
+    transform : sitk.Transform
+        The (composed) transform.
+
+    reference : sitk.Image
+        The image with the grid to sample the displacement field on, i.e. the grid images are resampled onto.
+
+    silent : bool
+        Whether to suppress messages.
+
+    Returns
+    -------
+    sitk.Image
+        The displacement field.
+    """
+    if not silent:
+        message("Pre-composing the transforms into a single displacement field.")
+    return sitk.TransformToDisplacementField(
+        transform,
+        sitk.sitkVectorFloat64,
+        reference.GetSize(),
+        reference.GetOrigin(),
+        reference.GetSpacing(),
+        reference.GetDirection()
+    )
+
+
+def check_additional_images(additional_images: Optional[List[List[str]]]) -> List[Tuple[str, str, str]]:
+    """
+    Check the moving image, output and interpolator given for each additional image.
+
+    Parameters
+    ----------
+    additional_images : Optional[List[List[str]]]
+        The `[moving image, output, interpolator]` of each additional image, or `None` if there are none.
+
+    Returns
+    -------
+    List[Tuple[str, str, str]]
+        The checked `(moving image, output, interpolator)` of each additional image.
+    """
+    moving_checker = create_file_extension_checker(INPUT_EXTENSIONS, "additional_image")
+    output_checker = create_file_extension_checker(IMAGE_EXTENSIONS, "additional_image output")
+    interpolator_checker = create_string_argument_checker(list(INTERPOLATORS.keys()), "additional_image interpolator")
+    checked = []
+    for moving_image, output, interpolator in additional_images or []:
+        try:
+            checked.append((moving_checker(moving_image), output_checker(output), interpolator_checker(interpolator)))
+        except ArgumentTypeError as err:
+            raise ValueError(str(err)) from err
+    return checked
+
+
+def resample_moving_image(
+        moving_image: sitk.Image,
+        fixed_image: Optional[sitk.Image],
+        transform: sitk.Transform,
+        interpolator: str,
+        background_value: float,
+        silent: bool
+) -> sitk.Image:
+    """
+    Resample a moving image onto the fixed image, or onto itself if there is no fixed image.
+
+    Parameters
+    ----------
+    moving_image : sitk.Image
+        The moving image.
+
+    fixed_image : Optional[sitk.Image]
+        The fixed image, if any.
+
+    transform : sitk.Transform
+        The transform.
+
+    interpolator : str
+        The name of the interpolator, a key of `INTERPOLATORS`.
+
+    background_value : float
+        The value of voxels outside of the moving image, when resampling onto the fixed image.
+
+    silent : bool
+        Whether to suppress messages.
+
+    Returns
+    -------
+    sitk.Image
+        The resampled moving image.
+    """
+    # a transform that only permutes and flips the voxel axes is applied by rearranging the voxels, no interpolation
+    resampled = resample_by_axis_permutation(
+        moving_image, fixed_image if fixed_image is not None else moving_image, transform
+    )
+    if resampled is not None:
+        if not silent:
+            message("Transform only permutes and flips the voxel axes, rearranging the voxels without resampling.")
+        return resampled
+    if fixed_image is not None:
+        if not silent:
+            message("Resampling moving image onto fixed image using given transform.")
+        return sitk.Resample(
+            moving_image, fixed_image, transform, INTERPOLATORS[interpolator],
+            defaultPixelValue=background_value
+        )
+    if not silent:
+        message("Resampling moving image onto itself using given transform.")
+    return sitk.Resample(moving_image, transform, INTERPOLATORS[interpolator])
+
+
 def apply_sitk_transform(args: Namespace):
-    check_inputs_exist([args.fixed_image, args.transform, args.moving_image], args.silent)
-    check_for_output_overwrite([args.output], args.overwrite, args.silent)
+    additional_images = check_additional_images(args.additional_image)
+    check_inputs_exist(
+        [args.fixed_image, *args.transform, args.moving_image] + [moving for moving, _, _ in additional_images],
+        args.silent
+    )
+    check_for_output_overwrite(
+        [args.output] + [output for _, output, _ in additional_images]
+        + ([args.composed_field] if args.composed_field is not None else []),
+        args.overwrite, args.silent
+    )
+    # the transforms are read, inverted and composed once, whatever the number of images they are applied to
+    transform = compose_transforms(
+        read_transform_chain(
+            args.transform, args.invert_items, args.invert_transform, args.silent, args.inverse_cache_directory
+        )
+    )
+    fixed_image = read_image(args.fixed_image, "fixed_image", args.silent) if args.fixed_image is not None else None
     moving_image = read_image(args.moving_image, "moving_image", args.silent)
-    transform = read_transform(args.transform, args.invert_transform, args.silent)
-    if args.fixed_image is not None:
-        fixed_image = read_image(args.fixed_image, "fixed_image", args.silent)
-        if not args.silent:
-            message("Resampling moving image onto fixed image using given transform.")
-        transformed_image = sitk.Resample(
-            moving_image, fixed_image, transform, INTERPOLATORS[args.interpolator],
-            defaultPixelValue=args.background_value
+    transformed_image = resample_moving_image(
+        moving_image, fixed_image, transform, args.interpolator, args.background_value, args.silent
+    )
+    if args.composed_field is not None:
+        composed_field = compose_displacement_field(
+            transform, fixed_image if fixed_image is not None else moving_image, args.silent
         )
-    else:
         if not args.silent:
-            message("Resampling moving image onto itself using given transform.")
-        transformed_image = sitk.Resample(moving_image, transform, INTERPOLATORS[args.interpolator])
+            message(f"Writing pre-composed displacement field to {args.composed_field}")
+        sitk.WriteImage(composed_field, args.composed_field)
+        del composed_field
+    del moving_image
     if not args.silent:
         message(f"Writing transformed moving image to {args.output}")
     sitk.WriteImage(transformed_image, args.output)
+    del transformed_image
+    # one additional image at a time, so that only one of them is in memory
+    for additional_moving_fn, additional_output, interpolator in additional_images:
+        transformed_image = resample_moving_image(
+            read_image(additional_moving_fn, "additional moving image", args.silent),
+            fixed_image, transform, interpolator, args.background_value, args.silent
+        )
+        if not args.silent:
+            message(f"Writing transformed additional image to {additional_output}")
+        sitk.WriteImage(transformed_image, additional_output)
+        del transformed_image
 
 
 def create_parser() -> ArgumentParser:
     parser = ArgumentParser(
         description="This tool allows you to apply a transformation to an image using SimpleITK. The transformation "
                     "can be either a rigid transformation stored in a transformation file, or it could be a deformable "
-                    "registration stored in an image. Remember that a transformation obtained using blRegistration "
-                    "or blRegistrationDemons will point from the MOVING to FIXED domain. If you want to transform "
-                    "an image or mask the other direction, you can give this program the FIXED image/mask as the "
-                    "MOVING argument and then give the `--invert-transform` option to invert the transformation.",
+                    "registration stored in an image. Several transformations can be given, in the order the "
+                    "registrations that produced them were run, and they are composed so that the image is only "
+                    "resampled once. Transforms from blRegistration can be chained, and so can displacement fields "
+                    "from blRegistrationDemons written with `--exclude-initial-transform` (e.g. a rigid "
+                    "transformation and then the field of a demons registration initialized with it). A demons field "
+                    "written without that flag already contains its initial transform, so chaining it after the "
+                    "initial transform would apply that transform twice. Remember that a transformation obtained "
+                    "using blRegistration or blRegistrationDemons will point from the MOVING to FIXED domain. If you "
+                    "want to transform an image or mask the other direction, you can give this program the FIXED "
+                    "image/mask as the MOVING argument and then give the `--invert-transform` option to invert the "
+                    "transformation.",
         epilog="",
         formatter_class=ArgumentDefaultsHelpFormatter
     )
@@ -70,9 +409,11 @@ def create_parser() -> ArgumentParser:
         help=f"Provide moving image input filename ({', '.join(INPUT_EXTENSIONS)})"
     )
     parser.add_argument(
-        "transform", metavar="TRANSFORM",
+        "transform", metavar="TRANSFORM", nargs="+",
         type=create_file_extension_checker(IMAGE_EXTENSIONS+TRANSFORM_EXTENSIONS, "transform"),
-        help=f"Provide transform filename ({', '.join(IMAGE_EXTENSIONS+TRANSFORM_EXTENSIONS)})"
+        help=f"Provide transform filename(s) ({', '.join(IMAGE_EXTENSIONS+TRANSFORM_EXTENSIONS)}), in the order the "
+             f"registrations that produced them were run. only chain a demons field after its initial transform if "
+             f"it was written with `--exclude-initial-transform`"
     )
     parser.add_argument(
         "output", metavar="OUTPUT",
@@ -96,13 +437,40 @@ def create_parser() -> ArgumentParser:
         "--invert-transform", "-it", default=False, action="store_true",
         help="enable this flag to invert the transform before applying it. you would want to do this if you registered "
              "image A (fixed) to image B (moving) but now you want to transform something from the coordinate system "
-             "of image B to image A"
+             "of image B to image A. with several transforms, the whole chain is inverted, which reverses the "
+             "order of the transforms and inverts each of them"
+    )
+    parser.add_argument(
+        "--invert-items", "-ii", default=[], type=int, nargs="+", metavar="N",
+        help="the positions (starting from 0) of transforms in the chain to invert on their own, before composing them"
+    )
+    parser.add_argument(
+        "--composed-field", "-cf", default=None, metavar="FIELD",
+        type=create_file_extension_checker(IMAGE_EXTENSIONS, "composed_field"),
+        help=f"Optionally provide a filename ({', '.join(IMAGE_EXTENSIONS)}) to write the composed transforms to as a "
+             f"single displacement field on the output grid. applying it costs one field lookup per voxel however "
+             f"long the chain is, so it is cheaper to reuse when the same chain is applied to several images"
     )
     parser.add_argument(
         "--interpolator", "-int", default="Linear", metavar="STR",
         type=create_string_argument_checker(list(INTERPOLATORS.keys()), "interpolator"),
         help="the interpolator to use, options: `Linear`, `NearestNeighbour`, `BSpline`"
     )
+    parser.add_argument(
+        "--additional-image", "-ai", default=None, action="append", nargs=3,
+        metavar=("MOVING", "OUTPUT", "INTERPOLATOR"),
+        help=f"an additional moving image ({', '.join(INPUT_EXTENSIONS)}) to apply the same transform(s) to, the "
+             f"output filename ({', '.join(IMAGE_EXTENSIONS)}) to write it to and the interpolator to use for it. "
+             f"give this option once per additional image, e.g. once for each mask of the moving image with the "
+             f"`NearestNeighbour` interpolator. the transforms are only read, inverted and composed once for all "
+             f"images"
+    )
+    parser.add_argument(
+        "--inverse-cache-directory", "-icd", default=None, type=str, metavar="DIR",
+        help="directory to cache the inverses of inverted displacement fields in. inverting a displacement field is "
+             "slow, so the inverse is named by a hash of the contents of the field file and reused by later runs "
+             "that invert the same field. if not given, inverted fields are not cached"
+    )
     parser.add_argument(
         "--background-value", "-bv", default=0, type=float, metavar="X",
         help="default value to set voxels to when outside of the image domain when resampling the moving image"
@@ -6,22 +6,47 @@ v0.1: (2022/04/13, Nathan Neeteson) First complete implementation
 v0.2: (2022/04/14, Nathan Neeteson) Expose all relevant parameters in the CLI
 '''
 import os
+import csv
+import math
+import time
+import traceback
 import vtk
 import vtkbone
+import numpy as np
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, ArgumentTypeError
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 from glob import glob
+from vtk.util.numpy_support import numpy_to_vtk
 
 from bonelab.util.aim_calibration_header import get_aim_density_equation
+from bonelab.util.buie_autocontour import autocontour_buie_array
 from bonelab.util.vtk_util import vtkImageData_to_numpy
 from bonelab.io.vtk_helpers import get_vtk_writer, handle_filetype_writing_special_cases
 
+SOFTWARE = 'Buie-Burghardt-Scanco Autocontour VTK Implemention'
+VERSION = 0.2
+
+REPORT_FIELDS = [
+    'aim', 'cort_mask', 'trab_mask', 'status', 'error',
+    'read_time', 'pipeline_time', 'write_time', 'total_time'
+]
+
+_pipeline = None
+
 def positive_int(n):
     n = int(n)
-    if n < 0:
+    if n < 1:
         raise ArgumentTypeError('this argument only takes positive integers')
     return n
 
+def non_negative_int(n):
+    n = int(n)
+    if n < 0:
+        raise ArgumentTypeError('this argument only takes non-negative integers')
+    return n
+
 def create_parser():
 
     parser = ArgumentParser(
@@ -55,7 +80,7 @@ def create_parser():
     )
 
     parser.add_argument(
-        '--out-value', '-ov', type=positive_int, default=0, metavar='IV',
+        '--out-value', '-ov', type=non_negative_int, default=0, metavar='IV',
         help = 'value to use for voxels not in a binary mask'
     )
 
@@ -93,11 +118,49 @@ def create_parser():
         help = 'threshold for rebinarizing after gaussian in step 13'
     )
     
+    parser.add_argument(
+        '--backend', '-b', type=str, default='vtk', choices=['vtk', 'numpy'],
+        help = 'implementation of the algorithm to use, both give identical masks'
+    )
+
+    parser.add_argument(
+        '--no-auto-crop', '-nac', dest='auto_crop', action='store_false', default=True,
+        help = 'run the algorithm on the full image instead of cropping it to the bone first'
+    )
+
+    parser.add_argument(
+        '--auto-crop-padding', '-acp', type=non_negative_int, nargs=3, default=None, metavar='N',
+        help = 'padding around the bone bounding box when auto-cropping: if given, must be 3 ints '
+               '(defaults to the combined reach of all kernels)'
+    )
+
     parser.add_argument(
         '--output-dir', '-o', type=str, default=None, metavar='OUTPUT_DIR',
         help = 'optional directory to write output masks to (defaults to input file directory)'
     )
 
+    parser.add_argument(
+        '--workers', '-w', type=positive_int, default=1, metavar='N',
+        help = 'number of AIMs to process in parallel, each in its own process'
+    )
+
+    parser.add_argument(
+        '--vtk-threads', '-vt', type=positive_int, default=None, metavar='N',
+        help = 'maximum number of threads each VTK filter may use (defaults to the number of CPUs divided '
+               'by the number of workers when running more than one worker, otherwise the VTK default)'
+    )
+
+    parser.add_argument(
+        '--skip-existing', '-se', action='store_true', default=False,
+        help = 'skip AIMs for which both output masks already exist, e.g. to resume an interrupted run'
+    )
+
+    parser.add_argument(
+        '--report', '-r', type=str, default=None, metavar='CSV',
+        help = 'CSV file to write the per-AIM status and read / pipeline / write timings to '
+               '(defaults to autocontour_report.csv in the output directory, or AIM_DIR if not given)'
+    )
+
     return parser
 
 def convert_aim_to_density(img, m, b):
@@ -112,144 +175,329 @@ def convert_aim_to_density(img, m, b):
     add.Update()
     return add.GetOutput()
 
-def autocontour_buie(img, args):
+def get_auto_crop_padding(args):
+    # the reach of every neighbourhood filter in the chain, summed up per axis,
+    # plus one voxel. every voxel further than this from the step 2 bone is
+    # out of both masks, and every filter near the edge of the crop only sees
+    # uniform values. the connectivity steps (5 and 10) keep the largest
+    # region though, and the air removed by the crop counts towards the size
+    # of the region outside of the bone, so they run on their input padded
+    # back to the full image with that uniform value. with that, cropping
+    # doesn't change the result
+    padding = []
+    for i in range(3):
+        gauss_radius = int(math.ceil(args.step_12_gaussian_std*args.step_12_gaussian_kernel[i]))
+        padding.append(
+            args.step_3_median_kernel[i]//2
+            + 2*(args.step_4_and_6_dilate_erode_kernel[i]//2)
+            + 2*(args.step_9_and_11_dilate_erode_kernel[i]//2)
+            + gauss_radius
+            + 1
+        )
+    return padding
+
+def get_auto_crop_extent(img, args):
+    # find the bounding box of the step 2 threshold, pad it, and return it as
+    # a VTK extent clipped to the extent of the image (or None if there is no
+    # bone at all, in which case the full image is used)
+    extent = img.GetExtent()
+    bone = vtkImageData_to_numpy(img) >= args.threshold_1
+    padding = args.auto_crop_padding
+    if padding is None:
+        padding = get_auto_crop_padding(args)
+
+    crop_extent = []
+    for axis in range(3):
+        other_axes = tuple(a for a in range(3) if a != axis)
+        indices = np.flatnonzero(bone.any(axis=other_axes))
+        if indices.size == 0:
+            return None
+        lower = max(extent[2*axis], extent[2*axis] + int(indices[0]) - padding[axis])
+        upper = min(extent[2*axis+1], extent[2*axis] + int(indices[-1]) + padding[axis])
+        crop_extent.extend([lower, upper])
+
+    return crop_extent
+
+class AutocontourBuiePipeline:
+    '''The VTK filter graph for Buie's autocontour algorithm
+
+    The graph is built once and can then be run on any number of images, so
+    batches of AIMs don't pay for constructing it again for every file.
+
+    If `args.auto_crop` is set, the image is first cropped to the bounding box
+    of the step 2 threshold plus a padding covering the reach of all of the
+    kernels, the algorithm is run on the cropped image, and the masks are
+    pasted back into the full extent of the image. The two connectivity steps
+    run on their input padded back to the full extent, see
+    `get_auto_crop_padding`.
+    '''
+
+    def __init__(self, args):
+
+        self.args = args
+
+        # these hard-coded constants just make sure that the connectivity filter
+        # actually works, they don't need to be configuable in my opinion
+        CONN_SCALAR_RANGE = [1,args.in_value+1]
+        CONN_SIZE_RANGE = [0,int(1E10)]
+
+        # Step 1 was just loading the AIM, crop it to the bone if asked to
+        self.crop = vtk.vtkExtractVOI()
+
+        # Step 2: Threshold
+        self.s2_threshold = vtk.vtkImageThreshold()
+        self.s2_threshold.ThresholdByUpper(args.threshold_1)
+        self.s2_threshold.SetInValue(args.in_value)
+        self.s2_threshold.SetOutValue(args.out_value)
+        self.s2_threshold.SetInputConnection(self.crop.GetOutputPort())
+
+        # Step 3: Median
+        self.s3_median = vtk.vtkImageMedian3D()
+        self.s3_median.SetKernelSize(*args.step_3_median_kernel)
+        self.s3_median.SetInputConnection(self.s2_threshold.GetOutputPort())
+
+        # Step 4: Dilate
+        self.s4_dilate = vtk.vtkImageDilateErode3D()
+        self.s4_dilate.SetDilateValue(args.in_value)
+        self.s4_dilate.SetErodeValue(args.out_value)
+        self.s4_dilate.SetKernelSize(*args.step_4_and_6_dilate_erode_kernel)
+        self.s4_dilate.SetInputConnection(self.s3_median.GetOutputPort())
+
+        # Step 5: Connectivity (applied to non-bone)
+        # first flip 0 <-> 127
+        self.s5a_invert = vtk.vtkImageThreshold()
+        self.s5a_invert.ThresholdByLower(args.in_value/2)
+        self.s5a_invert.SetInValue(args.in_value)
+        self.s5a_invert.SetOutValue(args.out_value)
+        self.s5a_invert.SetInputConnection(self.s4_dilate.GetOutputPort())
+
+        # then connectivity, on the full extent so that the non-bone removed by
+        # the crop counts towards the size of the region outside of the bone
+        self.s5_pad = vtk.vtkImageConstantPad()
+        self.s5_pad.SetConstant(args.in_value)
+        self.s5_pad.SetInputConnection(self.s5a_invert.GetOutputPort())
+
+        self.s5b_connectivity = vtk.vtkImageConnectivityFilter()
+        self.s5b_connectivity.SetExtractionModeToLargestRegion()
+        self.s5b_connectivity.SetScalarRange(*CONN_SCALAR_RANGE)
+        self.s5b_connectivity.SetSizeRange(*CONN_SIZE_RANGE)
+        self.s5b_connectivity.SetInputConnection(self.s5_pad.GetOutputPort())
+
+        self.s5_crop = vtk.vtkExtractVOI()
+        self.s5_crop.SetInputConnection(self.s5b_connectivity.GetOutputPort())
+
+        # then flip 0 <-> 127 again
+        self.s5c_invert = vtk.vtkImageThreshold()
+        self.s5c_invert.ThresholdByLower(0.5)
+        self.s5c_invert.SetInValue(args.in_value)
+        self.s5c_invert.SetOutValue(args.out_value)
+        self.s5c_invert.SetInputConnection(self.s5_crop.GetOutputPort())
+
+        # Step 6: Erode
+        self.s6_erode = vtk.vtkImageDilateErode3D()
+        self.s6_erode.SetDilateValue(args.out_value)
+        self.s6_erode.SetErodeValue(args.in_value)
+        self.s6_erode.SetKernelSize(*args.step_4_and_6_dilate_erode_kernel)
+        self.s6_erode.SetInputConnection(self.s5c_invert.GetOutputPort())
+
+        # Step 7: Threshold
+        self.s7_threshold = vtk.vtkImageThreshold()
+        self.s7_threshold.ThresholdByLower(args.threshold_2)
+        self.s7_threshold.SetInValue(args.in_value)
+        self.s7_threshold.SetOutValue(args.out_value)
+        self.s7_threshold.SetInputConnection(self.crop.GetOutputPort())
+
+        # Step 8: Mask
+        self.s8a_mask = vtk.vtkImageMask()
+        self.s8a_mask.SetInputConnection(0,self.s7_threshold.GetOutputPort())
+        self.s8a_mask.SetInputConnection(1,self.s6_erode.GetOutputPort())
+
+        self.s8b_invert = vtk.vtkImageThreshold()
+        self.s8b_invert.ThresholdByLower(args.in_value/2)
+        self.s8b_invert.SetInValue(args.in_value)
+        self.s8b_invert.SetOutValue(args.out_value)
+        self.s8b_invert.SetInputConnection(self.s8a_mask.GetOutputPort())
+
+        # Step 9: Dilate
+        self.s9_dilate = vtk.vtkImageDilateErode3D()
+        self.s9_dilate.SetDilateValue(args.out_value)
+        self.s9_dilate.SetErodeValue(args.in_value)
+        self.s9_dilate.SetKernelSize(*args.step_9_and_11_dilate_erode_kernel)
+        self.s9_dilate.SetInputConnection(self.s8b_invert.GetOutputPort())
+
+        # Step 10: Connectivity
+        # connectivity, on the full extent like in step 5
+        self.s10_pad = vtk.vtkImageConstantPad()
+        self.s10_pad.SetConstant(args.in_value)
+        self.s10_pad.SetInputConnection(self.s9_dilate.GetOutputPort())
+
+        self.s10a_connectivity = vtk.vtkImageConnectivityFilter()
+        self.s10a_connectivity.SetExtractionModeToLargestRegion()
+        self.s10a_connectivity.SetScalarRange(*CONN_SCALAR_RANGE)
+        self.s10a_connectivity.SetSizeRange(*CONN_SIZE_RANGE)
+        self.s10a_connectivity.SetInputConnection(self.s10_pad.GetOutputPort())
+
+        self.s10_crop = vtk.vtkExtractVOI()
+        self.s10_crop.SetInputConnection(self.s10a_connectivity.GetOutputPort())
+
+        # then convert to 127 and 0 again
+        self.s10b_convert = vtk.vtkImageThreshold()
+        self.s10b_convert.ThresholdByLower(0.5)
+        self.s10b_convert.SetInValue(args.out_value)
+        self.s10b_convert.SetOutValue(args.in_value)
+        self.s10b_convert.SetInputConnection(self.s10_crop.GetOutputPort())
+
+        # Step 11: Erode
+        self.s11_erode = vtk.vtkImageDilateErode3D()
+        self.s11_erode.SetDilateValue(args.in_value)
+        self.s11_erode.SetErodeValue(args.out_value)
+        self.s11_erode.SetKernelSize(*args.step_9_and_11_dilate_erode_kernel)
+        self.s11_erode.SetInputConnection(self.s10b_convert.GetOutputPort())
+
+        # Step 12: Gaussian Smooth
+        self.s12_gauss = vtk.vtkImageGaussianSmooth()
+        self.s12_gauss.SetStandardDeviation(args.step_12_gaussian_std)
+        self.s12_gauss.SetRadiusFactors(*args.step_12_gaussian_kernel)
+        self.s12_gauss.SetInputConnection(self.s11_erode.GetOutputPort())
+
+        # Step 13: Threshold
+        self.s13_threshold = vtk.vtkImageThreshold()
+        self.s13_threshold.ThresholdByLower(args.step_13_threshold)
+        self.s13_threshold.SetInValue(args.out_value)
+        self.s13_threshold.SetOutValue(args.in_value)
+        self.s13_threshold.SetInputConnection(self.s12_gauss.GetOutputPort())
+
+        # Step 14: Mask
+        self.s14_mask = vtk.vtkImageMask()
+        self.s14_mask.SetInputConnection(0,self.s6_erode.GetOutputPort())
+        self.s14_mask.SetInputConnection(1,self.s13_threshold.GetOutputPort())
+
+        # Step 15: Invert the Trabecular Mask
+        self.s15_invert = vtk.vtkImageThreshold()
+        self.s15_invert.ThresholdByLower(args.in_value/2)
+        self.s15_invert.SetInValue(args.in_value)
+        self.s15_invert.SetOutValue(args.out_value)
+        self.s15_invert.SetInputConnection(self.s13_threshold.GetOutputPort())
+
+        # paste the masks back into the full extent of the image
+        self.cort_pad = vtk.vtkImageConstantPad()
+        self.cort_pad.SetConstant(args.out_value)
+        self.cort_pad.SetInputConnection(self.s14_mask.GetOutputPort())
+
+        self.trab_pad = vtk.vtkImageConstantPad()
+        self.trab_pad.SetConstant(args.out_value)
+        self.trab_pad.SetInputConnection(self.s15_invert.GetOutputPort())
+
+    def run(self, img):
+
+        extent = None
+        if self.args.auto_crop:
+            extent = get_auto_crop_extent(img, self.args)
+        if extent is None:
+            extent = img.GetExtent()
+
+        self.crop.SetInputData(img)
+        self.crop.SetVOI(*extent)
+        for pad, crop in [(self.s5_pad, self.s5_crop), (self.s10_pad, self.s10_crop)]:
+            pad.SetOutputWholeExtent(*img.GetExtent())
+            crop.SetVOI(*extent)
+        self.cort_pad.SetOutputWholeExtent(*img.GetExtent())
+        self.trab_pad.SetOutputWholeExtent(*img.GetExtent())
+
+        # update the pipeline
+        self.cort_pad.Update()
+        self.trab_pad.Update()
+
+        # get masks, copied so that they survive the next run of the pipeline
+        cort_mask = vtk.vtkImageData()
+        cort_mask.DeepCopy(self.cort_pad.GetOutput())
+        trab_mask = vtk.vtkImageData()
+        trab_mask.DeepCopy(self.trab_pad.GetOutput())
+
+        # don't keep a reference to the input image around
+        self.crop.RemoveAllInputs()
+
+        return cort_mask, trab_mask
+
+class AutocontourBuieNumpyPipeline:
+    '''Buie's autocontour algorithm on NumPy arrays
+
+    Same interface and masks as `AutocontourBuiePipeline`, but the algorithm
+    runs on arrays with `bonelab.util.buie_autocontour`.
+    '''
+
+    def __init__(self, args):
+
+        if args.out_value != 0:
+            raise ValueError('the numpy backend only supports an `out-value` of 0')
+
+        self.args = args
+
+    def mask_to_vtk(self, mask, img):
+        # vtkImageThreshold clamps the in value to its output type
+        in_value = min(self.args.in_value, np.iinfo(np.uint8).max)
+        array = np.where(mask, in_value, self.args.out_value).astype(np.uint8)
+        vtk_mask = vtk.vtkImageData()
+        vtk_mask.CopyStructure(img)
+        vtk_mask.GetPointData().SetScalars(
+            numpy_to_vtk(array.ravel(order='F'), deep=True, array_type=vtk.VTK_UNSIGNED_CHAR)
+        )
+        return vtk_mask
+
+    def run(self, img):
+
+        args = self.args
+        density = vtkImageData_to_numpy(img)
+
+        extent = None
+        if args.auto_crop:
+            extent = get_auto_crop_extent(img, args)
+        if extent is None:
+            extent = img.GetExtent()
+        full_extent = img.GetExtent()
+        crop = tuple(
+            slice(extent[2*i] - full_extent[2*i], extent[2*i+1] - full_extent[2*i] + 1)
+            for i in range(3)
+        )
+
+        cort_mask = np.zeros(density.shape, dtype=bool)
+        trab_mask = np.zeros(density.shape, dtype=bool)
+        # the voxels removed by the crop, before and after it along each axis
+        crop_padding = [(c.start, n - c.stop) for c, n in zip(crop, density.shape)]
+        cort_mask[crop], trab_mask[crop] = autocontour_buie_array(
+            density[crop],
+            args.threshold_1,
+            args.threshold_2,
+            args.step_3_median_kernel,
+            args.step_4_and_6_dilate_erode_kernel,
+            args.step_9_and_11_dilate_erode_kernel,
+            args.step_12_gaussian_std,
+            args.step_12_gaussian_kernel,
+            args.step_13_threshold,
+            args.in_value,
+            crop_padding
+        )
+
+        # like in the VTK pipeline, both masks have the unsigned char type of
+        # the connectivity filter output
+        return self.mask_to_vtk(cort_mask, img), self.mask_to_vtk(trab_mask, img)
+
+PIPELINES = {
+    'vtk': AutocontourBuiePipeline,
+    'numpy': AutocontourBuieNumpyPipeline
+}
+
+def get_pipeline(args):
+    # each process builds the pipeline once and reuses it for every AIM; the
+    # arguments are compared by value, because worker processes receive a new
+    # (unpickled) copy of them with every AIM
+    global _pipeline
+    if _pipeline is None or vars(_pipeline.args) != vars(args):
+        _pipeline = PIPELINES[getattr(args, 'backend', 'vtk')](args)
+    return _pipeline
 
-    # these hard-coded constants just make sure that the connectivity filter
-    # actually works, they don't need to be configuable in my opinion
-    CONN_SCALAR_RANGE = [1,args.in_value+1]
-    CONN_SIZE_RANGE = [0,int(1E10)]
-
-    # Step 1 was just loading the AIM
-
-    # Step 2: Threshold
-    s2_threshold = vtk.vtkImageThreshold()
-    s2_threshold.ThresholdByUpper(args.threshold_1)
-    s2_threshold.SetInValue(args.in_value)
-    s2_threshold.SetOutValue(args.out_value)
-    s2_threshold.SetInputData(img)
-
-    # Step 3: Median
-    s3_median = vtk.vtkImageMedian3D()
-    s3_median.SetKernelSize(*args.step_3_median_kernel)
-    s3_median.SetInputConnection(s2_threshold.GetOutputPort())
-
-    # Step 4: Dilate
-    s4_dilate = vtk.vtkImageDilateErode3D()
-    s4_dilate.SetDilateValue(args.in_value)
-    s4_dilate.SetErodeValue(args.out_value)
-    s4_dilate.SetKernelSize(*args.step_4_and_6_dilate_erode_kernel)
-    s4_dilate.SetInputConnection(s3_median.GetOutputPort())
-
-    # Step 5: Connectivity (applied to non-bone)
-    # first flip 0 <-> 127
-    s5a_invert = vtk.vtkImageThreshold()
-    s5a_invert.ThresholdByLower(args.in_value/2)
-    s5a_invert.SetInValue(args.in_value)
-    s5a_invert.SetOutValue(args.out_value)
-    s5a_invert.SetInputConnection(s4_dilate.GetOutputPort())
-
-    # then connectivity
-    s5b_connectivity = vtk.vtkImageConnectivityFilter()
-    s5b_connectivity.SetExtractionModeToLargestRegion()
-    s5b_connectivity.SetScalarRange(*CONN_SCALAR_RANGE)
-    s5b_connectivity.SetSizeRange(*CONN_SIZE_RANGE)
-    s5b_connectivity.SetInputConnection(s5a_invert.GetOutputPort())
-
-    # then flip 0 <-> 127 again
-    s5c_invert = vtk.vtkImageThreshold()
-    s5c_invert.ThresholdByLower(0.5)
-    s5c_invert.SetInValue(args.in_value)
-    s5c_invert.SetOutValue(args.out_value)
-    s5c_invert.SetInputConnection(s5b_connectivity.GetOutputPort())
-
-    # Step 6: Erode
-    s6_erode = vtk.vtkImageDilateErode3D()
-    s6_erode.SetDilateValue(args.out_value)
-    s6_erode.SetErodeValue(args.in_value)
-    s6_erode.SetKernelSize(*args.step_4_and_6_dilate_erode_kernel)
-    s6_erode.SetInputConnection(s5c_invert.GetOutputPort())
-
-    # Step 7: Threshold
-    s7_threshold = vtk.vtkImageThreshold()
-    s7_threshold.ThresholdByLower(args.threshold_2)
-    s7_threshold.SetInValue(args.in_value)
-    s7_threshold.SetOutValue(args.out_value)
-    s7_threshold.SetInputData(img)
-
-    # Step 8: Mask
-    s8a_mask = vtk.vtkImageMask()
-    s8a_mask.SetInputConnection(0,s7_threshold.GetOutputPort())
-    s8a_mask.SetInputConnection(1,s6_erode.GetOutputPort())
-
-    s8b_invert = vtk.vtkImageThreshold()
-    s8b_invert.ThresholdByLower(args.in_value/2)
-    s8b_invert.SetInValue(args.in_value)
-    s8b_invert.SetOutValue(args.out_value)
-    s8b_invert.SetInputConnection(s8a_mask.GetOutputPort())
-
-    # Step 9: Dilate
-    s9_dilate = vtk.vtkImageDilateErode3D()
-    s9_dilate.SetDilateValue(args.out_value)
-    s9_dilate.SetErodeValue(args.in_value)
-    s9_dilate.SetKernelSize(*args.step_9_and_11_dilate_erode_kernel)
-    s9_dilate.SetInputConnection(s8b_invert.GetOutputPort())
-
-    # Step 10: Connectivity
-    # connectivity
-    s10a_connectivity = vtk.vtkImageConnectivityFilter()
-    s10a_connectivity.SetExtractionModeToLargestRegion()
-    s10a_connectivity.SetScalarRange(*CONN_SCALAR_RANGE)
-    s10a_connectivity.SetSizeRange(*CONN_SIZE_RANGE)
-    s10a_connectivity.SetInputConnection(s9_dilate.GetOutputPort())
-
-    # then convert to 127 and 0 again
-    s10b_convert = vtk.vtkImageThreshold()
-    s10b_convert.ThresholdByLower(0.5)
-    s10b_convert.SetInValue(args.out_value)
-    s10b_convert.SetOutValue(args.in_value)
-    s10b_convert.SetInputConnection(s10a_connectivity.GetOutputPort())
-
-    # Step 11: Erode
-    s11_erode = vtk.vtkImageDilateErode3D()
-    s11_erode.SetDilateValue(args.in_value)
-    s11_erode.SetErodeValue(args.out_value)
-    s11_erode.SetKernelSize(*args.step_9_and_11_dilate_erode_kernel)
-    s11_erode.SetInputConnection(s10b_convert.GetOutputPort())
-
-    # Step 12: Gaussian Smooth
-    s12_gauss = vtk.vtkImageGaussianSmooth()
-    s12_gauss.SetStandardDeviation(args.step_12_gaussian_std)
-    s12_gauss.SetRadiusFactors(*args.step_12_gaussian_kernel)
-    s12_gauss.SetInputConnection(s11_erode.GetOutputPort())
-
-    # Step 13: Threshold
-    s13_threshold = vtk.vtkImageThreshold()
-    s13_threshold.ThresholdByLower(args.step_13_threshold)
-    s13_threshold.SetInValue(args.out_value)
-    s13_threshold.SetOutValue(args.in_value)
-    s13_threshold.SetInputConnection(s12_gauss.GetOutputPort())
-
-    # Step 14: Mask
-    s14_mask = vtk.vtkImageMask()
-    s14_mask.SetInputConnection(0,s6_erode.GetOutputPort())
-    s14_mask.SetInputConnection(1,s13_threshold.GetOutputPort())
-
-    # Step 15: Invert the Trabecular Mask
-    s15_invert = vtk.vtkImageThreshold()
-    s15_invert.ThresholdByLower(args.in_value/2)
-    s15_invert.SetInValue(args.in_value)
-    s15_invert.SetOutValue(args.out_value)
-    s15_invert.SetInputConnection(s13_threshold.GetOutputPort())
-
-    # update the pipeline
-    s14_mask.Update()
-    s15_invert.Update()
-
-    # get masks
-    cort_mask = s14_mask.GetOutput()
-    trab_mask = s15_invert.GetOutput()
-
-    return cort_mask, trab_mask
+def autocontour_buie(img, args):
+    return AutocontourBuiePipeline(args).run(img)
 
 def write_mask(reader,mask,mask_fn,label,software,version):
 
@@ -263,53 +511,146 @@ def write_mask(reader,mask,mask_fn,label,software,version):
     if writer is None:
         raise RuntimeError(f'Cannot find writer for file {mask_fn}')
 
-    writer.SetFileName(mask_fn)
+    # write to a partial file and rename it, so an interrupted run never
+    # leaves a truncated mask behind for `--skip-existing` to accept
+    base, ext = os.path.splitext(mask_fn)
+    partial_fn = f'{base}.partial{ext}'
+
+    writer.SetFileName(partial_fn)
     writer.SetInputData(mask)
     handle_filetype_writing_special_cases(
         writer,
         processing_log=processing_log
     )
 
-    writer.Update()
+    try:
+        writer.Update()
+        if not os.path.isfile(partial_fn):
+            raise RuntimeError(f'Could not write {mask_fn}')
+        os.replace(partial_fn, mask_fn)
+    except BaseException:
+        if os.path.exists(partial_fn):
+            os.remove(partial_fn)
+        raise
 
-def main():
+def get_mask_filenames(aim_fn, output_dir):
 
-    SOFTWARE = 'Buie-Burghardt-Scanco Autocontour VTK Implemention'
-    VERSION = 0.2
+    # use the output directory if given, otherwise the same directory as the input file
+    output_dir = output_dir if output_dir else os.path.dirname(aim_fn)
 
-    args = create_parser().parse_args()
+    base = os.path.splitext(os.path.basename(aim_fn))[0]
+    cort_mask_fn = os.path.join(output_dir, f"{base}_CORT_MASK.AIM")
+    trab_mask_fn = os.path.join(output_dir, f"{base}_TRAB_MASK.AIM")
 
-    if args.out_value >= args.in_value:
-        raise ValueError('please make `in-value` larger than `out-value`')
+    return cort_mask_fn, trab_mask_fn
 
-    aim_fn_list = glob(os.path.join(args.aim_dir,args.aim_pattern))
+def set_vtk_threads(n):
+    # limit both the classic multithreader and the SMP backend, so that
+    # parallel workers don't each try to use every core
+    if n is not None:
+        vtk.vtkMultiThreader.SetGlobalMaximumNumberOfThreads(n)
+        vtk.vtkSMPTools.Initialize(n)
 
-    reader = vtkbone.vtkboneAIMReader()
-    reader.DataOnCellsOff()
+def process_aim(aim_fn, args):
 
-    for aim_fn in aim_fn_list:
+    cort_mask_fn, trab_mask_fn = get_mask_filenames(aim_fn, args.output_dir)
 
-        print(aim_fn)
-        
-        # Determine output directory: use --output-dir if provided, otherwise same directory as input file
-        output_dir = args.output_dir if args.output_dir else os.path.dirname(aim_fn)
-        os.makedirs(output_dir, exist_ok=True)
-        
-        base = os.path.splitext(os.path.basename(aim_fn))[0]
-        cort_mask_fn = os.path.join(output_dir, f"{base}_CORT_MASK.AIM")
-        trab_mask_fn = os.path.join(output_dir, f"{base}_TRAB_MASK.AIM")
+    row = OrderedDict((field, '') for field in REPORT_FIELDS)
+    row['aim'] = aim_fn
+    row['cort_mask'] = cort_mask_fn
+    row['trab_mask'] = trab_mask_fn
 
+    if args.skip_existing and os.path.isfile(cort_mask_fn) and os.path.isfile(trab_mask_fn):
+        row['status'] = 'skipped'
+        return row
+
+    start_time = time.time()
+    try:
+        os.makedirs(os.path.dirname(cort_mask_fn) or '.', exist_ok=True)
+
+        t = time.time()
+        reader = vtkbone.vtkboneAIMReader()
+        reader.DataOnCellsOff()
         reader.SetFileName(aim_fn)
         reader.Update()
+        row['read_time'] = f'{time.time() - t:.3f}'
 
+        t = time.time()
         img = reader.GetOutput()
         m,b = get_aim_density_equation(reader.GetProcessingLog())
         img = convert_aim_to_density(img,m,b)
+        cort_mask, trab_mask = get_pipeline(args).run(img)
+        row['pipeline_time'] = f'{time.time() - t:.3f}'
 
-        cort_mask, trab_mask = autocontour_buie(img,args)
-
+        t = time.time()
         write_mask(reader,cort_mask,cort_mask_fn,'CORT_MASK',SOFTWARE,VERSION)
         write_mask(reader,trab_mask,trab_mask_fn,'TRAB_MASK',SOFTWARE,VERSION)
+        row['write_time'] = f'{time.time() - t:.3f}'
+
+        row['status'] = 'done'
+    except Exception as e:
+        row['status'] = 'failed'
+        row['error'] = ' | '.join(traceback.format_exception_only(type(e), e)).strip()
+    row['total_time'] = f'{time.time() - start_time:.3f}'
+
+    return row
+
+def write_report(rows, report_fn):
+
+    report_dir = os.path.dirname(report_fn)
+    if report_dir:
+        os.makedirs(report_dir, exist_ok=True)
+
+    with open(report_fn, 'w', newline='') as f:
+        csv_writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        csv_writer.writeheader()
+        csv_writer.writerows(rows)
+
+def main():
+
+    args = create_parser().parse_args()
+
+    if args.out_value >= args.in_value:
+        raise ValueError('please make `in-value` larger than `out-value`')
+
+    if args.backend == 'numpy' and args.out_value != 0:
+        raise ValueError('the numpy backend only supports an `out-value` of 0')
+
+    aim_fn_list = sorted(glob(os.path.join(args.aim_dir,args.aim_pattern)))
+
+    report_fn = args.report
+    if report_fn is None:
+        report_fn = os.path.join(args.output_dir or args.aim_dir, 'autocontour_report.csv')
+
+    vtk_threads = args.vtk_threads
+    if vtk_threads is None and args.workers > 1:
+        vtk_threads = max(1, (os.cpu_count() or 1) // args.workers)
+
+    rows = {}
+    if args.workers > 1:
+        with ProcessPoolExecutor(
+            max_workers=args.workers, initializer=set_vtk_threads, initargs=(vtk_threads,)
+        ) as executor:
+            futures = {executor.submit(process_aim, aim_fn, args): aim_fn for aim_fn in aim_fn_list}
+            for future in as_completed(futures):
+                row = future.result()
+                rows[futures[future]] = row
+                print(f"{row['aim']}: {row['status']}")
+    else:
+        set_vtk_threads(vtk_threads)
+        for aim_fn in aim_fn_list:
+            row = process_aim(aim_fn, args)
+            rows[aim_fn] = row
+            print(f"{row['aim']}: {row['status']}")
+
+    # report in the same (sorted) order as the inputs, regardless of completion order
+    rows = [rows[aim_fn] for aim_fn in aim_fn_list]
+    write_report(rows, report_fn)
+    print(f'Report written to {report_fn}')
+
+    failed = [row['aim'] for row in rows if row['status'] == 'failed']
+    if failed:
+        raise RuntimeError(f'autocontouring failed for {len(failed)} AIM(s), see {report_fn}: {", ".join(failed)}')
 
 
 if __name__ == '__main__':
@@ -3,10 +3,12 @@ from __future__ import annotations
 # external imports
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace, ArgumentTypeError
 import SimpleITK as sitk
+import numpy as np
 from matplotlib import pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 import csv
 import yaml
-from typing import List, Callable
+from typing import List, Callable, Dict, Optional, Tuple, Union
 
 # internal imports
 from bonelab.util.time_stamp import message
@@ -20,58 +22,268 @@ def get_class_labels(class_labels: Optional[List[int]], silent: bool) -> List[in
     return class_labels
 
 
+# the metrics computed for every class label, in the order they are written to the output
+OVERLAP_METRICS = ["dice", "jaccard", "volume_similarity", "false_negative_error", "false_positive_error"]
+
+# above this many distinct values between the smallest and largest label, the labels are mapped to a compact range
+# before counting rather than counting every value in the range
+MAX_DENSE_LABEL_RANGE = 1024
+
+
+def compute_confusion_matrix(x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the label confusion matrix of two label images in a single counting pass.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The first label image.
+
+    y : np.ndarray
+        The second label image, the same shape as `x`.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The sorted labels found in either image, and the confusion matrix where element `[i, j]` is the number of
+        voxels with label `i` in `x` and label `j` in `y`.
+    """
+    x = np.asarray(x).ravel()
+    y = np.asarray(y).ravel()
+    if x.shape != y.shape:
+        raise ValueError(f"label images must be the same size, got {x.size} and {y.size} voxels")
+    if x.dtype == bool:
+        x = x.view(np.uint8)
+    if y.dtype == bool:
+        y = y.view(np.uint8)
+    if x.size > 0 and np.issubdtype(x.dtype, np.integer) and np.issubdtype(y.dtype, np.integer):
+        low = min(int(x.min()), int(y.min()))
+        n = max(int(x.max()), int(y.max())) - low + 1
+        if n <= MAX_DENSE_LABEL_RANGE:
+            pairs = (x.astype(np.int64) - low) * n + (y.astype(np.int64) - low)
+            counts = np.bincount(pairs, minlength=n * n).reshape(n, n)
+            present = (counts.sum(axis=1) > 0) | (counts.sum(axis=0) > 0)
+            return np.arange(low, low + n)[present], counts[np.ix_(present, present)]
+    labels, inverse = np.unique(np.concatenate([x, y]), return_inverse=True)
+    n = len(labels)
+    counts = np.bincount(inverse[:x.size] * n + inverse[x.size:], minlength=n * n).reshape(n, n)
+    return labels, counts
+
+
+def compute_overlap_metrics(
+        x: sitk.Image,
+        y: sitk.Image,
+        class_labels: List[int],
+        silent: bool
+) -> Dict[str, List[float]]:
+    """
+    Compute the overlap metrics of every class label from the label confusion matrix of two label images.
+
+    The metrics are those of `sitk.LabelOverlapMeasuresImageFilter` applied to `x == cl` and `y == cl`, with `x` as
+    the source and `y` as the target. A metric that is 0 / 0 for a class label, e.g. the Dice of a label in neither
+    image, is NaN.
+
+    Parameters
+    ----------
+    x : sitk.Image
+        The first label image.
+
+    y : sitk.Image
+        The second label image, in the same space as `x`.
+
+    class_labels : List[int]
+        The class labels to compute the metrics for.
+
+    silent : bool
+        Whether to suppress messages.
+
+    Returns
+    -------
+    Dict[str, List[float]]
+        Each of `OVERLAP_METRICS`, for each class label.
+    """
+    if not silent:
+        message("Calculating class metrics")
+    labels, counts = compute_confusion_matrix(sitk.GetArrayViewFromImage(x), sitk.GetArrayViewFromImage(y))
+    total = counts.sum()
+    source = np.zeros(len(class_labels), dtype=np.int64)
+    target = np.zeros(len(class_labels), dtype=np.int64)
+    intersection = np.zeros(len(class_labels), dtype=np.int64)
+    for i, cl in enumerate(class_labels):
+        index = np.flatnonzero(labels == cl)
+        if len(index) > 0:
+            source[i] = counts[index[0], :].sum()
+            target[i] = counts[:, index[0]].sum()
+            intersection[i] = counts[index[0], index[0]]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        metrics = {
+            "dice": 2.0 * intersection / (source + target),
+            "jaccard": intersection / (source + target - intersection),
+            "volume_similarity": 2.0 * (source - target) / (source + target),
+            "false_negative_error": (target - intersection) / target,
+            "false_positive_error": (source - intersection) / (total - target)
+        }
+    metrics = {metric: [float(v) for v in metrics[metric]] for metric in OVERLAP_METRICS}
+    if not silent:
+        for i, cl in enumerate(class_labels):
+            message(f"Class: {cl}, " + ", ".join([f"{metric}: {metrics[metric][i]}" for metric in OVERLAP_METRICS]))
+    return metrics
+
+
 def compute_dice_and_jaccard(
         x: sitk.Image,
         y: sitk.Image,
         class_labels: List[int],
         silent: bool
 ) -> Tuple[List[float]]:
+    metrics = compute_overlap_metrics(x, y, class_labels, silent)
+    return metrics["dice"], metrics["jaccard"]
+
+
+def compute_pair_overlap(
+        mask1_fn: str,
+        mask2_fn: str,
+        class_labels: Optional[List[int]],
+        silent: bool
+) -> Dict[str, Union[str, float]]:
+    """
+    Read two masks, resample the second onto the first and compute their overlap metrics.
+
+    Parameters
+    ----------
+    mask1_fn : str
+        The filename of the first mask.
+
+    mask2_fn : str
+        The filename of the second mask.
+
+    class_labels : Optional[List[int]]
+        The class labels to compute the metrics for. If `None`, the masks are binarized and the metrics are computed
+        for label 1.
+
+    silent : bool
+        Whether to suppress messages.
+
+    Returns
+    -------
+    Dict[str, Union[str, float]]
+        The output row: the two filenames and each metric for each class label.
+    """
+    labels = get_class_labels(class_labels, silent)
+    mask1 = read_image(mask1_fn, "mask1", silent)
+    mask2 = read_image(mask2_fn, "mask2", silent)
+    # resample mask2 onto mask1 so they share the same physical space
+    # use nearest neighbour because we do not want to "smear out" labels
     if not silent:
-        message("Calculating class metrics")
-    overlap = sitk.LabelOverlapMeasuresImageFilter()
-    dice = []
-    jaccard = []
-    for cl in class_labels:
-        overlap.Execute(x == cl, y == cl)
-        dice.append(overlap.GetDiceCoefficient())
-        jaccard.append(overlap.GetJaccardCoefficient())
+        message("Resampling mask 2 onto mask 1.")
+    mask2 = sitk.Resample(mask2, mask1, sitk.Transform(), sitk.sitkNearestNeighbor)
+    if class_labels is None:
         if not silent:
-            message(f"Class: {cl}, dice: {dice[-1]}, jaccard: {jaccard[-1]}")
-    return dice, jaccard
+            message("Binarizing masks, since class labels not provided.")
+        mask1 = sitk.Cast(mask1 > 0, sitk.sitkInt16)
+        mask2 = sitk.Cast(mask2 > 0, sitk.sitkInt16)
+    metrics = compute_overlap_metrics(mask1, mask2, labels, silent)
+    row = {"mask1": mask1_fn, "mask2": mask2_fn}
+    for i, cl in enumerate(labels):
+        for metric in OVERLAP_METRICS:
+            row[f"{metric}_{cl}"] = metrics[metric][i]
+    return row
 
 
-def write_output(fn: str, mask1: str, mask2: str, metrics: List[Tuple[int, float, float]], silent: bool) -> None:
+def write_output(fn: str, rows: List[Dict[str, Union[str, float]]], silent: bool) -> None:
     if not silent:
         message(f"Writing metrics to {fn}")
+    # the header is the union of the columns of all rows, in the order they are first seen
+    header = []
+    for row in rows:
+        header += [column for column in row.keys() if column not in header]
     with open(fn, "w") as f:
-        csv_writer = csv.writer(f)
-        header = ["mask1", "mask2"]
-        entries = [mask1, mask2]
-        for (i, dice, jaccard) in metrics:
-            header += [f"dice_{i}", f"jaccard_{i}"]
-            entries += [dice, jaccard]
-        csv_writer.writerow(header)
-        csv_writer.writerow(entries)
+        csv_writer = csv.DictWriter(f, fieldnames=header)
+        csv_writer.writeheader()
+        csv_writer.writerows(rows)
 
 
 def compute_overlap(args: Namespace):
     check_inputs_exist([args.mask1, args.mask2], args.silent)
     check_for_output_overwrite([args.output], args.overwrite, args.silent)
-    class_labels = get_class_labels(args.class_labels, args.silent)
-    mask1 = read_image(args.mask1, "mask1", args.silent)
-    mask2 = read_image(args.mask2, "mask2", args.silent)
-    # resample mask2 onto mask1 so they share the same physical space
-    # use nearest neighbour because we do not want to "smear out" labels
+    row = compute_pair_overlap(args.mask1, args.mask2, args.class_labels, args.silent)
+    write_output(args.output, [row], args.silent)
+
+
+def read_manifest(fn: str, silent: bool) -> List[Tuple[str, str]]:
+    """
+    Read the pairs of masks to compare from a CSV file with `mask1` and `mask2` columns.
+
+    Parameters
+    ----------
+    fn : str
+        The manifest filename.
+
+    silent : bool
+        Whether to suppress messages.
+
+    Returns
+    -------
+    List[Tuple[str, str]]
+        The pairs of mask filenames.
+    """
+    if not silent:
+        message(f"Reading mask pairs from {fn}")
+    with open(fn, "r", newline="") as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames is None or not {"mask1", "mask2"}.issubset(reader.fieldnames):
+            raise ValueError(f"{fn} must have a header with `mask1` and `mask2` columns")
+        pairs = [(row["mask1"], row["mask2"]) for row in reader]
+    if not silent:
+        message(f"Found {len(pairs)} mask pairs.")
+    return pairs
+
+
+def compute_pair_overlap_or_error(
+        mask1_fn: str,
+        mask2_fn: str,
+        class_labels: Optional[List[int]]
+) -> Dict[str, Union[str, float]]:
+    """
+    Compute the overlap of one pair of masks in a batch, recording the error in the row instead of raising it.
+    """
+    try:
+        check_inputs_exist([mask1_fn, mask2_fn], True)
+        row = compute_pair_overlap(mask1_fn, mask2_fn, class_labels, True)
+        row["error"] = ""
+    except Exception as e:
+        row = {"mask1": mask1_fn, "mask2": mask2_fn, "error": f"{type(e).__name__}: {e}"}
+    return row
+
+
+def compute_overlap_batch(args: Namespace):
+    check_inputs_exist([args.manifest], args.silent)
+    check_for_output_overwrite([args.output], args.overwrite, args.silent)
+    pairs = read_manifest(args.manifest, args.silent)
     if not args.silent:
-        message("Resampling mask 2 onto mask 1.")
-    mask2 = sitk.Resample(mask2, mask1, sitk.Transform(), sitk.sitkNearestNeighbor)
-    if args.class_labels is None:
-        if not args.silent:
-            message("Binarizing masks, since class labels not provided.")
-        mask1 = sitk.Cast(mask1 > 0, sitk.sitkInt16)
-        mask2 = sitk.Cast(mask2 > 0, sitk.sitkInt16)
-    dice, jaccard = compute_dice_and_jaccard(mask1, mask2, class_labels, args.silent)
-    write_output(args.output, args.mask1, args.mask2, list(zip(class_labels, dice, jaccard)), args.silent)
+        message(f"Computing overlap of {len(pairs)} mask pairs with {args.workers} workers.")
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [
+                executor.submit(compute_pair_overlap_or_error, mask1_fn, mask2_fn, args.class_labels)
+                for mask1_fn, mask2_fn in pairs
+            ]
+            rows = [future.result() for future in futures]
+    else:
+        rows = [
+            compute_pair_overlap_or_error(mask1_fn, mask2_fn, args.class_labels)
+            for mask1_fn, mask2_fn in pairs
+        ]
+    # keep the error column last
+    for row in rows:
+        row["error"] = row.pop("error")
+    write_output(args.output, rows, args.silent)
+    failed = [row for row in rows if row["error"]]
+    if len(failed) > 0:
+        raise RuntimeError(
+            f"{len(failed)} of {len(rows)} mask pairs failed, see the `error` column of {args.output}. "
+            f"First failure: {failed[0]['mask1']}, {failed[0]['mask2']}: {failed[0]['error']}"
+        )
 
 
 def create_parser() -> ArgumentParser:
@@ -114,9 +326,50 @@ def create_parser() -> ArgumentParser:
     return parser
 
 
+def create_batch_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="This tool allows you to compute the overlap metrics of many pairs of masks, listed in a manifest "
+                    "CSV file with `mask1` and `mask2` columns. The pairs are processed in parallel and the metrics of "
+                    "all pairs are written to one CSV file, one row per pair. A pair that fails does not stop the "
+                    "others, its error is written to the `error` column. See `blImageComputeOverlap` for how each pair "
+                    "is compared.",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "manifest", type=str, metavar="MANIFEST",
+        help="path to a csv file with a header row including `mask1` and `mask2` columns, one pair of masks per row."
+    )
+    parser.add_argument(
+        "output", type=str, metavar="OUTPUT",
+        help="path to the file to save the output to, should end with *.csv (since it will be a csv file regardless)."
+    )
+    parser.add_argument(
+        "--overwrite", "-ow", default=False, action="store_true",
+        help="enable this flag to overwrite existing files, if they exist at output targets"
+    )
+    parser.add_argument(
+        "--class-labels", "-cl", default=None, type=int, nargs="+", metavar="N",
+        help="the class labels to calculate overlap metrics for. If nothing is provided then the images will be "
+             "binarized and only a single value for each metric will be calculated."
+    )
+    parser.add_argument(
+        "--workers", "-w", default=1, type=int,
+        help="number of mask pairs to process in parallel"
+    )
+    parser.add_argument(
+        "--silent", "-s", default=False, action="store_true",
+        help="enable this flag to suppress terminal output about how the program is proceeding"
+    )
+    return parser
+
+
 def main():
     compute_overlap(create_parser().parse_args())
 
 
+def main_batch():
+    compute_overlap_batch(create_batch_parser().parse_args())
+
+
 if __name__ == "__main__":
     main()
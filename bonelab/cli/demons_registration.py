@@ -3,6 +3,7 @@ from __future__ import annotations
 # external imports
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
 import SimpleITK as sitk
+from typing import List, Optional, Tuple
 
 # internal imports
 from bonelab.util.time_stamp import message
@@ -10,14 +11,121 @@ from bonelab.util.echo_arguments import echo_arguments
 from bonelab.util.demons_registration_util import multiscale_demons, DEMONS_FILTERS, \
     IMAGE_EXTENSIONS, TRANSFORM_EXTENSIONS, demons_type_checker, construct_multiscale_progression, \
     get_initial_transform, add_initial_transform_to_displacement_field, write_transform_or_field, \
-    write_displacement_visualization
+    write_displacement_visualization, ImagePyramid
+from bonelab.util.registration_instrumentation import RegistrationInstrumentation, timed
 from bonelab.util.registration_util import (
     create_file_extension_checker, create_string_argument_checker,
     INPUT_EXTENSIONS, get_output_base, write_args_to_yaml, check_inputs_exist, check_for_output_overwrite,
-    write_metrics_to_csv, create_and_save_metrics_plot, read_and_downsample_images, check_image_size_and_shrink_factors
+    write_metrics_to_csv, create_and_save_metrics_plot, read_and_downsample_images, read_and_downsample_masks,
+    check_image_size_and_shrink_factors
 )
 
 
+def register_images(
+        args: Namespace,
+        fixed_image: sitk.Image,
+        moving_image: sitk.Image,
+        fixed_pyramid: Optional[ImagePyramid] = None,
+        fixed_mask: Optional[sitk.Image] = None,
+        moving_mask: Optional[sitk.Image] = None,
+        instrumentation: Optional[RegistrationInstrumentation] = None
+) -> Tuple[sitk.Image, List[float]]:
+    """
+    Register two images that have already been read (and optionally downsampled), without writing anything.
+
+    Parameters
+    ----------
+    args : Namespace
+        The parsed arguments from the command line.
+
+    fixed_image : sitk.Image
+        The fixed image.
+
+    moving_image : sitk.Image
+        The moving image.
+
+    fixed_pyramid : Optional[ImagePyramid]
+        A pyramid of the fixed image to reuse, e.g. one shared by several registrations to the same fixed image.
+        If not given, one is created from the fixed image and the pyramid arguments. It is not used if there is a
+        fixed mask, since the pyramid must then be of the masked fixed image. To share a pyramid between
+        registrations with a fixed mask, mask the fixed image before building the pyramid and pass no fixed mask,
+        as `blRegistrationBatch` does.
+
+    fixed_mask : Optional[sitk.Image]
+        A mask on the grid of the fixed image. This masks the image, not the metric: the fixed image is set to the
+        background value outside of the mask, so the edge at the mask boundary also drives the deformation, and the
+        centering initialization is computed from the masked image.
+
+    moving_mask : Optional[sitk.Image]
+        A mask on the grid of the moving image. Like the fixed mask, the moving image is set to the background value
+        outside of it.
+
+    instrumentation : Optional[RegistrationInstrumentation]
+        If given, the levels, iterations and time of each stage of the registration are recorded in it.
+
+    Returns
+    -------
+    Tuple[sitk.Image, List[float]]
+        The displacement field, including the initial transform unless `args.exclude_initial_transform` is set, and
+        the metric history.
+    """
+    # the demons filters cannot restrict their metric to a mask, so the images are masked instead. Unlike a metric
+    # mask, this adds an edge at the mask boundary, and it changes the images used for the centering initialization
+    if fixed_mask is not None:
+        if not args.silent:
+            message("Masking the fixed image.")
+        fixed_image = sitk.Mask(fixed_image, fixed_mask, args.background_value)
+        fixed_pyramid = None
+    if moving_mask is not None:
+        if not args.silent:
+            message("Masking the moving image.")
+        moving_image = sitk.Mask(moving_image, moving_mask, args.background_value)
+    initial_transform = get_initial_transform(
+        args.initial_transform, fixed_image, moving_image, args.centering_initialization, args.silent
+    )
+    if not args.silent:
+        message("Resampling moving image onto the fixed image using initial transform.")
+    with timed(instrumentation, "initial_resample"):
+        moving_image = sitk.Resample(
+            moving_image, fixed_image, initial_transform,
+            defaultPixelValue=args.background_value
+        )
+    multiscale_progression = construct_multiscale_progression(
+        args.shrink_factors, args.smoothing_sigmas, args.silent
+    )
+    # the fixed image pyramid can be cached on disk and reused by later registrations to the same fixed image
+    if fixed_pyramid is None:
+        fixed_pyramid = ImagePyramid(fixed_image, args.pyramid_cache_directory, args.incremental_pyramid)
+    # the moving image pyramid is only used by this registration, so each level is built when the registration gets
+    # to it and not all of them up front. the registration goes from coarse to fine, so there is never a finer level
+    # to build a moving level from incrementally
+    moving_pyramid = ImagePyramid(moving_image)
+    if multiscale_progression is not None:
+        if not args.silent:
+            message("Building the fixed image pyramid.")
+        with timed(instrumentation, "pyramid"):
+            fixed_pyramid.build(multiscale_progression)
+    # do the registration
+    displacement_field, metric_history = multiscale_demons(
+        fixed_pyramid, moving_pyramid, args.demons_type, args.max_iterations,
+        demons_displacement_field_smooth_std=args.displacement_smoothing_std,
+        demons_update_field_smooth_std=args.update_smoothing_std,
+        initial_transform=None,
+        multiscale_progression=multiscale_progression,
+        silent=args.silent,
+        field_pixel_type=sitk.sitkVectorFloat32 if args.float32_displacement_field else sitk.sitkVectorFloat64,
+        instrumentation=instrumentation
+    )
+    # add the initial transform and the demons transform together, unless the field is to be chained after the
+    # initial transform when it is applied
+    if not args.exclude_initial_transform:
+        with timed(instrumentation, "add_initial_transform"):
+            displacement_field = add_initial_transform_to_displacement_field(
+                displacement_field, initial_transform, args.silent
+            )
+    return displacement_field, metric_history
+
+
 def demons_registration(args: Namespace):
     # echo arguments
     print(echo_arguments("Demons Registration", vars(args)))
@@ -27,16 +135,20 @@ def demons_registration(args: Namespace):
     output_metric_csv = f"{output_base}_metric_history.csv"
     output_metric_png = f"{output_base}_metric_history.png"
     output_displacement_visualization = f"{output_base}_deformation_visualization.nii"
+    output_instrumentation_json = f"{output_base}_instrumentation.json"
     # check that the inputs actually exist
-    check_inputs_exist([args.fixed_image, args.moving_image, args.initial_transform], args.silent)
+    check_inputs_exist(
+        [args.fixed_image, args.moving_image, args.initial_transform, args.fixed_mask, args.moving_mask], args.silent
+    )
     # check if we're going to overwrite some outputs
     check_for_output_overwrite(
         [
             args.output, output_yaml, output_metric_csv, output_metric_png,
-            output_displacement_visualization
+            output_displacement_visualization, output_instrumentation_json
         ],
         args.overwrite, args.silent
     )
+    instrumentation = RegistrationInstrumentation()
     # save the arguments of this registration to a yaml file
     # this has the added benefit of ensuring up-front that we can write files to the "output" that was provided,
     # so we do not waste a lot of time doing the registration and then crashing at the end because of write permissions
@@ -44,36 +156,19 @@ def demons_registration(args: Namespace):
     fixed_image, moving_image = read_and_downsample_images(
         args.fixed_image, args.moving_image,
         args.downsampling_shrink_factor, args.downsampling_smoothing_sigma,
-        args.moving_is_downsampled_atlas, args.silent
-    )
-    check_image_size_and_shrink_factors(fixed_image, moving_image, args.shrink_factors, args.silent)
-    initial_transform = get_initial_transform(
-        args.initial_transform, fixed_image, moving_image, args.centering_initialization, args.silent
-    )
-    if not args.silent:
-        message("Resampling moving image onto the fixed image using initial transform.")
-    moving_image = sitk.Resample(
-        moving_image, fixed_image, initial_transform,
-        defaultPixelValue=args.background_value
-    )
-    multiscale_progression = construct_multiscale_progression(
-        args.shrink_factors, args.smoothing_sigmas, args.silent
+        args.moving_is_downsampled_atlas, args.silent, instrumentation
     )
-    # do the registration
-    displacement_field, metric_history = multiscale_demons(
-        fixed_image, moving_image, args.demons_type, args.max_iterations,
-        demons_displacement_field_smooth_std=args.displacement_smoothing_std,
-        demons_update_field_smooth_std=args.update_smoothing_std,
-        initial_transform=None,
-        multiscale_progression=multiscale_progression,
-        silent=args.silent
+    fixed_mask, moving_mask = read_and_downsample_masks(
+        args.fixed_mask, args.moving_mask, fixed_image, moving_image, args.silent, instrumentation
     )
-    # add the initial transform and the demons transform together
-    displacement_field = add_initial_transform_to_displacement_field(
-        displacement_field, initial_transform, args.silent
+    check_image_size_and_shrink_factors(fixed_image, moving_image, args.shrink_factors, args.silent)
+    displacement_field, metric_history = register_images(
+        args, fixed_image, moving_image, fixed_mask=fixed_mask, moving_mask=moving_mask,
+        instrumentation=instrumentation
     )
     # write the displacement transform or field
-    write_transform_or_field(args.output, displacement_field, args.silent)
+    with timed(instrumentation, "write"):
+        write_transform_or_field(args.output, displacement_field, args.silent)
     # save the metric history
     write_metrics_to_csv(output_metric_csv, metric_history, args.silent)
     # optionally, create a plot of the metric history and save it
@@ -88,6 +183,8 @@ def demons_registration(args: Namespace):
             args.visualization_grid_sigma,
             args.silent
         )
+    # save the per-level timings and counters next to the metric history
+    instrumentation.write(output_instrumentation_json, args.silent)
 
 
 def create_parser() -> ArgumentParser:
@@ -123,6 +220,23 @@ def create_parser() -> ArgumentParser:
         help="enable this flag if the moving image is an atlas that is already downsampled and does not need to be "
              "downsampled further."
     )
+    parser.add_argument(
+        "--fixed-mask", "-fm", default=None, type=create_file_extension_checker(INPUT_EXTENSIONS, "fixed_mask"),
+        metavar="FN",
+        help=f"a mask in the fixed image frame ({', '.join(INPUT_EXTENSIONS)}). Any nonzero voxel is inside the mask. "
+             f"It is downsampled along with the fixed image. The demons filters have no metric mask, so this masks "
+             f"the image itself: the fixed image is set to the background value outside of the mask. The edge this "
+             f"creates at the mask boundary also drives the deformation, and centering initialization is computed "
+             f"from the masked image. A fixed image pyramid cached with `--pyramid-cache-directory` is of the "
+             f"masked image."
+    )
+    parser.add_argument(
+        "--moving-mask", "-mm", default=None, type=create_file_extension_checker(INPUT_EXTENSIONS, "moving_mask"),
+        metavar="FN",
+        help=f"a mask in the moving image frame ({', '.join(INPUT_EXTENSIONS)}). Any nonzero voxel is inside the "
+             f"mask. It is downsampled along with the moving image. Like the fixed mask, this masks the image "
+             f"itself: the moving image is set to the background value outside of the mask."
+    )
     parser.add_argument(
         "--downsampling-shrink-factor", "-dsf", type=float, default=None, metavar="X",
         help="the shrink factor to apply to the fixed and moving image before starting the registration"
@@ -143,6 +257,14 @@ def create_parser() -> ArgumentParser:
         help="if no initial transform provided, the centering initialization to use. "
              "options: `Geometry`, `Moments`"
     )
+    parser.add_argument(
+        "--exclude-initial-transform", "-eit", default=False, action="store_true",
+        help="enable this flag to write only the displacement field found by the demons registration. by default the "
+             "initial transform (or centering initialization) is added into the field, so the field can be applied "
+             "on its own but must not be chained after the initial transform in blRegistrationApplyTransform, which "
+             "would apply the initial transform twice. with this flag, apply the initial transform followed by "
+             "the field"
+    )
     parser.add_argument(
         "--demons-type", "-dt", default="demons", type=demons_type_checker, metavar="STR",
         help=f"type of demons algorithm to use. options: {list(DEMONS_FILTERS.keys())}"
@@ -171,6 +293,25 @@ def create_parser() -> ArgumentParser:
         help="sigmas for the Gaussians used to smooth the fixed and moving image at each stage of the multiscale "
              "progression. you must give the same number of arguments here as you do for `shrink-factors`"
     )
+    parser.add_argument(
+        "--pyramid-cache-directory", "-pcd", default=None, type=str, metavar="DIR",
+        help="directory to cache the smoothed and downsampled levels of the fixed image in. the levels are named "
+             "after a hash of the fixed image, so later registrations to the same fixed image (e.g. an atlas) read "
+             "them instead of computing them again"
+    )
+    parser.add_argument(
+        "--incremental-pyramid", "-ip", default=False, action="store_true",
+        help="enable this flag to compute each level of the multiscale progression of the fixed image from a finer, "
+             "less smoothed level instead of from the full resolution image. this is faster but the levels are not "
+             "identical. the levels of the moving image are always computed from the full resolution image"
+    )
+    parser.add_argument(
+        "--float32-displacement-field", "-f32", default=False, action="store_true",
+        help="enable this flag to keep the displacement field in single precision between the stages of the "
+             "multiscale progression, only promoting it to double precision inside the Demons filters, and to write "
+             "it in single precision. this halves the memory used by the fields. transforms (.hdf, .mat) are always "
+             "written in double precision"
+    )
     parser.add_argument(
         "--plot-metric-history", "-pmh", default=False, action="store_true",
         help="enable this flag to save a plot of the metric history to file in addition to the raw data"
@@ -9,6 +9,7 @@ import os
 import numpy as np
 from datetime import datetime
 from skimage.morphology import remove_small_objects
+from typing import List, Optional, Tuple
 
 # internal imports
 from bonelab.util.registration_util import message_s
@@ -16,25 +17,24 @@ from bonelab.util.echo_arguments import echo_arguments
 from bonelab.util.registration_util import create_file_extension_checker
 from bonelab.util.vtk_util import vtkImageData_to_numpy, numpy_to_vtkImageData
 from bonelab.util.aim_calibration_header import get_aim_density_equation
+from bonelab.util.laplace_hamming import laplace_hamming_filter, LaplaceHammingKernelCache
 from bonelab.io.vtk_helpers import handle_filetype_writing_special_cases
 
 
-def compute_fft_laplace_hamming_segmentation(
+def compute_fft_laplace_hamming_image(
         image: np.ndarray,
         laplace_epsilon: float,
         hamming_a0: float,
         voxel_spacing: float,
-        threshold: float,
-        min_size: int,
         silent: bool
 ) -> np.ndarray:
     """
-    Compute the FFT Laplace Hamming segmentation of an image.
+    Compute the FFT Laplace Hamming filtered image with full complex FFTs and meshgrids in double precision.
 
     Parameters
     ----------
     image : np.ndarray
-        The image to segment.
+        The image to filter.
 
     laplace_epsilon : float
         The epsilon value to use to combine the original image and the laplace image.
@@ -45,19 +45,13 @@ def compute_fft_laplace_hamming_segmentation(
     voxel_spacing : float
         The voxel spacing of the image.
 
-    threshold : float
-        The threshold to use for the segmentation.
-
-    min_size : int
-        The minimum size of the objects to keep.
-
     silent : bool
         Whether or not to print messages.
 
     Returns
     -------
     np.ndarray
-        The segmented image.
+        The filtered image.
     """
     message_s("Construct mesh grids for spatial and frequency domains...", silent)
     x, y, z = np.meshgrid(
@@ -75,31 +69,173 @@ def compute_fft_laplace_hamming_segmentation(
             * (hamming_a0 - (1 - hamming_a0) * np.cos(2 * np.pi * z))
     )
     message_s("Compute the FFT Laplace-Hamming filter...", silent)
-    laplace_hamming = laplace_epsilon * np.real(np.fft.ifftn(np.fft.ifftshift(
+    return laplace_epsilon * np.real(np.fft.ifftn(np.fft.ifftshift(
         hamming * (vx ** 2 + vy ** 2 + vz ** 2) * np.fft.fftshift(np.fft.fftn(image))
     ))) + (1 - laplace_epsilon) * image
+
+
+def compute_fft_laplace_hamming_segmentation(
+        image: np.ndarray,
+        laplace_epsilon: float,
+        hamming_a0: float,
+        voxel_spacing: float,
+        threshold: float,
+        min_size: int,
+        silent: bool,
+        filter_method: str = "rfft",
+        workers: int = -1,
+        kernel_cache: Optional[LaplaceHammingKernelCache] = None
+) -> np.ndarray:
+    """
+    Compute the FFT Laplace Hamming segmentation of an image.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The image to segment.
+
+    laplace_epsilon : float
+        The epsilon value to use to combine the original image and the laplace image.
+
+    hamming_a0 : float
+        The a0 value to use for the hamming window.
+
+    voxel_spacing : float
+        The voxel spacing of the image.
+
+    threshold : float
+        The threshold to use for the segmentation.
+
+    min_size : int
+        The minimum size of the objects to keep.
+
+    silent : bool
+        Whether or not to print messages.
+
+    filter_method : str
+        How to compute the filter. `rfft` uses real-input FFTs in single precision with a kernel built from 1D
+        vectors (see `bonelab.util.laplace_hamming`), `fftn` uses full complex FFTs and meshgrids in double precision.
+
+    workers : int
+        The number of threads the `rfft` method may use for the FFTs. Negative values count back from the number of
+        CPUs.
+
+    kernel_cache : Optional[LaplaceHammingKernelCache]
+        A cache to get the `rfft` kernel from, so it is only built once for images of the same shape. If `None`, the
+        kernel is built from scratch.
+
+    Returns
+    -------
+    np.ndarray
+        The segmented image.
+    """
+    if filter_method == "rfft":
+        message_s("Compute the FFT Laplace-Hamming filter with real-input FFTs...", silent)
+        laplace_hamming = laplace_hamming_filter(
+            image, laplace_epsilon, hamming_a0, voxel_spacing, workers, kernel_cache=kernel_cache
+        )
+    elif filter_method == "fftn":
+        laplace_hamming = compute_fft_laplace_hamming_image(image, laplace_epsilon, hamming_a0, voxel_spacing, silent)
+    else:
+        raise ValueError(f"`filter_method` must be one of `rfft` or `fftn`, received {filter_method}.")
     message_s("Segment and remove small objects from segmentation...", silent)
     return remove_small_objects(laplace_hamming > threshold, min_size=min_size)
 
 
-def fft_laplace_hamming(args: Namespace) -> None:
-    print(echo_arguments("FFT Laplace-Hamming", vars(args)))
-    if not os.path.exists(args.input):
-        raise FileNotFoundError(f"Input file {args.input} does not exist.")
-    if os.path.exists(args.output) and not args.overwrite:
-        raise FileExistsError(f"Output file {args.output} already exists. Use the --overwrite flag to overwrite.")
-    message_s(f"Reading input image from {args.input}", args.silent)
+def get_batch_output_filename(input_fn: str, output_directory: str, suffix: str) -> str:
+    """
+    Get the output filename for an input in multi-file mode.
+
+    Parameters
+    ----------
+    input_fn : str
+        The input filename.
+
+    output_directory : str
+        The directory to write outputs to.
+
+    suffix : str
+        The suffix to add to the input basename, before the extension.
+
+    Returns
+    -------
+    str
+        The output filename.
+    """
+    basename = os.path.basename(input_fn)
+    if basename.lower().endswith(".nii.gz"):
+        stem, ext = basename[:-len(".nii.gz")], basename[-len(".nii.gz"):]
+    else:
+        stem, ext = os.path.splitext(basename)
+    return os.path.join(output_directory, f"{stem}{suffix}{ext}")
+
+
+def get_input_output_pairs(inputs: List[str], output: str, suffix: str) -> List[Tuple[str, str]]:
+    """
+    Pair up the inputs with their outputs. With one input, `output` is the output filename. With several inputs,
+    `output` is the directory to write the outputs to.
+
+    Parameters
+    ----------
+    inputs : List[str]
+        The input filenames.
+
+    output : str
+        The output filename or directory.
+
+    suffix : str
+        The suffix to add to the input basenames in multi-file mode.
+
+    Returns
+    -------
+    List[Tuple[str, str]]
+        The (input, output) filename pairs.
+    """
+    if len(inputs) == 1:
+        return [(inputs[0], output)]
+    if os.path.exists(output) and not os.path.isdir(output):
+        raise NotADirectoryError(f"With multiple inputs the output must be a directory, but {output} is a file.")
+    pairs = [(fn, get_batch_output_filename(fn, output, suffix)) for fn in inputs]
+    outputs = [o for _, o in pairs]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError("Multiple inputs would be written to the same output file, check the input basenames.")
+    return pairs
+
+
+def segment_file(input_fn: str, output_fn: str, args: Namespace, kernel_cache: LaplaceHammingKernelCache) -> None:
+    """
+    Read an image, segment it with the FFT Laplace-Hamming filter, and write the segmentation.
+
+    Parameters
+    ----------
+    input_fn : str
+        The input image filename.
+
+    output_fn : str
+        The output segmentation filename.
+
+    args : Namespace
+        The parsed command line arguments.
+
+    kernel_cache : LaplaceHammingKernelCache
+        The kernel cache shared by all inputs.
+
+    Returns
+    -------
+    None
+    """
+    message_s(f"Reading input image from {input_fn}", args.silent)
     if args.aims:
         reader = vtkboneAIMReader()
         reader.DataOnCellsOff()
-        reader.SetFileName(args.input)
+        reader.SetFileName(input_fn)
         reader.Update()
         image = vtkImageData_to_numpy(reader.GetOutput())
         if args.convert_to_density:
             m, b = get_aim_density_equation(reader.GetProcessingLog())
             image = m * image + b
     else:
-        image_sitk = sitk.ReadImage(args.input)
+        image_sitk = sitk.ReadImage(input_fn)
         image = sitk.GetArrayFromImage(image_sitk)
     segmentation = compute_fft_laplace_hamming_segmentation(
         image,
@@ -108,9 +244,12 @@ def fft_laplace_hamming(args: Namespace) -> None:
         args.voxel_spacing,
         args.threshold,
         args.min_size,
-        args.silent
+        args.silent,
+        args.filter_method,
+        args.workers,
+        kernel_cache
     )
-    message_s(f"Writing bone segmentation to {args.output}", args.silent)
+    message_s(f"Writing bone segmentation to {output_fn}", args.silent)
     if args.aims:
         segmentation_vtk = numpy_to_vtkImageData(
             127 * (segmentation > 0),
@@ -129,12 +268,31 @@ def fft_laplace_hamming(args: Namespace) -> None:
             writer,
             processing_log=processing_log
         )
-        writer.SetFileName(args.output)
+        writer.SetFileName(output_fn)
         writer.Update()
     else:
-        segmentation_sitk = sitk.GetImageFromArray(segmentation)
+        segmentation_sitk = sitk.GetImageFromArray(segmentation.astype(int))
         segmentation_sitk.CopyInformation(image_sitk)
-        sitk.WriteImage(segmentation_sitk, args.output)
+        sitk.WriteImage(segmentation_sitk, output_fn)
+
+
+def fft_laplace_hamming(args: Namespace) -> None:
+    print(echo_arguments("FFT Laplace-Hamming", vars(args)))
+    pairs = get_input_output_pairs(args.input, args.output, args.output_suffix)
+    for input_fn, output_fn in pairs:
+        if not os.path.exists(input_fn):
+            raise FileNotFoundError(f"Input file {input_fn} does not exist.")
+        if os.path.exists(output_fn) and not args.overwrite:
+            raise FileExistsError(f"Output file {output_fn} already exists. Use the --overwrite flag to overwrite.")
+    if len(pairs) > 1:
+        os.makedirs(args.output, exist_ok=True)
+    # the kernel (and scipy's FFT plan) only depend on the image shape and the filter parameters,
+    # so they are reused for every input with the same shape
+    kernel_cache = LaplaceHammingKernelCache(args.kernel_cache_directory)
+    for i, (input_fn, output_fn) in enumerate(pairs):
+        if len(pairs) > 1:
+            message_s(f"Processing input {i + 1} of {len(pairs)}", args.silent)
+        segment_file(input_fn, output_fn, args, kernel_cache)
 
 
 def create_parser() -> ArgumentParser:
@@ -151,12 +309,29 @@ def create_parser() -> ArgumentParser:
     parser.add_argument(
         "input",
         type=str,
-        help="Input image filename to be segmented."
+        nargs="+",
+        help="Input image filename(s) to be segmented. If more than one is given, the filter kernel and FFT plan "
+             "are reused across inputs of the same shape."
     )
     parser.add_argument(
         "output",
         type=str,
-        help="Output filename for the segmentation."
+        help="Output filename for the segmentation. If more than one input is given, this is the directory to write "
+             "the segmentations to, named after the inputs with `--output-suffix` added."
+    )
+    parser.add_argument(
+        "--output-suffix", "-os",
+        type=str,
+        default="_seg",
+        help="Suffix added to the input basenames to name the outputs when more than one input is given."
+    )
+    parser.add_argument(
+        "--kernel-cache-directory", "-kcd",
+        type=str,
+        default=None,
+        help="Directory to store the `rfft` filter kernels in as .npy files, so later runs on images with the same "
+             "shape and filter parameters can load them instead of building them. If not given, kernels are only "
+             "cached in memory for the duration of the run."
     )
     parser.add_argument(
         "--aims",
@@ -203,6 +378,22 @@ def create_parser() -> ArgumentParser:
         default=64,
         help="The minimum size of the objects to keep."
     )
+    parser.add_argument(
+        "--filter-method", "-fm",
+        type=str,
+        default="rfft",
+        choices=["rfft", "fftn"],
+        help="How to compute the filter. `rfft` uses real-input FFTs in single precision with the filter built from "
+             "1D vectors, which needs roughly a fifth of the memory of `fftn`. `fftn` uses full complex FFTs and "
+             "meshgrids in double precision. The two agree to within single precision round-off."
+    )
+    parser.add_argument(
+        "--workers", "-w",
+        type=int,
+        default=-1,
+        help="Number of threads to use for the FFTs with the `rfft` filter method. Negative values count back from "
+             "the number of CPUs, so -1 uses all of them."
+    )
     parser.add_argument(
         "--convert-to-density", "-cd",
         default=False,
@@ -1,18 +1,284 @@
 from __future__ import annotations
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
+from concurrent.futures import ProcessPoolExecutor
 import os
+from typing import Dict, List, Optional, Tuple, Union
 
 import SimpleITK as sitk
 
 from bonelab.util.registration_util import (
     create_file_extension_checker, create_string_argument_checker, INTERPOLATORS,
     INPUT_EXTENSIONS, TRANSFORM_EXTENSIONS, check_percentage, get_output_base, write_args_to_yaml, check_inputs_exist,
-    check_for_output_overwrite, write_metrics_to_csv, create_and_save_metrics_plot, read_and_downsample_image,
-    setup_optimizer, setup_similarity_metric, setup_interpolator, setup_transform, setup_multiscale_progression,
+    check_for_output_overwrite, write_metrics_to_csv, create_and_save_metrics_plot, read_image, downsample_image,
+    read_mask, resample_mask_to_image, setup_optimizer, setup_similarity_metric, setup_metric_masks,
+    setup_interpolator, setup_transform, setup_multiscale_progression, setup_instrumentation,
     check_image_size_and_shrink_factors, message_s, MetricTrackingCallback, write_metrics_to_csv
 )
 from bonelab.util.echo_arguments import echo_arguments
+from bonelab.util.registration_instrumentation import RegistrationInstrumentation
+
+
+# the baseline image and metric mask of a worker process, set once by `_init_worker` and only ever read
+_BASELINE_IMAGE = None
+_BASELINE_MASK = None
+
+
+def _init_worker(baseline_image: sitk.Image, baseline_mask: Optional[sitk.Image], threads: int) -> None:
+    global _BASELINE_IMAGE, _BASELINE_MASK
+    _BASELINE_IMAGE = baseline_image
+    _BASELINE_MASK = baseline_mask
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+
+
+def create_registration_method(args: Namespace) -> Tuple[sitk.ImageRegistrationMethod, MetricTrackingCallback]:
+    """
+    Create a registration method, without an initial transform, and a callback tracking its metric.
+
+    Parameters
+    ----------
+    args : Namespace
+        The parsed command line arguments.
+
+    Returns
+    -------
+    Tuple[sitk.ImageRegistrationMethod, MetricTrackingCallback]
+        The registration method and the metric tracking callback added to it.
+    """
+    registration_method = sitk.ImageRegistrationMethod()
+    registration_method = setup_optimizer(
+        registration_method,
+        args.max_iterations,
+        args.gradient_descent_learning_rate,
+        args.gradient_descent_convergence_min_value,
+        args.gradient_descent_convergence_window_size,
+        args.powell_max_line_iterations,
+        args.powell_step_length,
+        args.powell_step_tolerance,
+        args.powell_value_tolerance,
+        args.optimizer,
+        args.silent
+    )
+    registration_method = setup_similarity_metric(
+        registration_method,
+        args.similarity_metric,
+        args.mutual_information_num_histogram_bins,
+        args.joint_mutual_information_joint_smoothing_variance,
+        args.similarity_metric_sampling_strategy,
+        args.similarity_metric_sampling_rate,
+        args.similarity_metric_sampling_seed,
+        args.silent
+    )
+    registration_method = setup_interpolator(registration_method, args.interpolator, args.silent)
+    registration_method = setup_multiscale_progression(
+        registration_method,
+        args.shrink_factors, args.smoothing_sigmas,
+        args.silent
+    )
+    metric_callback = MetricTrackingCallback(registration_method, args.silent)
+    registration_method.AddCommand(sitk.sitkIterationEvent, metric_callback)
+    return registration_method, metric_callback
+
+
+def register_follow_up(
+        args: Namespace,
+        i: int,
+        follow_up_image_fn: str,
+        transform_fn: str,
+        metrics_csv_fn: str,
+        metrics_plot_fn: str,
+        common_region_grid: Tuple,
+        follow_up_mask_fn: Optional[str] = None,
+        instrumentation_fn: Optional[str] = None,
+        baseline_image: Optional[sitk.Image] = None,
+        baseline_mask: Optional[sitk.Image] = None
+) -> Tuple[sitk.Transform, sitk.Image, Tuple]:
+    """
+    Register one follow-up image to the baseline image, write the transform and metric history, and find the region
+    of the baseline frame covered by the follow-up image.
+
+    Parameters
+    ----------
+    args : Namespace
+        The parsed command line arguments.
+
+    i : int
+        The index of the follow-up, for terminal output.
+
+    follow_up_image_fn : str
+        The follow-up image filename.
+
+    transform_fn : str
+        The filename to write the transform to.
+
+    metrics_csv_fn : str
+        The filename to write the metric history to.
+
+    metrics_plot_fn : str
+        The filename to write the metric history plot to, if `args.plot_metric_history` is set.
+
+    common_region_grid : Tuple
+        The size, origin, spacing and direction of the full resolution baseline image.
+
+    follow_up_mask_fn : Optional[str]
+        The filename of a mask in the follow-up frame to restrict the similarity metric to, if any.
+
+    instrumentation_fn : Optional[str]
+        The filename to write the per-level timings and counters of the registration to, if any.
+
+    baseline_image : Optional[sitk.Image]
+        The (possibly downsampled) baseline image. If `None`, the baseline image and mask of the worker process are
+        used.
+
+    baseline_mask : Optional[sitk.Image]
+        The mask on the grid of `baseline_image` to restrict the similarity metric to, if any.
+
+    Returns
+    -------
+    Tuple[sitk.Transform, sitk.Image, Tuple]
+        The transform, the mask of the follow-up image field of view in the frame of the baseline image, and the
+        size, origin, spacing and direction of the full resolution follow-up image.
+    """
+    if baseline_image is None:
+        baseline_image = _BASELINE_IMAGE
+        baseline_mask = _BASELINE_MASK
+    instrumentation = RegistrationInstrumentation()
+    # each follow-up gets its own registration method, so that follow-ups can be registered concurrently
+    registration_method, metric_callback = create_registration_method(args)
+    registration_method = setup_instrumentation(
+        registration_method, instrumentation,
+        args.shrink_factors, args.smoothing_sigmas, args.optimizer,
+        args.silent
+    )
+    message_s(f"Processing follow-up {i}", args.silent)
+    # read the follow-up once, the registration uses a downsampled copy and the rest only needs the full resolution grid
+    with instrumentation.timer("read"):
+        follow_up_image_full_res = read_image(follow_up_image_fn, f"follow-up {i}", args.silent)
+    follow_up_grid = get_grid(follow_up_image_full_res)
+    follow_up_image = downsample_image(
+        follow_up_image_full_res,
+        args.downsampling_shrink_factor, args.downsampling_smoothing_sigma,
+        args.silent, instrumentation
+    )
+    del follow_up_image_full_res
+    follow_up_mask = None
+    if follow_up_mask_fn is not None:
+        with instrumentation.timer("read_masks"):
+            follow_up_mask = read_mask(follow_up_mask_fn, f"follow-up {i} mask", args.silent)
+        with instrumentation.timer("resample_masks"):
+            follow_up_mask = resample_mask_to_image(follow_up_mask, follow_up_image, args.silent)
+    registration_method = setup_metric_masks(registration_method, baseline_mask, follow_up_mask, args.silent)
+    check_image_size_and_shrink_factors(
+        baseline_image, follow_up_image,
+        args.shrink_factors, args.silent
+    )
+    registration_method = setup_transform(
+        registration_method,
+        baseline_image, follow_up_image,
+        args.transform_type, args.centering_initialization,
+        args.silent
+    )  # hard code to always use rigid transformation for longitudinal registration
+    message_s("Starting registration", args.silent)
+    with instrumentation.timer("registration"):
+        transform = registration_method.Execute(baseline_image, follow_up_image)
+    message_s(
+        f"Registration stopping condition: {registration_method.GetOptimizerStopConditionDescription()}",
+        args.silent
+    )
+    message_s(f"Writing transformation to {transform_fn}", args.silent)
+    with instrumentation.timer("write"):
+        sitk.WriteTransform(transform, transform_fn)
+    write_metrics_to_csv(metrics_csv_fn, metric_callback.metric_history, args.silent)
+    if args.plot_metric_history:
+        create_and_save_metrics_plot(metrics_plot_fn, metric_callback.metric_history, args.silent)
+    message_s("Transforming follow-up image to baseline space to update common region", args.silent)
+    size, origin, spacing, direction = follow_up_grid
+    follow_up_region = sitk.Add(sitk.Image(*size, sitk.sitkUInt8), 1)
+    follow_up_region.SetOrigin(origin)
+    follow_up_region.SetSpacing(spacing)
+    follow_up_region.SetDirection(direction)
+    size, origin, spacing, direction = common_region_grid
+    with instrumentation.timer("common_region"):
+        follow_up_region = sitk.Resample(
+            follow_up_region,
+            size,
+            transform,
+            sitk.sitkNearestNeighbor,
+            origin,
+            spacing,
+            direction
+        )
+    if instrumentation_fn is not None:
+        instrumentation.write(instrumentation_fn, args.silent)
+    return transform, follow_up_region, follow_up_grid
+
+
+def get_grid(image: sitk.Image) -> Tuple:
+    """
+    Get the voxel grid of an image, to resample onto it without keeping the image.
+
+    Parameters
+    ----------
+    image : sitk.Image
+        The image.
+
+    Returns
+    -------
+    Tuple
+        The size, origin, spacing and direction of the image.
+    """
+    return image.GetSize(), image.GetOrigin(), image.GetSpacing(), image.GetDirection()
+
+
+def propagate_masks(
+        masks: List[Union[sitk.Image, str]],
+        transform: sitk.Transform,
+        follow_up_grid: Tuple,
+        output_mask_fns: List[str],
+        silent: bool
+) -> None:
+    """
+    Transform baseline masks to the frame of one follow-up image and write them.
+
+    Masks with the same pixel type are stacked as the components of one vector image, so that they are all resampled
+    in a single pass, mapping each follow-up voxel through the inverse transform only once.
+
+    Parameters
+    ----------
+    masks : List[Union[sitk.Image, str]]
+        The baseline masks, already intersected with the common region, or the filenames they were written to. Worker
+        processes are given the filenames and read the masks themselves, instead of being sent every mask.
+
+    transform : sitk.Transform
+        The transform from the baseline to the follow-up frame found by the registration.
+
+    follow_up_grid : Tuple
+        The size, origin, spacing and direction of the full resolution follow-up image.
+
+    output_mask_fns : List[str]
+        The filename to write each transformed mask to.
+
+    silent : bool
+        Whether or not to silence the output.
+
+    Returns
+    -------
+    None
+    """
+    size, origin, spacing, direction = follow_up_grid
+    inverse = transform.GetInverse()
+    masks = [sitk.ReadImage(mask) if isinstance(mask, str) else mask for mask in masks]
+    groups: Dict[int, List[int]] = {}
+    for j, mask in enumerate(masks):
+        groups.setdefault(mask.GetPixelID(), []).append(j)
+    for indices in groups.values():
+        message_s(f"Transforming {len(indices)} baseline mask(s) to follow-up frame", silent)
+        stacked = masks[indices[0]] if len(indices) == 1 else sitk.Compose([masks[j] for j in indices])
+        stacked = sitk.Resample(stacked, size, inverse, sitk.sitkNearestNeighbor, origin, spacing, direction)
+        for component, j in enumerate(indices):
+            mask_transformed = stacked if len(indices) == 1 else sitk.VectorIndexSelectionCast(stacked, component)
+            message_s(f"Writing transformed baseline mask to {output_mask_fns[j]}", silent)
+            sitk.WriteImage(mask_transformed, output_mask_fns[j])
 
 
 def longitudinal_registration(args: Namespace):
@@ -42,7 +308,15 @@ def longitudinal_registration(args: Namespace):
                 f"The number of baseline masks ({len(args.baseline_masks)}) does not match the number of baseline "
                 f"mask labels ({len(args.baseline_mask_labels)})."
             )
-    check_inputs_exist([args.baseline_image] + args.follow_up_images, args.silent)
+    if args.moving_mask is not None:
+        if len(args.moving_mask) != len(args.follow_up_images):
+            raise ValueError(
+                f"The number of moving masks ({len(args.moving_mask)}) does not match the number of follow up "
+                f"images ({len(args.follow_up_images)})."
+            )
+    check_inputs_exist(
+        [args.baseline_image, args.fixed_mask] + args.follow_up_images + (args.moving_mask or []), args.silent
+    )
     output_common_region_fn = os.path.join(args.output_directory, f"{args.output_label}_common_region.nii.gz")
     output_transformation_fns = [
         os.path.join(args.output_directory, f"{args.output_label}_{follow_up_label}_transform.txt")
@@ -56,6 +330,10 @@ def longitudinal_registration(args: Namespace):
         os.path.join(args.output_directory, f"{args.output_label}_{follow_up_label}_metrics.png")
         for follow_up_label in args.follow_up_labels
     ]
+    output_instrumentation_fns = [
+        os.path.join(args.output_directory, f"{args.output_label}_{follow_up_label}_instrumentation.json")
+        for follow_up_label in args.follow_up_labels
+    ]
     if args.baseline_masks is not None:
         output_baseline_mask_fns = [
             os.path.join(
@@ -86,135 +364,103 @@ def longitudinal_registration(args: Namespace):
             + [j for i in output_followup_mask_fn_lists for j in i]
             + output_baseline_mask_fns
             + output_metrics_csv_fns
+            + output_instrumentation_fns
             + (output_metrics_plots_fns if args.plot_metric_history else [])
         ),
         args.overwrite, args.silent
     )
     write_args_to_yaml(output_yaml_fn, args, args.silent)
-    baseline_image = read_and_downsample_image(
-        args.baseline_image, "baseline",
-        args.downsampling_shrink_factor, args.downsampling_smoothing_sigma,
-        args.silent
-    )
-    message_s("Read baseline image at full resolution to use as base for common region image", args.silent)
-    baseline_image_full_res = sitk.ReadImage(args.baseline_image)
+    # read the baseline once, the registration uses a downsampled copy and the common region is on the full grid
+    baseline_image_full_res = read_image(args.baseline_image, "baseline", args.silent)
+    common_region_grid = get_grid(baseline_image_full_res)
     common_region = sitk.Add(sitk.Image(*baseline_image_full_res.GetSize(), sitk.sitkUInt8), 1)
     common_region.CopyInformation(baseline_image_full_res)
-    registration_method = sitk.ImageRegistrationMethod()
-    registration_method = setup_optimizer(
-        registration_method,
-        args.max_iterations,
-        args.gradient_descent_learning_rate,
-        args.gradient_descent_convergence_min_value,
-        args.gradient_descent_convergence_window_size,
-        args.powell_max_line_iterations,
-        args.powell_step_length,
-        args.powell_step_tolerance,
-        args.powell_value_tolerance,
-        args.optimizer,
-        args.silent
-    )
-    registration_method = setup_similarity_metric(
-        registration_method,
-        args.similarity_metric,
-        args.mutual_information_num_histogram_bins,
-        args.joint_mutual_information_joint_smoothing_variance,
-        args.similarity_metric_sampling_strategy,
-        args.similarity_metric_sampling_rate,
-        args.similarity_metric_sampling_seed,
-        args.silent
-    )
-    registration_method = setup_interpolator(registration_method, args.interpolator, args.silent)
-    registration_method = setup_multiscale_progression(
-        registration_method,
-        args.shrink_factors, args.smoothing_sigmas,
+    baseline_image = downsample_image(
+        baseline_image_full_res,
+        args.downsampling_shrink_factor, args.downsampling_smoothing_sigma,
         args.silent
     )
-    metric_callback = MetricTrackingCallback(registration_method, args.silent)
-    registration_method.AddCommand(sitk.sitkIterationEvent, metric_callback)
-
-    transforms = []
-
-    for i, (follow_up_image_fn, transform_fn, metrics_csv_fn, metrics_plot_fn) in \
-            enumerate(zip(
-                args.follow_up_images,
-                output_transformation_fns,
-                output_metrics_csv_fns,
-                output_metrics_plots_fns
-            )):
-        message_s(f"Processing follow-up {i}", args.silent)
-        follow_up_image = read_and_downsample_image(
-            follow_up_image_fn, f"follow-up {i}",
-            args.downsampling_shrink_factor, args.downsampling_smoothing_sigma,
-            args.silent
+    del baseline_image_full_res
+    baseline_mask = None
+    if args.fixed_mask is not None:
+        baseline_mask = resample_mask_to_image(
+            read_mask(args.fixed_mask, "baseline mask", args.silent), baseline_image, args.silent
         )
-        check_image_size_and_shrink_factors(
-            baseline_image, follow_up_image,
-            args.shrink_factors, args.silent
-        )
-        registration_method = setup_transform(
-            registration_method,
-            baseline_image, follow_up_image,
-            args.transform_type, args.centering_initialization,
-            args.silent
-        )  # hard code to always use rigid transformation for longitudinal registration
-        message_s("Starting registration", args.silent)
-        transform = registration_method.Execute(baseline_image, follow_up_image)
-        message_s(
-            f"Registration stopping condition: {registration_method.GetOptimizerStopConditionDescription()}",
-            args.silent
+
+    jobs = [
+        (
+            args, i, follow_up_image_fn, transform_fn, metrics_csv_fn, metrics_plot_fn, common_region_grid,
+            follow_up_mask_fn, instrumentation_fn
         )
-        transforms.append(transform)
-        message_s(f"Writing transformation to {transform_fn}", args.silent)
-        sitk.WriteTransform(transform, transform_fn)
-        write_metrics_to_csv(metrics_csv_fn, metric_callback.metric_history, args.silent)
-        if args.plot_metric_history:
-            create_and_save_metrics_plot(metrics_plot_fn, metric_callback.metric_history, args.silent)
-        message_s("Reading follow-up image at full resolution to update common region", args.silent)
-        follow_up_image_full_res = sitk.ReadImage(follow_up_image_fn)
-        message_s("Transforming follow-up image to baseline space to update common region", args.silent)
-        follow_up_region = sitk.Add(sitk.Image(*follow_up_image_full_res.GetSize(), sitk.sitkUInt8), 1)
-        follow_up_region.CopyInformation(follow_up_image_full_res)
-        common_region = sitk.Multiply(
-            common_region,
-            sitk.Resample(
-                follow_up_region,
-                common_region,
-                transform,
-                sitk.sitkNearestNeighbor
-            )
+        for i, (follow_up_image_fn, transform_fn, metrics_csv_fn, metrics_plot_fn, follow_up_mask_fn,
+                instrumentation_fn) in
+        enumerate(zip(
+            args.follow_up_images,
+            output_transformation_fns,
+            output_metrics_csv_fns,
+            output_metrics_plots_fns,
+            args.moving_mask or [None] * len(args.follow_up_images),
+            output_instrumentation_fns
+        ))
+    ]
+    workers = max(1, min(args.workers, len(jobs)))
+    executor = None
+    if workers > 1:
+        # share the cores between the workers, each gets its own copy of the baseline image once
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        message_s(f"Registering {len(jobs)} follow-ups with {workers} workers, {threads} thread(s) each", args.silent)
+        executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(baseline_image, baseline_mask, threads)
         )
-        metric_callback.reset()
+    try:
+        if executor is not None:
+            futures = [executor.submit(register_follow_up, *job) for job in jobs]
+            results = [future.result() for future in futures]
+        else:
+            results = [
+                register_follow_up(*job, baseline_image=baseline_image, baseline_mask=baseline_mask) for job in jobs
+            ]
 
-    common_region.CopyInformation(baseline_image_full_res)
-    message_s(f"Writing common region to {output_common_region_fn}", args.silent)
-    sitk.WriteImage(common_region, output_common_region_fn)
+        # merge in the order of the follow-ups, whatever order they finished in
+        for _, follow_up_region, _ in results:
+            follow_up_region.CopyInformation(common_region)
+            common_region = sitk.Multiply(common_region, follow_up_region)
 
-    if args.baseline_masks is not None:
-        message_s("Transforming baseline masks to follow-up frames, using common region.", args.silent)
-        for (baseline_mask, output_followup_mask_fns, output_baseline_mask_fn) in \
-                zip(args.baseline_masks, output_followup_mask_fn_lists, output_baseline_mask_fns):
-            message_s(f"Processing {baseline_mask}", args.silent)
-            message_s("Reading baseline mask", args.silent)
-            mask = sitk.ReadImage(baseline_mask)
-            message_s("Finding intersection of baseline mask and common region", args.silent)
-            mask.CopyInformation(common_region)
-            mask = sitk.Multiply(mask, sitk.Cast(common_region, mask.GetPixelID()))
-            message_s(f"Writing intersection of baseline mask and common region mask to {output_baseline_mask_fn}", args.silent)
-            sitk.WriteImage(mask, output_baseline_mask_fn)
-            for (follow_up_image_fn, transform, output_mask_fn) in \
-                    zip(args.follow_up_images, transforms, output_followup_mask_fns):
-                message_s(f"Reading followup image {follow_up_image_fn}", args.silent)
-                follow_up_image = sitk.ReadImage(follow_up_image_fn)
-                message_s("Transforming baseline mask to follow-up frame", args.silent)
-                mask_transformed = sitk.Resample(
-                    mask, follow_up_image, transform.GetInverse(), sitk.sitkNearestNeighbor
-                )
-                message_s(f"Writing transformed baseline mask to {output_mask_fn}", args.silent)
-                sitk.WriteImage(mask_transformed, output_mask_fn)
+        message_s(f"Writing common region to {output_common_region_fn}", args.silent)
+        sitk.WriteImage(common_region, output_common_region_fn)
 
-    else:
-        message_s("No baseline masks provided, skipping baseline mask transformation.", args.silent)
+        if args.baseline_masks is not None:
+            message_s("Transforming baseline masks to follow-up frames, using common region.", args.silent)
+            masks = []
+            for (baseline_mask, output_baseline_mask_fn) in zip(args.baseline_masks, output_baseline_mask_fns):
+                message_s(f"Processing {baseline_mask}", args.silent)
+                message_s("Reading baseline mask", args.silent)
+                mask = sitk.ReadImage(baseline_mask)
+                message_s("Finding intersection of baseline mask and common region", args.silent)
+                mask.CopyInformation(common_region)
+                mask = sitk.Multiply(mask, sitk.Cast(common_region, mask.GetPixelID()))
+                message_s(f"Writing intersection of baseline mask and common region mask to {output_baseline_mask_fn}", args.silent)
+                sitk.WriteImage(mask, output_baseline_mask_fn)
+                masks.append(mask)
+            # all masks are propagated to a follow-up together, using the grid found when it was read. the workers
+            # read the masks from the files just written, rather than each job pickling all of the masks
+            job_masks = output_baseline_mask_fns if executor is not None else masks
+            mask_jobs = [
+                (job_masks, transform, follow_up_grid, [fns[i] for fns in output_followup_mask_fn_lists], args.silent)
+                for i, (transform, _, follow_up_grid) in enumerate(results)
+            ]
+            if executor is not None:
+                for future in [executor.submit(propagate_masks, *job) for job in mask_jobs]:
+                    future.result()
+            else:
+                for job in mask_jobs:
+                    propagate_masks(*job)
+
+        else:
+            message_s("No baseline masks provided, skipping baseline mask transformation.", args.silent)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
 
 def create_parser() -> ArgumentParser:
@@ -266,10 +512,28 @@ def create_parser() -> ArgumentParser:
              "label to create transformed common masks as such: "
              "{output_directory}/{output_label}_{follow-up-label}_{baseline-mask-label}.nii.gz"
     )
+    parser.add_argument(
+        "--fixed-mask", "-fm", default=None, type=create_file_extension_checker(INPUT_EXTENSIONS, "fixed_mask"),
+        metavar="FN",
+        help=f"a mask in the baseline image frame to restrict the similarity metric to ({', '.join(INPUT_EXTENSIONS)})."
+             f" Any nonzero voxel is inside the mask. It is downsampled along with the baseline image."
+    )
+    parser.add_argument(
+        "--moving-mask", "-mm", nargs="+", default=None,
+        type=create_file_extension_checker(INPUT_EXTENSIONS, "moving_mask"), metavar="FN",
+        help=f"masks in the follow-up image frames to restrict the similarity metric to "
+             f"({', '.join(INPUT_EXTENSIONS)}), one per follow-up image and in the same order. Any nonzero voxel is "
+             f"inside the mask. Each is downsampled along with its follow-up image."
+    )
     parser.add_argument(
         "--overwrite", "-ow", default=False, action="store_true",
         help="enable this flag to overwrite existing files, if they exist at output targets"
     )
+    parser.add_argument(
+        "--workers", "-w", default=1, type=int, metavar="N",
+        help="number of follow-ups to register in parallel, each in its own process. The CPUs are shared between "
+             "the workers by limiting the number of threads SimpleITK uses in each"
+    )
     parser.add_argument(
         "--downsampling-shrink-factor", "-dsf", type=float, default=None, metavar="X",
         help="the shrink factor to apply to the fixed and moving image before starting the registration"
@@ -3,13 +3,13 @@ from __future__ import annotations
 # external imports
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace, ArgumentTypeError
 import SimpleITK as sitk
-from typing import List
+from typing import List, Tuple
 import numpy as np
 
 # internal imports
 from bonelab.util.time_stamp import message
 from bonelab.util.registration_util import create_file_extension_checker, check_inputs_exist, \
-    check_for_output_overwrite, read_image, INTERPOLATORS, create_string_argument_checker
+    check_for_output_overwrite, read_image, INTERPOLATORS, create_string_argument_checker, resample_by_axis_permutation
 
 # define file extensions that we consider available for input images
 INPUT_EXTENSIONS = [".aim", ".nii", ".nii.gz"]
@@ -23,7 +23,8 @@ def get_image_center(img: sitk.Image) -> Tuple[float, ...]:
     spacing = np.asarray(img.GetSpacing())
     size = np.asarray(img.GetSize())
     direction = np.asarray(img.GetDirection()).reshape(3, 3)
-    return origin + np.matmul(direction, (spacing*size/2))
+    # the center of the voxel centers, so that mirroring maps voxel centers onto voxel centers
+    return origin + np.matmul(direction, (spacing*(size - 1)/2))
 
 
 def mirror_image(args: Namespace):
@@ -36,9 +37,15 @@ def mirror_image(args: Namespace):
     transform = sitk.AffineTransform(img.GetDimension())
     transform.SetCenter(get_image_center(img))
     transform.Scale([-1 if i == args.axis else 1 for i in range(img.GetDimension())])
-    if not args.silent:
-        message("Mirroring image")
-    mirrored = sitk.Resample(img, img, transform, INTERPOLATORS[args.interpolator])
+    # an image with an axis-aligned direction matrix is mirrored by flipping its voxels, without interpolating
+    mirrored = resample_by_axis_permutation(img, img, transform)
+    if mirrored is not None:
+        if not args.silent:
+            message("Mirroring image by flipping its voxels")
+    else:
+        if not args.silent:
+            message("Mirroring image by resampling it, since its direction matrix is not axis-aligned")
+        mirrored = sitk.Resample(img, img, transform, INTERPOLATORS[args.interpolator])
     if not args.silent:
         message(f"Writing mirrored image to {args.output}")
     sitk.WriteImage(mirrored, args.output)
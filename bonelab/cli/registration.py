@@ -3,53 +3,57 @@ from __future__ import annotations
 # external imports
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
 import SimpleITK as sitk
+from typing import List, Optional, Tuple
 
 # internal imports
 from bonelab.util.registration_util import (
     create_file_extension_checker, create_string_argument_checker, INTERPOLATORS,
     INPUT_EXTENSIONS, TRANSFORM_EXTENSIONS, check_percentage, get_output_base, write_args_to_yaml, check_inputs_exist,
     check_for_output_overwrite, write_metrics_to_csv, create_and_save_metrics_plot, read_and_downsample_images,
-    setup_optimizer, setup_similarity_metric, setup_interpolator, setup_transform, setup_multiscale_progression,
-    check_image_size_and_shrink_factors, MetricTrackingCallback
+    read_and_downsample_masks, setup_optimizer, setup_similarity_metric, setup_metric_masks, setup_interpolator,
+    setup_transform, setup_multiscale_progression, setup_instrumentation, check_image_size_and_shrink_factors,
+    MetricTrackingCallback
 )
+from bonelab.util.registration_instrumentation import RegistrationInstrumentation, timed
 from bonelab.util.time_stamp import message
 
 
-def registration(args: Namespace):
+def register_images(
+        args: Namespace,
+        fixed_image: sitk.Image,
+        moving_image: sitk.Image,
+        fixed_mask: Optional[sitk.Image] = None,
+        moving_mask: Optional[sitk.Image] = None,
+        instrumentation: Optional[RegistrationInstrumentation] = None
+) -> Tuple[sitk.Transform, List[float], str]:
     """
-    Perform a registration between two images.
+    Register two images that have already been read (and optionally downsampled), without writing anything.
 
     Parameters
     ----------
     args : Namespace
         The parsed arguments from the command line.
 
+    fixed_image : sitk.Image
+        The fixed image.
+
+    moving_image : sitk.Image
+        The moving image.
+
+    fixed_mask : Optional[sitk.Image]
+        The mask to restrict the similarity metric to, in the fixed image frame.
+
+    moving_mask : Optional[sitk.Image]
+        The mask to restrict the similarity metric to, in the moving image frame.
+
+    instrumentation : Optional[RegistrationInstrumentation]
+        If given, the levels, iterations and time of the registration are recorded in it.
+
     Returns
     -------
-    None
+    Tuple[sitk.Transform, List[float], str]
+        The transform, the metric history and the optimizer stopping condition.
     """
-    # get the base of the output, so we can construct the filenames of the auxiliary outputs
-    output_base = get_output_base(args.output, TRANSFORM_EXTENSIONS, args.silent)
-    output_yaml = f"{output_base}.yaml"
-    output_metric_csv = f"{output_base}_metric_history.csv"
-    output_metric_png = f"{output_base}_metric_history.png"
-    # check that the inputs actually exist
-    check_inputs_exist([args.fixed_image, args.moving_image], args.silent)
-    # check if we're going to overwrite some outputs
-    check_for_output_overwrite(
-        [args.output, output_yaml, output_metric_csv, output_metric_png],
-        args.overwrite, args.silent
-    )
-    # save the arguments of this registration to a yaml file
-    # this has the added benefit of ensuring up-front that we can write files to the "output" that was provided,
-    # so we do not waste a lot of time doing the registration and then crashing at the end because of write permissions
-    write_args_to_yaml(output_yaml, args, args.silent)
-    fixed_image, moving_image = read_and_downsample_images(
-        args.fixed_image, args.moving_image,
-        args.downsampling_shrink_factor, args.downsampling_smoothing_sigma,
-        args.moving_is_downsampled_atlas, args.silent
-    )
-    check_image_size_and_shrink_factors(fixed_image, moving_image, args.shrink_factors, args.silent)
     # create the object
     registration_method = sitk.ImageRegistrationMethod()
     # set it up
@@ -76,6 +80,7 @@ def registration(args: Namespace):
         args.similarity_metric_sampling_seed,
         args.silent
     )
+    registration_method = setup_metric_masks(registration_method, fixed_mask, moving_mask, args.silent)
     registration_method = setup_interpolator(registration_method, args.interpolator, args.silent)
     registration_method = setup_transform(
         registration_method,
@@ -91,21 +96,78 @@ def registration(args: Namespace):
     # monitor the metric over time - init the list and add the callback
     metric_callback = MetricTrackingCallback(registration_method, args.silent)
     registration_method.AddCommand(sitk.sitkIterationEvent, metric_callback)
+    if instrumentation is not None:
+        registration_method = setup_instrumentation(
+            registration_method, instrumentation,
+            args.shrink_factors, args.smoothing_sigmas, args.optimizer,
+            args.silent
+        )
     # do the registration
     if not args.silent:
         message("Starting registration.")
-    transform = registration_method.Execute(fixed_image, moving_image)
+    with timed(instrumentation, "registration"):
+        transform = registration_method.Execute(fixed_image, moving_image)
+    stop_condition = registration_method.GetOptimizerStopConditionDescription()
     if not args.silent:
-        message(f"Registration stopping condition: {registration_method.GetOptimizerStopConditionDescription()}")
+        message(f"Registration stopping condition: {stop_condition}")
+    return transform, metric_callback.metric_history, stop_condition
+
+
+def registration(args: Namespace):
+    """
+    Perform a registration between two images.
+
+    Parameters
+    ----------
+    args : Namespace
+        The parsed arguments from the command line.
+
+    Returns
+    -------
+    None
+    """
+    # get the base of the output, so we can construct the filenames of the auxiliary outputs
+    output_base = get_output_base(args.output, TRANSFORM_EXTENSIONS, args.silent)
+    output_yaml = f"{output_base}.yaml"
+    output_metric_csv = f"{output_base}_metric_history.csv"
+    output_metric_png = f"{output_base}_metric_history.png"
+    output_instrumentation_json = f"{output_base}_instrumentation.json"
+    # check that the inputs actually exist
+    check_inputs_exist([args.fixed_image, args.moving_image, args.fixed_mask, args.moving_mask], args.silent)
+    # check if we're going to overwrite some outputs
+    check_for_output_overwrite(
+        [args.output, output_yaml, output_metric_csv, output_metric_png, output_instrumentation_json],
+        args.overwrite, args.silent
+    )
+    instrumentation = RegistrationInstrumentation()
+    # save the arguments of this registration to a yaml file
+    # this has the added benefit of ensuring up-front that we can write files to the "output" that was provided,
+    # so we do not waste a lot of time doing the registration and then crashing at the end because of write permissions
+    write_args_to_yaml(output_yaml, args, args.silent)
+    fixed_image, moving_image = read_and_downsample_images(
+        args.fixed_image, args.moving_image,
+        args.downsampling_shrink_factor, args.downsampling_smoothing_sigma,
+        args.moving_is_downsampled_atlas, args.silent, instrumentation
+    )
+    fixed_mask, moving_mask = read_and_downsample_masks(
+        args.fixed_mask, args.moving_mask, fixed_image, moving_image, args.silent, instrumentation
+    )
+    check_image_size_and_shrink_factors(fixed_image, moving_image, args.shrink_factors, args.silent)
+    transform, metric_history, _ = register_images(
+        args, fixed_image, moving_image, fixed_mask, moving_mask, instrumentation
+    )
     # write transform to file
     if not args.silent:
         message(f"Writing transformation to {args.output}")
-    sitk.WriteTransform(transform, args.output)
+    with timed(instrumentation, "write"):
+        sitk.WriteTransform(transform, args.output)
     # save the metric history
-    write_metrics_to_csv(output_metric_csv, metric_callback.metric_history, args.silent)
+    write_metrics_to_csv(output_metric_csv, metric_history, args.silent)
     # optionally, create a plot of the metric history and save it
     if args.plot_metric_history:
-        create_and_save_metrics_plot(output_metric_png, metric_callback.metric_history, args.silent)
+        create_and_save_metrics_plot(output_metric_png, metric_history, args.silent)
+    # save the per-level timings and counters next to the metric history
+    instrumentation.write(output_instrumentation_json, args.silent)
 
 
 def create_parser() -> ArgumentParser:
@@ -143,6 +205,18 @@ def create_parser() -> ArgumentParser:
         help="enable this flag if the moving image is an atlas that is already downsampled and does not need to be "
              "downsampled further."
     )
+    parser.add_argument(
+        "--fixed-mask", "-fm", default=None, type=create_file_extension_checker(INPUT_EXTENSIONS, "fixed_mask"),
+        metavar="FN",
+        help=f"a mask in the fixed image frame to restrict the similarity metric to ({', '.join(INPUT_EXTENSIONS)}). "
+             f"Any nonzero voxel is inside the mask. It is downsampled along with the fixed image."
+    )
+    parser.add_argument(
+        "--moving-mask", "-mm", default=None, type=create_file_extension_checker(INPUT_EXTENSIONS, "moving_mask"),
+        metavar="FN",
+        help=f"a mask in the moving image frame to restrict the similarity metric to ({', '.join(INPUT_EXTENSIONS)}). "
+             f"Any nonzero voxel is inside the mask. It is downsampled along with the moving image."
+    )
     parser.add_argument(
         "--downsampling-shrink-factor", "-dsf", type=float, default=None, metavar="X",
         help="the shrink factor to apply to the fixed and moving image before starting the registration"
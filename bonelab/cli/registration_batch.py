@@ -0,0 +1,472 @@
+from __future__ import annotations
+
+# external imports
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import SimpleITK as sitk
+import csv
+import os
+import shlex
+import tempfile
+import time
+from typing import Dict, List, Optional, Union
+
+# internal imports
+from bonelab.util.time_stamp import message
+from bonelab.util.registration_util import (
+    TRANSFORM_EXTENSIONS, check_inputs_exist, check_for_output_overwrite, get_output_base, read_image,
+    downsample_image, read_and_downsample_masks, check_image_size_and_shrink_factors
+)
+from bonelab.util.demons_registration_util import (
+    ImagePyramid, write_transform_or_field,
+    IMAGE_EXTENSIONS as DEMONS_IMAGE_EXTENSIONS, TRANSFORM_EXTENSIONS as DEMONS_TRANSFORM_EXTENSIONS
+)
+from bonelab.cli import registration, demons_registration
+
+# the single pair registration tools that can be run in a batch
+REGISTRATION_METHODS = {
+    "rigid": registration,
+    "demons": demons_registration,
+}
+
+# the columns of the output table, in order
+TABLE_COLUMNS = [
+    "fixed", "moving", "output", "status", "final_metric", "iterations", "stop_condition", "seconds", "error"
+]
+
+# the fixed images of a worker process, most recently used last, keyed by `fixed_image_key`
+_FIXED_IMAGES: "OrderedDict[tuple, Union[sitk.Image, ImagePyramid]]" = OrderedDict()
+_FIXED_CACHE_SIZE = 2
+
+
+def _init_worker(threads: Optional[int], fixed_cache_size: int) -> None:
+    global _FIXED_CACHE_SIZE
+    _FIXED_CACHE_SIZE = fixed_cache_size
+    if threads is not None:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+
+
+def read_manifest(fn: str, silent: bool) -> List[Dict[str, str]]:
+    """
+    Read the pairs of images to register from a CSV file with `fixed`, `moving` and `output` columns, and an optional
+    `overrides` column.
+
+    Parameters
+    ----------
+    fn : str
+        The manifest filename.
+
+    silent : bool
+        Whether to suppress messages.
+
+    Returns
+    -------
+    List[Dict[str, str]]
+        One row per pair, with the `overrides` set to an empty string if the column is missing or blank.
+    """
+    if not silent:
+        message(f"Reading image pairs from {fn}")
+    with open(fn, "r", newline="") as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames is None or not {"fixed", "moving", "output"}.issubset(reader.fieldnames):
+            raise ValueError(f"{fn} must have a header with `fixed`, `moving` and `output` columns")
+        rows = [
+            {
+                "fixed": row["fixed"], "moving": row["moving"], "output": row["output"],
+                "overrides": row.get("overrides") or ""
+            }
+            for row in reader
+        ]
+    if not silent:
+        message(f"Found {len(rows)} image pairs.")
+    return rows
+
+
+def parse_pair_arguments(method: str, row: Dict[str, str], options: str) -> Namespace:
+    """
+    Parse the arguments of one pair the same way the single pair tool would parse its command line.
+
+    Parameters
+    ----------
+    method : str
+        The registration method, a key of `REGISTRATION_METHODS`.
+
+    row : Dict[str, str]
+        The manifest row.
+
+    options : str
+        The options shared by all pairs. The row's `overrides` come after them, so they take precedence.
+
+    Returns
+    -------
+    Namespace
+        The arguments of the pair, always silent since pairs may run concurrently.
+    """
+    argv = [row["fixed"], row["moving"], row["output"]] + shlex.split(options) + shlex.split(row["overrides"])
+    try:
+        pair_args = REGISTRATION_METHODS[method].create_parser().parse_args(argv)
+    except SystemExit:
+        # argparse has already printed the reason
+        raise ValueError(f"could not parse the options of the pair {row['fixed']}, {row['moving']}: {argv[3:]}")
+    pair_args.silent = True
+    return pair_args
+
+
+def fixed_image_key(method: str, args: Namespace) -> tuple:
+    """
+    Get the key of a fixed image in the cache. Pairs with the same key share the fixed image, so the key includes
+    everything the cached image depends on, including the modification time of the file.
+    """
+    stat = os.stat(args.fixed_image)
+    key = (
+        method, os.path.abspath(args.fixed_image), stat.st_mtime_ns, stat.st_size,
+        args.downsampling_shrink_factor, args.downsampling_smoothing_sigma
+    )
+    if method == "demons":
+        key += (args.pyramid_cache_directory, args.incremental_pyramid)
+        # the demons fixed image is cached masked
+        if args.fixed_mask is not None:
+            mask_stat = os.stat(args.fixed_mask)
+            key += (
+                os.path.abspath(args.fixed_mask), mask_stat.st_mtime_ns, mask_stat.st_size, args.background_value
+            )
+    return key
+
+
+def get_fixed_image(method: str, args: Namespace) -> Union[sitk.Image, ImagePyramid]:
+    """
+    Get the downsampled fixed image of a pair, reading it only if this process has not recently read it for another
+    pair. For demons, the fixed image pyramid is cached, so the levels built for one pair are reused by the next. The
+    demons filters mask the fixed image itself, so with a fixed mask the pyramid is built from the masked fixed image
+    and is shared by the pairs with the same fixed image and mask.
+
+    Parameters
+    ----------
+    method : str
+        The registration method, a key of `REGISTRATION_METHODS`.
+
+    args : Namespace
+        The arguments of the pair.
+
+    Returns
+    -------
+    Union[sitk.Image, ImagePyramid]
+        The fixed image, or its pyramid for demons.
+    """
+    key = fixed_image_key(method, args)
+    if key in _FIXED_IMAGES:
+        _FIXED_IMAGES.move_to_end(key)
+        return _FIXED_IMAGES[key]
+    fixed_image = downsample_image(
+        read_image(args.fixed_image, "fixed_image", args.silent),
+        args.downsampling_shrink_factor, args.downsampling_smoothing_sigma,
+        args.silent
+    )
+    if method == "demons":
+        if args.fixed_mask is not None:
+            fixed_mask, _ = read_and_downsample_masks(args.fixed_mask, None, fixed_image, None, args.silent)
+            fixed_image = sitk.Mask(fixed_image, fixed_mask, args.background_value)
+        fixed_image = ImagePyramid(fixed_image, args.pyramid_cache_directory, args.incremental_pyramid)
+    _FIXED_IMAGES[key] = fixed_image
+    while len(_FIXED_IMAGES) > _FIXED_CACHE_SIZE:
+        _FIXED_IMAGES.popitem(last=False)
+    return fixed_image
+
+
+def get_moving_image(args: Namespace) -> sitk.Image:
+    moving_image = read_image(args.moving_image, "moving_image", args.silent)
+    if args.moving_is_downsampled_atlas:
+        return sitk.Cast(moving_image, sitk.sitkFloat32)
+    return downsample_image(
+        moving_image, args.downsampling_shrink_factor, args.downsampling_smoothing_sigma, args.silent
+    )
+
+
+def register_pair(method: str, args: Namespace) -> Dict[str, Union[str, float, int]]:
+    """
+    Register one pair and write its transform, or displacement field for demons, to the pair's output.
+
+    The output is written to a temporary file next to it and then moved into place, so an output that exists is
+    always complete and can be skipped when resuming.
+
+    Parameters
+    ----------
+    method : str
+        The registration method, a key of `REGISTRATION_METHODS`.
+
+    args : Namespace
+        The arguments of the pair.
+
+    Returns
+    -------
+    Dict[str, Union[str, float, int]]
+        The final metric value, number of iterations and optimizer stopping condition of the registration.
+    """
+    check_inputs_exist([args.fixed_image, args.moving_image, args.fixed_mask, args.moving_mask], args.silent)
+    fixed = get_fixed_image(method, args)
+    fixed_image = fixed.image if isinstance(fixed, ImagePyramid) else fixed
+    moving_image = get_moving_image(args)
+    # the cached demons fixed image is already masked
+    fixed_mask, moving_mask = read_and_downsample_masks(
+        args.fixed_mask if method != "demons" else None, args.moving_mask, fixed_image, moving_image, args.silent
+    )
+    check_image_size_and_shrink_factors(fixed_image, moving_image, args.shrink_factors, args.silent)
+    if method == "demons":
+        check_inputs_exist([args.initial_transform], args.silent)
+        displacement_field, metric_history = demons_registration.register_images(
+            args, fixed_image, moving_image, fixed_pyramid=fixed, fixed_mask=fixed_mask, moving_mask=moving_mask
+        )
+        stop_condition = ""
+        extensions = DEMONS_TRANSFORM_EXTENSIONS + DEMONS_IMAGE_EXTENSIONS
+    else:
+        transform, metric_history, stop_condition = registration.register_images(
+            args, fixed_image, moving_image, fixed_mask, moving_mask
+        )
+        extensions = TRANSFORM_EXTENSIONS
+    output_base = get_output_base(args.output, extensions, True)
+    partial_output = f"{output_base}.partial{args.output[len(output_base):]}"
+    try:
+        if method == "demons":
+            write_transform_or_field(partial_output, displacement_field, args.silent)
+        else:
+            sitk.WriteTransform(transform, partial_output)
+        os.replace(partial_output, args.output)
+    except BaseException:
+        if os.path.exists(partial_output):
+            os.remove(partial_output)
+        raise
+    return {
+        "final_metric": metric_history[-1] if len(metric_history) > 0 else "",
+        "iterations": len(metric_history),
+        "stop_condition": stop_condition,
+    }
+
+
+def register_pair_or_error(method: str, args: Namespace) -> Dict[str, Union[str, float, int]]:
+    """
+    Register one pair in a batch, recording the error in the row instead of raising it.
+    """
+    row = {"fixed": args.fixed_image, "moving": args.moving_image, "output": args.output}
+    start = time.perf_counter()
+    try:
+        row.update(register_pair(method, args))
+        row["status"] = "done"
+        row["error"] = ""
+    except Exception as e:
+        row["status"] = "failed"
+        row["error"] = f"{type(e).__name__}: {e}"
+    row["seconds"] = f"{time.perf_counter() - start:.3f}"
+    return {column: row.get(column, "") for column in TABLE_COLUMNS}
+
+
+def register_pairs_or_error(
+        method: str, pairs: List[Namespace]
+) -> List[Dict[str, Union[str, float, int]]]:
+    """
+    Register several pairs in a batch one after the other in the same process, recording errors in the rows. The
+    pairs given together share a fixed image, so it is read once and then taken from this process's cache.
+    """
+    return [register_pair_or_error(method, pair_args) for pair_args in pairs]
+
+
+def group_by_fixed_image(pairs: List[Namespace], todo: List[int], workers: int) -> List[List[int]]:
+    """
+    Group the pairs to register by fixed image, in manifest order, so that the pairs of a group are registered by the
+    same worker. Groups larger than an even share of the pairs per worker are split, so that a batch with few fixed
+    images is still spread over all workers.
+
+    Parameters
+    ----------
+    pairs : List[Namespace]
+        The arguments of all pairs.
+
+    todo : List[int]
+        The indices of the pairs to register.
+
+    workers : int
+        The number of workers.
+
+    Returns
+    -------
+    List[List[int]]
+        The groups of pair indices, each to be registered by one worker.
+    """
+    groups: "OrderedDict[str, List[int]]" = OrderedDict()
+    for i in todo:
+        groups.setdefault(os.path.abspath(pairs[i].fixed_image), []).append(i)
+    max_group_size = max(1, -(-len(todo) // workers))
+    return [
+        group[start:start + max_group_size]
+        for group in groups.values()
+        for start in range(0, len(group), max_group_size)
+    ]
+
+
+def read_previous_rows(fn: str) -> Dict[str, Dict[str, str]]:
+    """
+    Read the rows of a previous run's output table, keyed by the pair output, so resumed pairs keep their metrics.
+    """
+    if not os.path.isfile(fn):
+        return {}
+    with open(fn, "r", newline="") as f:
+        return {row["output"]: row for row in csv.DictReader(f) if row.get("status") == "done"}
+
+
+def pending_row(args: Namespace) -> Dict[str, str]:
+    row = {column: "" for column in TABLE_COLUMNS}
+    row.update({"fixed": args.fixed_image, "moving": args.moving_image, "output": args.output, "status": "pending"})
+    return row
+
+
+def write_table(fn: str, rows: List[Dict[str, Union[str, float, int]]]) -> None:
+    """
+    Write the table of all pairs to a temporary file next to `fn` and move it into place, so the table on disk is
+    never partially written even though it is rewritten every time a pair finishes.
+    """
+    directory = os.path.dirname(os.path.abspath(fn))
+    fd, tmp_fn = tempfile.mkstemp(prefix=f".{os.path.basename(fn)}.", dir=directory)
+    try:
+        with os.fdopen(fd, "w", newline="") as f:
+            csv_writer = csv.DictWriter(f, fieldnames=TABLE_COLUMNS)
+            csv_writer.writeheader()
+            csv_writer.writerows(rows)
+        os.replace(tmp_fn, fn)
+    except BaseException:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+        raise
+
+
+def registration_batch(args: Namespace):
+    check_inputs_exist([args.manifest], args.silent)
+    # when resuming, the table of the previous run is read and then replaced
+    check_for_output_overwrite([args.output], args.overwrite or args.resume, args.silent)
+    manifest = read_manifest(args.manifest, args.silent)
+    # parse every pair up-front, so a typo in the last row does not surface after hours of registrations
+    pairs = [parse_pair_arguments(args.method, row, args.options) for row in manifest]
+    pair_outputs = [pair_args.output for pair_args in pairs]
+    duplicates = sorted({output for output in pair_outputs if pair_outputs.count(output) > 1})
+    if len(duplicates) > 0:
+        raise ValueError(f"the following outputs appear more than once in {args.manifest}: {', '.join(duplicates)}")
+    rows: List[Optional[Dict[str, Union[str, float, int]]]] = [None] * len(pairs)
+    if args.resume:
+        previous_rows = read_previous_rows(args.output)
+        for i, pair_args in enumerate(pairs):
+            if os.path.isfile(pair_args.output):
+                rows[i] = {column: "" for column in TABLE_COLUMNS}
+                rows[i].update(previous_rows.get(pair_args.output, {}))
+                rows[i].update(
+                    {"fixed": pair_args.fixed_image, "moving": pair_args.moving_image, "output": pair_args.output}
+                )
+                if rows[i]["status"] != "done":
+                    rows[i]["status"] = "skipped"
+    else:
+        check_for_output_overwrite(pair_outputs, args.overwrite, args.silent)
+    todo = [i for i in range(len(pairs)) if rows[i] is None]
+    if not args.silent:
+        message(f"Registering {len(todo)} of {len(pairs)} image pairs ({len(pairs) - len(todo)} already done).")
+
+    def record(i: int, row: Dict[str, Union[str, float, int]]) -> None:
+        rows[i] = row
+        if not args.silent:
+            message(f"[{sum(r is not None for r in rows)}/{len(rows)}] {row['status']}: {row['output']}")
+        # the table is kept up to date so that an interrupted batch still reports what it finished
+        write_table(args.output, [r if r is not None else pending_row(pairs[j]) for j, r in enumerate(rows)])
+
+    write_table(args.output, [r if r is not None else pending_row(pairs[j]) for j, r in enumerate(rows)])
+    if args.workers > 1 and len(todo) > 1:
+        workers = min(args.workers, len(todo))
+        # cap the threads of each worker so that the workers together do not oversubscribe the cpus
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        if not args.silent:
+            message(f"Using {workers} workers, {threads} thread(s) each")
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(threads, args.fixed_cache_size)
+        ) as executor:
+            # each worker gets whole groups of pairs sharing a fixed image, so it reads the fixed image once for
+            # all of them instead of the pairs of a fixed image going to whichever worker is free
+            futures = {
+                executor.submit(register_pairs_or_error, args.method, [pairs[i] for i in group]): group
+                for group in group_by_fixed_image(pairs, todo, workers)
+            }
+            for future in as_completed(futures):
+                for i, row in zip(futures[future], future.result()):
+                    record(i, row)
+    else:
+        _init_worker(None, args.fixed_cache_size)
+        # in one process, registering the pairs grouped by fixed image keeps the fixed image cache hits
+        for i in [i for group in group_by_fixed_image(pairs, todo, 1) for i in group]:
+            record(i, register_pair_or_error(args.method, pairs[i]))
+    failed = [row for row in rows if row["status"] == "failed"]
+    if len(failed) > 0:
+        raise RuntimeError(
+            f"{len(failed)} of {len(rows)} image pairs failed, see the `error` column of {args.output}. "
+            f"First failure: {failed[0]['fixed']}, {failed[0]['moving']}: {failed[0]['error']}"
+        )
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="This tool allows you to run many pairwise registrations, listed in a manifest CSV file with "
+                    "`fixed`, `moving` and `output` columns and an optional `overrides` column. Each pair is "
+                    "registered exactly as `blRegistration` (or `blRegistrationDemons`) would register it, given the "
+                    "shared `--options` followed by the pair's `overrides`. The pairs are processed in parallel, each "
+                    "worker keeps the fixed images it has recently read so pairs sharing a fixed image do not read it "
+                    "again, and the final metric of every pair is written to one CSV file, one row per pair. A pair "
+                    "that fails does not stop the others, its error is written to the `error` column.",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "manifest", type=str, metavar="MANIFEST",
+        help="path to a csv file with a header row including `fixed`, `moving` and `output` columns, one pair of "
+             "images per row. An optional `overrides` column can give options for the pair only, "
+             "e.g. `--max-iterations 500`."
+    )
+    parser.add_argument(
+        "output", type=str, metavar="OUTPUT",
+        help="path to the file to save the table of metrics to, should end with *.csv (since it will be a csv file "
+             "regardless)."
+    )
+    parser.add_argument(
+        "--method", "-m", default="rigid", choices=list(REGISTRATION_METHODS.keys()),
+        help="the registration tool to run for every pair: `rigid` for `blRegistration`, `demons` for "
+             "`blRegistrationDemons`"
+    )
+    parser.add_argument(
+        "--options", "-o", default="", type=str, metavar="STR",
+        help="options of the registration tool to use for every pair, as they would be given on its command line, "
+             "e.g. `--optimizer Powell --shrink-factors 4 2`. Quote the string and start it with a space or use "
+             "`--options=...` so it is not read as options of this tool."
+    )
+    parser.add_argument(
+        "--overwrite", "-ow", default=False, action="store_true",
+        help="enable this flag to overwrite existing files, if they exist at output targets"
+    )
+    parser.add_argument(
+        "--resume", "-r", default=False, action="store_true",
+        help="enable this flag to skip the pairs whose output already exists, e.g. to continue an interrupted batch. "
+             "Their metrics are carried over from the existing table at OUTPUT, if it has them."
+    )
+    parser.add_argument(
+        "--workers", "-w", default=1, type=int,
+        help="number of image pairs to register in parallel. The threads of each worker are capped so that all "
+             "workers together use about one thread per cpu."
+    )
+    parser.add_argument(
+        "--fixed-cache-size", "-fcs", default=2, type=int, metavar="N",
+        help="number of fixed images each worker keeps in memory for reuse by later pairs"
+    )
+    parser.add_argument(
+        "--silent", "-s", default=False, action="store_true",
+        help="enable this flag to suppress terminal output about how the program is proceeding"
+    )
+    return parser
+
+
+def main():
+    registration_batch(create_parser().parse_args())
+
+
+if __name__ == "__main__":
+    main()
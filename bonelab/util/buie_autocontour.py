@@ -0,0 +1,363 @@
+"""
+NumPy / SciPy implementation of Buie's autocontour algorithm, used by the `numpy` backend of `blAutocontour`.
+
+https://doi.org/10.1016/j.bone.2007.07.007
+
+The VTK implementation in `bonelab.cli.autocontour` carries binary images around as `in_value` / 0 images in the
+scalar type of the density image. Here they are boolean arrays and every step is written to give exactly the same
+voxels as the VTK filter it replaces:
+
+- `vtkImageMedian3D` uses a box kernel that is clipped at the image boundary, so near the boundary the neighbourhood
+  can have an even number of voxels and the median is then the mean of the two middle values. For a binary image this
+  is half of `in_value`, which is neither bone nor background, so the median step returns both the bone voxels and
+  these undecided voxels. The median is computed from box sums of the bone voxels and of the in-bounds voxels.
+- `vtkImageDilateErode3D` uses an ellipsoidal kernel, also clipped at the image boundary. The kernel is decomposed into
+  runs along the first axis and each run is handled with two lookups into a running sum, so the cost does not grow
+  with the area of the kernel.
+- `vtkImageConnectivityFilter` keeps the largest face-connected region. When the image has been cropped, the voxels
+  removed by the crop are counted as part of the region they touch, as they are in the full image.
+- `vtkImageConnectivityFilter` outputs unsigned char labels, so everything after step 10 is unsigned char, including
+  the input and output of the Gaussian smoothing and both masks.
+- `vtkImageGaussianSmooth` smooths one axis at a time (last axis first), renormalises the kernel where it is clipped by
+  the image boundary, and truncates back to the scalar type of the image after every axis.
+
+The array indexing is that of `bonelab.util.vtk_util.vtkImageData_to_numpy`, i.e. `[x, y, z]`.
+"""
+
+from __future__ import annotations
+
+import math
+import numpy as np
+from scipy import ndimage
+from typing import Optional, Sequence, Tuple
+
+from bonelab.util.mean_filter import footprint_row_runs
+
+
+def dilate_erode_footprint(kernel_size: Sequence[int]) -> np.ndarray:
+    """
+    Get the ellipsoidal footprint that `vtkImageDilateErode3D` uses for a given kernel size.
+
+    Parameters
+    ----------
+    kernel_size : Sequence[int]
+        The kernel size along each axis.
+
+    Returns
+    -------
+    np.ndarray
+        The boolean footprint. Element `k` of the footprint is compared to the voxel `k - kernel_size // 2` away.
+    """
+    coordinates = np.meshgrid(*[np.arange(k, dtype=float) for k in kernel_size], indexing="ij")
+    distance = np.zeros(tuple(kernel_size))
+    for c, k in zip(coordinates, kernel_size):
+        if k > 1:
+            distance += ((c - (k - 1) / 2) / (k / 2)) ** 2
+    return distance <= 1
+
+
+def clipped_dilation(mask: np.ndarray, footprint: np.ndarray) -> np.ndarray:
+    """
+    Dilate a binary image with the neighbourhood convention of `vtkImageDilateErode3D`. Voxels outside of the image
+    never contribute.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        The binary image.
+
+    footprint : np.ndarray
+        The footprint, from `dilate_erode_footprint`.
+
+    Returns
+    -------
+    np.ndarray
+        The boolean dilated image: `True` where any voxel under the footprint is `True`.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    middle = [k // 2 for k in footprint.shape]
+    padding = [(m, k - 1 - m) for k, m in zip(footprint.shape, middle)]
+    padded = np.pad(mask, padding)
+    # running sum along the first axis, with a leading zero so that a run [a, b) is cumsum[b] - cumsum[a]
+    cumsum = np.zeros((padded.shape[0] + 1,) + padded.shape[1:], dtype=np.int32)
+    np.cumsum(padded, axis=0, out=cumsum[1:])
+    output = np.zeros(mask.shape, dtype=bool)
+    n = mask.shape[0]
+    # runs along the first axis, i.e. along the last axis of the footprint moved to the back
+    for row_index, start, stop in footprint_row_runs(np.moveaxis(footprint, 0, -1)):
+        rows = tuple(slice(r, r + s) for r, s in zip(row_index, mask.shape[1:]))
+        output |= (cumsum[(slice(stop, stop + n),) + rows] - cumsum[(slice(start, start + n),) + rows]) > 0
+    return output
+
+
+def box_count(mask: np.ndarray, kernel_size: Sequence[int]) -> np.ndarray:
+    """
+    Count the `True` voxels in a box around each voxel, with the neighbourhood convention of `vtkImageMedian3D`. Voxels
+    outside of the image are not counted.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        The binary image.
+
+    kernel_size : Sequence[int]
+        The size of the box along each axis.
+
+    Returns
+    -------
+    np.ndarray
+        The counts.
+    """
+    count = np.asarray(mask, dtype=np.int32)
+    for axis, k in enumerate(kernel_size):
+        if k > 1:
+            count = ndimage.correlate1d(count, np.ones(k, dtype=np.int32), axis=axis, mode="constant")
+    return count
+
+
+def clipped_median(mask: np.ndarray, kernel_size: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the median of a binary image the way `vtkImageMedian3D` does.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        The binary image.
+
+    kernel_size : Sequence[int]
+        The kernel size along each axis.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Boolean images of the voxels where the median is `True`, and of the voxels where the clipped neighbourhood is
+        split exactly in half and the median is half way between `True` and `False`.
+    """
+    count = 2 * box_count(mask, kernel_size)
+    in_bounds = np.ones((1,) * mask.ndim, dtype=np.int32)
+    for axis, (n, k) in enumerate(zip(mask.shape, kernel_size)):
+        shape = [1] * mask.ndim
+        shape[axis] = n
+        in_bounds = in_bounds * box_count(np.ones(n, dtype=bool), [k]).reshape(shape)
+    return count > in_bounds, count == in_bounds
+
+
+def largest_component(
+        mask: np.ndarray,
+        crop_padding: Optional[Sequence[Tuple[int, int]]] = None
+) -> np.ndarray:
+    """
+    Get the largest face-connected component of a binary image.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        The binary image.
+
+    crop_padding : Optional[Sequence[Tuple[int, int]]]
+        If the image is a crop of a larger one in which all of the voxels around the crop are `True`, the number of
+        voxels removed before and after the crop along each axis. The components are then those of the full image.
+
+    Returns
+    -------
+    np.ndarray
+        The boolean image of the largest component, empty if there are no components.
+    """
+    if crop_padding is not None and any(p != (0, 0) for p in crop_padding):
+        crop = tuple(slice(before, before + n) for (before, _), n in zip(crop_padding, mask.shape))
+        return largest_component(np.pad(mask, crop_padding, constant_values=True))[crop]
+    labels, num_labels = ndimage.label(mask, structure=ndimage.generate_binary_structure(mask.ndim, 1))
+    if num_labels == 0:
+        return np.zeros(mask.shape, dtype=bool)
+    sizes = np.bincount(labels.ravel())
+    sizes[0] = 0
+    return labels == np.argmax(sizes)
+
+
+def gaussian_kernel(lower: int, upper: int, std: float) -> np.ndarray:
+    """
+    Compute a normalised Gaussian kernel over the offsets `lower` to `upper` the way `vtkImageGaussianSmooth` does.
+
+    Parameters
+    ----------
+    lower : int
+        The first offset.
+
+    upper : int
+        The last offset.
+
+    std : float
+        The standard deviation, in voxels.
+
+    Returns
+    -------
+    np.ndarray
+        The kernel.
+    """
+    # `math.exp` rather than `np.exp`, which can differ from the C library in the last bit
+    kernel = np.array([math.exp((-x * x) / (std * std * 2.0)) for x in range(lower, upper + 1)])
+    total = 0.0
+    for k in kernel:
+        total += k
+    return kernel / total
+
+
+def gaussian_smooth(image: np.ndarray, std: float, radius_factors: Sequence[float]) -> np.ndarray:
+    """
+    Smooth an image the way `vtkImageGaussianSmooth` does, down to the order of the floating point operations, so that
+    the truncation to integer scalar types gives the same values.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The image to smooth. The result is cast back to its dtype after every axis.
+
+    std : float
+        The standard deviation of the Gaussian, in voxels.
+
+    radius_factors : Sequence[float]
+        The kernel radius along each axis, in standard deviations.
+
+    Returns
+    -------
+    np.ndarray
+        The smoothed image.
+    """
+    dtype = image.dtype
+    # VTK smooths the last axis first
+    for axis in reversed(range(image.ndim)):
+        radius = int(std * radius_factors[axis])
+        if std == 0 or radius == 0:
+            continue
+        n = image.shape[axis]
+        # the kernel weights at every position along the axis, renormalised where the kernel is clipped by the image
+        # boundary and zero for the offsets that fall outside of the image
+        weights = np.zeros((2 * radius + 1, n))
+        for position in range(n):
+            lower, upper = max(-radius, -position), min(radius, n - 1 - position)
+            weights[lower + radius:upper + radius + 1, position] = gaussian_kernel(lower, upper, std)
+        padding = [(0, 0)] * image.ndim
+        padding[axis] = (radius, radius)
+        padded = np.pad(image.astype(np.float64), padding)
+        shape = [1] * image.ndim
+        shape[axis] = n
+        # accumulate one offset at a time, in the same order as VTK
+        smoothed = np.zeros(image.shape)
+        index = [slice(None)] * image.ndim
+        for offset in range(2 * radius + 1):
+            index[axis] = slice(offset, offset + n)
+            smoothed += weights[offset].reshape(shape) * padded[tuple(index)]
+        image = smoothed.astype(dtype)
+    return image
+
+
+def autocontour_buie_array(
+        density: np.ndarray,
+        threshold_1: float,
+        threshold_2: float,
+        median_kernel: Sequence[int],
+        dilate_erode_kernel_1: Sequence[int],
+        dilate_erode_kernel_2: Sequence[int],
+        gaussian_std: float,
+        gaussian_kernel: Sequence[int],
+        gaussian_threshold: float,
+        in_value: int = 127,
+        crop_padding: Optional[Sequence[Tuple[int, int]]] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the cortical and trabecular masks of a bone with Buie's autocontour algorithm.
+
+    Parameters
+    ----------
+    density : np.ndarray
+        The density image, indexed `[x, y, z]`.
+
+    threshold_1 : float
+        The bone threshold in step 2.
+
+    threshold_2 : float
+        The soft tissue threshold in step 7.
+
+    median_kernel : Sequence[int]
+        The median kernel size in step 3.
+
+    dilate_erode_kernel_1 : Sequence[int]
+        The dilate and erode kernel size in steps 4 and 6.
+
+    dilate_erode_kernel_2 : Sequence[int]
+        The dilate and erode kernel size in steps 9 and 11.
+
+    gaussian_std : float
+        The standard deviation of the Gaussian in step 12.
+
+    gaussian_kernel : Sequence[int]
+        The radius factors of the Gaussian in step 12.
+
+    gaussian_threshold : float
+        The threshold applied to the smoothed image in step 13.
+
+    in_value : int
+        The value of voxels in a mask. Step 12 smooths an unsigned char image, so it is clamped to 255 there.
+
+    crop_padding : Optional[Sequence[Tuple[int, int]]]
+        If `density` has been cropped to the bone, the number of voxels removed before and after it along each axis.
+        The crop must leave every voxel it removes outside of the bone after step 4, so those voxels are part of the
+        background in both connectivity steps, and they are counted there so that the largest components are those
+        of the full image.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The boolean cortical and trabecular masks.
+    """
+    footprint_1 = dilate_erode_footprint(dilate_erode_kernel_1)
+    footprint_2 = dilate_erode_footprint(dilate_erode_kernel_2)
+
+    # Step 2: Threshold
+    bone = density >= threshold_1
+
+    # Step 3: Median, which can leave voxels at the boundary half way between bone and background
+    bone, undecided = clipped_median(bone, median_kernel)
+
+    # Step 4: Dilate, only background voxels become bone
+    background = ~(bone | undecided)
+    bone |= background & clipped_dilation(bone, footprint_1)
+    del background, undecided
+
+    # Step 5: Connectivity, applied to non-bone
+    periosteal = ~largest_component(~bone, crop_padding)
+    del bone
+
+    # Step 6: Erode
+    periosteal &= ~clipped_dilation(~periosteal, footprint_1)
+
+    # Steps 7 and 8: Threshold and mask, then invert
+    not_soft_tissue = ~((density <= threshold_2) & periosteal)
+
+    # Step 9: Dilate the soft tissue
+    not_soft_tissue &= ~clipped_dilation(~not_soft_tissue, footprint_2)
+
+    # Step 10: Connectivity, keeps the background and everything connected to it
+    outer = largest_component(not_soft_tissue, crop_padding)
+    del not_soft_tissue
+
+    # Step 11: Erode the soft tissue
+    outer |= clipped_dilation(outer, footprint_2)
+
+    # Step 12: Gaussian smooth
+    smoothed = gaussian_smooth(
+        (min(in_value, np.iinfo(np.uint8).max) * outer).astype(np.uint8), gaussian_std, gaussian_kernel
+    )
+    del outer
+
+    # Step 13: Threshold
+    cortical_region = smoothed > gaussian_threshold
+    del smoothed
+
+    # Step 14: Mask
+    cort_mask = periosteal & cortical_region
+
+    # Step 15: Invert the trabecular mask
+    trab_mask = ~cortical_region
+
+    return cort_mask, trab_mask
@@ -7,12 +7,17 @@ Modified slightly but mechanically the same as the source. Also some extra stuff
 from __future__ import annotations
 
 from enum import Enum
+import hashlib
+import math
+import os
+import tempfile
 
 import SimpleITK as sitk
 import numpy as np
-from typing import Callable, Optional, List, Tuple
+from typing import Callable, Dict, Optional, List, Tuple, Union
 
 from bonelab.util.time_stamp import message
+from bonelab.util.registration_instrumentation import RegistrationInstrumentation, timed
 
 
 # a list of Demons registration filters available in SimpleITK
@@ -39,7 +44,8 @@ class MetricTrackingCallback:
                  silent: bool = True,
                  demons: bool = True,
                  patience: int = 50,
-                 rolling_average_window: int = 10
+                 rolling_average_window: int = 10,
+                 instrumentation: Optional[RegistrationInstrumentation] = None
                  ):
         """
         Initialize the callback class.
@@ -61,6 +67,9 @@ class MetricTrackingCallback:
 
         rolling_average_window : int
             The number of iterations to use for the rolling average when checking for convergence.
+
+        instrumentation : Optional[RegistrationInstrumentation]
+            If given, each iteration is also recorded in it.
         """
         self._registration_filter = registration_filter
         self._silent = silent
@@ -69,6 +78,7 @@ class MetricTrackingCallback:
         self._patience_counter = 0
         self._rolling_average_window = rolling_average_window
         self._metric_history = []
+        self._instrumentation = instrumentation
 
     @property
     def metric_history(self) -> List[float]:
@@ -180,6 +190,8 @@ class MetricTrackingCallback:
         else:
             metric = self._registration_filter.GetMetricValue()
         self._metric_history.append(metric)
+        if self._instrumentation is not None:
+            self._instrumentation.record_iteration(metric)
         # check for convergence
         is_converged = False
         if not(
@@ -204,6 +216,32 @@ class MetricTrackingCallback:
         self._patience_counter += 1
 
 
+def downsampled_grid(image: sitk.Image, shrink_factor: float) -> Tuple[List[int], List[float]]:
+    """
+    Compute the size and spacing of an image downsampled by a shrink factor, keeping the first and last voxel centres
+    where they are.
+
+    Parameters
+    ----------
+    image : sitk.Image
+        The image at full resolution.
+
+    shrink_factor : float
+        The multiple by which to shrink the image.
+
+    Returns
+    -------
+    Tuple[List[int], List[float]]
+        The size and spacing of the downsampled image.
+    """
+    new_size = [int(sz / float(shrink_factor) + 0.5) for sz in image.GetSize()]
+    new_spacing = [
+        ((osz - 1) * osp) / (nsz - 1)
+        for (osz, osp, nsz) in zip(image.GetSize(), image.GetSpacing(), new_size)
+    ]
+    return new_size, new_spacing
+
+
 def smooth_and_resample(image: sitk.Image, shrink_factor: float, smoothing_sigma: float) -> sitk.Image:
     """
     This function can be used on its own to smooth and resample an image, but it is here mainly because it is used
@@ -226,11 +264,7 @@ def smooth_and_resample(image: sitk.Image, shrink_factor: float, smoothing_sigma
         The filtered and downsampled image.
     """
     # compute the size and spacing of the resampled image
-    new_size = [int(sz / float(shrink_factor) + 0.5) for sz in image.GetSize()]
-    new_spacing = [
-        ((osz - 1) * osp) / (nsz - 1)
-        for (osz, osp, nsz) in zip(image.GetSize(), image.GetSpacing(), new_size)
-    ]
+    new_size, new_spacing = downsampled_grid(image, shrink_factor)
 
     # smooth and resample
     return sitk.Resample(
@@ -240,13 +274,266 @@ def smooth_and_resample(image: sitk.Image, shrink_factor: float, smoothing_sigma
     )
 
 
+class ImagePyramid:
+    """
+    The smoothed and downsampled levels of an image for a multiscale registration, built when first needed and cached
+    in memory, and optionally on disk. Building the pyramid of the fixed image once and passing it to every
+    registration against it, e.g. when registering an atlas to many subjects, means the levels are only computed once.
+
+    By default, each level is computed from the full resolution image with `smooth_and_resample`, exactly as in a
+    registration without a pyramid. If `incremental` is set, a level is instead computed from the most smoothed of
+    the levels already built that are finer (no coarser) and less smoothed (no more smoothed), with the remaining
+    smoothing: Gaussian smoothing with sigma `a` then `b` is smoothing with sigma `sqrt(a**2 + b**2)`. This is faster
+    for progressions with many levels but not identical, since the finer level was interpolated. Levels are only
+    computed incrementally if the finer levels are built first, e.g. with `build`.
+    """
+
+    def __init__(self, image: sitk.Image, cache_directory: Optional[str] = None, incremental: bool = False):
+        """
+        Initialize the pyramid. No levels are built until they are asked for.
+
+        Parameters
+        ----------
+        image : sitk.Image
+            The image at full resolution.
+
+        cache_directory : Optional[str]
+            A directory to cache the levels in, as MetaImage files named after a hash of the image. Levels found there
+            are read instead of being computed. If `None`, levels are only cached in memory.
+
+        incremental : bool
+            Whether or not to compute levels from finer (no coarser), less smoothed levels that have already been
+            built.
+        """
+        self._image = image
+        self._cache_directory = cache_directory
+        self._incremental = incremental
+        self._levels: Dict[Tuple[float, float], sitk.Image] = {}
+        self._key = None
+
+    @property
+    def image(self) -> sitk.Image:
+        """
+        The image at full resolution.
+
+        Returns
+        -------
+        sitk.Image
+            The image at full resolution.
+        """
+        return self._image
+
+    @property
+    def cache_directory(self) -> Optional[str]:
+        """
+        The directory the levels are cached in, if any.
+
+        Returns
+        -------
+        Optional[str]
+            The directory the levels are cached in.
+        """
+        return self._cache_directory
+
+    @property
+    def incremental(self) -> bool:
+        """
+        Whether or not levels are computed from finer (no coarser), less smoothed levels that have already been built.
+
+        Returns
+        -------
+        bool
+            Whether or not levels are computed incrementally.
+        """
+        return self._incremental
+
+    @property
+    def key(self) -> str:
+        """
+        A hash of the voxels, pixel type and geometry of the image, identifying its levels in the cache directory.
+
+        Returns
+        -------
+        str
+            The hash, as a hexadecimal string.
+        """
+        if self._key is None:
+            h = hashlib.sha1()
+            h.update(repr((
+                self._image.GetPixelIDValue(), self._image.GetNumberOfComponentsPerPixel(), self._image.GetSize(),
+                self._image.GetOrigin(), self._image.GetSpacing(), self._image.GetDirection()
+            )).encode())
+            h.update(np.ascontiguousarray(sitk.GetArrayViewFromImage(self._image)).data)
+            self._key = h.hexdigest()
+        return self._key
+
+    def level_filename(self, shrink_factor: float, smoothing_sigma: float) -> Optional[str]:
+        """
+        Get the filename a level is cached under on disk.
+
+        Parameters
+        ----------
+        shrink_factor : float
+            The shrink factor of the level.
+
+        smoothing_sigma : float
+            The smoothing sigma of the level.
+
+        Returns
+        -------
+        Optional[str]
+            The filename, or `None` if the levels are not cached on disk.
+        """
+        if self._cache_directory is None:
+            return None
+        mode = "incremental" if self._incremental else "direct"
+        return os.path.join(
+            self._cache_directory,
+            f"{self.key}_{mode}_sf{float(shrink_factor)!r}_ss{float(smoothing_sigma)!r}.mha"
+        )
+
+    def get_level(self, shrink_factor: float, smoothing_sigma: float) -> sitk.Image:
+        """
+        Get the image smoothed and downsampled for one level of a multiscale progression.
+
+        Parameters
+        ----------
+        shrink_factor : float
+            The multiple by which to shrink the image.
+
+        smoothing_sigma : float
+            The sigma for the gaussian smoothing, in the same physical units as the image spacing.
+
+        Returns
+        -------
+        sitk.Image
+            The smoothed and downsampled image.
+        """
+        level_key = (float(shrink_factor), float(smoothing_sigma))
+        if level_key in self._levels:
+            return self._levels[level_key]
+        fn = self.level_filename(shrink_factor, smoothing_sigma)
+        if fn is not None and os.path.isfile(fn):
+            level = sitk.ReadImage(fn)
+        else:
+            level = self._build_level(shrink_factor, smoothing_sigma)
+            if fn is not None:
+                # write to a temporary file and move it into place, so that concurrent runs never read a partial file
+                os.makedirs(self._cache_directory, exist_ok=True)
+                handle, tmp_fn = tempfile.mkstemp(suffix=".mha", dir=self._cache_directory)
+                os.close(handle)
+                try:
+                    sitk.WriteImage(level, tmp_fn)
+                    os.replace(tmp_fn, fn)
+                except BaseException:
+                    if os.path.exists(tmp_fn):
+                        os.remove(tmp_fn)
+                    raise
+        self._levels[level_key] = level
+        return level
+
+    def build(self, multiscale_progression: List[Tuple[float, float]]) -> None:
+        """
+        Build all the levels of a multiscale progression ahead of time, from the finest to the coarsest so that
+        incremental pyramids can compute each level from the previous one.
+
+        Parameters
+        ----------
+        multiscale_progression : List[Tuple[float, float]]
+            A list of (shrink factor, smoothing sigma) pairs, in any order.
+
+        Returns
+        -------
+        None
+        """
+        for shrink_factor, smoothing_sigma in sorted(multiscale_progression):
+            self.get_level(shrink_factor, smoothing_sigma)
+
+    def _build_level(self, shrink_factor: float, smoothing_sigma: float) -> sitk.Image:
+        if self._incremental:
+            # the most smoothed level already built that the new level can be reached from
+            sources = [
+                (sigma, shrink) for (shrink, sigma) in self._levels
+                if shrink <= shrink_factor and sigma <= smoothing_sigma
+            ]
+            if sources:
+                sigma, shrink = max(sources)
+                source = self._levels[(shrink, sigma)]
+                remaining_sigma = math.sqrt(smoothing_sigma ** 2 - sigma ** 2)
+                if remaining_sigma > 0:
+                    source = sitk.SmoothingRecursiveGaussian(source, remaining_sigma)
+                new_size, new_spacing = downsampled_grid(self._image, shrink_factor)
+                return sitk.Resample(
+                    source,
+                    new_size, sitk.Transform(), sitk.sitkLinear, self._image.GetOrigin(),
+                    new_spacing, self._image.GetDirection(), 0.0, self._image.GetPixelID()
+                )
+        return smooth_and_resample(self._image, shrink_factor, smoothing_sigma)
+
+
+def cast_displacement_field(field: sitk.Image, pixel_type: int) -> sitk.Image:
+    """
+    Cast a displacement field to a pixel type, without copying it if it already has that type.
+
+    Parameters
+    ----------
+    field : sitk.Image
+        The displacement field.
+
+    pixel_type : int
+        The pixel type, `sitk.sitkVectorFloat64` or `sitk.sitkVectorFloat32`.
+
+    Returns
+    -------
+    sitk.Image
+        The displacement field with the given pixel type.
+    """
+    if field.GetPixelID() == pixel_type:
+        return field
+    return sitk.Cast(field, pixel_type)
+
+
+def resample_displacement_field(
+        field: Optional[sitk.Image],
+        reference_image: sitk.Image,
+        pixel_type: int
+) -> sitk.Image:
+    """
+    Resample a displacement field onto the grid of an image, as the initial field of a Demons filter. The field is
+    resampled in the pixel type it is kept in, then promoted to `sitk.sitkVectorFloat64` as the Demons filters require.
+
+    Parameters
+    ----------
+    field : Optional[sitk.Image]
+        The displacement field, or `None` for a field of zeros.
+
+    reference_image : sitk.Image
+        The image whose grid to resample the field onto.
+
+    pixel_type : int
+        The pixel type the field is kept in.
+
+    Returns
+    -------
+    sitk.Image
+        The displacement field on the grid of the reference image, with pixel type `sitk.sitkVectorFloat64`.
+    """
+    if field is None:
+        field = sitk.Image(*reference_image.GetSize(), sitk.sitkVectorFloat64)
+        field.CopyInformation(reference_image)
+        return field
+    return cast_displacement_field(sitk.Resample(field, reference_image), sitk.sitkVectorFloat64)
+
+
 def multiscale_registration(
     registration_algorithm: sitk.ImageFilter,
-    fixed_image: sitk.Image,
-    moving_image: sitk.Image,
+    fixed_image: Union[sitk.Image, ImagePyramid],
+    moving_image: Union[sitk.Image, ImagePyramid],
     initial_transform: Optional[sitk.Transform] = None,
     multiscale_progression: Optional[List[Tuple[float, float]]] = None,
-    silent: bool = True
+    silent: bool = True,
+    field_pixel_type: int = sitk.sitkVectorFloat64,
+    instrumentation: Optional[RegistrationInstrumentation] = None
 ) -> sitk.DisplacementFieldTransform:
     """
     Perform a multiscale registration using a given registration algorithm and fixed/moving image pair. You can
@@ -258,13 +545,14 @@ def multiscale_registration(
         Any registration image filter in SimpleITK that has a method called `Execute` that takes two SimpleITK images
         and a displacement field image as arguments and which returns a displacement field.
 
-    fixed_image : sitk.Image
-        A SimpleITK image. The resulting transformation will point from this image's coordinate system into the
-        moving_image's coordinate system.
+    fixed_image : Union[sitk.Image, ImagePyramid]
+        A SimpleITK image, or its pyramid. The resulting transformation will point from this image's coordinate
+        system into the moving_image's coordinate system. Pass the same pyramid to several registrations to only
+        smooth and downsample the image once.
 
-    moving_image : sitk.Image
-        A SimpleITK image. The resulting transformation will point from the fixed_image's coordinate system into this
-        image's coordinate system.
+    moving_image : Union[sitk.Image, ImagePyramid]
+        A SimpleITK image, or its pyramid. The resulting transformation will point from the fixed_image's coordinate
+        system into this image's coordinate system.
 
     initial_transform : Optional[sitk.Transform]
         A SimpleITK transform to initialize the registration with, if provided.
@@ -278,21 +566,33 @@ def multiscale_registration(
     silent : bool
         Suppress terminal output.
 
+    field_pixel_type : int
+        The pixel type the displacement field is kept in between registrations, and returned in. The Demons filters
+        require `sitk.sitkVectorFloat64`, so with `sitk.sitkVectorFloat32` the field is only promoted when it is passed
+        to a filter, halving the memory of every field held outside of the filters.
+
+    instrumentation : Optional[RegistrationInstrumentation]
+        If given, the start and end of each level, and the time spent getting pyramid levels, resampling the
+        displacement field and registering, are recorded in it.
+
     Returns
     -------
     sitk.DisplacementFieldTransform
         The final transform output by the final registration at full resolution.
     """
-    # Create initial displacement field
-    # The pixel type is required to be sitkVectorFloat64 because of a constraint imposed by the Demons filters.
+    fixed_pyramid = fixed_image if isinstance(fixed_image, ImagePyramid) else ImagePyramid(fixed_image)
+    moving_pyramid = moving_image if isinstance(moving_image, ImagePyramid) else ImagePyramid(moving_image)
+    fixed_image, moving_image = fixed_pyramid.image, moving_pyramid.image
+
+    # Create initial displacement field, if there is an initial transform. Otherwise, the field starts as zeros on the
+    # grid of the first registration, so no full resolution field is allocated only to be downsampled.
     if initial_transform:
         displacement_field = sitk.TransformToDisplacementField(
-            initial_transform, sitk.sitkVectorFloat64, fixed_image.GetSize(),
+            initial_transform, field_pixel_type, fixed_image.GetSize(),
             fixed_image.GetOrigin(), fixed_image.GetSpacing(), fixed_image.GetDirection()
         )
     else:
-        displacement_field = sitk.Image(*fixed_image.GetSize(), sitk.sitkVectorFloat64)
-        displacement_field.CopyInformation(fixed_image)
+        displacement_field = None
 
     # If we are doing this with a multiscale progression, work through this progression in order first
     if multiscale_progression is not None:
@@ -302,33 +602,98 @@ def multiscale_registration(
             if not silent:
                 message(f"Step {i+1:d} of {len(multiscale_progression):d} "
                         f"| Shrink factor: {shrink_factor:0.2f}, Sigma: {smoothing_sigma:0.2f} | Starting:")
-            resampled_fixed_image = smooth_and_resample(fixed_image, shrink_factor, smoothing_sigma)
-            resampled_moving_image = smooth_and_resample(moving_image, shrink_factor, smoothing_sigma)
-            displacement_field = registration_algorithm.Execute(
-                resampled_fixed_image, resampled_moving_image,
-                sitk.Resample(displacement_field, resampled_fixed_image)
+            with timed(instrumentation, "pyramid"):
+                resampled_fixed_image = fixed_pyramid.get_level(shrink_factor, smoothing_sigma)
+                resampled_moving_image = moving_pyramid.get_level(shrink_factor, smoothing_sigma)
+            displacement_field = cast_displacement_field(
+                execute_level(
+                    registration_algorithm, resampled_fixed_image, resampled_moving_image, displacement_field,
+                    field_pixel_type, shrink_factor, smoothing_sigma, instrumentation
+                ),
+                field_pixel_type
             )
 
     # Finish off by doing one registration at full resolution
     if not silent:
         message("Final registration at full resolution:")
-    transform = registration_algorithm.Execute(
-        fixed_image, moving_image,
-        sitk.Resample(displacement_field, fixed_image)
+    transform = execute_level(
+        registration_algorithm, fixed_image, moving_image, displacement_field,
+        field_pixel_type, 1.0, 0.0, instrumentation
     )
-    return transform
+    return cast_displacement_field(transform, field_pixel_type)
 
 
-def multiscale_demons(
+def execute_level(
+    registration_algorithm: sitk.ImageFilter,
     fixed_image: sitk.Image,
     moving_image: sitk.Image,
+    displacement_field: Optional[sitk.Image],
+    field_pixel_type: int,
+    shrink_factor: float,
+    smoothing_sigma: float,
+    instrumentation: Optional[RegistrationInstrumentation] = None
+) -> sitk.Image:
+    """
+    Run one level of a multiscale registration, starting from the displacement field of the previous level.
+
+    Parameters
+    ----------
+    registration_algorithm : sitk.ImageFilter
+        The registration filter.
+
+    fixed_image : sitk.Image
+        The fixed image of the level.
+
+    moving_image : sitk.Image
+        The moving image of the level.
+
+    displacement_field : Optional[sitk.Image]
+        The displacement field of the previous level, on any grid, or `None` to start from zero displacement.
+
+    field_pixel_type : int
+        The pixel type `displacement_field` is kept in.
+
+    shrink_factor : float
+        The shrink factor of the level, for the instrumentation.
+
+    smoothing_sigma : float
+        The smoothing sigma of the level, for the instrumentation.
+
+    instrumentation : Optional[RegistrationInstrumentation]
+        If given, the level and the time spent resampling the field and registering are recorded in it.
+
+    Returns
+    -------
+    sitk.Image
+        The displacement field output by the registration filter.
+    """
+    with timed(instrumentation, "resample_field"):
+        initial_field = resample_displacement_field(displacement_field, fixed_image, field_pixel_type)
+    if instrumentation is None:
+        return registration_algorithm.Execute(fixed_image, moving_image, initial_field)
+    # the demons metric is dense, so it is evaluated on every voxel of the level at every iteration
+    instrumentation.start_level(
+        valid_points=int(np.prod(fixed_image.GetSize())),
+        shrink_factor=shrink_factor, smoothing_sigma=smoothing_sigma
+    )
+    with instrumentation.timer("registration"):
+        field = registration_algorithm.Execute(fixed_image, moving_image, initial_field)
+    instrumentation.end_level()
+    return field
+
+
+def multiscale_demons(
+    fixed_image: Union[sitk.Image, ImagePyramid],
+    moving_image: Union[sitk.Image, ImagePyramid],
     demons_type: str = "demons",
     demons_iterations: int = 100,
     demons_displacement_field_smooth_std: Optional[float] = 1.0,
     demons_update_field_smooth_std: Optional[float] = 1.0,
     initial_transform: Optional[sitk.Transform] = None,
     multiscale_progression: Optional[List[Tuple[float, float]]] = None,
-    silent: bool = True
+    silent: bool = True,
+    field_pixel_type: int = sitk.sitkVectorFloat64,
+    instrumentation: Optional[RegistrationInstrumentation] = None
 ) -> Tuple[sitk.Image, List[float]]:
     """
     Perform a multiscale registration using a given registration algorithm and fixed/moving image pair. You can
@@ -336,13 +701,13 @@ def multiscale_demons(
 
     Parameters
     ----------
-    fixed_image : sitk.Image
-        A SimpleITK image. The resulting transformation will point from this image's coordinate system into the
-        moving_image's coordinate system.
+    fixed_image : Union[sitk.Image, ImagePyramid]
+        A SimpleITK image, or its pyramid. The resulting transformation will point from this image's coordinate
+        system into the moving_image's coordinate system.
 
-    moving_image : sitk.Image
-        A SimpleITK image. The resulting transformation will point from the fixed_image's coordinate system into this
-        image's coordinate system.
+    moving_image : Union[sitk.Image, ImagePyramid]
+        A SimpleITK image, or its pyramid. The resulting transformation will point from the fixed_image's coordinate
+        system into this image's coordinate system.
 
     demons_type : str
         Specify what kind of Demons deformable registration filter to use. Default is "demons"
@@ -375,6 +740,13 @@ def multiscale_demons(
     silent : bool
         Suppress terminal output.
 
+    field_pixel_type : int
+        The pixel type the displacement field is kept in between registrations, and returned in. Use
+        `sitk.sitkVectorFloat32` to halve the memory of the fields. Default: `sitk.sitkVectorFloat64`
+
+    instrumentation : Optional[RegistrationInstrumentation]
+        If given, the timings and iterations of each level are recorded in it.
+
     Returns
     -------
     sitk.DisplacementFieldTransform
@@ -396,11 +768,12 @@ def multiscale_demons(
         demons.SetUpdateFieldStandardDeviations(demons_update_field_smooth_std)
     else:
         demons.SetSmoothUpdateField(False)
-    metric_callback = MetricTrackingCallback(demons, silent, True)
+    metric_callback = MetricTrackingCallback(demons, silent, True, instrumentation=instrumentation)
     demons.AddCommand(sitk.sitkIterationEvent, metric_callback)
     demons.AddCommand(sitk.sitkStartEvent, metric_callback.reset_patience)
     deformation_field = multiscale_registration(
-        demons, fixed_image, moving_image, initial_transform, multiscale_progression, silent
+        demons, fixed_image, moving_image, initial_transform, multiscale_progression, silent, field_pixel_type,
+        instrumentation
     )
     demons.RemoveAllCommands()
     return deformation_field, metric_callback.metric_history
@@ -610,17 +983,16 @@ def add_initial_transform_to_displacement_field(
     """
     if not silent:
         message("Converting initial transform to displacement field and adding it to the Demons displacement field.")
-    return sitk.Add(
-        field,
-        sitk.TransformToDisplacementField(
-            transform,
-            field.GetPixelID(),
-            field.GetSize(),
-            field.GetOrigin(),
-            field.GetSpacing(),
-            field.GetDirection()
-        )
+    # add in place, in the pixel type of the field, so that no third field is allocated
+    field += sitk.TransformToDisplacementField(
+        transform,
+        field.GetPixelID(),
+        field.GetSize(),
+        field.GetOrigin(),
+        field.GetSpacing(),
+        field.GetDirection()
     )
+    return field
 
 
 def write_transform_or_field(fn: str, field: sitk.Image, silent: bool) -> None:
@@ -646,7 +1018,10 @@ def write_transform_or_field(fn: str, field: sitk.Image, silent: bool) -> None:
         if fn.lower().endswith(ext):
             if not silent:
                 message(f"Writing transform to {fn}")
-            sitk.WriteTransform(sitk.DisplacementFieldTransform(field), fn)
+            # displacement field transforms only support double precision fields
+            sitk.WriteTransform(
+                sitk.DisplacementFieldTransform(cast_displacement_field(field, sitk.sitkVectorFloat64)), fn
+            )
             return
     for ext in IMAGE_EXTENSIONS:
         if fn.lower().endswith(ext):
@@ -699,4 +1074,7 @@ def write_displacement_visualization(
         spacing=field.GetSpacing(),
         direction=field.GetDirection()
     )
-    sitk.WriteImage(sitk.Resample(grid_image, sitk.DisplacementFieldTransform(field)), fn)
+    sitk.WriteImage(
+        sitk.Resample(grid_image, sitk.DisplacementFieldTransform(cast_displacement_field(field, sitk.sitkVectorFloat64))),
+        fn
+    )
@@ -0,0 +1,178 @@
+"""
+Minimum, maximum, mean, variance and histograms of an image, computed in one chunked pass.
+
+The image is flattened and read in chunks of `chunk_size` voxels, so the extra memory does not depend on the size of
+the image and the image is never upcast as a whole.
+
+- For 8 and 16 bit integer images, which covers AIMs, each chunk is counted with `bincount` into one bin per possible
+  value. Every statistic then follows exactly from these at most 65536 counts, and so does any fixed-bin histogram,
+  even when its range is only chosen after looking at the minimum and maximum.
+- For other images, the count, mean and sum of squared deviations of each chunk are merged with Welford's update
+  (in the pairwise form of Chan et al.), and the minimum and maximum are tracked per chunk. Histograms take another
+  chunked pass.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+from typing import Sequence, Tuple
+
+# the number of voxels read at a time
+DEFAULT_CHUNK_SIZE = 2 ** 20
+
+# the integer types that are counted with one bin per possible value
+VALUE_COUNT_DTYPES = [np.dtype(t) for t in [np.int8, np.uint8, np.int16, np.uint16]]
+
+
+class ImageStatistics:
+
+    def __init__(self, array: np.ndarray, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        """
+        Compute the statistics of an image in one chunked pass.
+
+        Parameters
+        ----------
+        array : np.ndarray
+            The image. It is flattened, so any shape works. It is kept (not copied) to compute histograms of images
+            that are not 8 or 16 bit integers.
+
+        chunk_size : int
+            The number of voxels to read at a time.
+        """
+        self.array = np.asarray(array).reshape(-1)
+        self.chunk_size = chunk_size
+        self.value_counts = None
+        if self.array.dtype in VALUE_COUNT_DTYPES:
+            self._count_values()
+        else:
+            self._merge_chunks()
+
+    def chunks(self):
+        """
+        Iterate over the flattened image in chunks.
+
+        Yields
+        ------
+        np.ndarray
+            Views of consecutive chunks of at most `chunk_size` voxels.
+        """
+        for start in range(0, self.array.size, self.chunk_size):
+            yield self.array[start:start + self.chunk_size]
+
+    def _count_values(self):
+        offset = int(np.iinfo(self.array.dtype).min)
+        n_values = int(np.iinfo(self.array.dtype).max) - offset + 1
+        counts = np.zeros(n_values, dtype=np.int64)
+        for chunk in self.chunks():
+            if offset == 0:
+                counts += np.bincount(chunk, minlength=n_values)
+            else:
+                counts += np.bincount(chunk.astype(np.intp) - offset, minlength=n_values)
+        self.value_counts = counts
+        self.values = np.arange(offset, offset + n_values)
+
+        present = np.flatnonzero(counts)
+        self.count = int(counts.sum())
+        if self.count == 0:
+            self.min = self.max = None
+            self.mean = self.variance = np.nan
+            return
+        self.min = self.array.dtype.type(self.values[present[0]])
+        self.max = self.array.dtype.type(self.values[present[-1]])
+        values = self.values[present].astype(np.float64)
+        weights = counts[present]
+        self.mean = float(np.dot(weights, values) / self.count)
+        self.variance = float(np.dot(weights, (values - self.mean) ** 2) / self.count)
+
+    def _merge_chunks(self):
+        self.count = 0
+        self.min = self.max = None
+        self.mean = 0.0
+        sum_squares = 0.0
+        for chunk in self.chunks():
+            n = chunk.size
+            chunk_mean = float(np.mean(chunk, dtype=np.float64))
+            chunk_sum_squares = float(np.sum((chunk.astype(np.float64) - chunk_mean) ** 2))
+            total = self.count + n
+            delta = chunk_mean - self.mean
+            self.mean += delta * n / total
+            sum_squares += chunk_sum_squares + delta ** 2 * self.count * n / total
+            self.count = total
+            self.min = np.min(chunk) if self.min is None else min(self.min, np.min(chunk))
+            self.max = np.max(chunk) if self.max is None else max(self.max, np.max(chunk))
+        if self.count == 0:
+            self.mean = self.variance = np.nan
+        else:
+            self.variance = sum_squares / self.count
+
+    @property
+    def std(self) -> float:
+        """
+        Get the standard deviation, with the same convention as `np.std` (dividing by the number of voxels).
+
+        Returns
+        -------
+        float
+            The standard deviation.
+        """
+        return float(np.sqrt(self.variance))
+
+    def histogram(self, bins: int, range: Sequence[float]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Compute a histogram with fixed bins, the same as `np.histogram(array, bins, range)`.
+
+        Parameters
+        ----------
+        bins : int
+            The number of equal width bins.
+
+        range : Sequence[float]
+            The lower and upper edge of the bins. Values outside of the range are not counted.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            The number of voxels in each bin and the bin edges.
+        """
+        if self.value_counts is not None:
+            # every voxel with a given value falls in the same bin
+            return np.histogram(self.values, bins, range, weights=self.value_counts)
+        hist = np.zeros(bins, dtype=np.int64)
+        bin_edges = None
+        for chunk in self.chunks():
+            chunk_hist, bin_edges = np.histogram(chunk, bins, range)
+            hist += chunk_hist
+        if bin_edges is None:
+            bin_edges = np.histogram(self.array, bins, range)[1]
+        return hist, bin_edges
+
+
+def histogram_range(statistics: ImageStatistics) -> Tuple[int, int]:
+    """
+    Choose the range of a histogram from the smallest integer type range that holds the image values.
+
+    Parameters
+    ----------
+    statistics : ImageStatistics
+        The statistics of the image.
+
+    Returns
+    -------
+    Tuple[int, int]
+        The range: from -32768, -128 or 0, to 32767, 255 or 127.
+    """
+    if statistics.min < -128:
+        range_min = -32768
+    elif statistics.min < 0:
+        range_min = -128
+    else:
+        range_min = 0
+
+    if statistics.max > 255:
+        range_max = 32767
+    elif statistics.max > 127:
+        range_max = 255
+    else:
+        range_max = 127
+
+    return range_min, range_max
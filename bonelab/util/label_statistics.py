@@ -0,0 +1,183 @@
+"""
+Voxel counts, volumes, centroids and bounding boxes of every label in a label image, computed in a single pass.
+
+The image is visited one slice at a time along its slowest-varying axis in memory. For each slice, `bincount` gives the
+number of voxels of each label at each coordinate along every axis. The centroids, bounding boxes and counts of all
+labels then follow from these small per-axis histograms, so the image is read once whatever the number of labels and
+no coordinate arrays larger than a slice are ever built.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+from typing import Optional, Sequence, Tuple
+
+# above this many distinct values between the smallest and largest label, the labels are mapped to a compact range
+# with `np.unique` before counting rather than counting every value in the range. Every slice adds a histogram of
+# `range * size` bins along each axis, so a wide range of mostly absent labels (e.g. {0, 1, 60000}) would cost far
+# more than the sort in `np.unique`. This is the same threshold as `blComputeOverlap` uses
+MAX_DENSE_LABEL_RANGE = 1024
+
+
+class LabelStatistics:
+
+    def __init__(
+            self,
+            labels: np.ndarray,
+            counts: np.ndarray,
+            centroids: np.ndarray,
+            bounding_boxes: np.ndarray,
+            voxel_volume: float
+    ):
+        """
+        The statistics of the labels in a label image.
+
+        Parameters
+        ----------
+        labels : np.ndarray
+            The sorted labels present in the image.
+
+        counts : np.ndarray
+            The number of voxels of each label.
+
+        centroids : np.ndarray
+            The centroid of each label in physical coordinates, shape `(len(labels), ndim)`.
+
+        bounding_boxes : np.ndarray
+            The first and last voxel index of each label along each axis, shape `(len(labels), ndim, 2)`.
+
+        voxel_volume : float
+            The volume of one voxel.
+        """
+        self.labels = labels
+        self.counts = counts
+        self.centroids = centroids
+        self.bounding_boxes = bounding_boxes
+        self.voxel_volume = voxel_volume
+
+    @property
+    def volumes(self) -> np.ndarray:
+        """
+        Get the volume of each label.
+
+        Returns
+        -------
+        np.ndarray
+            The number of voxels of each label times the voxel volume.
+        """
+        return self.counts * self.voxel_volume
+
+    def index(self, label) -> Optional[int]:
+        """
+        Get the position of a label in the statistics.
+
+        Parameters
+        ----------
+        label
+            The label.
+
+        Returns
+        -------
+        Optional[int]
+            The position of the label in `labels`, or `None` if it is not in the image.
+        """
+        position = np.searchsorted(self.labels, label)
+        if position < len(self.labels) and self.labels[position] == label:
+            return int(position)
+        return None
+
+
+def map_labels(image: np.ndarray) -> Tuple[np.ndarray, Optional[int]]:
+    """
+    Find the range of labels to count.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The label image.
+
+    Returns
+    -------
+    Tuple[np.ndarray, Optional[int]]
+        The candidate labels, and the offset to subtract from a label to get its position among them. The offset is
+        `None` when the labels are not a dense integer range, in which case they are the unique values of the image.
+    """
+    if image.size > 0 and np.issubdtype(image.dtype, np.integer):
+        low, high = int(image.min()), int(image.max())
+        if high - low < MAX_DENSE_LABEL_RANGE:
+            return np.arange(low, high + 1), low
+    return np.unique(image), None
+
+
+def compute_label_statistics(
+        image: np.ndarray,
+        spacing: Optional[Sequence[float]] = None,
+        origin: Optional[Sequence[float]] = None
+) -> LabelStatistics:
+    """
+    Compute the voxel counts, volumes, centroids and bounding boxes of all labels in a label image in a single pass.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The label image. Boolean images are treated as labels 0 and 1.
+
+    spacing : Optional[Sequence[float]]
+        The voxel spacing along each axis of `image`. Defaults to 1.
+
+    origin : Optional[Sequence[float]]
+        The physical position of the first voxel, along each axis of `image`. Defaults to 0.
+
+    Returns
+    -------
+    LabelStatistics
+        The statistics of every label present in the image, including the background.
+    """
+    image = np.asarray(image)
+    if image.dtype == bool:
+        image = image.view(np.uint8)
+    spacing = np.ones(image.ndim) if spacing is None else np.asarray(spacing, dtype=float)
+    origin = np.zeros(image.ndim) if origin is None else np.asarray(origin, dtype=float)
+
+    labels, offset = map_labels(image)
+    n_labels = len(labels)
+
+    # visit slices along the axis with the largest stride, so that each slice is contiguous in memory
+    axis = int(np.argmax(np.abs(image.strides))) if image.ndim > 0 else 0
+    other_axes = [a for a in range(image.ndim) if a != axis]
+    index = [slice(None)] * image.ndim
+    index[axis] = 0
+    # flatten the slices in memory order, e.g. the transposed view of a VTK image is Fortran ordered
+    order = "F" if image[tuple(index)].flags.f_contiguous else "C"
+    slice_shape = tuple(image.shape[a] for a in other_axes)
+    # coordinate of each voxel of a slice along the other axes
+    coordinates = [c.ravel(order=order) for c in np.indices(slice_shape)]
+
+    # histograms[a][l, c] is the number of voxels with label l at coordinate c along axis a
+    histograms = [np.zeros((n_labels, n), dtype=np.int64) for n in image.shape]
+    for i in range(image.shape[axis]):
+        index[axis] = i
+        image_slice = image[tuple(index)].ravel(order=order)
+        if offset is not None:
+            positions = image_slice.astype(np.intp) - offset
+        else:
+            positions = np.searchsorted(labels, image_slice)
+        histograms[axis][:, i] = np.bincount(positions, minlength=n_labels)
+        for a, c in zip(other_axes, coordinates):
+            n = image.shape[a]
+            histograms[a] += np.bincount(positions * n + c, minlength=n_labels * n).reshape(n_labels, n)
+
+    counts = histograms[axis].sum(axis=1)
+    present = counts > 0
+    labels, counts = labels[present], counts[present]
+    histograms = [h[present] for h in histograms]
+
+    centroids = np.zeros((len(labels), image.ndim))
+    bounding_boxes = np.zeros((len(labels), image.ndim, 2), dtype=np.int64)
+    for a, h in enumerate(histograms):
+        centroids[:, a] = origin[a] + spacing[a] * ((h @ np.arange(h.shape[1])) / counts)
+        occupied = h > 0
+        bounding_boxes[:, a, 0] = np.argmax(occupied, axis=1)
+        bounding_boxes[:, a, 1] = h.shape[1] - 1 - np.argmax(occupied[:, ::-1], axis=1)
+
+    return LabelStatistics(labels, counts, centroids, bounding_boxes, float(np.prod(spacing)))
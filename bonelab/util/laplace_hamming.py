@@ -0,0 +1,351 @@
+"""
+Real-input FFT implementation of the Laplace-Hamming filter used by `blFFTLaplaceHamming`.
+
+The reference implementation builds full 3D meshgrids for the spatial and frequency coordinates, shifts the complex
+spectrum of the image so that the Hamming window can be evaluated on the shifted grid, and keeps the full complex
+spectrum in double precision. The filter is separable apart from the |v|^2 term, so here it is built by broadcasting
+1D vectors given directly in FFT order (no shifts), applied to the half spectrum from `scipy.fft.rfftn` in single
+precision, and the `(1 - epsilon) * image` term is folded into the kernel so that only one inverse transform is needed.
+
+Taking the real part of the inverse transform in the reference implementation keeps only the part of the filter that
+is symmetric under `v -> -v`. For even image sizes the shifted Hamming window already is, but for odd sizes it is not,
+so the kernel here is the symmetrised window, which gives the same result for all image sizes.
+
+When many images with the same shape are filtered (e.g. a cohort), the kernel only depends on the shape, spacing,
+Hamming a0, Laplace epsilon and precision, so it can be kept in a `LaplaceHammingKernelCache`, in memory and optionally
+on disk. Only the most recently used kernels are kept in memory, since each is as large as the half spectrum of an
+image. `scipy.fft` keeps its own cache of FFT plans, so repeated transforms of the same shape also reuse their plan.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import tempfile
+import numpy as np
+import scipy.fft
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+
+def hamming_window_vector(n: int, hamming_a0: float) -> np.ndarray:
+    """
+    Get the 1D Hamming window used by the Laplace-Hamming filter, in FFT (unshifted) order.
+
+    Parameters
+    ----------
+    n : int
+        The length of the axis.
+
+    hamming_a0 : float
+        The a0 value of the hamming window.
+
+    Returns
+    -------
+    np.ndarray
+        The window, such that element `k` multiplies the spectrum at frequency `np.fft.fftfreq(n)[k]`.
+    """
+    return np.fft.ifftshift(hamming_a0 - (1 - hamming_a0) * np.cos(2 * np.pi * np.arange(n) / n))
+
+
+def laplace_hamming_kernel(
+        shape: Tuple[int, ...],
+        voxel_spacing: float,
+        hamming_a0: float,
+        laplace_epsilon: float,
+        dtype: type = np.float32
+) -> np.ndarray:
+    """
+    Build the frequency-domain Laplace-Hamming kernel for the half spectrum returned by `scipy.fft.rfftn`.
+
+    Parameters
+    ----------
+    shape : Tuple[int, ...]
+        The shape of the image.
+
+    voxel_spacing : float
+        The voxel spacing used to scale the frequencies.
+
+    hamming_a0 : float
+        The a0 value of the hamming window.
+
+    laplace_epsilon : float
+        The weight of the Laplace-Hamming filtered image, the original image is weighted by `1 - laplace_epsilon`.
+
+    dtype : type
+        The floating point type of the kernel.
+
+    Returns
+    -------
+    np.ndarray
+        The kernel, with shape `shape[:-1] + (shape[-1] // 2 + 1,)`.
+    """
+    ndim = len(shape)
+    half = shape[-1] // 2 + 1
+
+    def broadcast(v: np.ndarray, axis: int) -> np.ndarray:
+        return v.astype(dtype).reshape([-1 if a == axis else 1 for a in range(ndim)])
+
+    windows, reversed_windows, frequencies = [], [], []
+    for axis, n in enumerate(shape):
+        w = hamming_window_vector(n, hamming_a0)
+        w_reversed = w[(-np.arange(n)) % n]
+        f = np.fft.fftfreq(n, d=voxel_spacing)
+        if axis == ndim - 1:
+            w, w_reversed, f = w[:half], w_reversed[:half], f[:half]
+        windows.append(broadcast(w, axis))
+        reversed_windows.append(broadcast(w_reversed, axis))
+        frequencies.append(broadcast(f ** 2, axis))
+    kernel_shape = tuple(shape[:-1]) + (half,)
+    window = np.ones(kernel_shape, dtype=dtype)
+    for w in windows:
+        window *= w
+    window_reversed = np.ones(kernel_shape, dtype=dtype)
+    for w in reversed_windows:
+        window_reversed *= w
+    window += window_reversed
+    del window_reversed
+    window *= dtype(0.5 * laplace_epsilon)
+    frequency_squared = np.zeros(kernel_shape, dtype=dtype)
+    for f in frequencies:
+        frequency_squared += f
+    window *= frequency_squared
+    del frequency_squared
+    window += dtype(1 - laplace_epsilon)
+    return window
+
+
+class LaplaceHammingKernelCache:
+
+    def __init__(self, cache_directory: Optional[str] = None, max_kernels: int = 2):
+        """
+        A cache of Laplace-Hamming kernels, keyed on everything the kernel depends on.
+
+        Parameters
+        ----------
+        cache_directory : Optional[str]
+            A directory to store kernels in as `.npy` files, so they can be reused by later runs. If `None`, kernels
+            are only cached in memory.
+
+        max_kernels : int
+            The number of kernels to keep in memory. When more are needed, the least recently used kernel is dropped
+            from memory (but kept on disk, if there is a cache directory).
+        """
+        if max_kernels < 1:
+            raise ValueError(f"`max_kernels` must be at least 1, got {max_kernels}")
+        self._cache_directory = cache_directory
+        self._max_kernels = max_kernels
+        # the kernels in memory, most recently used last
+        self._kernels: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+
+    @property
+    def cache_directory(self) -> Optional[str]:
+        """
+        Get the directory kernels are stored in.
+
+        Returns
+        -------
+        Optional[str]
+            The directory, or `None` if kernels are only cached in memory.
+        """
+        return self._cache_directory
+
+    @staticmethod
+    def key(
+            shape: Tuple[int, ...],
+            voxel_spacing: float,
+            hamming_a0: float,
+            laplace_epsilon: float,
+            dtype: type
+    ) -> tuple:
+        """
+        Get the cache key for a kernel.
+
+        Parameters
+        ----------
+        shape : Tuple[int, ...]
+            The shape of the image.
+
+        voxel_spacing : float
+            The voxel spacing used to scale the frequencies.
+
+        hamming_a0 : float
+            The a0 value of the hamming window.
+
+        laplace_epsilon : float
+            The weight of the Laplace-Hamming filtered image.
+
+        dtype : type
+            The floating point type of the kernel.
+
+        Returns
+        -------
+        tuple
+            The key.
+        """
+        return (
+            tuple(int(s) for s in shape), float(voxel_spacing), float(hamming_a0), float(laplace_epsilon),
+            np.dtype(dtype).str
+        )
+
+    def filename(self, key: tuple) -> str:
+        """
+        Get the filename a kernel is stored under in the cache directory.
+
+        Parameters
+        ----------
+        key : tuple
+            The cache key.
+
+        Returns
+        -------
+        str
+            The filename.
+        """
+        if self._cache_directory is None:
+            raise ValueError("this cache does not have a cache directory")
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self._cache_directory, f"laplace_hamming_kernel_{digest}.npy")
+
+    def get(
+            self,
+            shape: Tuple[int, ...],
+            voxel_spacing: float,
+            hamming_a0: float,
+            laplace_epsilon: float,
+            dtype: type = np.float32
+    ) -> np.ndarray:
+        """
+        Get a kernel from the cache, building (and storing) it if it is not there yet.
+
+        Parameters
+        ----------
+        shape : Tuple[int, ...]
+            The shape of the image.
+
+        voxel_spacing : float
+            The voxel spacing used to scale the frequencies.
+
+        hamming_a0 : float
+            The a0 value of the hamming window.
+
+        laplace_epsilon : float
+            The weight of the Laplace-Hamming filtered image.
+
+        dtype : type
+            The floating point type of the kernel.
+
+        Returns
+        -------
+        np.ndarray
+            The kernel.
+        """
+        key = self.key(shape, voxel_spacing, hamming_a0, laplace_epsilon, dtype)
+        if key in self._kernels:
+            self._kernels.move_to_end(key)
+            return self._kernels[key]
+        kernel = None
+        if self._cache_directory is not None:
+            fn = self.filename(key)
+            if os.path.isfile(fn):
+                kernel = np.load(fn)
+        if kernel is None:
+            kernel = laplace_hamming_kernel(shape, voxel_spacing, hamming_a0, laplace_epsilon, dtype)
+            if self._cache_directory is not None:
+                os.makedirs(self._cache_directory, exist_ok=True)
+                # write to a temporary file and rename, so concurrent runs never read a partially written kernel
+                fd, tmp_fn = tempfile.mkstemp(suffix=".npy", dir=self._cache_directory)
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, kernel)
+                os.replace(tmp_fn, self.filename(key))
+        self._kernels[key] = kernel
+        while len(self._kernels) > self._max_kernels:
+            self._kernels.popitem(last=False)
+        return kernel
+
+    def clear(self) -> None:
+        """
+        Remove all kernels from the in-memory cache. Kernels stored on disk are kept.
+
+        Returns
+        -------
+        None
+        """
+        self._kernels.clear()
+
+
+def apply_laplace_hamming_kernel(image: np.ndarray, kernel: np.ndarray, workers: int = -1) -> np.ndarray:
+    """
+    Filter an image with a precomputed Laplace-Hamming kernel.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The image to filter.
+
+    kernel : np.ndarray
+        The kernel from `laplace_hamming_kernel`, built for the shape of `image`.
+
+    workers : int
+        The number of threads `scipy.fft` may use. Negative values count back from the number of CPUs.
+
+    Returns
+    -------
+    np.ndarray
+        The filtered image, in the floating point precision of the kernel.
+    """
+    expected_shape = tuple(image.shape[:-1]) + (image.shape[-1] // 2 + 1,)
+    if kernel.shape != expected_shape:
+        raise ValueError(f"kernel has shape {kernel.shape} but an image of shape {image.shape} "
+                         f"needs a kernel of shape {expected_shape}")
+    spectrum = scipy.fft.rfftn(np.asarray(image, dtype=kernel.dtype), workers=workers)
+    spectrum *= kernel
+    return scipy.fft.irfftn(spectrum, s=image.shape, workers=workers, overwrite_x=True)
+
+
+def laplace_hamming_filter(
+        image: np.ndarray,
+        laplace_epsilon: float,
+        hamming_a0: float,
+        voxel_spacing: float,
+        workers: int = -1,
+        dtype: type = np.float32,
+        kernel_cache: Optional[LaplaceHammingKernelCache] = None
+) -> np.ndarray:
+    """
+    Compute `laplace_epsilon * LH(image) + (1 - laplace_epsilon) * image`, where `LH` is the FFT Laplace-Hamming
+    filter.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The image to filter.
+
+    laplace_epsilon : float
+        The weight of the Laplace-Hamming filtered image.
+
+    hamming_a0 : float
+        The a0 value of the hamming window.
+
+    voxel_spacing : float
+        The voxel spacing used to scale the frequencies.
+
+    workers : int
+        The number of threads `scipy.fft` may use. Negative values count back from the number of CPUs.
+
+    dtype : type
+        The floating point type to compute in.
+
+    kernel_cache : Optional[LaplaceHammingKernelCache]
+        A cache to get the kernel from. If `None`, the kernel is built from scratch.
+
+    Returns
+    -------
+    np.ndarray
+        The filtered image.
+    """
+    if kernel_cache is not None:
+        kernel = kernel_cache.get(image.shape, voxel_spacing, hamming_a0, laplace_epsilon, dtype)
+    else:
+        kernel = laplace_hamming_kernel(image.shape, voxel_spacing, hamming_a0, laplace_epsilon, dtype)
+    return apply_laplace_hamming_kernel(image, kernel, workers)
@@ -0,0 +1,238 @@
+"""
+Local mean filters whose cost per voxel does not grow with the volume of the footprint.
+
+`ndimage.convolve` with a dense 3D kernel touches every footprint voxel for every output voxel. The functions here
+produce the same local mean but work from running sums instead:
+
+- all-ones (cube / box) footprints are separable, so the mean is computed with one running-sum pass per axis and the
+  cost per voxel is independent of the footprint width.
+- any other footprint (e.g. a ball) is decomposed into contiguous runs along the last axis. The image is cumulatively
+  summed along that axis once, so every run costs two lookups regardless of its length, and the cost per voxel scales
+  with the number of runs (~r^2 for a ball of radius r) instead of the number of footprint voxels (~r^3).
+
+Both paths work in single precision and reproduce the boundary handling and centering of
+`ndimage.convolve(image, footprint / footprint.sum())` (mode `reflect`). Neither path carries running sums across the
+whole first axis: the run-length path only sums along the last axis, and the box path sums along the first axis in
+blocks as long as the footprint that start at fixed positions of the full image. Filtering a slab of the image (with
+enough halo, see `first_axis_halo`) and its position in the full image therefore gives exactly the same values as
+filtering the whole image and cutting the slab out afterwards.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+from scipy import ndimage
+from typing import List, Tuple
+
+
+def convolve_origins(footprint: np.ndarray) -> List[int]:
+    """
+    Get the per-axis origins that make a correlation with the flipped footprint equivalent to `ndimage.convolve`.
+
+    Parameters
+    ----------
+    footprint : np.ndarray
+        The footprint.
+
+    Returns
+    -------
+    List[int]
+        The origin for each axis, `-1` for even-length axes and `0` for odd-length axes.
+    """
+    return [0 if s % 2 else -1 for s in footprint.shape]
+
+
+def footprint_row_runs(footprint: np.ndarray) -> List[Tuple[Tuple[int, ...], int, int]]:
+    """
+    Decompose a footprint into runs of contiguous nonzero elements along the last axis.
+
+    Parameters
+    ----------
+    footprint : np.ndarray
+        The footprint to decompose.
+
+    Returns
+    -------
+    List[Tuple[Tuple[int, ...], int, int]]
+        A list of `(row_index, start, stop)` tuples, where `row_index` indexes all but the last axis of the footprint
+        and `footprint[row_index][start:stop]` is a run of nonzero elements.
+    """
+    footprint = np.asarray(footprint) != 0
+    runs = []
+    for row_index in np.ndindex(*footprint.shape[:-1]):
+        row = np.concatenate([[False], footprint[row_index], [False]]).astype(np.int8)
+        edges = np.flatnonzero(np.diff(row))
+        for start, stop in zip(edges[0::2], edges[1::2]):
+            runs.append((row_index, int(start), int(stop)))
+    return runs
+
+
+def first_axis_halo(footprint: np.ndarray) -> int:
+    """
+    Get how many voxels a slab needs on either side along the first axis so that `mean_filter` gives exactly the same
+    values for it as for the whole image.
+
+    Parameters
+    ----------
+    footprint : np.ndarray
+        The footprint.
+
+    Returns
+    -------
+    int
+        The halo size. The block sums of the box path reach up to one footprint width further than the footprint.
+    """
+    return 2 * np.asarray(footprint).shape[0]
+
+
+def block_window_sum(padded: np.ndarray, width: int, phase: int) -> np.ndarray:
+    """
+    Sum every window of `width` consecutive elements along the first axis with running sums that restart every `width`
+    elements. A window spans at most two blocks, so its sum is the suffix sum of the first block plus the prefix sum of
+    the second, and depends only on the elements of those two blocks.
+
+    Parameters
+    ----------
+    padded : np.ndarray
+        The array to sum, of length `n + width - 1` along the first axis for `n` windows.
+
+    width : int
+        The width of the windows and blocks.
+
+    phase : int
+        The position of the first element of `padded` within its block, so that blocks start at the same elements
+        whichever part of a larger array `padded` was cut from.
+
+    Returns
+    -------
+    np.ndarray
+        The `n` window sums.
+    """
+    n = padded.shape[0] - width + 1
+    num_blocks = -(-(phase + padded.shape[0]) // width)
+    shape = (num_blocks * width,) + padded.shape[1:]
+    blocks = np.zeros(shape, dtype=padded.dtype)
+    blocks[phase:phase + padded.shape[0]] = padded
+    blocks = blocks.reshape((num_blocks, width) + padded.shape[1:])
+    prefix = np.cumsum(blocks, axis=1).reshape(shape)
+    suffix = np.cumsum(blocks[:, ::-1], axis=1, out=blocks[:, ::-1])
+    suffix = blocks.reshape(shape)
+    total = suffix[phase:phase + n] + prefix[phase + width - 1:phase + width - 1 + n]
+    # a window that starts on a block boundary is that whole block, which the suffix sum already is
+    first = -phase % width
+    total[first::width] = suffix[phase + first:phase + n:width]
+    return total
+
+
+def box_mean_filter(image: np.ndarray, size: Tuple[int, ...], first_axis_offset: int = 0) -> np.ndarray:
+    """
+    Compute the local mean over an all-ones (box) footprint using one running-sum pass per axis. Along the first axis,
+    the running sums restart at blocks anchored to the full image, see `block_window_sum`.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The image to filter.
+
+    size : Tuple[int, ...]
+        The width of the box along each axis.
+
+    first_axis_offset : int
+        The index along the first axis of the full image of the first voxel of `image`, if `image` is a slab of it.
+
+    Returns
+    -------
+    np.ndarray
+        The local mean image, as float32.
+    """
+    image = np.asarray(image, dtype=np.float32)
+    output = image
+    for axis, s in list(enumerate(size))[1:]:
+        output = ndimage.uniform_filter1d(
+            output, s, axis=axis, output=np.float32, mode="reflect", origin=(0 if s % 2 else -1)
+        )
+    center = size[0] // 2 + (0 if size[0] % 2 else -1)
+    padded = np.pad(output, [(center, size[0] - 1 - center)] + [(0, 0)] * (image.ndim - 1), mode="symmetric")
+    del output
+    total = block_window_sum(padded, size[0], (first_axis_offset - center) % size[0])
+    total /= size[0]
+    return total
+
+
+def run_length_mean_filter(image: np.ndarray, footprint: np.ndarray) -> np.ndarray:
+    """
+    Compute the local mean over an arbitrary footprint by summing row runs read from a cumulative sum image.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The image to filter.
+
+    footprint : np.ndarray
+        The footprint, must have the same number of dimensions as `image`.
+
+    Returns
+    -------
+    np.ndarray
+        The local mean image, as float32.
+    """
+    image = np.asarray(image, dtype=np.float32)
+    footprint = np.asarray(footprint)
+    if footprint.ndim != image.ndim:
+        raise ValueError(f"`footprint` must have {image.ndim} dimensions, got {footprint.ndim}")
+    # convolution flips the footprint, so do the same and then treat the problem as a correlation
+    flipped = footprint[(slice(None, None, -1),) * footprint.ndim] != 0
+    count = int(flipped.sum())
+    if count == 0:
+        raise ValueError("`footprint` must contain at least one nonzero element")
+    centers = [s // 2 + o for s, o in zip(flipped.shape, convolve_origins(flipped))]
+    pad_width = [(c, s - 1 - c) for c, s in zip(centers, flipped.shape)]
+    padded = np.pad(image, pad_width, mode="symmetric")
+    # centering each line on its own midrange keeps the magnitude of the single precision running sums small
+    line_offset = 0.5 * (padded.min(axis=-1, keepdims=True) + padded.max(axis=-1, keepdims=True))
+    padded -= line_offset
+    cumulative = np.zeros(padded.shape[:-1] + (padded.shape[-1] + 1,), dtype=np.float32)
+    np.cumsum(padded, axis=-1, out=cumulative[..., 1:])
+    del padded
+    total = np.zeros(image.shape, dtype=np.float32)
+    correction = np.zeros(image.shape[:-1] + (1,), dtype=np.float32)
+    n = image.shape[-1]
+    for row_index, start, stop in footprint_row_runs(flipped):
+        row_slices = tuple(slice(j, j + s) for j, s in zip(row_index, image.shape[:-1]))
+        total += cumulative[row_slices + (slice(stop, stop + n),)]
+        total -= cumulative[row_slices + (slice(start, start + n),)]
+        correction += (stop - start) * line_offset[row_slices]
+    total += correction
+    total /= count
+    return total
+
+
+def mean_filter(image: np.ndarray, footprint: np.ndarray, first_axis_offset: int = 0) -> np.ndarray:
+    """
+    Compute the local mean of an image over a footprint. Equivalent to
+    `ndimage.convolve(image, footprint / footprint.sum())` but in single precision and without a dense kernel.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The image to filter.
+
+    footprint : np.ndarray
+        The footprint (binary) over which the mean is computed.
+
+    first_axis_offset : int
+        The index along the first axis of the full image of the first voxel of `image`, if `image` is a slab of it
+        (with a halo of at least `first_axis_halo(footprint)`), so that the slab gets exactly the values of the full
+        image.
+
+    Returns
+    -------
+    np.ndarray
+        The local mean image, as float32.
+    """
+    footprint = np.asarray(footprint)
+    if footprint.ndim != np.ndim(image):
+        raise ValueError(f"`footprint` must have {np.ndim(image)} dimensions, got {footprint.ndim}")
+    if np.all(footprint != 0):
+        return box_mean_filter(image, footprint.shape, first_axis_offset)
+    return run_length_mean_filter(image, footprint)
@@ -0,0 +1,198 @@
+"""
+Timings and counters of one registration, written to a JSON sidecar next to the metric history.
+
+The sidecar has three parts:
+
+- `total_seconds`: the wall time from creating the instrumentation to writing it.
+- `timings`: the wall time spent in each named stage, e.g. reading, downsampling, registering and writing.
+- `levels`: one entry per multiscale level, in the order the levels ran, with when the level started (relative to
+  the start), how long it took, its shrink factor and smoothing sigma, the number of iterations and metric
+  evaluations, how many points the metric was evaluated on, and the last metric value.
+"""
+
+from __future__ import annotations
+
+import json
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, Iterator, List, Optional
+
+from bonelab.util.time_stamp import message
+
+
+class RegistrationInstrumentation:
+
+    def __init__(self):
+        """
+        Start collecting the timings and counters of a registration.
+        """
+        self._start = time.perf_counter()
+        self._timings: Dict[str, float] = {}
+        self._levels: List[Dict[str, Any]] = []
+        self._level_start: Optional[float] = None
+        self._level_valid_points: Optional[int] = None
+
+    @property
+    def timings(self) -> Dict[str, float]:
+        """
+        Get the wall time spent in each stage.
+
+        Returns
+        -------
+        Dict[str, float]
+            The seconds spent in each stage, in the order the stages were first timed.
+        """
+        return self._timings
+
+    @property
+    def levels(self) -> List[Dict[str, Any]]:
+        """
+        Get the counters of each multiscale level.
+
+        Returns
+        -------
+        List[Dict[str, Any]]
+            One dictionary per level, in the order the levels ran.
+        """
+        return self._levels
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """
+        Time a stage. Stages timed more than once with the same name are added up.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._timings[name] = self._timings.get(name, 0.0) + time.perf_counter() - start
+
+    def start_level(self, valid_points: Optional[int] = None, **properties) -> None:
+        """
+        Record that a multiscale level started, ending the previous one.
+
+        Parameters
+        ----------
+        valid_points : Optional[int]
+            The number of points the metric is evaluated on at every iteration of the level, e.g. the number of voxels
+            for a dense metric, if the iterations do not report it themselves.
+
+        **properties
+            Properties of the level to record, e.g. `shrink_factor` and `smoothing_sigma`.
+        """
+        self.end_level()
+        now = time.perf_counter()
+        self._levels.append({
+            "level": len(self._levels),
+            **properties,
+            "start_seconds": now - self._start,
+            "seconds": None,
+            "iterations": 0,
+            "metric_evaluations": 0,
+            "metric_valid_points": None,
+            "metric_samples": 0,
+            "final_metric": None,
+        })
+        self._level_start = now
+        self._level_valid_points = valid_points
+
+    def record_iteration(
+            self,
+            metric: float,
+            valid_points: Optional[int] = None,
+            evaluations: Optional[int] = 1
+    ) -> None:
+        """
+        Record one iteration of the current level, starting a level if none has been started.
+
+        Parameters
+        ----------
+        metric : float
+            The metric value at the iteration.
+
+        valid_points : Optional[int]
+            The number of points the metric was evaluated on. Defaults to the `valid_points` of the level, if any.
+
+        evaluations : Optional[int]
+            The number of metric evaluations the iteration made, or `None` if it is not known, in which case the
+            level's `metric_evaluations` is `None` as well.
+        """
+        if self._level_start is None:
+            self.start_level()
+        level = self._levels[-1]
+        level["iterations"] += 1
+        valid_points = valid_points if valid_points is not None else self._level_valid_points
+        if evaluations is None or level["metric_evaluations"] is None:
+            level["metric_evaluations"] = None
+        else:
+            level["metric_evaluations"] += evaluations
+        if valid_points is not None:
+            level["metric_valid_points"] = valid_points
+            level["metric_samples"] += valid_points
+        level["final_metric"] = metric
+
+    def end_level(self) -> None:
+        """
+        Record that the current level ended, if one is running.
+        """
+        if self._level_start is not None:
+            self._levels[-1]["seconds"] = time.perf_counter() - self._level_start
+            self._level_start = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Get all timings and counters, ending the current level.
+
+        Returns
+        -------
+        Dict[str, Any]
+            The `total_seconds`, `timings` and `levels`.
+        """
+        self.end_level()
+        return {
+            "total_seconds": time.perf_counter() - self._start,
+            "timings": dict(self._timings),
+            "levels": [dict(level) for level in self._levels],
+        }
+
+    def write(self, fn: str, silent: bool) -> None:
+        """
+        Write all timings and counters to a JSON file.
+
+        Parameters
+        ----------
+        fn : str
+            The filename.
+
+        silent : bool
+            Whether to suppress messages.
+        """
+        if not silent:
+            message(f"Writing registration instrumentation to {fn}.")
+        with open(fn, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def timed(instrumentation: Optional[RegistrationInstrumentation], name: str):
+    """
+    Time a stage if there is an instrumentation, otherwise do nothing.
+
+    Parameters
+    ----------
+    instrumentation : Optional[RegistrationInstrumentation]
+        The instrumentation, or `None`.
+
+    name : str
+        The name of the stage.
+
+    Returns
+    -------
+    ContextManager
+        The timer of the stage, or a context manager that does nothing.
+    """
+    return instrumentation.timer(name) if instrumentation is not None else nullcontext()
@@ -4,13 +4,15 @@ import csv
 import os
 from argparse import ArgumentTypeError, Namespace
 
+import numpy as np
 import SimpleITK as sitk
-from typing import List, Callable
+from typing import List, Callable, Optional
 import yaml
 from matplotlib import pyplot as plt
 
 from bonelab.io.vtk_helpers import get_vtk_reader
 from bonelab.util.demons_registration_util import smooth_and_resample
+from bonelab.util.registration_instrumentation import RegistrationInstrumentation, timed
 from bonelab.util.time_stamp import message
 from bonelab.util.vtk_util import vtkImageData_to_numpy
 
@@ -25,6 +27,9 @@ INPUT_EXTENSIONS = [".aim", ".nii", ".nii.gz"]
 
 TRANSFORM_EXTENSIONS = [".txt", ".tfm", ".xfm", ".hdf", ".mat"]
 
+# how far, in voxels, a transformed voxel center can be from a voxel center and still count as landing on it
+AXIS_PERMUTATION_TOLERANCE = 1e-6
+
 
 # CLASSES #
 class MetricTrackingCallback:
@@ -453,7 +458,8 @@ def read_and_downsample_images(
         downsampling_shrink_factor: float,
         downsampling_smoothing_sigma: float,
         moving_is_downsampled_atlas: bool,
-        silent: bool
+        silent: bool,
+        instrumentation: Optional[RegistrationInstrumentation] = None
 ) -> Tuple[sitk.Image, sitk.Image]:
     """
     Read the fixed and moving images, optionally downsampling both or just the fixed image if the moving image is an
@@ -479,6 +485,9 @@ def read_and_downsample_images(
     silent : bool
         Whether to suppress messages.
 
+    instrumentation : Optional[RegistrationInstrumentation]
+        If given, the time spent reading and downsampling is recorded in it.
+
     Returns
     -------
     Tuple[sitk.Image, sitk.Image]
@@ -487,20 +496,22 @@ def read_and_downsample_images(
     if not silent:
         message("Reading inputs.")
     # load images, cast to single precision float
-    fixed_image = sitk.Cast(read_image(fixed_image, "fixed_image", silent), sitk.sitkFloat32)
-    moving_image = sitk.Cast(read_image(moving_image, "moving_image", silent), sitk.sitkFloat32)
+    with timed(instrumentation, "read"):
+        fixed_image = sitk.Cast(read_image(fixed_image, "fixed_image", silent), sitk.sitkFloat32)
+        moving_image = sitk.Cast(read_image(moving_image, "moving_image", silent), sitk.sitkFloat32)
     # optionally, downsample the fixed and moving images
     if (downsampling_shrink_factor is not None) and (downsampling_smoothing_sigma is not None):
         if not silent:
             message(f"Downsampling and smoothing inputs with shrink factor {downsampling_shrink_factor} and sigma "
                     f"{downsampling_smoothing_sigma}.")
-        fixed_image = smooth_and_resample(
-            fixed_image, downsampling_shrink_factor, downsampling_smoothing_sigma
-        )
-        if not moving_is_downsampled_atlas:
-            moving_image = smooth_and_resample(
-                moving_image, downsampling_shrink_factor, downsampling_smoothing_sigma
+        with timed(instrumentation, "downsample"):
+            fixed_image = smooth_and_resample(
+                fixed_image, downsampling_shrink_factor, downsampling_smoothing_sigma
             )
+            if not moving_is_downsampled_atlas:
+                moving_image = smooth_and_resample(
+                    moving_image, downsampling_shrink_factor, downsampling_smoothing_sigma
+                )
     elif (downsampling_shrink_factor is None) and (downsampling_smoothing_sigma is None):
         # do not downsample fixed and moving images
         if not silent:
@@ -511,6 +522,184 @@ def read_and_downsample_images(
     return fixed_image, moving_image
 
 
+def read_mask(fn: str, mask_name: str, silent: bool) -> sitk.Image:
+    """
+    Read a mask and binarize it, so that any nonzero voxel is inside the mask.
+
+    Parameters
+    ----------
+    fn : str
+        The mask filename.
+
+    mask_name : str
+        The name of the mask, for terminal output.
+
+    silent : bool
+        Whether to suppress messages.
+
+    Returns
+    -------
+    sitk.Image
+        The mask, with value 1 inside and 0 outside, as an unsigned char image.
+    """
+    return sitk.Cast(sitk.NotEqual(read_image(fn, mask_name, silent), 0), sitk.sitkUInt8)
+
+
+def resample_mask_to_image(mask: sitk.Image, image: sitk.Image, silent: bool) -> sitk.Image:
+    """
+    Resample a mask onto the voxel grid of an image with nearest neighbour interpolation, e.g. onto the grid of an
+    image after it has been downsampled. A mask already on the grid of the image is returned as it is.
+
+    Parameters
+    ----------
+    mask : sitk.Image
+        The mask.
+
+    image : sitk.Image
+        The image whose grid the mask should be on.
+
+    silent : bool
+        Whether to suppress messages.
+
+    Returns
+    -------
+    sitk.Image
+        The mask on the grid of the image.
+    """
+    if (
+        mask.GetSize() == image.GetSize()
+        and mask.GetOrigin() == image.GetOrigin()
+        and mask.GetSpacing() == image.GetSpacing()
+        and mask.GetDirection() == image.GetDirection()
+    ):
+        return mask
+    if not silent:
+        message("Resampling mask onto the image grid.")
+    return sitk.Resample(mask, image, sitk.Transform(), sitk.sitkNearestNeighbor, 0, sitk.sitkUInt8)
+
+
+def resample_by_axis_permutation(
+        moving: sitk.Image,
+        reference: sitk.Image,
+        transform: sitk.Transform
+) -> Optional[sitk.Image]:
+    """
+    Resample an image onto the grid of a reference image by permuting and flipping its axes, if the transform maps
+    every voxel center of the reference exactly onto a voxel center of the image, e.g. when mirroring an image with an
+    axis-aligned direction matrix about its center.
+
+    The voxels are only rearranged in memory, so this is much faster than `sitk.Resample` and, whatever the
+    interpolator, gives the voxel values exactly.
+
+    Parameters
+    ----------
+    moving : sitk.Image
+        The image to resample.
+
+    reference : sitk.Image
+        The image with the grid to resample onto.
+
+    transform : sitk.Transform
+        The transform from the reference to the moving image, as given to `sitk.Resample`.
+
+    Returns
+    -------
+    Optional[sitk.Image]
+        The resampled image, the same as `sitk.Resample(moving, reference, transform)`, or `None` if the transform
+        does not map the grid of the reference one-to-one onto the grid of the image, in which case the image has to
+        be resampled with interpolation.
+    """
+    dimension = moving.GetDimension()
+    if not transform.IsLinear() or reference.GetDimension() != dimension:
+        return None
+    # the affine map of the transform, from where it takes the origin and the unit vectors
+    offset = np.asarray(transform.TransformPoint((0.0,) * dimension))
+    matrix = np.stack(
+        [np.asarray(transform.TransformPoint(tuple(unit))) - offset for unit in np.eye(dimension)], axis=1
+    )
+
+    def index_to_physical(image: sitk.Image) -> np.ndarray:
+        return np.asarray(image.GetDirection()).reshape(dimension, dimension) * np.asarray(image.GetSpacing())
+
+    # the map from reference voxel indices to moving voxel indices
+    physical_to_moving = np.linalg.inv(index_to_physical(moving))
+    index_matrix = physical_to_moving @ matrix @ index_to_physical(reference)
+    index_offset = physical_to_moving @ (
+        matrix @ np.asarray(reference.GetOrigin()) + offset - np.asarray(moving.GetOrigin())
+    )
+    permutation, voxel_offset = np.round(index_matrix), np.round(index_offset)
+    if (
+        not np.allclose(index_matrix, permutation, rtol=0, atol=AXIS_PERMUTATION_TOLERANCE)
+        or not np.allclose(index_offset, voxel_offset, rtol=0, atol=AXIS_PERMUTATION_TOLERANCE)
+        or not np.all(np.isin(permutation, [-1, 0, 1]))
+        or not np.all(np.abs(permutation).sum(axis=0) == 1)
+        or not np.all(np.abs(permutation).sum(axis=1) == 1)
+    ):
+        return None
+    # reference axis k is read from moving axis order[k], forwards or backwards
+    order = [int(np.flatnonzero(permutation[:, k])[0]) for k in range(dimension)]
+    flip = [bool(permutation[order[k], k] < 0) for k in range(dimension)]
+    for k, m in enumerate(order):
+        if reference.GetSize()[k] != moving.GetSize()[m]:
+            return None
+        if voxel_offset[m] != (moving.GetSize()[m] - 1 if flip[k] else 0):
+            return None
+    resampled = sitk.PermuteAxes(moving, order) if order != list(range(dimension)) else sitk.Image(moving)
+    if any(flip):
+        resampled = sitk.Flip(resampled, flip)
+    resampled.CopyInformation(reference)
+    return resampled
+
+
+def read_and_downsample_masks(
+        fixed_mask: Optional[str],
+        moving_mask: Optional[str],
+        fixed_image: sitk.Image,
+        moving_image: sitk.Image,
+        silent: bool,
+        instrumentation: Optional[RegistrationInstrumentation] = None
+) -> Tuple[Optional[sitk.Image], Optional[sitk.Image]]:
+    """
+    Read the fixed and moving masks and put them on the grids of the fixed and moving images returned by
+    `read_and_downsample_images`, so the masks are downsampled exactly when, and as much as, their images are.
+
+    Parameters
+    ----------
+    fixed_mask : Optional[str]
+        The fixed mask filename, or `None` for no fixed mask.
+
+    moving_mask : Optional[str]
+        The moving mask filename, or `None` for no moving mask.
+
+    fixed_image : sitk.Image
+        The (possibly downsampled) fixed image.
+
+    moving_image : sitk.Image
+        The (possibly downsampled) moving image.
+
+    silent : bool
+        Whether to suppress messages.
+
+    instrumentation : Optional[RegistrationInstrumentation]
+        If given, the time spent reading and resampling the masks is recorded in it.
+
+    Returns
+    -------
+    Tuple[Optional[sitk.Image], Optional[sitk.Image]]
+        The fixed and moving masks, `None` for a mask that was not given.
+    """
+    masks = []
+    for fn, mask_name, image in [(fixed_mask, "fixed_mask", fixed_image), (moving_mask, "moving_mask", moving_image)]:
+        if fn is None:
+            masks.append(None)
+        else:
+            with timed(instrumentation, "read_masks"):
+                mask = read_mask(fn, mask_name, silent)
+            with timed(instrumentation, "resample_masks"):
+                masks.append(resample_mask_to_image(mask, image, silent))
+    return masks[0], masks[1]
+
+
 def setup_optimizer(
         registration_method: sitk.ImageRegistrationMethod,
         max_iterations: int,
@@ -679,6 +868,113 @@ def setup_similarity_metric(
     return registration_method
 
 
+def setup_metric_masks(
+        registration_method: sitk.ImageRegistrationMethod,
+        fixed_mask: Optional[sitk.Image],
+        moving_mask: Optional[sitk.Image],
+        silent: bool
+) -> sitk.ImageRegistrationMethod:
+    """
+    Restrict the similarity metric to the voxels inside the fixed and moving masks. Metric samples are only taken
+    where the fixed mask is nonzero, and samples that map outside of the moving mask are discarded.
+
+    Parameters
+    ----------
+    registration_method : sitk.ImageRegistrationMethod
+        The registration method to set the metric masks for.
+
+    fixed_mask : Optional[sitk.Image]
+        The mask in the fixed image frame, or `None` to sample the whole fixed image.
+
+    moving_mask : Optional[sitk.Image]
+        The mask in the moving image frame, or `None` to not restrict where samples may map to.
+
+    silent : bool
+        Whether to suppress messages.
+
+    Returns
+    -------
+    sitk.ImageRegistrationMethod
+        The registration method with the metric masks set.
+    """
+    if fixed_mask is not None:
+        if not silent:
+            message("Restricting the similarity metric to the fixed mask.")
+        registration_method.SetMetricFixedMask(fixed_mask)
+    if moving_mask is not None:
+        if not silent:
+            message("Restricting the similarity metric to the moving mask.")
+        registration_method.SetMetricMovingMask(moving_mask)
+    return registration_method
+
+
+def setup_instrumentation(
+        registration_method: sitk.ImageRegistrationMethod,
+        instrumentation: RegistrationInstrumentation,
+        shrink_factors: Optional[List[int]],
+        smoothing_sigmas: Optional[List[float]],
+        optimizer: str,
+        silent: bool
+) -> sitk.ImageRegistrationMethod:
+    """
+    Record the start and end of each multiscale level and every iteration of the registration method in the
+    instrumentation.
+
+    Parameters
+    ----------
+    registration_method : sitk.ImageRegistrationMethod
+        The registration method to instrument.
+
+    instrumentation : RegistrationInstrumentation
+        The instrumentation to record in.
+
+    shrink_factors : Optional[List[int]]
+        The shrink factor of each level, or `None` for a single level at full resolution.
+
+    smoothing_sigmas : Optional[List[float]]
+        The smoothing sigma of each level, or `None` for a single level at full resolution.
+
+    optimizer : str
+        The optimizer, `GradientDescent` or `Powell`. A gradient descent iteration evaluates the metric once, but the
+        number of metric evaluations in the line searches of a Powell iteration is not reported by SimpleITK, so for
+        Powell the evaluations are recorded as unknown.
+
+    silent : bool
+        Whether to suppress messages.
+
+    Returns
+    -------
+    sitk.ImageRegistrationMethod
+        The registration method with the instrumentation commands added.
+    """
+    if not silent:
+        message("Recording per-level timings and metric evaluation counts.")
+    shrink_factors = shrink_factors if shrink_factors is not None else [1]
+    smoothing_sigmas = smoothing_sigmas if smoothing_sigmas is not None else [0]
+    evaluations = 1 if optimizer == "GradientDescent" else None
+
+    def start_level():
+        level = registration_method.GetCurrentLevel()
+        sampling_percentages = registration_method.GetMetricSamplingPercentagePerLevel()
+        instrumentation.start_level(
+            shrink_factor=shrink_factors[level],
+            smoothing_sigma=smoothing_sigmas[level],
+            sampling_percentage=sampling_percentages[min(level, len(sampling_percentages) - 1)]
+        )
+
+    def record_iteration():
+        instrumentation.record_iteration(
+            registration_method.GetMetricValue(),
+            registration_method.GetMetricNumberOfValidPoints(),
+            evaluations
+        )
+
+    registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, start_level)
+    registration_method.AddCommand(sitk.sitkIterationEvent, record_iteration)
+    registration_method.AddCommand(sitk.sitkEndEvent, instrumentation.end_level)
+    return registration_method
+
+
 def setup_interpolator(
         registration_method: sitk.ImageRegistrationMethod,
         interpolator: str,
@@ -890,6 +1186,59 @@ def message_s(m: str, s: bool) -> None:
         message(m)
 
 
+def downsample_image(
+        image: sitk.Image,
+        downsampling_shrink_factor: Optional[float],
+        downsampling_smoothing_sigma: Optional[float],
+        silent: bool,
+        instrumentation: Optional[RegistrationInstrumentation] = None
+) -> sitk.Image:
+    """
+    Cast an image that has already been read to single precision float and optionally downsample it, so that an image
+    needed at both full resolution and downsampled only has to be read once.
+
+    Parameters
+    ----------
+    image : sitk.Image
+        The image at full resolution
+
+    downsampling_shrink_factor : Optional[float]
+        The shrink factor to apply to the image. If `None`, the image will not be downsampled. If
+        `downsampling_smoothing_sigma` is `None`, this parameter must also be `None`
+
+    downsampling_smoothing_sigma : Optional[float]
+        The smoothing sigma to apply to the image. If `None`, the image will not be smoothed. If
+        `downsampling_shrink_factor` is `None`, this parameter must also be `None`
+
+    silent : bool
+        Silent flag
+
+    instrumentation : Optional[RegistrationInstrumentation]
+        If given, the time spent downsampling is recorded in it.
+
+    Returns
+    -------
+    sitk.Image
+        The image, possibly downsampled and smoothed
+    """
+    image = sitk.Cast(image, sitk.sitkFloat32)
+    # optionally, downsample the fixed and moving images
+    if (downsampling_shrink_factor is not None) and (downsampling_smoothing_sigma is not None):
+        message_s(f"Downsampling and smoothing inputs with shrink factor {downsampling_shrink_factor} and sigma "
+                  f"{downsampling_smoothing_sigma}.", silent)
+        with timed(instrumentation, "downsample"):
+            image = smooth_and_resample(
+                image, downsampling_shrink_factor, downsampling_smoothing_sigma
+            )
+    elif (downsampling_shrink_factor is None) and (downsampling_smoothing_sigma is None):
+        # do not downsample fixed and moving images
+        message_s("Using inputs at full resolution.", silent)
+    else:
+        raise ValueError("one of `downsampling-shrink-factor` or `downsampling-smoothing-sigma` have not been specified"
+                         " - you must either leave both as the default `None` or specify both")
+    return image
+
+
 def read_and_downsample_image(
         image: str,
         label: str,
@@ -925,19 +1274,8 @@ def read_and_downsample_image(
         The image, possibly downsampled and smoothed
     """
     message_s("Reading inputs.", silent)
-    # load images, cast to single precision float
-    image = sitk.Cast(read_image(image, label, silent), sitk.sitkFloat32)
-    # optionally, downsample the fixed and moving images
-    if (downsampling_shrink_factor is not None) and (downsampling_smoothing_sigma is not None):
-        message_s(f"Downsampling and smoothing inputs with shrink factor {downsampling_shrink_factor} and sigma "
-                  f"{downsampling_smoothing_sigma}.", silent)
-        image = smooth_and_resample(
-            image, downsampling_shrink_factor, downsampling_smoothing_sigma
-        )
-    elif (downsampling_shrink_factor is None) and (downsampling_smoothing_sigma is None):
-        # do not downsample fixed and moving images
-        message_s("Using inputs at full resolution.", silent)
-    else:
-        raise ValueError("one of `downsampling-shrink-factor` or `downsampling-smoothing-sigma` have not been specified"
-                         " - you must either leave both as the default `None` or specify both")
-    return image
+    return downsample_image(
+        read_image(image, label, silent),
+        downsampling_shrink_factor, downsampling_smoothing_sigma,
+        silent
+    )
@@ -0,0 +1,248 @@
+"""
+Process a volume in slabs along its first axis, so that only a slab (plus a halo) has to be held in memory at a time.
+
+The input and output volumes live on disk as `.npy` files that are memory-mapped by each worker. A mask function is
+applied to each slab and its halo, and the halo is cut away before the result is written. Small connected components
+are then removed with the same semantics as `skimage.morphology.remove_small_objects` (face connectivity, components
+with fewer than `min_size` voxels are removed): each slab is labelled independently, the labels that touch across slab
+boundaries are merged, and the sizes of the merged components decide which labels are kept in each slab.
+
+The mask function is given each slab together with the index of its first voxel in the volume, for computations that
+have to line up with the whole volume (e.g. running sums restarted at fixed positions). As long as the mask function
+computes each voxel only from the voxels within `halo` of it along the first axis, the result is identical to
+applying the mask function and `remove_small_objects` to the whole volume.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from typing import Callable, List, Tuple
+
+from bonelab.util.time_stamp import message
+
+
+class Slab:
+
+    def __init__(self, start: int, stop: int, halo_start: int, halo_stop: int):
+        """
+        A slab of a volume along the first axis.
+
+        Parameters
+        ----------
+        start : int
+            The first index of the slab.
+
+        stop : int
+            One past the last index of the slab.
+
+        halo_start : int
+            The first index of the slab including the halo.
+
+        halo_stop : int
+            One past the last index of the slab including the halo.
+        """
+        self.start = start
+        self.stop = stop
+        self.halo_start = halo_start
+        self.halo_stop = halo_stop
+
+    @property
+    def core(self) -> slice:
+        """
+        Get the slice that crops the slab out of the slab plus halo.
+
+        Returns
+        -------
+        slice
+            The slice, relative to `halo_start`.
+        """
+        return slice(self.start - self.halo_start, self.stop - self.halo_start)
+
+
+def get_slabs(length: int, slab_thickness: int, halo: int) -> List[Slab]:
+    """
+    Split the first axis of a volume into slabs with halos.
+
+    Parameters
+    ----------
+    length : int
+        The length of the first axis of the volume.
+
+    slab_thickness : int
+        The thickness of each slab, not counting the halo. The last slab may be thinner.
+
+    halo : int
+        The number of voxels to add on either side of each slab, where available.
+
+    Returns
+    -------
+    List[Slab]
+        The slabs.
+    """
+    if slab_thickness < 1:
+        raise ValueError(f"`slab_thickness` must be at least 1, got {slab_thickness}")
+    if halo < 0:
+        raise ValueError(f"`halo` must be non-negative, got {halo}")
+    return [
+        Slab(start, min(start + slab_thickness, length), max(start - halo, 0), min(start + slab_thickness + halo, length))
+        for start in range(0, length, slab_thickness)
+    ]
+
+
+def _label(mask: np.ndarray) -> Tuple[np.ndarray, int]:
+    return ndimage.label(mask, structure=ndimage.generate_binary_structure(mask.ndim, 1))
+
+
+def _mask_slab(
+        input_fn: str,
+        output_fn: str,
+        mask_function: Callable[[np.ndarray, int], np.ndarray],
+        slab: Slab
+) -> Tuple[int, np.ndarray, np.ndarray, np.ndarray]:
+    image = np.load(input_fn, mmap_mode="r")
+    mask = np.asarray(
+        mask_function(np.array(image[slab.halo_start:slab.halo_stop]), slab.halo_start), dtype=bool
+    )[slab.core]
+    del image
+    output = np.load(output_fn, mmap_mode="r+")
+    output[slab.start:slab.stop] = mask
+    output.flush()
+    del output
+    labels, num_labels = _label(mask)
+    return num_labels, np.bincount(labels.ravel(), minlength=num_labels + 1), labels[0].copy(), labels[-1].copy()
+
+
+def _filter_slab(output_fn: str, slab: Slab, keep: np.ndarray) -> None:
+    output = np.load(output_fn, mmap_mode="r+")
+    labels, _ = _label(np.array(output[slab.start:slab.stop]))
+    output[slab.start:slab.stop] = keep[labels]
+    output.flush()
+
+
+def stitch_components(
+        num_labels: List[int],
+        sizes: List[np.ndarray],
+        first_planes: List[np.ndarray],
+        last_planes: List[np.ndarray],
+        min_size: int
+) -> List[np.ndarray]:
+    """
+    Merge connected components that touch across slab boundaries and decide which labels to keep in each slab.
+
+    Parameters
+    ----------
+    num_labels : List[int]
+        The number of labels in each slab.
+
+    sizes : List[np.ndarray]
+        The voxel count of each label in each slab, including the background (label 0).
+
+    first_planes : List[np.ndarray]
+        The labels in the first plane of each slab.
+
+    last_planes : List[np.ndarray]
+        The labels in the last plane of each slab.
+
+    min_size : int
+        The minimum size of a merged component for it to be kept.
+
+    Returns
+    -------
+    List[np.ndarray]
+        For each slab, a boolean lookup table indexed by label that is `True` for labels to keep.
+    """
+    offsets = np.concatenate([[0], np.cumsum(num_labels)]).astype(np.int64)
+    total = int(offsets[-1])
+    if total == 0:
+        return [np.zeros(n + 1, dtype=bool) for n in num_labels]
+    rows, cols = [], []
+    for i in range(len(num_labels) - 1):
+        touching = (last_planes[i] > 0) & (first_planes[i + 1] > 0)
+        rows.append(offsets[i] + last_planes[i][touching].astype(np.int64) - 1)
+        cols.append(offsets[i + 1] + first_planes[i + 1][touching].astype(np.int64) - 1)
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+    graph = coo_matrix((np.ones(rows.shape[0], dtype=np.int8), (rows, cols)), shape=(total, total))
+    _, component = connected_components(graph, directed=False)
+    component_sizes = np.bincount(component, weights=np.concatenate([s[1:] for s in sizes]))
+    keep = component_sizes[component] >= min_size
+    return [np.concatenate([[False], keep[offsets[i]:offsets[i + 1]]]) for i in range(len(num_labels))]
+
+
+def mask_in_slabs(
+        input_fn: str,
+        output_fn: str,
+        mask_function: Callable[[np.ndarray, int], np.ndarray],
+        halo: int,
+        slab_thickness: int,
+        min_size: int,
+        workers: int,
+        silent: bool
+) -> None:
+    """
+    Apply a mask function to a volume slab by slab and then remove small connected components across the whole volume.
+
+    Parameters
+    ----------
+    input_fn : str
+        The `.npy` file containing the input volume.
+
+    output_fn : str
+        The `.npy` file to write the boolean output volume to.
+
+    mask_function : Callable[[np.ndarray, int], np.ndarray]
+        The function mapping a slab (with halo) of the input, and the index along the first axis of the volume of the
+        first voxel of the slab, to a boolean mask of the same shape. Must be picklable if `workers` is greater than 1.
+
+    halo : int
+        The number of voxels along the first axis that the mask function needs on either side of a voxel.
+
+    slab_thickness : int
+        The thickness of each slab, not counting the halo.
+
+    min_size : int
+        The minimum size of connected components to keep.
+
+    workers : int
+        The number of worker processes. If 1, slabs are processed serially in this process.
+
+    silent : bool
+        Whether to suppress terminal output.
+
+    Returns
+    -------
+    None
+    """
+    image = np.load(input_fn, mmap_mode="r")
+    shape = image.shape
+    del image
+    np.lib.format.open_memmap(output_fn, mode="w+", dtype=bool, shape=shape).flush()
+    slabs = get_slabs(shape[0], slab_thickness, halo)
+    if not silent:
+        message(f"Processing {len(slabs)} slabs of thickness {slab_thickness} with a halo of {halo} "
+                f"using {workers} worker(s).")
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        if executor is not None:
+            results = list(executor.map(
+                _mask_slab, *zip(*[(input_fn, output_fn, mask_function, slab) for slab in slabs])
+            ))
+        else:
+            results = [_mask_slab(input_fn, output_fn, mask_function, slab) for slab in slabs]
+        if not silent:
+            message("Stitching connected components across slab boundaries...")
+        keep = stitch_components(*[list(r) for r in zip(*results)], min_size=min_size)
+        if not silent:
+            message("Removing small objects...")
+        if executor is not None:
+            list(executor.map(_filter_slab, *zip(*[(output_fn, slab, k) for slab, k in zip(slabs, keep)])))
+        else:
+            for slab, k in zip(slabs, keep):
+                _filter_slab(output_fn, slab, k)
+    finally:
+        if executor is not None:
+            executor.shutdown()
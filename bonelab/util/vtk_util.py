@@ -48,3 +48,33 @@ def vtkImageData_to_numpy(image):
     array = vtk_to_numpy(image.GetPointData().GetScalars())
     array = array.reshape(image. GetDimensions(), order='F')
     return array
+
+def vtkImageData_to_sitk(image):
+    '''Convert vtkImageData to a SimpleITK image
+
+    The result is the same image that writing `image` with
+    vtkNIFTIImageWriter and reading the file back with `sitk.ReadImage`
+    gives, without the round trip through the disk: the pixel type is
+    kept, the spacing and origin are single precision, and the RAS
+    coordinates VTK writes are converted to the LPS coordinates ITK reads,
+    so the x and y axes of the origin and direction are flipped.
+
+    The pixel buffer is read directly from VTK and copied once into the
+    SimpleITK image.
+
+    Args:
+        image (vtkImageData):   Input data
+
+    Returns:
+        sitk.Image:             Image converted to SimpleITK
+    '''
+    import SimpleITK as sitk
+
+    # [x, y, z] view of the VTK buffer -> C ordered [z, y, x] view
+    array = np.transpose(vtkImageData_to_numpy(image))
+    sitk_image = sitk.GetImageFromArray(array)
+    sitk_image.SetSpacing([float(np.float32(s)) for s in image.GetSpacing()])
+    origin = [float(np.float32(o)) for o in image.GetOrigin()]
+    sitk_image.SetOrigin([-origin[0], -origin[1], origin[2]])
+    sitk_image.SetDirection([-1, 0, 0, 0, -1, 0, 0, 0, 1])
+    return sitk_image
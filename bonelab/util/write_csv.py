@@ -1,6 +1,7 @@
 '''Utility function for writing to a csv file'''
 
 import os
+import uuid
 from collections import OrderedDict
 
 
@@ -33,3 +34,46 @@ def write_csv(entry, csv_file, delimiter=','):
     # Write entry
     with open(csv_file, 'a') as f:
         f.write(delimiter.join(['{}'.format(v) for k,v in entry.items()]) + os.linesep)
+
+
+def write_csv_rows(entries, csv_file, delimiter=','):
+    '''Write many entries to a CSV file in one go, atomically.
+
+    Unlike `write_csv`, this always replaces the file. The rows are written
+    to a temporary file in the same directory which is then moved over
+    `csv_file`, so readers never see a partially written file and two
+    writers cannot interleave their rows.
+
+    The header is the union of the keys of all entries, in the order they
+    are first seen. Entries missing a key get an empty value for it.
+
+    Args:
+        entries (list):         List of OrderedDict entries to write
+        csv_file (string):      Filename to write to
+        delimiter (string):     Delimiter to be used for writing
+
+    Returns:
+        None
+    '''
+    # Header is the union of all keys
+    header = OrderedDict()
+    for entry in entries:
+        for k in entry.keys():
+            header[k] = None
+
+    # Write to a temporary file next to the output and move it into place.
+    # The file is created with the usual permissions (0o666 minus the umask),
+    # like `open` would, rather than owner-only like `tempfile.mkstemp`
+    directory = os.path.dirname(os.path.abspath(csv_file))
+    tmp_file = os.path.join(directory, '.{}.{}'.format(os.path.basename(csv_file), uuid.uuid4().hex))
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(delimiter.join(header.keys()) + os.linesep)
+            for entry in entries:
+                f.write(delimiter.join(['{}'.format(entry.get(k, '')) for k in header.keys()]) + os.linesep)
+        os.replace(tmp_file, csv_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
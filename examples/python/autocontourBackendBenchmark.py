@@ -0,0 +1,74 @@
+# Description:
+#   Benchmark the VTK and NumPy backends of blAutocontour against each other
+#   on a synthetic distal radius-like phantom (a noisy cortical ring around
+#   trabecular bone and marrow, surrounded by air), and check that both
+#   backends give identical masks.
+#
+# Notes:
+#   - Needs vtkbone, since the pipelines live in bonelab.cli.autocontour
+#   - Each pipeline is built once and then run --repeats times, the best time
+#     is reported
+#
+# Usage:
+#   python autocontourBackendBenchmark.py --size 600 --slices 168
+
+# Libraries
+import argparse
+import time
+import numpy as np
+import vtk
+
+from bonelab.cli.autocontour import create_parser, AutocontourBuiePipeline, AutocontourBuieNumpyPipeline
+from bonelab.util.vtk_util import numpy_to_vtkImageData, vtkImageData_to_numpy
+
+# Setup and parse command line arguments
+parser = argparse.ArgumentParser(
+    description='Benchmark the VTK and NumPy autocontour backends',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+parser.add_argument('--size', default=400, type=int,
+                    help='In-plane size of the phantom, in voxels')
+parser.add_argument('--slices', default=40, type=int,
+                    help='Number of slices of the phantom')
+parser.add_argument('--bone-fraction', default=0.6, type=float,
+                    help='Diameter of the bone as a fraction of the in-plane size')
+parser.add_argument('--repeats', default=3, type=int,
+                    help='Number of times to run each backend')
+parser.add_argument('--no-auto-crop', dest='auto_crop', action='store_false',
+                    help='Run both backends on the full image')
+args = parser.parse_args()
+
+# Build the phantom
+print('Building a {}x{}x{} phantom'.format(args.size, args.size, args.slices))
+rng = np.random.default_rng(0)
+x, y = np.meshgrid(np.arange(args.size), np.arange(args.size), indexing='ij')
+r = np.hypot(x - args.size / 2, y - args.size / 2) / (args.bone_fraction * args.size / 2)
+density = np.full((args.size, args.size), -100.0)
+trabecular = (r <= 0.8) & (rng.random(r.shape) < 0.3)
+density[(r <= 0.8) & ~trabecular] = 50
+density[trabecular] = 500
+density[(r > 0.8) & (r < 1.0)] = 800
+density = np.repeat(density[:, :, np.newaxis], args.slices, axis=2)
+density += rng.normal(0, 60, density.shape)
+image = numpy_to_vtkImageData(
+    np.round(density).astype(np.int16), spacing=[0.061] * 3, array_type=vtk.VTK_SHORT
+)
+del density
+
+# Run both backends with the default blAutocontour parameters
+autocontour_args = create_parser().parse_args(['.'] + ([] if args.auto_crop else ['--no-auto-crop']))
+masks = {}
+for name, pipeline_class in [('vtk', AutocontourBuiePipeline), ('numpy', AutocontourBuieNumpyPipeline)]:
+    pipeline = pipeline_class(autocontour_args)
+    times = []
+    for _ in range(args.repeats):
+        # otherwise VTK sees an unchanged input and doesn't re-execute
+        image.Modified()
+        start = time.time()
+        cort_mask, trab_mask = pipeline.run(image)
+        times.append(time.time() - start)
+    masks[name] = [vtkImageData_to_numpy(cort_mask), vtkImageData_to_numpy(trab_mask)]
+    print('{:>6}: {:8.3f} s (best of {})'.format(name, min(times), args.repeats))
+
+identical = all(np.array_equal(a, b) for a, b in zip(masks['vtk'], masks['numpy']))
+print('Masks identical: {}'.format(identical))
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import unittest
+from hypothesis import given, settings, strategies as st
+import os
+import shutil
+import tempfile
+import SimpleITK as sitk
+import numpy as np
+from scipy import ndimage
+
+from bonelab.cli.adaptive_local_thresholding import create_parser, adaptive_local_thresholding
+
+HYPOTHESIS_DEADLINE = None  # this is how many milliseconds each test has to finish in
+
+
+class TestAdaptiveLocalThresholding(unittest.TestCase):
+
+    def setUp(self):
+        # Create temporary directory to work in
+        self.test_dir = tempfile.mkdtemp()
+        # smoothed noise spanning the thresholds, so that the local thresholds decide many voxels
+        rng = np.random.default_rng(0)
+        arr = ndimage.gaussian_filter(rng.normal(0, 1, (23, 18, 17)), 1.5)
+        arr = 300 + 400 * arr / np.abs(arr).max()
+        image = sitk.GetImageFromArray(arr.astype(np.float32))
+        image.SetOrigin((1.0, -2.0, 3.0))
+        image.SetSpacing((0.5, 0.6, 0.7))
+        self.input_fn = os.path.join(self.test_dir, "input.nii.gz")
+        sitk.WriteImage(image, self.input_fn)
+
+    def tearDown(self):
+        # Remove temporary directory and all files
+        shutil.rmtree(self.test_dir)
+
+    def _run(self, output: str, extra_args: list) -> sitk.Image:
+        output = os.path.join(self.test_dir, output)
+        args = [self.input_fn, output, "-s", "-ow", "-ms", "5"] + extra_args
+        adaptive_local_thresholding(create_parser().parse_args(args=args))
+        return sitk.ReadImage(output)
+
+    @settings(deadline=HYPOTHESIS_DEADLINE, max_examples=4)
+    @given(
+        slab_thickness=st.integers(min_value=1, max_value=9),
+        workers=st.sampled_from([1, 2])
+    )
+    def test_tiled_matches_in_core(self, slab_thickness, workers):
+        for mode in ["mean", "minmax"]:
+            for shape, size in [("ball", 2), ("cube", 4)]:
+                footprint_args = ["-ltm", mode, "-sh", shape, "-sz", f"{size}"]
+                in_core = self._run("in_core.nii.gz", footprint_args)
+                tiled = self._run(
+                    "tiled.nii.gz", footprint_args + ["-st", f"{slab_thickness}", "-w", f"{workers}"]
+                )
+                in_core_array = sitk.GetArrayFromImage(in_core)
+                self.assertGreater(in_core_array.sum(), 0)
+                self.assertLess(in_core_array.sum(), in_core_array.size)
+                np.testing.assert_array_equal(sitk.GetArrayFromImage(tiled), in_core_array)
+                self.assertEqual(tiled.GetPixelID(), in_core.GetPixelID())
+                self.assertEqual(tiled.GetOrigin(), in_core.GetOrigin())
+                self.assertEqual(tiled.GetSpacing(), in_core.GetSpacing())
+
+if __name__ == '__main__':
+    unittest.main()
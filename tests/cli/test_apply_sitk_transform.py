@@ -8,7 +8,7 @@ import tempfile
 import SimpleITK as sitk
 import numpy as np
 
-from bonelab.cli.apply_sitk_transform import apply_sitk_transform, create_parser
+from bonelab.cli.apply_sitk_transform import apply_sitk_transform, create_parser, inverse_field_filename
 from bonelab.util.registration_util import INTERPOLATORS
 
 HYPOTHESIS_DEADLINE = 2000  # this is how many milliseconds each test has to finish in
@@ -72,6 +72,141 @@ class TestApplySitkTransform(unittest.TestCase):
         args += ["-int", f"{interpolator}"]
         apply_sitk_transform(create_parser().parse_args(args=args))
 
+    def _write_translation(self, fn: str, offset) -> str:
+        fn = os.path.join(self.test_dir, fn)
+        sitk.WriteTransform(sitk.TranslationTransform(3, offset), fn)
+        return fn
+
+    def _apply(self, transforms: list, extra_args: list = None) -> np.ndarray:
+        output = os.path.join(self.test_dir, TEST_OUTPUT_LABEL)
+        args = [self.random_images["medium"], *transforms, output, "-s", "-ow", "-int", "NearestNeighbour"]
+        apply_sitk_transform(create_parser().parse_args(args=args + (extra_args or [])))
+        return sitk.GetArrayFromImage(sitk.ReadImage(output))
+
+    def test_chain_resamples_once(self):
+        first = self._write_translation("first.tfm", (1.0, 0.0, 2.0))
+        second = self._write_translation("second.tfm", (0.0, 3.0, -1.0))
+        total = self._write_translation("total.tfm", (1.0, 3.0, 1.0))
+        np.testing.assert_array_equal(self._apply([first, second]), self._apply([total]))
+        # inverting the second undoes it, and inverting both undoes everything
+        np.testing.assert_array_equal(self._apply([first, second, second], ["-ii", "2"]), self._apply([first]))
+        original = sitk.GetArrayFromImage(sitk.ReadImage(self.random_images["medium"]))
+        np.testing.assert_array_equal(self._apply([total, first, second], ["-ii", "1", "2"]), original)
+        # inverting the chain inverts the composition
+        inverse_total = self._write_translation("inverse_total.tfm", (-1.0, -3.0, -1.0))
+        np.testing.assert_array_equal(self._apply([first, second], ["-it"]), self._apply([inverse_total]))
+        with self.assertRaises(ValueError):
+            self._apply([first, second], ["-ii", "2"])
+
+    def _write_rotation(self, fn: str) -> sitk.Euler3DTransform:
+        center = [(IMAGE_SIZE_DICT["medium"] - 1) / 2] * 3
+        transform = sitk.Euler3DTransform(center, 0.1, -0.2, 0.3, (1.0, -2.0, 0.5))
+        sitk.WriteTransform(transform, os.path.join(self.test_dir, fn))
+        return transform
+
+    def _apply_linear(self, transforms: list) -> np.ndarray:
+        return self._apply(transforms, ["-int", "Linear"])
+
+    def test_chain_of_rotation_and_translation(self):
+        # rotations and translations do not commute, so this checks the order in which the chain is composed
+        rotation = self._write_rotation("rotation.tfm")
+        translation = (0.0, 3.0, -1.0)
+        translation_fn = self._write_translation("translation.tfm", translation)
+        # the transforms map points of the output to the moving image: the later transform is applied first, as the
+        # later registration was run on the moving image already resampled by the earlier one
+        composed = sitk.Euler3DTransform(
+            rotation.GetCenter(), rotation.GetAngleX(), rotation.GetAngleY(), rotation.GetAngleZ(),
+            np.array(rotation.GetTranslation()) + np.array(rotation.GetMatrix()).reshape(3, 3) @ translation
+        )
+        composed_fn = os.path.join(self.test_dir, "composed.tfm")
+        sitk.WriteTransform(composed, composed_fn)
+        rotation_fn = os.path.join(self.test_dir, "rotation.tfm")
+        chained = self._apply_linear([rotation_fn, translation_fn])
+        np.testing.assert_allclose(chained, self._apply_linear([composed_fn]), atol=1e-6)
+        self.assertFalse(np.allclose(chained, self._apply_linear([translation_fn, rotation_fn])))
+
+    def test_chain_of_rotation_and_field(self):
+        size = IMAGE_SIZE_DICT["medium"]
+        rotation = self._write_rotation("rotation.tfm")
+        displacement = 0.5 * np.random.rand(size, size, size, 3) - 0.25
+        field_fn = os.path.join(self.test_dir, "chained_field.nii")
+        sitk.WriteImage(sitk.GetImageFromArray(displacement, isVector=True), field_fn)
+        # compose by hand: the field moves each voxel, then the rotation maps it into the moving image
+        points = np.stack(np.meshgrid(*[np.arange(size)] * 3, indexing="ij")[::-1], axis=-1).astype(float)
+        moved = points + displacement
+        composed = np.array([rotation.TransformPoint(p) for p in moved.reshape(-1, 3)]).reshape(moved.shape) - points
+        composed_fn = os.path.join(self.test_dir, "composed_by_hand.nii")
+        sitk.WriteImage(sitk.GetImageFromArray(composed, isVector=True), composed_fn)
+        np.testing.assert_allclose(
+            self._apply_linear([os.path.join(self.test_dir, "rotation.tfm"), field_fn]),
+            self._apply_linear([composed_fn]),
+            atol=1e-6
+        )
+
+    def test_composed_field(self):
+        size = IMAGE_SIZE_DICT["medium"]
+        field = sitk.GetImageFromArray(np.random.rand(size, size, size, 3) - 0.5, isVector=True)
+        field_fn = os.path.join(self.test_dir, "smooth_field.nii")
+        sitk.WriteImage(field, field_fn)
+        rigid = self._write_translation("rigid.tfm", (1.0, 0.0, 2.0))
+        composed_field = os.path.join(self.test_dir, "composed.nii")
+        chained = self._apply([rigid, field_fn], ["-cf", composed_field])
+        self.assertEqual(sitk.ReadImage(composed_field).GetSize(), (size, size, size))
+        np.testing.assert_array_equal(self._apply([composed_field]), chained)
+
+    def test_additional_images(self):
+        transform = self._write_translation("translation.tfm", (1.5, -0.5, 2.0))
+        additional_output = os.path.join(self.test_dir, "additional_output.nii")
+        main_output = self._apply(
+            [transform], ["-ai", self.random_images["medium"], additional_output, "Linear"]
+        )
+        np.testing.assert_array_equal(main_output, self._apply([transform]))
+        output = os.path.join(self.test_dir, TEST_OUTPUT_LABEL)
+        apply_sitk_transform(create_parser().parse_args(
+            [self.random_images["medium"], transform, output, "-s", "-ow", "-int", "Linear"]
+        ))
+        np.testing.assert_array_equal(
+            sitk.GetArrayFromImage(sitk.ReadImage(additional_output)),
+            sitk.GetArrayFromImage(sitk.ReadImage(output))
+        )
+        with self.assertRaises(ValueError):
+            self._apply([transform], ["-ai", self.random_images["medium"], additional_output, "Cubic"])
+
+    def test_inverse_cache(self):
+        cache_directory = os.path.join(self.test_dir, "inverse_cache")
+        args = ["-ii", "0", "-icd", cache_directory]
+        inverted = self._apply([self.field_fn], args)
+        np.testing.assert_array_equal(self._apply([self.field_fn], ["-ii", "0"]), inverted)
+        cached_fn = inverse_field_filename(self.field_fn, cache_directory)
+        self.assertEqual(os.listdir(cache_directory), [os.path.basename(cached_fn)])
+        # later runs read the inverse from the cache, so replacing it with a zero field gives the identity
+        inverse_field = sitk.ReadImage(cached_fn)
+        zero_field = sitk.GetImageFromArray(np.zeros_like(sitk.GetArrayFromImage(inverse_field)), isVector=True)
+        zero_field.CopyInformation(inverse_field)
+        sitk.WriteImage(zero_field, cached_fn)
+        original = sitk.GetArrayFromImage(sitk.ReadImage(self.random_images["medium"]))
+        np.testing.assert_array_equal(self._apply([self.field_fn], args), original)
+
+    def test_float32_field(self):
+        # fields written by `blRegistrationDemons --float32-displacement-field` can be applied and inverted
+        field_fn = os.path.join(self.test_dir, "field_f32.nii")
+        sitk.WriteImage(sitk.Cast(sitk.ReadImage(self.field_fn), sitk.sitkVectorFloat32), field_fn)
+        self.assertEqual(self._apply([field_fn]).shape, (IMAGE_SIZE_DICT["medium"],) * 3)
+        self.assertEqual(self._apply([field_fn], ["-it"]).shape, (IMAGE_SIZE_DICT["medium"],) * 3)
+
+    def test_axis_permutation(self):
+        # a half turn about the image center maps voxels onto voxels, so they are rearranged exactly
+        center = (IMAGE_SIZE_DICT["medium"] - 1) / 2
+        transform = sitk.Euler3DTransform((center, center, center), 0.0, 0.0, np.pi)
+        fn = os.path.join(self.test_dir, "half_turn.tfm")
+        sitk.WriteTransform(transform, fn)
+        output = os.path.join(self.test_dir, TEST_OUTPUT_LABEL)
+        apply_sitk_transform(create_parser().parse_args(
+            [self.random_images["medium"], fn, output, "-s", "-ow", "-int", "BSpline"]
+        ))
+        original = sitk.GetArrayFromImage(sitk.ReadImage(self.random_images["medium"]))
+        np.testing.assert_array_equal(sitk.GetArrayFromImage(sitk.ReadImage(output)), original[:, ::-1, ::-1])
+
 
 if __name__ == '__main__':
     unittest.main()
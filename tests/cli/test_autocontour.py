@@ -0,0 +1,229 @@
+from __future__ import annotations
+
+import copy
+import csv
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from hypothesis import given, settings, strategies as st
+import numpy as np
+import vtk
+import vtkbone
+
+from bonelab.util.vtk_util import numpy_to_vtkImageData, vtkImageData_to_numpy
+from bonelab.cli.autocontour import (
+    create_parser, get_pipeline, get_mask_filenames, process_aim, main,
+    AutocontourBuiePipeline, AutocontourBuieNumpyPipeline
+)
+
+
+HYPOTHESIS_DEADLINE = None  # this is how many milliseconds each test has to finish in
+
+# a calibration that makes the density equal to the native values
+PROCESSING_LOG = (
+    "Mu_Scaling                                        1\n"
+    "HU: mu water                                      0.24000\n"
+    "Density: slope                                    1.00000E+00\n"
+    "Density: intercept                                0.00000E+00\n"
+)
+
+IMAGE_SIZE = 120
+NUM_SLICES = 6
+
+
+def create_phantom(seed: int, center_offset: int, array_type: int) -> vtk.vtkImageData:
+    # a noisy ring of cortical bone around trabecular bone and marrow, in air
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.arange(IMAGE_SIZE), np.arange(IMAGE_SIZE), indexing="ij")
+    r = np.hypot(x - IMAGE_SIZE / 2 - center_offset, y - IMAGE_SIZE / 2)
+    density = np.full((IMAGE_SIZE, IMAGE_SIZE), -100.0)
+    trabecular = (r <= 28) & (rng.random(r.shape) < 0.3)
+    density[(r <= 28) & ~trabecular] = 50
+    density[trabecular] = 500
+    density[(r > 28) & (r < 36)] = 800
+    density = np.repeat(density[:, :, np.newaxis], NUM_SLICES, axis=2) + rng.normal(0, 60, (*r.shape, NUM_SLICES))
+    if array_type == vtk.VTK_SHORT:
+        density = np.round(density).astype(np.int16)
+    return numpy_to_vtkImageData(density, spacing=[0.061] * 3, origin=[1, 2, 3], array_type=array_type)
+
+
+class TestAutocontour(unittest.TestCase):
+
+    @settings(deadline=HYPOTHESIS_DEADLINE, max_examples=6)
+    @given(
+        seed=st.integers(min_value=0, max_value=1000),
+        # the largest offset puts the bone against the edge of the image
+        center_offset=st.sampled_from([0, 10, 30]),
+        array_type=st.sampled_from([vtk.VTK_SHORT, vtk.VTK_FLOAT]),
+        auto_crop=st.booleans()
+    )
+    def test_backends_match(self, seed, center_offset, array_type, auto_crop):
+        img = create_phantom(seed, center_offset, array_type)
+        args = create_parser().parse_args(["aim_dir"] + ([] if auto_crop else ["--no-auto-crop"]))
+        vtk_masks = AutocontourBuiePipeline(args).run(img)
+        numpy_masks = AutocontourBuieNumpyPipeline(args).run(img)
+        for vtk_mask, numpy_mask in zip(vtk_masks, numpy_masks):
+            self.assertEqual(numpy_mask.GetScalarType(), vtk_mask.GetScalarType())
+            self.assertEqual(numpy_mask.GetExtent(), vtk_mask.GetExtent())
+            np.testing.assert_array_equal(vtkImageData_to_numpy(numpy_mask), vtkImageData_to_numpy(vtk_mask))
+
+    def test_auto_crop_matches_full_image(self):
+        img = create_phantom(0, 0, vtk.VTK_SHORT)
+        args = create_parser().parse_args(["aim_dir"])
+        cropped_masks = AutocontourBuiePipeline(args).run(img)
+        args.auto_crop = False
+        full_masks = AutocontourBuiePipeline(args).run(img)
+        for cropped_mask, full_mask in zip(cropped_masks, full_masks):
+            self.assertTrue(vtkImageData_to_numpy(full_mask).any())
+            np.testing.assert_array_equal(vtkImageData_to_numpy(cropped_mask), vtkImageData_to_numpy(full_mask))
+
+    def test_auto_crop_matches_full_image_with_large_marrow_cavity(self):
+        # a thin ring around an empty marrow cavity that fills most of the image, so that the cavity is larger
+        # than the air left around the bone by the crop
+        size = 400
+        x, y = np.meshgrid(np.arange(size), np.arange(size), indexing="ij")
+        r = np.hypot(x - size / 2, y - size / 2)
+        density = np.full((size, size), -100.0)
+        density[r < 140] = 50
+        density[(r >= 136) & (r < 140)] = 800
+        density = np.repeat(density[:, :, np.newaxis], 3, axis=2)
+        img = numpy_to_vtkImageData(density, spacing=[0.061] * 3, origin=[0, 0, 0], array_type=vtk.VTK_FLOAT)
+        for pipeline_class in [AutocontourBuiePipeline, AutocontourBuieNumpyPipeline]:
+            args = create_parser().parse_args(["aim_dir"])
+            cropped_masks = [vtkImageData_to_numpy(m).copy() for m in pipeline_class(args).run(img)]
+            args.auto_crop = False
+            full_masks = [vtkImageData_to_numpy(m).copy() for m in pipeline_class(args).run(img)]
+            # the trabecular mask fills the cavity
+            self.assertGreater((full_masks[1] > 0).sum(), 3 * 120 ** 2)
+            for cropped_mask, full_mask in zip(cropped_masks, full_masks):
+                np.testing.assert_array_equal(cropped_mask, full_mask)
+
+    def test_pipeline_reuse(self):
+        args = create_parser().parse_args(["aim_dir"])
+        pipeline = AutocontourBuiePipeline(args)
+        first = [vtkImageData_to_numpy(m).copy() for m in pipeline.run(create_phantom(0, 0, vtk.VTK_SHORT))]
+        pipeline.run(create_phantom(1, 10, vtk.VTK_SHORT))
+        again = [vtkImageData_to_numpy(m) for m in pipeline.run(create_phantom(0, 0, vtk.VTK_SHORT))]
+        for a, b in zip(first, again):
+            np.testing.assert_array_equal(a, b)
+
+    def test_get_pipeline_reuses_pipeline_for_equal_args(self):
+        args = create_parser().parse_args(["aim_dir"])
+        pipeline = get_pipeline(args)
+        # worker processes receive an unpickled copy of the arguments with every AIM
+        self.assertIs(get_pipeline(pickle.loads(pickle.dumps(args))), pipeline)
+        changed = copy.deepcopy(args)
+        changed.threshold_1 += 1
+        self.assertIsNot(get_pipeline(changed), pipeline)
+        self.assertEqual(get_pipeline(changed).args.threshold_1, args.threshold_1 + 1)
+
+    def test_numpy_backend_out_value(self):
+        args = create_parser().parse_args(["aim_dir", "--backend", "numpy", "--out-value", "1"])
+        with self.assertRaises(ValueError):
+            AutocontourBuieNumpyPipeline(args)
+
+
+class TestAutocontourBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.aim_dir = os.path.join(self.test_dir, "aims")
+        self.output_dir = os.path.join(self.test_dir, "masks")
+        os.makedirs(self.aim_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_aim(self, name: str, seed: int = 0) -> str:
+        aim_fn = os.path.join(self.aim_dir, name)
+        writer = vtkbone.vtkboneAIMWriter()
+        writer.SetFileName(aim_fn)
+        writer.SetInputData(create_phantom(seed, 0, vtk.VTK_SHORT))
+        writer.SetProcessingLog(PROCESSING_LOG)
+        writer.Update()
+        return aim_fn
+
+    def read_aim(self, aim_fn: str) -> np.ndarray:
+        reader = vtkbone.vtkboneAIMReader()
+        reader.DataOnCellsOff()
+        reader.SetFileName(aim_fn)
+        reader.Update()
+        return vtkImageData_to_numpy(reader.GetOutput())
+
+    def test_process_aim(self):
+        aim_fn = self.write_aim("TEST_0001_01.AIM")
+        args = create_parser().parse_args([self.aim_dir, "--output-dir", self.output_dir])
+        row = process_aim(aim_fn, args)
+        self.assertEqual(row["status"], "done", row["error"])
+        self.assertEqual(row["error"], "")
+        cort_mask_fn, trab_mask_fn = get_mask_filenames(aim_fn, self.output_dir)
+        self.assertEqual((row["cort_mask"], row["trab_mask"]), (cort_mask_fn, trab_mask_fn))
+        for field in ["read_time", "pipeline_time", "write_time", "total_time"]:
+            self.assertGreaterEqual(float(row[field]), 0)
+        # the masks are renamed into place, without leaving partial files behind
+        self.assertEqual(
+            sorted(f for f in os.listdir(self.output_dir) if f.endswith(".AIM")),
+            sorted(os.path.basename(fn) for fn in [cort_mask_fn, trab_mask_fn])
+        )
+        expected = AutocontourBuiePipeline(args).run(create_phantom(0, 0, vtk.VTK_SHORT))
+        for mask_fn, expected_mask in zip([cort_mask_fn, trab_mask_fn], expected):
+            mask = self.read_aim(mask_fn)
+            self.assertTrue(mask.any())
+            np.testing.assert_array_equal(mask, vtkImageData_to_numpy(expected_mask))
+
+    def test_process_aim_failure(self):
+        aim_fn = os.path.join(self.aim_dir, "TEST_0001_01.AIM")
+        with open(aim_fn, "w") as f:
+            f.write("not an AIM")
+        args = create_parser().parse_args([self.aim_dir, "--output-dir", self.output_dir])
+        row = process_aim(aim_fn, args)
+        self.assertEqual(row["status"], "failed")
+        self.assertNotEqual(row["error"], "")
+        self.assertFalse(any(os.path.isfile(fn) for fn in get_mask_filenames(aim_fn, self.output_dir)))
+
+    def test_skip_existing(self):
+        aim_fn = self.write_aim("TEST_0001_01.AIM")
+        os.makedirs(self.output_dir)
+        mask_fns = get_mask_filenames(aim_fn, self.output_dir)
+        for mask_fn in mask_fns:
+            with open(mask_fn, "w") as f:
+                f.write("existing")
+        args = create_parser().parse_args([self.aim_dir, "--output-dir", self.output_dir, "--skip-existing"])
+        self.assertEqual(process_aim(aim_fn, args)["status"], "skipped")
+        for mask_fn in mask_fns:
+            with open(mask_fn) as f:
+                self.assertEqual(f.read(), "existing")
+        # both masks have to exist for an AIM to be skipped
+        os.remove(mask_fns[1])
+        self.assertEqual(process_aim(aim_fn, args)["status"], "done")
+        self.assertTrue(self.read_aim(mask_fns[0]).any())
+
+    def test_report(self):
+        aim_fns = [self.write_aim("TEST_0002_01.AIM", 1), self.write_aim("TEST_0001_01.AIM", 0)]
+        failed_fn = os.path.join(self.aim_dir, "TEST_0003_01.AIM")
+        with open(failed_fn, "w") as f:
+            f.write("not an AIM")
+        report_fn = os.path.join(self.test_dir, "reports", "report.csv")
+        argv = ["blAutocontour", self.aim_dir, "--output-dir", self.output_dir, "--report", report_fn]
+        with mock.patch.object(sys, "argv", argv):
+            with self.assertRaises(RuntimeError):
+                main()
+        with open(report_fn, newline="") as f:
+            rows = list(csv.DictReader(f))
+        # the report is in the sorted order of the inputs
+        self.assertEqual([row["aim"] for row in rows], sorted(aim_fns + [failed_fn]))
+        self.assertEqual([row["status"] for row in rows], ["done", "done", "failed"])
+        self.assertNotEqual(rows[2]["error"], "")
+
+    def test_workers_must_be_positive(self):
+        with self.assertRaises(SystemExit):
+            create_parser().parse_args([self.aim_dir, "--workers", "0"])
+        self.assertEqual(create_parser().parse_args([self.aim_dir, "--out-value", "0"]).out_value, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+'''Test blImageCentroids'''
+
+import unittest
+from unittest import mock
+import numpy as np
+import numpy.testing as npt
+import vtk
+
+from bonelab.util.vtk_util import numpy_to_vtkImageData, vtkImageData_to_numpy
+from bonelab.cli import ImageCentroids
+from bonelab.cli.ImageCentroids import get_centroid
+
+
+class TestGetCentroid(unittest.TestCase):
+    '''Test the centroids of single labels'''
+
+    def setUp(self):
+        labels = np.zeros((6, 5, 4), dtype=np.uint8)
+        labels[1:3, 2, 1:3] = 1
+        labels[4, 0:4, 3] = 7
+        self.image = numpy_to_vtkImageData(
+            labels, spacing=[0.5, 2.0, 1.0], origin=[1, 2, 3], array_type=vtk.VTK_UNSIGNED_CHAR
+        )
+
+    def test_centroids(self):
+        npt.assert_allclose(get_centroid(self.image, 1), [1 + 0.5*1.5, 2 + 2.0*2, 3 + 1.0*1.5])
+        npt.assert_allclose(get_centroid(self.image, 7), [1 + 0.5*4, 2 + 2.0*1.5, 3 + 1.0*3])
+        self.assertTrue(np.all(np.isnan(get_centroid(self.image, 5))))
+
+    def test_statistics_computed_once_per_image(self):
+        compute = ImageCentroids.compute_label_statistics
+        with mock.patch.object(ImageCentroids, 'compute_label_statistics', side_effect=compute) as spy:
+            for label in [1, 5, 7]:
+                get_centroid(self.image, label)
+            self.assertEqual(spy.call_count, 1)
+
+            # a modified image is measured again
+            vtkImageData_to_numpy(self.image)[4, 0:4, 3] = 0
+            self.image.Modified()
+            self.assertTrue(np.all(np.isnan(get_centroid(self.image, 7))))
+            self.assertEqual(spy.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+'''Test blImageMask'''
+
+import unittest
+from unittest import mock
+import shutil, tempfile
+import os
+import numpy as np
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
+
+from bonelab.cli import ImageMask as ImageMask_module
+from bonelab.cli.ImageMask import ImageMask, scan_mask, kernel_reach
+
+
+def to_vtk(array, array_type):
+    image = vtk.vtkImageData()
+    image.SetDimensions(array.shape[::-1])
+    image.SetSpacing(0.5, 0.6, 0.7)
+    image.GetPointData().SetScalars(numpy_to_vtk(array.ravel(), deep=True, array_type=array_type))
+    return image
+
+
+class TestblImageMask(unittest.TestCase):
+    '''Test blImageMask against masking the whole image in VTK'''
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.image = rng.integers(-1000, 1000, (20, 25, 30)).astype(np.int16)
+        self.image_file = os.path.join(self.test_dir, 'image.nii')
+        self.mask_file = os.path.join(self.test_dir, 'mask.nii.gz')
+        self.output_file = os.path.join(self.test_dir, 'output.nii')
+        self.write(self.image, self.image_file, vtk.VTK_SHORT)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write(self, array, filename, array_type):
+        writer = vtk.vtkNIFTIImageWriter()
+        writer.SetInputData(to_vtk(array, array_type))
+        writer.SetFileName(filename)
+        writer.Write()
+
+    def read(self, filename):
+        reader = vtk.vtkNIFTIImageReader()
+        reader.SetFileName(filename)
+        reader.Update()
+        return vtk_to_numpy(reader.GetOutput().GetPointData().GetScalars()).reshape(self.image.shape)
+
+    def expected(self, mask, kernel):
+        dilate = vtk.vtkImageDilateErode3D()
+        dilate.SetInputData(to_vtk(mask, vtk.VTK_UNSIGNED_CHAR))
+        dilate.SetDilateValue(float(mask.max()))
+        dilate.SetErodeValue(float(mask.min()))
+        dilate.SetKernelSize(*kernel)
+        dilate.Update()
+        masker = vtk.vtkImageMask()
+        masker.SetImageInputData(to_vtk(self.image, vtk.VTK_SHORT))
+        masker.SetMaskInputData(dilate.GetOutput())
+        masker.SetMaskedOutputValue(0.0)
+        masker.Update()
+        return vtk_to_numpy(masker.GetOutput().GetPointData().GetScalars()).reshape(self.image.shape)
+
+    def runner(self, mask, kernel):
+        self.write(mask, self.mask_file, vtk.VTK_UNSIGNED_CHAR)
+        ImageMask(self.image_file, self.mask_file, self.output_file, kernel, True)
+        np.testing.assert_array_equal(self.read(self.output_file), self.expected(mask, kernel))
+
+    def test_interior_mask(self):
+        mask = np.zeros(self.image.shape, np.uint8)
+        mask[8:12, 5:15, 10:13] = 1
+        mask[9, 7, 11] = 0
+        self.runner(mask, [5, 4, 3])
+
+    def test_mask_at_border(self):
+        mask = np.zeros(self.image.shape, np.uint8)
+        mask[0:3, 20:, 0] = 127
+        mask[19, 0, 29] = 127
+        self.runner(mask, [4, 4, 4])
+
+    def test_no_dilation(self):
+        mask = np.zeros(self.image.shape, np.uint8)
+        mask[3:5, 6:9, 2:4] = 1
+        self.runner(mask, [1, 1, 1])
+
+    def test_empty_mask(self):
+        self.runner(np.zeros(self.image.shape, np.uint8), [3, 3, 3])
+
+    def count_mask_reads(self, mask, kernel):
+        # the number of times the mask file is read, counted by the start events of its reader
+        reader_class = vtk.vtkNIFTIImageReader
+        readers = []
+
+        def counting_reader():
+            reader = reader_class()
+            reader.starts = 0
+            reader.AddObserver('StartEvent', lambda obj, event: setattr(reader, 'starts', reader.starts + 1))
+            readers.append(reader)
+            return reader
+
+        self.write(mask, self.mask_file, vtk.VTK_UNSIGNED_CHAR)
+        with mock.patch.object(ImageMask_module.vtk, 'vtkNIFTIImageReader', side_effect=counting_reader):
+            ImageMask(self.image_file, self.mask_file, self.output_file, kernel, True)
+        mask_reader, = [reader for reader in readers if reader.GetFileName() == self.mask_file]
+        single_read = counting_reader()
+        single_read.SetFileName(self.mask_file)
+        single_read.Update()
+        return mask_reader.starts / single_read.starts
+
+    def test_gzipped_mask_read_once(self):
+        mask = np.zeros(self.image.shape, np.uint8)
+        mask[8:12, 5:15, 10:13] = 1
+        self.assertEqual(self.count_mask_reads(mask, [5, 4, 3]), 1)
+        self.assertEqual(self.count_mask_reads(mask, [1, 1, 1]), 1)
+        np.testing.assert_array_equal(self.read(self.output_file), self.expected(mask, [1, 1, 1]))
+
+    def test_scan_mask(self):
+        mask = np.zeros(self.image.shape, np.uint8)
+        mask[4:7, 2, 10:20] = 3
+        self.write(mask, self.mask_file, vtk.VTK_UNSIGNED_CHAR)
+        reader = vtk.vtkNIFTIImageReader()
+        reader.SetFileName(self.mask_file)
+        reader.UpdateInformation()
+        self.assertEqual(scan_mask(reader, reader.GetDataExtent(), slab_slices=3), (0.0, 3.0, [10, 19, 2, 2, 4, 6]))
+
+    def test_kernel_reach(self):
+        self.assertEqual(kernel_reach([1, 3, 4]), ([0, 1, 1], [0, 1, 2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,12 @@ import os
 import numpy.testing as npt
 
 from tests.config_cli import cfg
-from bonelab.cli.Muscle import Muscle
+import numpy as np
+import SimpleITK as sitk
+import vtk
+import vtkbone
+from bonelab.cli.Muscle import Muscle, MuscleBatch, bone_region
+from bonelab.util.vtk_util import numpy_to_vtkImageData
 
 
 class TestblMuscle(unittest.TestCase):
@@ -89,5 +94,154 @@ class TestblMuscle(unittest.TestCase):
         npt.assert_almost_equal(float(entry[0][7]), 118632.01818181819, decimal=4)
 
 
+class TestBoneRegion(unittest.TestCase):
+    '''Test the region around the bones used by `--roi_padding`'''
+
+    def setUp(self):
+        # Two bones in a 40x30x10 image, indexed [z, y, x]
+        labels = np.zeros((10, 30, 40), dtype=np.uint8)
+        labels[:, 5:10, 10:15] = 1
+        labels[:, 12:20, 20:30] = 2
+        self.image = sitk.GetImageFromArray(labels)
+        self.image.SetSpacing([0.5, 0.5, 0.5])
+        self.stat_filter = sitk.LabelShapeStatisticsImageFilter()
+        self.stat_filter.Execute(self.image)
+
+    def test_no_padding(self):
+        index, size = bone_region(self.stat_filter, [1, 2], self.image, 0.0)
+        self.assertEqual(index, [10, 5, 0])
+        self.assertEqual(size, [20, 15, 10])
+
+    def test_padding_is_clipped(self):
+        index, size = bone_region(self.stat_filter, [1, 2], self.image, 1.2)
+        self.assertEqual(index, [7, 2, 0])
+        self.assertEqual(size, [26, 21, 10])
+
+        index, size = bone_region(self.stat_filter, [1, 2], self.image, 100.0)
+        self.assertEqual(index, [0, 0, 0])
+        self.assertEqual(size, [40, 30, 10])
+
+
+class TestblMuscleROI(unittest.TestCase):
+    '''Test that `--roi_padding` gives the same outputs as the whole image'''
+
+    processing_log = (
+        'Mu_Scaling                                        8192\n'
+        'HU: mu water                                      0.24090\n'
+        'Density: slope                                    1.60351E+03\n'
+        'Density: intercept                               -3.91209E+02\n'
+    )
+
+    def setUp(self):
+        # Create temporary directory to work in
+        self.test_dir = tempfile.mkdtemp()
+
+        # A leg in air: muscle inside a layer of fat, with two bones in the
+        # muscle. Indexed [x, y, z] in native units
+        rng = np.random.default_rng(0)
+        x, y = np.meshgrid(np.arange(120), np.arange(100), indexing='ij')
+        native = np.full(x.shape, 500.0)
+        native[np.hypot(x-60, y-50) < 38] = 2600.0
+        native[np.hypot(x-60, y-50) < 32] = 3800.0
+        native[np.hypot(x-42, y-45) < 8] = 9000.0
+        native[np.hypot(x-78, y-55) < 6] = 9000.0
+        native = np.repeat(native[:, :, np.newaxis], 8, axis=2) + rng.normal(0, 150, (*x.shape, 8))
+
+        self.input_filename = os.path.join(self.test_dir, 'LEG.AIM')
+        writer = vtkbone.vtkboneAIMWriter()
+        writer.SetFileName(self.input_filename)
+        writer.SetInputData(numpy_to_vtkImageData(
+            np.round(native).astype(np.int16), spacing=[0.182]*3, origin=[0, 0, 0], array_type=vtk.VTK_SHORT
+        ))
+        writer.SetProcessingLog(self.processing_log)
+        writer.Update()
+
+    def tearDown(self):
+        # Remove temporary directory and all files
+        shutil.rmtree(self.test_dir)
+
+    def run_muscle(self, name, roi_padding):
+        segmentation_filename = os.path.join(self.test_dir, name + '_SEG.nii')
+        csv_filename = os.path.join(self.test_dir, name + '.csv')
+        Muscle(
+            self.input_filename, '', segmentation_filename,
+            bone_threshold=800.0, smoothing_iterations=10, segmentation_iterations=2,
+            segmentation_multiplier=2.0, initial_neighborhood_radius=1.0, closing_radius=0.5,
+            csv_filename=csv_filename, roi_padding=roi_padding
+        )
+        with open(csv_filename, 'r') as fp:
+            lines = [line.rstrip(os.linesep).split(',') for line in fp]
+        return sitk.GetArrayFromImage(sitk.ReadImage(segmentation_filename)), lines
+
+    def test_roi_covering_image_is_identical(self):
+        '''A region covering the whole image gives exactly the default outputs'''
+        seg, lines = self.run_muscle('whole', None)
+        roi_seg, roi_lines = self.run_muscle('roi', 100.0)
+
+        # Both bones and the muscle around them are segmented
+        self.assertEqual(sorted(np.unique(seg)), [0, 1, 2])
+        npt.assert_array_equal(roi_seg, seg)
+        self.assertEqual(roi_lines, lines)
+
+    def test_roi_matches_whole_image(self):
+        '''A region holding the muscle gives nearly the default outputs
+
+        The conductance of the anisotropic diffusion is scaled by the mean
+        gradient of the image it runs on, so smoothing the region is not
+        exactly the same as smoothing the whole image.'''
+        seg, lines = self.run_muscle('whole', None)
+        roi_seg, roi_lines = self.run_muscle('roi', 4.0)
+
+        muscle = np.count_nonzero(seg == 2)
+        self.assertGreater(muscle, 0)
+        npt.assert_array_equal(roi_seg == 1, seg == 1)
+        self.assertLess(np.count_nonzero(roi_seg != seg), 0.01*muscle)
+
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(roi_lines[0], lines[0])
+        self.assertEqual(roi_lines[1][:6], lines[1][:6])
+        npt.assert_allclose([float(v) for v in roi_lines[1][6:]], [float(v) for v in lines[1][6:]], rtol=0.01)
+
+
+class TestblMuscleBatch(unittest.TestCase):
+    '''Test blMuscleBatch'''
+
+    def setUp(self):
+        # Create temporary directory to work in
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        # Remove temporary directory and all files
+        shutil.rmtree(self.test_dir)
+
+    def test_failures_are_recorded(self):
+        '''Failed scans are written to the CSV without stopping the batch'''
+        not_aim = os.path.join(self.test_dir, 'image.nii')
+        open(not_aim, 'w').close()
+        missing = os.path.join(self.test_dir, 'missing.AIM')
+        csv_filename = os.path.join(self.test_dir, 'muscle.csv')
+
+        rows = MuscleBatch(
+            [not_aim, missing], os.path.join(self.test_dir, 'out'), csv_filename, workers=2
+        )
+
+        self.assertEqual([row['Status'] for row in rows], ['failed', 'failed'])
+        with open(csv_filename, 'r') as fp:
+            lines = [line.rstrip(os.linesep).split(',') for line in fp]
+        self.assertEqual(lines[0], ['Filename', 'Status', 'Error'])
+        self.assertEqual([line[0] for line in lines[1:]], [not_aim, missing])
+        self.assertEqual([line[1] for line in lines[1:]], ['failed', 'failed'])
+        self.assertEqual(os.listdir(self.test_dir).count('muscle.csv'), 1)
+
+    def test_duplicate_basenames(self):
+        '''Inputs whose outputs would overwrite each other are rejected'''
+        inputs = [os.path.join(self.test_dir, d, 'scan.AIM') for d in ['a', 'b']]
+        csv_filename = os.path.join(self.test_dir, 'muscle.csv')
+
+        with self.assertRaises(ValueError):
+            MuscleBatch(inputs, os.path.join(self.test_dir, 'out'), csv_filename)
+        self.assertFalse(os.path.exists(csv_filename))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,10 +4,12 @@ import unittest
 import subprocess
 import shutil, tempfile
 import os
+import numpy as np
 import numpy.testing as npt
+import SimpleITK as sitk
 
 from tests.config_cli import cfg
-from bonelab.cli.PseudoCT import PseudoCT
+from bonelab.cli.PseudoCT import PseudoCT, stream_slices
 
 @unittest.skip('`gdcm` dependency issue')
 class TestblPseudoCT(unittest.TestCase):
@@ -54,5 +56,38 @@ class TestblPseudoCT(unittest.TestCase):
         # Output exists
         self.assertTrue(os.path.isdir(self.args['output_directory']))
 
+class TestStreamSlices(unittest.TestCase):
+    '''Test the slice streaming of blPseudoCT'''
+
+    def setUp(self):
+        # Create temporary directory to work in
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        # Remove temporary directory and all files
+        shutil.rmtree(self.test_dir)
+
+    def test_mask_matches_volume(self):
+        '''Masks of the streamed slices are the same as closing the whole volume'''
+        rng = np.random.default_rng(0)
+        for n_slices in [1, 2, 7, 20]:
+            data = rng.integers(0, 3, (n_slices, 12, 13)).astype(np.uint16)
+            filenames = []
+            for idx in range(n_slices):
+                filenames.append(os.path.join(self.test_dir, 'slice_{}_{:03d}.mha'.format(n_slices, idx)))
+                sitk.WriteImage(sitk.GetImageFromArray(data[idx]), filenames[-1])
+
+            CloseFilter = sitk.BinaryMorphologicalClosingImageFilter()
+            CloseFilter.SetForegroundValue(1)
+            CloseFilter.SetKernelRadius(1)
+            expected = sitk.GetArrayFromImage(CloseFilter.Execute(
+                sitk.BinaryThreshold(sitk.GetImageFromArray(data), 0, 1, 0, 1)
+            ))
+
+            streamed = list(stream_slices(filenames, 0, 1, 1, chunk_slices=3))
+            self.assertEqual([idx for idx, _, _ in streamed], list(range(n_slices)))
+            npt.assert_array_equal(np.stack([d for _, d, _ in streamed]), data)
+            npt.assert_array_equal(np.stack([m for _, _, m in streamed]), expected)
+
 if __name__ == '__main__':
     unittest.main()
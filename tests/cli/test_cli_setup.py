@@ -52,6 +52,10 @@ class TestCommandLineInterfeceSetup(unittest.TestCase):
         '''Can run `blMuscle`'''
         self.runner('blMuscle')
 
+    def test_blMuscleBatch(self):
+        '''Can run `blMuscleBatch`'''
+        self.runner('blMuscleBatch')
+
     def test_blSliceViewer(self):
         '''Can run `blSliceViewer`'''
         self.runner('blSliceViewer')
@@ -97,6 +101,10 @@ class TestCommandLineInterfeceSetup(unittest.TestCase):
         ''' Can run `blRegistrationDemons` '''
         self.runner('blRegistrationDemons')
 
+    def test_blRegistrationBatch(self):
+        ''' Can run `blRegistrationBatch` '''
+        self.runner('blRegistrationBatch')
+
     def test_blITKSnapAnnotParser(self):
         ''' Can run `blITKSnapAnnotParser` '''
         self.runner('blITKSnapAnnotParser')
@@ -117,6 +125,10 @@ class TestCommandLineInterfeceSetup(unittest.TestCase):
         ''' Can run `blImageComputeOverlap` '''
         self.runner('blImageComputeOverlap')
 
+    def test_blComputeOverlapBatch(self):
+        ''' Can run `blImageComputeOverlapBatch` '''
+        self.runner('blImageComputeOverlapBatch')
+
     def test_blAdaptiveLocalThresholding(self):
         ''' Can run `blAdaptiveLocalThresholding` '''
         self.runner('blAdaptiveLocalThresholding')
@@ -9,7 +9,10 @@ import SimpleITK as sitk
 import numpy as np
 import pandas as pd
 
-from bonelab.cli.compute_overlap import create_parser, compute_overlap
+from bonelab.cli.compute_overlap import (
+    create_parser, compute_overlap, create_batch_parser, compute_overlap_batch,
+    compute_confusion_matrix, compute_overlap_metrics
+)
 
 
 HYPOTHESIS_DEADLINE = None  # this is how many milliseconds each test has to finish in
@@ -84,6 +87,92 @@ class TestComputeOverlap(unittest.TestCase):
         self.assertAlmostEqual(0.0, df["dice_1"].values[0])
         self.assertAlmostEqual(0.0, df["jaccard_1"].values[0])
 
+    def test_batch(self):
+        output = os.path.join(self.test_dir, "batch.csv")
+        manifest = os.path.join(self.test_dir, "manifest.csv")
+        pairs = [("small", "medium"), ("big", "big"), ("medium", "small")]
+        with open(manifest, "w") as f:
+            f.write("mask1,mask2\n")
+            for img1, img2 in pairs:
+                f.write(f"{self.random_images[img1]},{self.random_images[img2]}\n")
+        args = [manifest, output, "-s", "-ow", "-w", "2", "-cl", "1", "3"]
+        compute_overlap_batch(create_batch_parser().parse_args(args=args))
+        df = pd.read_csv(output)
+        self.assertEqual(len(df), len(pairs))
+        for i, (img1, img2) in enumerate(pairs):
+            single = os.path.join(self.test_dir, f"single_{i}.csv")
+            args = [self.random_images[img1], self.random_images[img2], single, "-s", "-ow", "-cl", "1", "3"]
+            compute_overlap(create_parser().parse_args(args=args))
+            expected = pd.read_csv(single)
+            for column in expected.columns:
+                self.assertEqual(expected[column].values[0], df[column].values[i])
+        self.assertTrue(df["error"].isna().all())
+
+    def test_batch_records_failures(self):
+        output = os.path.join(self.test_dir, "batch.csv")
+        manifest = os.path.join(self.test_dir, "manifest.csv")
+        missing = os.path.join(self.test_dir, "missing.nii")
+        with open(manifest, "w") as f:
+            f.write("mask1,mask2\n")
+            f.write(f"{self.random_images['small']},{self.random_images['small']}\n")
+            f.write(f"{self.random_images['small']},{missing}\n")
+        args = [manifest, output, "-s", "-ow"]
+        with self.assertRaises(RuntimeError):
+            compute_overlap_batch(create_batch_parser().parse_args(args=args))
+        df = pd.read_csv(output)
+        self.assertAlmostEqual(1.0, df["dice_1"].values[0])
+        self.assertTrue(np.isnan(df["dice_1"].values[1]))
+        self.assertIn("missing.nii", df["error"].values[1])
+
+
+class TestOverlapMetrics(unittest.TestCase):
+
+    @settings(deadline=HYPOTHESIS_DEADLINE, max_examples=50)
+    @given(
+        shape=st.tuples(*[st.integers(min_value=1, max_value=8)] * 3),
+        low=st.integers(min_value=-3, max_value=3),
+        n_labels=st.integers(min_value=1, max_value=5),
+        cl=st.lists(st.integers(min_value=-3, max_value=8), min_size=1, max_size=5, unique=True)
+    )
+    def test_matches_label_overlap_filter(self, shape, low, n_labels, cl):
+        x = np.random.randint(low, low + n_labels, shape).astype(np.int16)
+        y = np.random.randint(low, low + n_labels, shape).astype(np.int16)
+        x_img, y_img = sitk.GetImageFromArray(x), sitk.GetImageFromArray(y)
+        metrics = compute_overlap_metrics(x_img, y_img, cl, True)
+        overlap = sitk.LabelOverlapMeasuresImageFilter()
+        for i, label in enumerate(cl):
+            overlap.Execute(x_img == label, y_img == label)
+            # the filter gives arbitrary values for a label in neither image, and when a metric is 0 / 0, which is
+            # NaN here
+            source, target = (x == label).sum(), (y == label).sum()
+            if source + target == 0:
+                self.assertTrue(np.isnan(metrics["dice"][i]))
+                continue
+            self.assertAlmostEqual(overlap.GetDiceCoefficient(), metrics["dice"][i])
+            self.assertAlmostEqual(overlap.GetJaccardCoefficient(), metrics["jaccard"][i])
+            self.assertAlmostEqual(overlap.GetVolumeSimilarity(), metrics["volume_similarity"][i])
+            if target > 0:
+                self.assertAlmostEqual(overlap.GetFalseNegativeError(), metrics["false_negative_error"][i])
+            if target < x.size:
+                self.assertAlmostEqual(overlap.GetFalsePositiveError(), metrics["false_positive_error"][i])
+
+    def test_confusion_matrix(self):
+        x = np.array([0, 0, 2, 2, 5])
+        y = np.array([0, 2, 2, 5, 5])
+        labels, counts = compute_confusion_matrix(x, y)
+        np.testing.assert_array_equal(labels, [0, 2, 5])
+        np.testing.assert_array_equal(counts, [[1, 1, 0], [0, 1, 1], [0, 0, 1]])
+
+    def test_confusion_matrix_sparse_and_float_labels(self):
+        x = np.array([0, 100000, 100000, 0])
+        y = np.array([0, 100000, 0, 0])
+        labels, counts = compute_confusion_matrix(x, y)
+        np.testing.assert_array_equal(labels, [0, 100000])
+        np.testing.assert_array_equal(counts, [[2, 0], [1, 1]])
+        labels, counts = compute_confusion_matrix(x.astype(float) / 2, y.astype(float) / 2)
+        np.testing.assert_array_equal(labels, [0, 50000])
+        np.testing.assert_array_equal(counts, [[2, 0], [1, 1]])
+
 
 if __name__ == '__main__':
     unittest.main()
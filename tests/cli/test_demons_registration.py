@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import unittest
 from hypothesis import given, settings, strategies as st
+import json
 import os
 import shutil
 import tempfile
@@ -42,6 +43,14 @@ class TestDemonsRegistration(unittest.TestCase):
             fn = os.path.join(self.test_dir, f"{image_key}.nii")
             sitk.WriteImage(img, fn)
             self.random_images[image_key] = fn
+        # and a mask of a central block of each image
+        self.masks = {}
+        for image_key, image_size in IMAGE_SIZE_DICT.items():
+            arr = np.zeros((image_size, image_size, image_size), dtype=np.uint8)
+            arr[image_size // 4:-image_size // 4, image_size // 4:-image_size // 4, image_size // 4:-image_size // 4] = 1
+            fn = os.path.join(self.test_dir, f"{image_key}_mask.nii")
+            sitk.WriteImage(sitk.GetImageFromArray(arr), fn)
+            self.masks[image_key] = fn
 
     def tearDown(self):
         # Remove temporary directory and all files
@@ -90,6 +99,23 @@ class TestDemonsRegistration(unittest.TestCase):
         )
         demons_registration(create_parser().parse_args(args=args))
 
+    @settings(deadline=HYPOTHESIS_DEADLINE)
+    @given(
+        fixed_image=st.sampled_from(list(IMAGE_SIZE_DICT.keys())),
+        moving_image=st.sampled_from(list(IMAGE_SIZE_DICT.keys())),
+        downsampling=st.sampled_from([None, 2]),
+        masks=st.sampled_from(["fixed", "moving", "both"])
+    )
+    def test_masks(self, fixed_image, moving_image, downsampling, masks):
+        args = self._construct_default_args(fixed_image, moving_image)
+        if masks in ["fixed", "both"]:
+            args += ["-fm", self.masks[fixed_image]]
+        if masks in ["moving", "both"]:
+            args += ["-mm", self.masks[moving_image]]
+        if downsampling is not None:
+            args += ["-dsf", f"{downsampling}", "-dss", f"{downsampling}"]
+        demons_registration(create_parser().parse_args(args=args))
+
     @settings(deadline=HYPOTHESIS_DEADLINE)
     @given(
         fixed_image=st.sampled_from(list(IMAGE_SIZE_DICT.keys())),
@@ -122,6 +148,19 @@ class TestDemonsRegistration(unittest.TestCase):
         args = self._construct_default_args(fixed_image, moving_image, output_image=output_image)
         demons_registration(create_parser().parse_args(args=args))
 
+    @settings(deadline=HYPOTHESIS_DEADLINE)
+    @given(
+        fixed_image=st.sampled_from(list(IMAGE_SIZE_DICT.keys())),
+        moving_image=st.sampled_from(list(IMAGE_SIZE_DICT.keys())),
+        output_image=st.booleans()
+    )
+    def test_float32_displacement_field(self, fixed_image, moving_image, output_image):
+        args = self._construct_default_args(fixed_image, moving_image, output_image=output_image) + ["-f32"]
+        demons_registration(create_parser().parse_args(args=args))
+        if output_image:
+            field = sitk.ReadImage(os.path.join(self.test_dir, f"{TEST_OUTPUT_LABEL}.nii"))
+            self.assertEqual(field.GetPixelID(), sitk.sitkVectorFloat32)
+
     @settings(deadline=HYPOTHESIS_DEADLINE)
     @given(
         fixed_image=st.sampled_from(list(IMAGE_SIZE_DICT.keys())),
@@ -143,6 +182,34 @@ class TestDemonsRegistration(unittest.TestCase):
         args = self._construct_default_args(fixed_image, moving_image) + ["-ds", f"{ds}", "-us", f"{us}"]
         demons_registration(create_parser().parse_args(args=args))
 
+    def test_exclude_initial_transform(self):
+        # by default the initial transform is added into the field, otherwise the field is only the demons part
+        initial_transform = os.path.join(self.test_dir, "initial.tfm")
+        sitk.WriteTransform(sitk.TranslationTransform(3, (1.0, -0.5, 2.0)), initial_transform)
+        args = self._construct_default_args("medium", "medium") + ["-it", initial_transform]
+        demons_registration(create_parser().parse_args(args=args))
+        field = sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(self.test_dir, f"{TEST_OUTPUT_LABEL}.nii")))
+        args[2] = os.path.join(self.test_dir, "demons_only.nii")
+        demons_registration(create_parser().parse_args(args=args + ["-eit"]))
+        demons_only = sitk.GetArrayFromImage(sitk.ReadImage(args[2]))
+        np.testing.assert_allclose(field, demons_only + np.array([1.0, -0.5, 2.0]), atol=1e-6)
+
+    def test_instrumentation(self):
+        args = self._construct_default_args("medium", "medium") + ["-sf", "4", "2", "-ss", "2", "1"]
+        demons_registration(create_parser().parse_args(args=args))
+        with open(os.path.join(self.test_dir, f"{TEST_OUTPUT_LABEL}_instrumentation.json")) as f:
+            instrumentation = json.load(f)
+        # the given levels are followed by a final level at full resolution
+        self.assertEqual([level["shrink_factor"] for level in instrumentation["levels"]], [4, 2, 1])
+        # the demons metric is computed on every voxel of the level
+        valid_points = [level["metric_valid_points"] for level in instrumentation["levels"]]
+        self.assertEqual(valid_points, sorted(valid_points))
+        self.assertEqual(valid_points[-1], IMAGE_SIZE_DICT["medium"] ** 3)
+        for level in instrumentation["levels"]:
+            self.assertEqual(level["metric_evaluations"], level["iterations"])
+        for stage in ["read", "pyramid", "registration", "write"]:
+            self.assertIn(stage, instrumentation["timings"])
+
 
 if __name__ == '__main__':
     unittest.main()
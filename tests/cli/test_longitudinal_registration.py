@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import SimpleITK as sitk
+import numpy as np
+
+from bonelab.cli.longitudinal_registration import create_parser, longitudinal_registration, get_grid, propagate_masks
+
+# set this low so that testing goes quickly
+DEFAULT_ITERATIONS = 10
+
+FOLLOW_UP_LABELS = ["fu1", "fu2", "fu3"]
+
+
+class TestLongitudinalRegistration(unittest.TestCase):
+
+    def setUp(self):
+        # Create temporary directory to work in
+        self.test_dir = tempfile.mkdtemp()
+        # a blob and shifted copies of it, so that the common region is smaller than the baseline image
+        rng = np.random.default_rng(0)
+        zz, yy, xx = np.mgrid[:24, :24, :24]
+        arr = (((zz - 12) ** 2 + (yy - 12) ** 2 / 2 + (xx - 11) ** 2) < 50) + rng.normal(0, 0.05, zz.shape)
+        self.baseline_image = self._write(arr, "baseline.nii")
+        self.follow_up_images = [
+            self._write(arr[shift:], f"{label}.nii") for shift, label in enumerate(FOLLOW_UP_LABELS)
+        ]
+        self.baseline_mask = self._write((arr > 0.5).astype(np.uint8), "mask.nii")
+        self.follow_up_masks = [
+            self._write((arr[shift:] > 0.5).astype(np.uint8), f"{label}_mask.nii")
+            for shift, label in enumerate(FOLLOW_UP_LABELS)
+        ]
+
+    def tearDown(self):
+        # Remove temporary directory and all files
+        shutil.rmtree(self.test_dir)
+
+    def _write(self, arr: np.ndarray, fn: str) -> str:
+        fn = os.path.join(self.test_dir, fn)
+        sitk.WriteImage(sitk.GetImageFromArray(arr), fn)
+        return fn
+
+    def _run(self, output_directory: str, workers: int, extra_args: tuple = ()) -> None:
+        os.makedirs(output_directory)
+        args = [
+            output_directory, "test", self.baseline_image, *self.follow_up_images,
+            "-bl", "baseline", "-fl", *FOLLOW_UP_LABELS, "-bm", self.baseline_mask, "-bml", "mask",
+            "-mi", f"{DEFAULT_ITERATIONS}", "-s", "-w", f"{workers}", *extra_args
+        ]
+        longitudinal_registration(create_parser().parse_args(args=args))
+
+    def test_workers_match_serial(self):
+        serial_directory = os.path.join(self.test_dir, "serial")
+        parallel_directory = os.path.join(self.test_dir, "parallel")
+        self._run(serial_directory, 1)
+        self._run(parallel_directory, 2)
+        for label in FOLLOW_UP_LABELS:
+            with open(os.path.join(serial_directory, f"test_{label}_transform.txt")) as f:
+                serial_transform = f.read()
+            with open(os.path.join(parallel_directory, f"test_{label}_transform.txt")) as f:
+                self.assertEqual(serial_transform, f.read())
+        for fn in ["test_common_region.nii.gz", "test_baseline_mask.nii.gz"] + \
+                [f"test_{label}_mask.nii.gz" for label in FOLLOW_UP_LABELS]:
+            np.testing.assert_array_equal(
+                sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(serial_directory, fn))),
+                sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(parallel_directory, fn)))
+            )
+        # the follow-ups are shifted along z, so the common region excludes the last slices of the baseline
+        common_region = sitk.GetArrayFromImage(
+            sitk.ReadImage(os.path.join(serial_directory, "test_common_region.nii.gz"))
+        )
+        self.assertGreater(common_region.sum(), 0)
+        self.assertLess(common_region.sum(), common_region.size)
+        # each follow-up writes its own instrumentation, also from the worker processes
+        for directory in [serial_directory, parallel_directory]:
+            for label in FOLLOW_UP_LABELS:
+                with open(os.path.join(directory, f"test_{label}_instrumentation.json")) as f:
+                    instrumentation = json.load(f)
+                self.assertEqual(len(instrumentation["levels"]), 1)
+                self.assertGreater(instrumentation["levels"][0]["iterations"], 0)
+                self.assertIn("registration", instrumentation["timings"])
+
+    def test_metric_masks(self):
+        mask_args = ("-fm", self.baseline_mask, "-mm", *self.follow_up_masks)
+        serial_directory = os.path.join(self.test_dir, "serial")
+        parallel_directory = os.path.join(self.test_dir, "parallel")
+        self._run(serial_directory, 1, mask_args)
+        self._run(parallel_directory, 2, mask_args)
+        for label in FOLLOW_UP_LABELS:
+            with open(os.path.join(serial_directory, f"test_{label}_transform.txt")) as f:
+                serial_transform = f.read()
+            with open(os.path.join(parallel_directory, f"test_{label}_transform.txt")) as f:
+                self.assertEqual(serial_transform, f.read())
+        # there must be one moving mask per follow-up
+        with self.assertRaises(ValueError):
+            self._run(os.path.join(self.test_dir, "mismatched"), 1, ("-mm", *self.follow_up_masks[:2]))
+
+    def test_propagate_masks(self):
+        # masks of two pixel types, so that both the stacked and the single mask paths are used
+        rng = np.random.default_rng(1)
+        masks = [
+            sitk.GetImageFromArray(rng.integers(0, 3, (10, 11, 12)).astype(np.uint8)),
+            sitk.GetImageFromArray(rng.integers(0, 2, (10, 11, 12)).astype(np.uint8)),
+            sitk.GetImageFromArray(rng.integers(0, 5, (10, 11, 12)).astype(np.int16))
+        ]
+        transform = sitk.Euler3DTransform((5, 5, 5), 0.1, -0.2, 0.05, (0.5, -1.0, 0.25))
+        follow_up = sitk.Image(9, 13, 8, sitk.sitkFloat32)
+        follow_up.SetOrigin((-1.0, 0.5, 0.0))
+        follow_up.SetSpacing((1.2, 0.9, 1.1))
+        output_mask_fns = [os.path.join(self.test_dir, f"mask{j}.nii") for j in range(len(masks))]
+        propagate_masks(masks, transform, get_grid(follow_up), output_mask_fns, True)
+        for mask, fn in zip(masks, output_mask_fns):
+            expected = sitk.Resample(mask, follow_up, transform.GetInverse(), sitk.sitkNearestNeighbor)
+            propagated = sitk.ReadImage(fn)
+            self.assertEqual(propagated.GetPixelID(), mask.GetPixelID())
+            np.testing.assert_array_equal(sitk.GetArrayFromImage(propagated), sitk.GetArrayFromImage(expected))
+        # the worker processes are given the filenames of the masks instead
+        mask_fns = [os.path.join(self.test_dir, f"baseline_mask{j}.nii") for j in range(len(masks))]
+        for mask, fn in zip(masks, mask_fns):
+            sitk.WriteImage(mask, fn)
+        output_from_file_fns = [os.path.join(self.test_dir, f"mask{j}_from_file.nii") for j in range(len(masks))]
+        propagate_masks(mask_fns, transform, get_grid(follow_up), output_from_file_fns, True)
+        for fn, from_file_fn in zip(output_mask_fns, output_from_file_fns):
+            np.testing.assert_array_equal(
+                sitk.GetArrayFromImage(sitk.ReadImage(from_file_fn)), sitk.GetArrayFromImage(sitk.ReadImage(fn))
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
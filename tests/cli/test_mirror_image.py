@@ -52,5 +52,40 @@ class TestMirrorImage(unittest.TestCase):
         mirror_image(create_parser().parse_args(args=args))
 
 
+    @given(
+        img=st.sampled_from(list(IMAGE_SIZE_DICT.keys())),
+        axis=st.integers(min_value=MIN_AXIS, max_value=MAX_AXIS)
+    )
+    def test_axis_aligned_is_flipped_exactly(self, img, axis):
+        output = os.path.join(self.test_dir, TEST_OUTPUT_LABEL)
+        args = [self.random_images[img], str(axis), output, "-s", "-ow", "-int", "BSpline"]
+        mirror_image(create_parser().parse_args(args=args))
+        original = sitk.ReadImage(self.random_images[img])
+        mirrored = sitk.ReadImage(output)
+        # numpy axes are in the reverse order of the image axes
+        np.testing.assert_array_equal(
+            sitk.GetArrayFromImage(mirrored), np.flip(sitk.GetArrayFromImage(original), 2 - axis)
+        )
+        self.assertEqual(mirrored.GetOrigin(), original.GetOrigin())
+        self.assertEqual(mirrored.GetDirection(), original.GetDirection())
+
+    def test_permuted_and_oblique_directions(self):
+        arr = (MAX_VALUE * np.random.rand(6, 7, 8)).astype(np.int16)
+        fn = os.path.join(self.test_dir, "directed.nii")
+        output = os.path.join(self.test_dir, TEST_OUTPUT_LABEL)
+        # the image x axis points along physical y, so mirroring along physical y flips the image x axis
+        img = sitk.GetImageFromArray(arr)
+        img.SetDirection((0, 1, 0, 1, 0, 0, 0, 0, 1))
+        sitk.WriteImage(img, fn)
+        mirror_image(create_parser().parse_args(args=[fn, "1", output, "-s", "-ow"]))
+        np.testing.assert_array_equal(sitk.GetArrayFromImage(sitk.ReadImage(output)), np.flip(arr, 2))
+        # an oblique image is resampled instead
+        angle = np.pi / 6
+        img.SetDirection((np.cos(angle), -np.sin(angle), 0, np.sin(angle), np.cos(angle), 0, 0, 0, 1))
+        sitk.WriteImage(img, fn)
+        mirror_image(create_parser().parse_args(args=[fn, "0", output, "-s", "-ow"]))
+        self.assertEqual(sitk.ReadImage(output).GetSize(), img.GetSize())
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import unittest
 from hypothesis import given, settings, strategies as st
+import json
 import os
 import shutil
 import tempfile
@@ -37,6 +38,14 @@ class TestRegistration(unittest.TestCase):
             fn = os.path.join(self.test_dir, f"{image_key}.nii")
             sitk.WriteImage(img, fn)
             self.random_images[image_key] = fn
+        # and a mask of a central block of each image
+        self.masks = {}
+        for image_key, image_size in IMAGE_SIZE_DICT.items():
+            arr = np.zeros((image_size, image_size, image_size), dtype=np.uint8)
+            arr[image_size // 4:-image_size // 4, image_size // 4:-image_size // 4, image_size // 4:-image_size // 4] = 1
+            fn = os.path.join(self.test_dir, f"{image_key}_mask.nii")
+            sitk.WriteImage(sitk.GetImageFromArray(arr), fn)
+            self.masks[image_key] = fn
 
     def tearDown(self):
         # Remove temporary directory and all files
@@ -71,6 +80,23 @@ class TestRegistration(unittest.TestCase):
         )
         registration(create_parser().parse_args(args=args))
 
+    @settings(deadline=HYPOTHESIS_DEADLINE)
+    @given(
+        fixed_image=st.sampled_from(list(IMAGE_SIZE_DICT.keys())),
+        moving_image=st.sampled_from(list(IMAGE_SIZE_DICT.keys())),
+        downsampling=st.sampled_from([None, 2]),
+        masks=st.sampled_from(["fixed", "moving", "both"])
+    )
+    def test_masks(self, fixed_image, moving_image, downsampling, masks):
+        args = self._construct_default_args(fixed_image, moving_image)
+        if masks in ["fixed", "both"]:
+            args += ["-fm", self.masks[fixed_image]]
+        if masks in ["moving", "both"]:
+            args += ["-mm", self.masks[moving_image]]
+        if downsampling is not None:
+            args += ["-dsf", f"{downsampling}", "-dss", f"{downsampling}"]
+        registration(create_parser().parse_args(args=args))
+
     @settings(deadline=HYPOTHESIS_DEADLINE)
     @given(
         fixed_image=st.sampled_from(list(IMAGE_SIZE_DICT.keys())),
@@ -168,6 +194,20 @@ class TestRegistration(unittest.TestCase):
         args = self._construct_default_args(fixed_image, moving_image) + ["-ci", f"{initialization}"]
         registration(create_parser().parse_args(args=args))
 
+    def test_instrumentation(self):
+        args = self._construct_default_args("medium", "medium") + ["-sf", "4", "2", "1", "-ss", "2", "1", "0"]
+        registration(create_parser().parse_args(args=args))
+        with open(os.path.join(self.test_dir, "test_output_instrumentation.json")) as f:
+            instrumentation = json.load(f)
+        self.assertEqual([level["shrink_factor"] for level in instrumentation["levels"]], [4, 2, 1])
+        for level in instrumentation["levels"]:
+            self.assertGreater(level["iterations"], 0)
+            self.assertLessEqual(level["iterations"], DEFAULT_ITERATIONS)
+            self.assertGreater(level["metric_valid_points"], 0)
+            self.assertIsNotNone(level["seconds"])
+        for stage in ["read", "registration", "write"]:
+            self.assertIn(stage, instrumentation["timings"])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import unittest
+from unittest import mock
+import multiprocessing
+import os
+import csv
+import shutil
+import tempfile
+import SimpleITK as sitk
+import numpy as np
+
+from bonelab.cli import registration_batch as registration_batch_module
+from bonelab.cli.registration_batch import create_parser, registration_batch, get_fixed_image, parse_pair_arguments
+from bonelab.util.demons_registration_util import ImagePyramid
+from bonelab.cli.registration import create_parser as create_registration_parser, registration
+from bonelab.cli.demons_registration import (
+    create_parser as create_demons_registration_parser, demons_registration
+)
+
+# set this low so that testing goes quickly
+DEFAULT_ITERATIONS = 10
+
+
+class TestRegistrationBatch(unittest.TestCase):
+
+    def setUp(self):
+        # Create temporary directory to work in
+        self.test_dir = tempfile.mkdtemp()
+        # two fixed images, each with two shifted copies as moving images
+        rng = np.random.default_rng(0)
+        zz, yy, xx = np.mgrid[:24, :24, :24]
+        self.pairs = []
+        for f in range(2):
+            arr = (((zz - 12) ** 2 + (yy - 12 + f) ** 2 / 2 + (xx - 11) ** 2) < 50) + rng.normal(0, 0.05, zz.shape)
+            fixed = self._write(arr, f"fixed{f}.nii")
+            for m in range(2):
+                moving = self._write(np.roll(arr, m + 1, axis=0), f"moving{f}{m}.nii")
+                self.pairs.append((fixed, moving, f"{f}{m}"))
+
+    def tearDown(self):
+        # Remove temporary directory and all files
+        shutil.rmtree(self.test_dir)
+
+    def _write(self, arr: np.ndarray, fn: str) -> str:
+        fn = os.path.join(self.test_dir, fn)
+        sitk.WriteImage(sitk.GetImageFromArray(arr), fn)
+        return fn
+
+    def _write_manifest(self, extension: str, overrides: dict = None) -> str:
+        overrides = overrides if overrides is not None else {}
+        manifest = os.path.join(self.test_dir, f"manifest_{extension.strip('.')}.csv")
+        with open(manifest, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["fixed", "moving", "output", "overrides"])
+            for fixed, moving, name in self.pairs:
+                output = os.path.join(self.test_dir, f"batch_{name}{extension}")
+                writer.writerow([fixed, moving, output, overrides.get(name, "")])
+        return manifest
+
+    def _read_table(self, fn: str) -> list:
+        with open(fn, "r", newline="") as f:
+            return list(csv.DictReader(f))
+
+    def test_rigid_matches_single_pair(self):
+        options = f"-mi {DEFAULT_ITERATIONS} -sf 2 1 -ss 1 0"
+        overrides = {"01": "-mi 5"}
+        manifest = self._write_manifest(".txt", overrides)
+        table = os.path.join(self.test_dir, "metrics.csv")
+        registration_batch(create_parser().parse_args([manifest, table, f"--options={options}", "-w", "2", "-s"]))
+        rows = self._read_table(table)
+        self.assertEqual(
+            [os.path.basename(row["output"]) for row in rows], [f"batch_{name}.txt" for _, _, name in self.pairs]
+        )
+        for (fixed, moving, name), row in zip(self.pairs, rows):
+            self.assertEqual(row["status"], "done")
+            self.assertEqual(row["error"], "")
+            single_output = os.path.join(self.test_dir, f"single_{name}.txt")
+            registration(create_registration_parser().parse_args(
+                [fixed, moving, single_output, "-s"] + options.split() + overrides.get(name, "").split()
+            ))
+            with open(single_output) as f:
+                single_transform = f.read()
+            with open(row["output"]) as f:
+                self.assertEqual(f.read(), single_transform)
+            with open(os.path.join(self.test_dir, f"single_{name}_metric_history.csv")) as f:
+                metric_history = next(csv.reader(f))
+            self.assertEqual(int(row["iterations"]), len(metric_history))
+            self.assertAlmostEqual(float(row["final_metric"]), float(metric_history[-1]))
+        # the override only applies to its own row
+        self.assertLessEqual(int(rows[1]["iterations"]), 2 * 5)
+
+    def test_demons_matches_single_pair(self):
+        options = f"-mi {DEFAULT_ITERATIONS} -sf 2 1 -ss 1 0.5"
+        manifest = self._write_manifest(".nii")
+        table = os.path.join(self.test_dir, "metrics.csv")
+        registration_batch(create_parser().parse_args(
+            [manifest, table, "-m", "demons", f"--options={options}", "-s"]
+        ))
+        for (fixed, moving, name), row in zip(self.pairs, self._read_table(table)):
+            self.assertEqual(row["status"], "done")
+            single_output = os.path.join(self.test_dir, f"single_{name}.nii")
+            demons_registration(create_demons_registration_parser().parse_args(
+                [fixed, moving, single_output, "-s"] + options.split()
+            ))
+            np.testing.assert_array_equal(
+                sitk.GetArrayFromImage(sitk.ReadImage(row["output"])),
+                sitk.GetArrayFromImage(sitk.ReadImage(single_output))
+            )
+
+    def test_demons_fixed_mask_matches_single_pair(self):
+        # the masked fixed image pyramid is cached and shared by the pairs with the same fixed image and mask
+        zz, yy, xx = np.mgrid[:24, :24, :24]
+        fixed_mask = self._write(((zz - 12) ** 2 + (yy - 12) ** 2 + (xx - 11) ** 2 < 81).astype(np.uint8), "mask.nii")
+        options = f"-mi {DEFAULT_ITERATIONS} -sf 2 1 -ss 1 0.5 -fm {fixed_mask}"
+        manifest = self._write_manifest(".nii")
+        table = os.path.join(self.test_dir, "metrics.csv")
+        registration_batch(create_parser().parse_args(
+            [manifest, table, "-m", "demons", f"--options={options}", "-s"]
+        ))
+        for (fixed, moving, name), row in zip(self.pairs, self._read_table(table)):
+            self.assertEqual(row["status"], "done")
+            single_output = os.path.join(self.test_dir, f"single_{name}.nii")
+            demons_registration(create_demons_registration_parser().parse_args(
+                [fixed, moving, single_output, "-s"] + options.split()
+            ))
+            np.testing.assert_array_equal(
+                sitk.GetArrayFromImage(sitk.ReadImage(row["output"])),
+                sitk.GetArrayFromImage(sitk.ReadImage(single_output))
+            )
+        rows = [
+            {"fixed": fixed, "moving": moving, "output": name + ".nii", "overrides": ""}
+            for fixed, moving, name in self.pairs[:2]
+        ]
+        pyramids = [get_fixed_image("demons", parse_pair_arguments("demons", row, options)) for row in rows]
+        self.assertIsInstance(pyramids[0], ImagePyramid)
+        self.assertIs(pyramids[0], pyramids[1])
+        self.assertEqual(sitk.GetArrayViewFromImage(pyramids[0].image)[0, 0, 0], 0)
+        unmasked = get_fixed_image("demons", parse_pair_arguments("demons", rows[0], options.split(" -fm")[0]))
+        self.assertIsNot(unmasked, pyramids[0])
+
+    @unittest.skipUnless(
+        multiprocessing.get_start_method() == "fork", "the workers only see the patched reader when forked"
+    )
+    def test_workers_read_each_fixed_image_once(self):
+        # each worker gets all of the pairs of a fixed image, so it is read once, from its cache for the other pairs
+        reads_log = os.path.join(self.test_dir, "reads.log")
+        read_image = registration_batch_module.read_image
+
+        def logged_read_image(fn, *args, **kwargs):
+            with open(reads_log, "a") as f:
+                f.write(f"{fn}\n")
+            return read_image(fn, *args, **kwargs)
+
+        manifest = self._write_manifest(".txt")
+        table = os.path.join(self.test_dir, "metrics.csv")
+        with mock.patch.object(registration_batch_module, "read_image", side_effect=logged_read_image):
+            registration_batch(create_parser().parse_args(
+                [manifest, table, f"--options=-mi {DEFAULT_ITERATIONS}", "-w", "2", "-s"]
+            ))
+        self.assertEqual([row["status"] for row in self._read_table(table)], ["done"] * len(self.pairs))
+        with open(reads_log) as f:
+            reads = f.read().splitlines()
+        for fixed in sorted({fixed for fixed, _, _ in self.pairs}):
+            self.assertEqual(reads.count(fixed), 1)
+
+    def test_resume(self):
+        manifest = self._write_manifest(".txt")
+        table = os.path.join(self.test_dir, "metrics.csv")
+        args = [manifest, table, f"--options=-mi {DEFAULT_ITERATIONS}", "-s"]
+        registration_batch(create_parser().parse_args(args))
+        first_rows = self._read_table(table)
+        # remove one output, only that pair should be registered again
+        os.remove(first_rows[2]["output"])
+        mtimes = [os.stat(row["output"]).st_mtime_ns for i, row in enumerate(first_rows) if i != 2]
+        with self.assertRaises(FileExistsError):
+            registration_batch(create_parser().parse_args(args))
+        registration_batch(create_parser().parse_args(args + ["--resume"]))
+        rows = self._read_table(table)
+        self.assertEqual(
+            mtimes, [os.stat(row["output"]).st_mtime_ns for i, row in enumerate(rows) if i != 2]
+        )
+        self.assertTrue(os.path.isfile(rows[2]["output"]))
+        for first_row, row in zip(first_rows, rows):
+            self.assertEqual(row["status"], "done")
+            self.assertEqual(row["final_metric"], first_row["final_metric"])
+
+    def test_failed_pair_does_not_stop_others(self):
+        self.pairs[1] = (self.pairs[1][0], os.path.join(self.test_dir, "missing.nii"), self.pairs[1][2])
+        manifest = self._write_manifest(".txt")
+        table = os.path.join(self.test_dir, "metrics.csv")
+        with self.assertRaises(RuntimeError):
+            registration_batch(create_parser().parse_args(
+                [manifest, table, f"--options=-mi {DEFAULT_ITERATIONS}", "-s"]
+            ))
+        rows = self._read_table(table)
+        self.assertEqual([row["status"] for row in rows], ["done", "failed", "done", "done"])
+        self.assertIn("FileNotFoundError", rows[1]["error"])
+
+    def test_invalid_overrides(self):
+        manifest = self._write_manifest(".txt", {"10": "--no-such-option"})
+        table = os.path.join(self.test_dir, "metrics.csv")
+        with self.assertRaises(ValueError):
+            registration_batch(create_parser().parse_args([manifest, table, "-s"]))
+        self.assertFalse(os.path.exists(table))
+
+
+if __name__ == '__main__':
+    unittest.main()
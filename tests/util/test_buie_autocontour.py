@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import unittest
+from hypothesis import given, settings, strategies as st
+import numpy as np
+import vtk
+
+from bonelab.util.vtk_util import numpy_to_vtkImageData, vtkImageData_to_numpy
+from bonelab.util.buie_autocontour import (
+    dilate_erode_footprint, clipped_dilation, clipped_median, largest_component, gaussian_smooth
+)
+
+
+HYPOTHESIS_DEADLINE = None  # this is how many milliseconds each test has to finish in
+
+IN_VALUE = 127
+
+kernel_sizes = st.tuples(*[st.integers(min_value=1, max_value=6)] * 3)
+
+
+def run_vtk_filter(vtk_filter, array: np.ndarray, array_type: int = vtk.VTK_FLOAT) -> np.ndarray:
+    vtk_filter.SetInputData(numpy_to_vtkImageData(array, array_type=array_type))
+    vtk_filter.Update()
+    return vtkImageData_to_numpy(vtk_filter.GetOutput())
+
+
+def random_mask(shape, fraction: float = 0.3) -> np.ndarray:
+    return np.random.rand(*shape) < fraction
+
+
+class TestClippedDilation(unittest.TestCase):
+
+    @settings(deadline=HYPOTHESIS_DEADLINE, max_examples=20)
+    @given(kernel_size=kernel_sizes)
+    def test_matches_vtk_dilate(self, kernel_size):
+        mask = random_mask((12, 11, 10), 0.05)
+        dilate = vtk.vtkImageDilateErode3D()
+        dilate.SetDilateValue(IN_VALUE)
+        dilate.SetErodeValue(0)
+        dilate.SetKernelSize(*kernel_size)
+        expected = run_vtk_filter(dilate, IN_VALUE * mask.astype(np.float32)) == IN_VALUE
+        np.testing.assert_array_equal(clipped_dilation(mask, dilate_erode_footprint(kernel_size)), expected)
+
+    @settings(deadline=HYPOTHESIS_DEADLINE, max_examples=20)
+    @given(kernel_size=kernel_sizes)
+    def test_matches_vtk_erode(self, kernel_size):
+        mask = random_mask((12, 11, 10), 0.9)
+        erode = vtk.vtkImageDilateErode3D()
+        erode.SetDilateValue(0)
+        erode.SetErodeValue(IN_VALUE)
+        erode.SetKernelSize(*kernel_size)
+        expected = run_vtk_filter(erode, IN_VALUE * mask.astype(np.float32)) == IN_VALUE
+        np.testing.assert_array_equal(mask & ~clipped_dilation(~mask, dilate_erode_footprint(kernel_size)), expected)
+
+    def test_default_kernel_sizes(self):
+        mask = random_mask((40, 40, 3), 0.01)
+        for kernel_size in [(15, 15, 1), (10, 10, 1)]:
+            dilate = vtk.vtkImageDilateErode3D()
+            dilate.SetDilateValue(IN_VALUE)
+            dilate.SetErodeValue(0)
+            dilate.SetKernelSize(*kernel_size)
+            expected = run_vtk_filter(dilate, IN_VALUE * mask.astype(np.float32)) == IN_VALUE
+            np.testing.assert_array_equal(clipped_dilation(mask, dilate_erode_footprint(kernel_size)), expected)
+
+
+class TestClippedMedian(unittest.TestCase):
+
+    @settings(deadline=HYPOTHESIS_DEADLINE, max_examples=20)
+    @given(kernel_size=kernel_sizes)
+    def test_matches_vtk_median(self, kernel_size):
+        mask = random_mask((9, 8, 7), 0.5)
+        median = vtk.vtkImageMedian3D()
+        median.SetKernelSize(*kernel_size)
+        expected = run_vtk_filter(median, IN_VALUE * mask.astype(np.float32))
+        bone, undecided = clipped_median(mask, kernel_size)
+        np.testing.assert_array_equal(bone, expected == IN_VALUE)
+        np.testing.assert_array_equal(undecided, expected == IN_VALUE / 2)
+
+
+class TestLargestComponent(unittest.TestCase):
+
+    def test_matches_vtk_connectivity(self):
+        mask = random_mask((20, 20, 5), 0.4)
+        connectivity = vtk.vtkImageConnectivityFilter()
+        connectivity.SetExtractionModeToLargestRegion()
+        connectivity.SetScalarRange(1, IN_VALUE + 1)
+        expected = run_vtk_filter(connectivity, IN_VALUE * mask.astype(np.float32)) > 0
+        np.testing.assert_array_equal(largest_component(mask), expected)
+
+    def test_empty(self):
+        self.assertFalse(largest_component(np.zeros((3, 4, 5), dtype=bool)).any())
+
+
+class TestGaussianSmooth(unittest.TestCase):
+
+    @settings(deadline=HYPOTHESIS_DEADLINE, max_examples=20)
+    @given(
+        std=st.floats(min_value=0.3, max_value=2.0),
+        radius_factors=st.tuples(*[st.integers(min_value=0, max_value=4)] * 3),
+        array_type=st.sampled_from([vtk.VTK_UNSIGNED_CHAR, vtk.VTK_SHORT, vtk.VTK_FLOAT])
+    )
+    def test_matches_vtk_gaussian(self, std, radius_factors, array_type):
+        dtype = {vtk.VTK_UNSIGNED_CHAR: np.uint8, vtk.VTK_SHORT: np.int16, vtk.VTK_FLOAT: np.float32}[array_type]
+        image = (IN_VALUE * random_mask((10, 9, 8), 0.5)).astype(dtype)
+        gaussian = vtk.vtkImageGaussianSmooth()
+        gaussian.SetStandardDeviation(std)
+        gaussian.SetRadiusFactors(*radius_factors)
+        expected = run_vtk_filter(gaussian, image, array_type)
+        result = gaussian_smooth(image, std, radius_factors)
+        self.assertEqual(result.dtype, expected.dtype)
+        np.testing.assert_array_equal(result, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import unittest
+from hypothesis import given, settings, strategies as st
+import numpy as np
+
+from bonelab.util.image_statistics import ImageStatistics, histogram_range
+
+
+HYPOTHESIS_DEADLINE = None  # this is how many milliseconds each test has to finish in
+
+
+class TestImageStatistics(unittest.TestCase):
+
+    @settings(deadline=HYPOTHESIS_DEADLINE, max_examples=40)
+    @given(
+        dtype=st.sampled_from([np.int8, np.uint8, np.int16, np.uint16, np.int32, np.float32, np.float64]),
+        size=st.integers(min_value=1, max_value=3000),
+        chunk_size=st.integers(min_value=1, max_value=1000)
+    )
+    def test_matches_numpy(self, dtype, size, chunk_size):
+        if np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            array = np.random.randint(max(info.min, -40000), min(info.max, 40000) + 1, size).astype(dtype)
+        else:
+            array = (1000 * np.random.randn(size)).astype(dtype)
+        stats = ImageStatistics(array.reshape(1, 1, -1), chunk_size=chunk_size)
+        self.assertEqual(stats.count, size)
+        self.assertEqual(stats.min, array.min())
+        self.assertEqual(stats.max, array.max())
+        np.testing.assert_allclose(stats.mean, array.mean(dtype=np.float64), rtol=1e-10, atol=1e-8)
+        np.testing.assert_allclose(stats.std, array.std(dtype=np.float64), rtol=1e-8, atol=1e-8)
+        for bins, hist_range in [(128, (-32768, 32767)), (128, (-128, 127)), (7, (-3.5, 250.2))]:
+            hist, bin_edges = stats.histogram(bins, hist_range)
+            expected_hist, expected_bin_edges = np.histogram(array, bins, hist_range)
+            np.testing.assert_array_equal(hist, expected_hist)
+            np.testing.assert_array_equal(bin_edges, expected_bin_edges)
+
+    def test_histogram_range(self):
+        self.assertEqual(histogram_range(ImageStatistics(np.array([0, 100], dtype=np.int16))), (0, 127))
+        self.assertEqual(histogram_range(ImageStatistics(np.array([-1, 200], dtype=np.int16))), (-128, 255))
+        self.assertEqual(histogram_range(ImageStatistics(np.array([-200, 300], dtype=np.int16))), (-32768, 32767))
+
+
+if __name__ == '__main__':
+    unittest.main()
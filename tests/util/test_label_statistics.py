@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import unittest
+from hypothesis import given, settings, strategies as st
+import numpy as np
+
+from bonelab.util.label_statistics import compute_label_statistics, map_labels, MAX_DENSE_LABEL_RANGE
+
+
+HYPOTHESIS_DEADLINE = None  # this is how many milliseconds each test has to finish in
+
+
+def reference_label_statistics(image, spacing, origin):
+    # one pass per label, as `blImageCentroids` used to do
+    result = {}
+    for label in np.unique(image):
+        matches = np.transpose((image == label).nonzero())
+        result[label] = (
+            len(matches),
+            origin + spacing * np.mean(matches, axis=0),
+            np.stack([matches.min(axis=0), matches.max(axis=0)], axis=1)
+        )
+    return result
+
+
+class TestComputeLabelStatistics(unittest.TestCase):
+
+    @settings(deadline=HYPOTHESIS_DEADLINE, max_examples=30)
+    @given(
+        shape=st.tuples(*[st.integers(min_value=1, max_value=12)] * 3),
+        low=st.integers(min_value=-5, max_value=5),
+        n_labels=st.integers(min_value=1, max_value=6),
+        fortran_order=st.booleans()
+    )
+    def test_matches_reference(self, shape, low, n_labels, fortran_order):
+        image = np.random.randint(low, low + n_labels, shape).astype(np.int16)
+        if fortran_order:
+            image = np.asfortranarray(image)
+        spacing = np.array([0.5, 0.7, 1.1])
+        origin = np.array([-3.0, 2.0, 10.0])
+        stats = compute_label_statistics(image, spacing, origin)
+        expected = reference_label_statistics(image, spacing, origin)
+        np.testing.assert_array_equal(stats.labels, sorted(expected.keys()))
+        for i, label in enumerate(stats.labels):
+            count, centroid, bounding_box = expected[label]
+            self.assertEqual(stats.counts[i], count)
+            np.testing.assert_allclose(stats.centroids[i], centroid)
+            np.testing.assert_array_equal(stats.bounding_boxes[i], bounding_box)
+            self.assertAlmostEqual(stats.volumes[i], count * np.prod(spacing))
+
+    def test_sparse_labels(self):
+        image = np.zeros((4, 5, 6), dtype=np.int64)
+        image[1:3, 2, 3:5] = 10 ** 9
+        stats = compute_label_statistics(image)
+        np.testing.assert_array_equal(stats.labels, [0, 10 ** 9])
+        np.testing.assert_array_equal(stats.counts, [116, 4])
+        np.testing.assert_allclose(stats.centroids[1], [1.5, 2.0, 3.5])
+        np.testing.assert_array_equal(stats.bounding_boxes[1], [[1, 2], [2, 2], [3, 4]])
+        self.assertEqual(stats.index(10 ** 9), 1)
+        self.assertIsNone(stats.index(5))
+
+    def test_wide_label_range_is_mapped(self):
+        image = np.zeros((4, 5, 6), dtype=np.uint16)
+        image[0, 0, 0] = 1
+        image[1, 2, 3] = 60000
+        labels, offset = map_labels(image)
+        self.assertIsNone(offset)
+        np.testing.assert_array_equal(labels, [0, 1, 60000])
+        image[1, 2, 3] = MAX_DENSE_LABEL_RANGE - 1
+        labels, offset = map_labels(image)
+        self.assertEqual(offset, 0)
+        self.assertEqual(len(labels), MAX_DENSE_LABEL_RANGE)
+        stats = compute_label_statistics(image)
+        np.testing.assert_array_equal(stats.labels, [0, 1, MAX_DENSE_LABEL_RANGE - 1])
+
+    def test_absent_labels_are_dropped(self):
+        image = np.zeros((3, 3, 3), dtype=np.uint8)
+        image[0, 0, 0] = 5
+        stats = compute_label_statistics(image)
+        np.testing.assert_array_equal(stats.labels, [0, 5])
+
+
+if __name__ == '__main__':
+    unittest.main()
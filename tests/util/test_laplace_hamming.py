@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import unittest
+from hypothesis import given, settings, strategies as st
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from bonelab.util.laplace_hamming import laplace_hamming_filter, laplace_hamming_kernel, LaplaceHammingKernelCache
+
+
+HYPOTHESIS_DEADLINE = None  # this is how many milliseconds each test has to finish in
+
+
+def reference_laplace_hamming(
+        image: np.ndarray, laplace_epsilon: float, hamming_a0: float, voxel_spacing: float
+) -> np.ndarray:
+    # the meshgrid / fftshift implementation from `bonelab.cli.fft_laplace_hamming`
+    x, y, z = np.meshgrid(*[np.arange(s) / s for s in image.shape], indexing="ij")
+    vx, vy, vz = np.meshgrid(
+        *[np.fft.fftshift(np.fft.fftfreq(s, d=voxel_spacing)) for s in image.shape], indexing="ij"
+    )
+    hamming = (
+            (hamming_a0 - (1 - hamming_a0) * np.cos(2 * np.pi * x))
+            * (hamming_a0 - (1 - hamming_a0) * np.cos(2 * np.pi * y))
+            * (hamming_a0 - (1 - hamming_a0) * np.cos(2 * np.pi * z))
+    )
+    return laplace_epsilon * np.real(np.fft.ifftn(np.fft.ifftshift(
+        hamming * (vx ** 2 + vy ** 2 + vz ** 2) * np.fft.fftshift(np.fft.fftn(image))
+    ))) + (1 - laplace_epsilon) * image
+
+
+class TestLaplaceHammingFilter(unittest.TestCase):
+
+    @settings(deadline=HYPOTHESIS_DEADLINE, max_examples=20)
+    @given(
+        shape=st.tuples(*[st.integers(min_value=3, max_value=16)] * 3),
+        laplace_epsilon=st.floats(min_value=0.0, max_value=1.0),
+        hamming_a0=st.floats(min_value=0.3, max_value=0.7),
+        voxel_spacing=st.floats(min_value=0.5, max_value=2.0)
+    )
+    def test_matches_reference_double_precision(self, shape, laplace_epsilon, hamming_a0, voxel_spacing):
+        image = 1000 * np.random.rand(*shape)
+        expected = reference_laplace_hamming(image, laplace_epsilon, hamming_a0, voxel_spacing)
+        result = laplace_hamming_filter(image, laplace_epsilon, hamming_a0, voxel_spacing, dtype=np.float64)
+        np.testing.assert_allclose(result, expected, atol=1e-8)
+
+    def test_single_precision(self):
+        image = 1000 * np.random.rand(12, 13, 14)
+        expected = reference_laplace_hamming(image, 0.5, 25 / 46, 1.0)
+        result = laplace_hamming_filter(image, 0.5, 25 / 46, 1.0)
+        self.assertEqual(result.dtype, np.float32)
+        np.testing.assert_allclose(result, expected, atol=1e-2)
+
+    def test_kernel_shape(self):
+        self.assertEqual(laplace_hamming_kernel((4, 5, 7), 1.0, 0.5, 0.5).shape, (4, 5, 4))
+
+
+class TestLaplaceHammingKernelCache(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_memory_cache_reuses_kernel(self):
+        cache = LaplaceHammingKernelCache()
+        kernel = cache.get((6, 7, 8), 1.0, 0.5, 0.5)
+        self.assertIs(cache.get((6, 7, 8), 1.0, 0.5, 0.5), kernel)
+        self.assertIsNot(cache.get((6, 7, 8), 1.0, 0.5, 0.4), kernel)
+        self.assertIsNot(cache.get((6, 7, 8), 1.0, 0.5, 0.5, np.float64), kernel)
+
+    def test_memory_cache_is_bounded(self):
+        cache = LaplaceHammingKernelCache(max_kernels=2)
+        first = cache.get((6, 7, 8), 1.0, 0.5, 0.5)
+        second = cache.get((6, 7, 9), 1.0, 0.5, 0.5)
+        self.assertIs(cache.get((6, 7, 8), 1.0, 0.5, 0.5), first)
+        cache.get((6, 7, 10), 1.0, 0.5, 0.5)
+        self.assertIs(cache.get((6, 7, 8), 1.0, 0.5, 0.5), first)
+        self.assertIsNot(cache.get((6, 7, 9), 1.0, 0.5, 0.5), second)
+
+    def test_max_kernels_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            LaplaceHammingKernelCache(max_kernels=0)
+
+    def test_disk_cache(self):
+        cache = LaplaceHammingKernelCache(self.test_dir)
+        kernel = cache.get((6, 7, 8), 1.0, 0.5, 0.5)
+        self.assertEqual(len(os.listdir(self.test_dir)), 1)
+        loaded = LaplaceHammingKernelCache(self.test_dir).get((6, 7, 8), 1.0, 0.5, 0.5)
+        np.testing.assert_array_equal(loaded, kernel)
+        np.testing.assert_array_equal(loaded, laplace_hamming_kernel((6, 7, 8), 1.0, 0.5, 0.5))
+
+    def test_filter_with_cache(self):
+        image = 1000 * np.random.rand(6, 7, 8)
+        cache = LaplaceHammingKernelCache()
+        np.testing.assert_array_equal(
+            laplace_hamming_filter(image, 0.5, 0.5, 1.0, kernel_cache=cache),
+            laplace_hamming_filter(image, 0.5, 0.5, 1.0)
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
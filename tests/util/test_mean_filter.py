@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+import unittest
+from hypothesis import given, settings, strategies as st
+import numpy as np
+from scipy import ndimage
+from skimage.morphology import ball
+
+from bonelab.util.mean_filter import mean_filter, footprint_row_runs, first_axis_halo
+
+
+HYPOTHESIS_DEADLINE = None  # this is how many milliseconds each test has to finish in
+
+
+class TestFootprintRowRuns(unittest.TestCase):
+
+    def test_ball_runs_cover_footprint(self):
+        footprint = ball(3)
+        reconstructed = np.zeros_like(footprint)
+        for row_index, start, stop in footprint_row_runs(footprint):
+            reconstructed[row_index][start:stop] = 1
+        np.testing.assert_array_equal(reconstructed, footprint)
+
+    def test_split_row(self):
+        footprint = np.array([[1, 1, 0, 1]])
+        self.assertEqual(footprint_row_runs(footprint), [((0,), 0, 2), ((0,), 3, 4)])
+
+
+class TestMeanFilter(unittest.TestCase):
+
+    @settings(deadline=HYPOTHESIS_DEADLINE, max_examples=20)
+    @given(
+        shape=st.tuples(*[st.integers(min_value=5, max_value=20)] * 3),
+        radius=st.integers(min_value=1, max_value=4)
+    )
+    def test_ball_matches_convolve(self, shape, radius):
+        image = 1000 * np.random.rand(*shape)
+        footprint = ball(radius)
+        expected = ndimage.convolve(image, footprint / footprint.sum())
+        result = mean_filter(image, footprint)
+        self.assertEqual(result.dtype, np.float32)
+        np.testing.assert_allclose(result, expected, atol=1e-2)
+
+    @settings(deadline=HYPOTHESIS_DEADLINE, max_examples=20)
+    @given(
+        shape=st.tuples(*[st.integers(min_value=5, max_value=20)] * 3),
+        size=st.tuples(*[st.integers(min_value=1, max_value=6)] * 3)
+    )
+    def test_box_matches_convolve(self, shape, size):
+        image = 1000 * np.random.rand(*shape)
+        footprint = np.ones(size)
+        expected = ndimage.convolve(image, footprint / footprint.sum())
+        result = mean_filter(image, footprint)
+        self.assertEqual(result.dtype, np.float32)
+        np.testing.assert_allclose(result, expected, atol=1e-2)
+
+    def test_asymmetric_footprint_matches_convolve(self):
+        image = 1000 * np.random.rand(12, 13, 14)
+        footprint = np.zeros((3, 4, 5))
+        footprint[0, 1, :3] = 1
+        footprint[2, 3, 1:] = 1
+        footprint[1, 0, [0, 4]] = 1
+        expected = ndimage.convolve(image, footprint / footprint.sum())
+        np.testing.assert_allclose(mean_filter(image, footprint), expected, atol=1e-2)
+
+    @settings(deadline=HYPOTHESIS_DEADLINE, max_examples=20)
+    @given(
+        size=st.tuples(*[st.integers(min_value=1, max_value=6)] * 3),
+        use_ball=st.booleans(),
+        slab_thickness=st.integers(min_value=1, max_value=7)
+    )
+    def test_slabs_match_whole_image(self, size, use_ball, slab_thickness):
+        image = 1000 * np.random.rand(19, 9, 8)
+        footprint = ball(size[0] // 2 + 1) if use_ball else np.ones(size)
+        expected = mean_filter(image, footprint)
+        halo = first_axis_halo(footprint)
+        for start in range(0, image.shape[0], slab_thickness):
+            halo_start = max(start - halo, 0)
+            stop = min(start + slab_thickness, image.shape[0])
+            slab = mean_filter(image[halo_start:min(stop + halo, image.shape[0])], footprint, halo_start)
+            np.testing.assert_array_equal(slab[start - halo_start:stop - halo_start], expected[start:stop])
+
+    def test_dimension_mismatch(self):
+        with self.assertRaises(ValueError):
+            mean_filter(np.zeros((5, 5, 5)), np.ones((3, 3)))
+
+
+if __name__ == '__main__':
+    unittest.main()
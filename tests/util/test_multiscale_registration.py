@@ -3,9 +3,12 @@ from __future__ import annotations
 import unittest
 from hypothesis import given, settings, strategies as st
 from bonelab.util.demons_registration_util import (
-    smooth_and_resample, multiscale_registration, multiscale_demons, DEMONS_FILTERS
+    smooth_and_resample, multiscale_registration, multiscale_demons, DEMONS_FILTERS, ImagePyramid
 )
 
+import os
+import shutil
+import tempfile
 import numpy as np
 import SimpleITK as sitk
 
@@ -38,6 +41,74 @@ class TestSmoothAndResample(unittest.TestCase):
         self.assertEqual(tuple([int(x / s + 0.5) for x in shape]), resampled_img.GetSize())
 
 
+class TestImagePyramid(unittest.TestCase):
+
+    def setUp(self):
+        # Create temporary directory to work in
+        self.test_dir = tempfile.mkdtemp()
+        self.image = generate_sitk_image((20, 24, 28))
+        self.image.SetSpacing((0.5, 0.7, 0.9))
+        self.image.SetOrigin((1.0, -2.0, 3.5))
+
+    def tearDown(self):
+        # Remove temporary directory and all files
+        shutil.rmtree(self.test_dir)
+
+    def assert_images_equal(self, a: sitk.Image, b: sitk.Image):
+        self.assertEqual(a.GetSize(), b.GetSize())
+        self.assertEqual(a.GetOrigin(), b.GetOrigin())
+        self.assertEqual(a.GetSpacing(), b.GetSpacing())
+        self.assertEqual(a.GetDirection(), b.GetDirection())
+        np.testing.assert_array_equal(sitk.GetArrayFromImage(a), sitk.GetArrayFromImage(b))
+
+    def test_levels_match_smooth_and_resample(self):
+        pyramid = ImagePyramid(self.image)
+        for shrink_factor, smoothing_sigma in [(4, 2.0), (2, 1.0), (1.5, 0.5)]:
+            level = pyramid.get_level(shrink_factor, smoothing_sigma)
+            self.assert_images_equal(level, smooth_and_resample(self.image, shrink_factor, smoothing_sigma))
+            # the second time the cached level is returned
+            self.assertIs(pyramid.get_level(shrink_factor, smoothing_sigma), level)
+
+    def test_disk_cache(self):
+        pyramid = ImagePyramid(self.image, self.test_dir)
+        level = pyramid.get_level(2, 1.0)
+        fn = pyramid.level_filename(2, 1.0)
+        self.assertTrue(os.path.isfile(fn))
+        self.assertEqual(os.listdir(self.test_dir), [os.path.basename(fn)])
+        # a new pyramid of the same image reads the level written by the first
+        cached_level = ImagePyramid(sitk.Image(self.image), self.test_dir).get_level(2, 1.0)
+        self.assert_images_equal(cached_level, level)
+        # a different image does not
+        other = ImagePyramid(generate_sitk_image((20, 24, 28)), self.test_dir)
+        self.assertNotEqual(other.level_filename(2, 1.0), fn)
+
+    def test_incremental(self):
+        pyramid = ImagePyramid(self.image, incremental=True)
+        pyramid.build([(4, 2.0), (2, 1.0)])
+        for shrink_factor, smoothing_sigma in [(4, 2.0), (2, 1.0)]:
+            level = pyramid.get_level(shrink_factor, smoothing_sigma)
+            expected = smooth_and_resample(self.image, shrink_factor, smoothing_sigma)
+            self.assertEqual(level.GetSize(), expected.GetSize())
+            self.assertEqual(level.GetSpacing(), expected.GetSpacing())
+            # the finest level is built directly, the coarser one from it is only approximately the same
+            np.testing.assert_allclose(
+                sitk.GetArrayFromImage(level), sitk.GetArrayFromImage(expected),
+                atol=0 if shrink_factor == 2 else 0.05
+            )
+
+    def test_registration_with_pyramids(self):
+        fixed, moving = generate_sitk_image((20, 20, 20)), generate_sitk_image((20, 20, 20))
+        registration_filter = sitk.DemonsRegistrationFilter()
+        registration_filter.SetNumberOfIterations(5)
+        progression = [(2, 1.0)]
+        ddf = multiscale_registration(registration_filter, fixed, moving, multiscale_progression=progression)
+        ddf_pyramids = multiscale_registration(
+            registration_filter, ImagePyramid(fixed, self.test_dir), ImagePyramid(moving),
+            multiscale_progression=progression
+        )
+        self.assert_images_equal(ddf, ddf_pyramids)
+
+
 class TestMultiscaleRegistration(unittest.TestCase):
 
     def setUp(self):
@@ -69,6 +140,26 @@ class TestMultiscaleRegistration(unittest.TestCase):
         )
         self.assertEqual(ddf.GetSize(), fixed.GetSize())
 
+    @settings(deadline=HYPOTHESIS_DEADLINE)
+    @given(d=st.integers(min_value=20, max_value=30), initial_transform=st.booleans())
+    def test_float32_field(self, d, initial_transform):
+        shape = (d, d, d)
+        fixed, moving = generate_sitk_image(shape), generate_sitk_image(shape)
+        transform = sitk.Euler3DTransform((d / 2, d / 2, d / 2), 0.01, 0.0, 0.02, (0.5, 0.0, 0.0)) \
+            if initial_transform else None
+        ddf64 = multiscale_registration(
+            self.registration_filter, fixed, moving, transform, multiscale_progression=[(2.0, 1.0)]
+        )
+        ddf32 = multiscale_registration(
+            self.registration_filter, fixed, moving, transform, multiscale_progression=[(2.0, 1.0)],
+            field_pixel_type=sitk.sitkVectorFloat32
+        )
+        self.assertEqual(ddf64.GetPixelID(), sitk.sitkVectorFloat64)
+        self.assertEqual(ddf32.GetPixelID(), sitk.sitkVectorFloat32)
+        np.testing.assert_allclose(
+            sitk.GetArrayFromImage(ddf32), sitk.GetArrayFromImage(ddf64), rtol=0, atol=1e-4
+        )
+
 
 class TestMultiscaleDemons(unittest.TestCase):
 
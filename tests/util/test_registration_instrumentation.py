@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import unittest
+import json
+import os
+import shutil
+import tempfile
+
+from bonelab.util.registration_instrumentation import RegistrationInstrumentation, timed
+
+
+class TestRegistrationInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        # Create temporary directory to work in
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        # Remove temporary directory and all files
+        shutil.rmtree(self.test_dir)
+
+    def test_timings_add_up(self):
+        instrumentation = RegistrationInstrumentation()
+        with instrumentation.timer("read"):
+            pass
+        first = instrumentation.timings["read"]
+        with timed(instrumentation, "read"):
+            pass
+        self.assertGreaterEqual(instrumentation.timings["read"], first)
+        self.assertEqual(list(instrumentation.timings.keys()), ["read"])
+
+    def test_timed_without_instrumentation(self):
+        with timed(None, "read"):
+            pass
+
+    def test_levels(self):
+        instrumentation = RegistrationInstrumentation()
+        instrumentation.start_level(shrink_factor=2, smoothing_sigma=1.0)
+        instrumentation.record_iteration(0.5, valid_points=100)
+        instrumentation.record_iteration(0.25, valid_points=80)
+        instrumentation.start_level(valid_points=1000, shrink_factor=1, smoothing_sigma=0.0)
+        instrumentation.record_iteration(0.125)
+        instrumentation.record_iteration(0.0625, evaluations=None)
+        levels = instrumentation.to_dict()["levels"]
+        self.assertEqual([level["level"] for level in levels], [0, 1])
+        self.assertEqual([level["shrink_factor"] for level in levels], [2, 1])
+        self.assertEqual([level["iterations"] for level in levels], [2, 2])
+        self.assertEqual([level["metric_evaluations"] for level in levels], [2, None])
+        self.assertEqual([level["metric_valid_points"] for level in levels], [80, 1000])
+        self.assertEqual([level["metric_samples"] for level in levels], [180, 2000])
+        self.assertEqual([level["final_metric"] for level in levels], [0.25, 0.0625])
+        for level in levels:
+            self.assertIsNotNone(level["seconds"])
+
+    def test_iteration_without_level(self):
+        instrumentation = RegistrationInstrumentation()
+        instrumentation.record_iteration(1.0)
+        self.assertEqual(len(instrumentation.levels), 1)
+        self.assertEqual(instrumentation.levels[0]["iterations"], 1)
+
+    def test_write(self):
+        instrumentation = RegistrationInstrumentation()
+        with instrumentation.timer("registration"):
+            instrumentation.start_level(shrink_factor=1)
+            instrumentation.record_iteration(1.0)
+        fn = os.path.join(self.test_dir, "instrumentation.json")
+        instrumentation.write(fn, True)
+        with open(fn) as f:
+            written = json.load(f)
+        self.assertEqual(set(written.keys()), {"total_seconds", "timings", "levels"})
+        self.assertEqual(written["levels"][0]["final_metric"], 1.0)
+        self.assertGreaterEqual(written["total_seconds"], written["timings"]["registration"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import unittest
+from hypothesis import given, settings, strategies as st
+import os
+import shutil
+import tempfile
+import numpy as np
+from functools import partial
+from scipy import ndimage
+
+from bonelab.util.slab_processing import get_slabs, mask_in_slabs
+
+
+HYPOTHESIS_DEADLINE = None  # this is how many milliseconds each test has to finish in
+
+SIGMA = 1.0
+THRESHOLD = 0.5
+
+
+def smooth_and_threshold(image: np.ndarray, offset: int, sigma: float, threshold: float) -> np.ndarray:
+    return ndimage.gaussian_filter(image, sigma) > threshold
+
+
+def remove_small_objects(mask: np.ndarray, min_size: int) -> np.ndarray:
+    # reference implementation, `skimage.morphology.remove_small_objects` semantics with face connectivity
+    labels, _ = ndimage.label(mask)
+    return (np.bincount(labels.ravel()) >= min_size)[labels] & mask
+
+
+class TestGetSlabs(unittest.TestCase):
+
+    def test_slabs_cover_axis(self):
+        slabs = get_slabs(23, 5, 2)
+        self.assertEqual([(s.start, s.stop) for s in slabs], [(0, 5), (5, 10), (10, 15), (15, 20), (20, 23)])
+        self.assertEqual([(s.halo_start, s.halo_stop) for s in slabs], [(0, 7), (3, 12), (8, 17), (13, 22), (18, 23)])
+
+    def test_invalid_thickness(self):
+        with self.assertRaises(ValueError):
+            get_slabs(10, 0, 1)
+
+
+class TestMaskInSlabs(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.input_fn = os.path.join(self.test_dir, "input.npy")
+        self.output_fn = os.path.join(self.test_dir, "output.npy")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    @settings(deadline=HYPOTHESIS_DEADLINE, max_examples=10)
+    @given(
+        slab_thickness=st.integers(min_value=1, max_value=12),
+        min_size=st.integers(min_value=0, max_value=50),
+        workers=st.sampled_from([1, 2])
+    )
+    def test_matches_whole_volume(self, slab_thickness, min_size, workers):
+        image = np.random.rand(24, 15, 16)
+        np.save(self.input_fn, image)
+        expected = remove_small_objects(smooth_and_threshold(image, 0, SIGMA, THRESHOLD), min_size)
+        mask_in_slabs(
+            self.input_fn, self.output_fn, partial(smooth_and_threshold, sigma=SIGMA, threshold=THRESHOLD),
+            int(4 * SIGMA + 0.5), slab_thickness, min_size, workers, True
+        )
+        np.testing.assert_array_equal(np.load(self.output_fn), expected)
+
+    def test_component_spanning_all_slabs(self):
+        image = np.zeros((20, 5, 5))
+        image[:, 2, 2] = 1
+        np.save(self.input_fn, image)
+        threshold = partial(smooth_and_threshold, sigma=0, threshold=0)
+        mask_in_slabs(self.input_fn, self.output_fn, threshold, 0, 3, 20, 1, True)
+        np.testing.assert_array_equal(np.load(self.output_fn), image > 0)
+        mask_in_slabs(self.input_fn, self.output_fn, threshold, 0, 3, 21, 1, True)
+        self.assertFalse(np.load(self.output_fn).any())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,7 @@
 '''Test write csv functionality'''
 
 import unittest
-from bonelab.util.write_csv import write_csv
+from bonelab.util.write_csv import write_csv, write_csv_rows
 import subprocess
 import shutil, tempfile, filecmp
 import os
@@ -110,5 +110,74 @@ class TestWriteCSV(unittest.TestCase):
         self.assertTrue(filecmp.cmp(correct_file_name, self.csv_file_name),
           'Files are not the same')
 
+
+class TestWriteCSVRows(unittest.TestCase):
+    '''Test atomic write of many rows'''
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.csv_file_name = os.path.join(self.test_dir, 'test.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_union_of_keys(self):
+        # Create test data
+        first = OrderedDict()
+        first['FileName'] = 'a.txt'
+        first['A'] = 2
+        second = OrderedDict()
+        second['FileName'] = 'b.txt'
+        second['Error'] = 'failed'
+
+        # Create the expected file
+        correct_file_name = os.path.join(self.test_dir, 'test_correct.csv')
+        with open(correct_file_name, 'w') as f:
+            f.write('FileName,A,Error' + os.linesep)
+            f.write('a.txt,2,' + os.linesep)
+            f.write('b.txt,,failed' + os.linesep)
+
+        # Print result
+        write_csv_rows([first, second], self.csv_file_name)
+
+        # Test
+        self.assertTrue(filecmp.cmp(correct_file_name, self.csv_file_name),
+          'Files are not the same')
+        self.assertEqual(os.listdir(self.test_dir).count('test.csv'), 1)
+        self.assertEqual(len(os.listdir(self.test_dir)), 2,
+          'Temporary file was left behind')
+
+    def test_replaces_file(self):
+        # Create test data
+        data = OrderedDict()
+        data['FileName'] = 'filename.txt'
+        data['A'] = 2
+
+        # Write twice, the second write replaces the first
+        write_csv(data, self.csv_file_name)
+        write_csv_rows([data], self.csv_file_name)
+
+        # Create the expected file
+        correct_file_name = os.path.join(self.test_dir, 'test_correct.csv')
+        with open(correct_file_name, 'w') as f:
+            f.write('FileName,A' + os.linesep)
+            f.write('filename.txt,2' + os.linesep)
+
+        # Test
+        self.assertTrue(filecmp.cmp(correct_file_name, self.csv_file_name),
+          'Files are not the same')
+    def test_rows_file_permissions(self):
+        data = OrderedDict()
+        data['FileName'] = 'filename.txt'
+
+        # Same permissions as a file created with `open`
+        reference_file_name = os.path.join(self.test_dir, 'reference.csv')
+        with open(reference_file_name, 'w'):
+            pass
+        write_csv_rows([data], self.csv_file_name)
+
+        # Test
+        self.assertEqual(os.stat(self.csv_file_name).st_mode, os.stat(reference_file_name).st_mode)
+
 if __name__ == '__main__':
     unittest.main()
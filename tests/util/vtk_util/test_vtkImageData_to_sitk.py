@@ -0,0 +1,57 @@
+'''Test vtkImageData_to_sitk'''
+
+import unittest
+import os
+import numpy as np
+import numpy.testing as npt
+import shutil, tempfile
+import vtk
+import SimpleITK as sitk
+
+from bonelab.util.vtk_util import vtkImageData_to_sitk, numpy_to_vtkImageData
+
+
+class TestvtkImageDataToSitk(unittest.TestCase):
+    '''Test vtkImageData_to_sitk'''
+
+    def setUp(self):
+        # Create temporary directory to work in
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        # Remove temporary directory and all files
+        shutil.rmtree(self.test_dir)
+
+    def test_matches_nifti_round_trip(self):
+        '''Same image as writing a NIfTI with VTK and reading it with SimpleITK'''
+        array = np.arange(4*5*6, dtype=np.int16).reshape(4,5,6)
+        image = numpy_to_vtkImageData(
+            array, spacing=[0.082, 0.1, 0.3], origin=[1.1, -2.3, 3.7], array_type=vtk.VTK_SHORT
+        )
+
+        filename = os.path.join(self.test_dir, 'image.nii')
+        writer = vtk.vtkNIFTIImageWriter()
+        writer.SetInputData(image)
+        writer.SetFileName(filename)
+        writer.Write()
+        expected = sitk.ReadImage(filename)
+
+        result = vtkImageData_to_sitk(image)
+
+        self.assertEqual(result.GetPixelID(), expected.GetPixelID())
+        self.assertEqual(result.GetSize(), expected.GetSize())
+        self.assertEqual(result.GetSpacing(), expected.GetSpacing())
+        self.assertEqual(result.GetOrigin(), expected.GetOrigin())
+        self.assertEqual(result.GetDirection(), expected.GetDirection())
+        npt.assert_array_equal(sitk.GetArrayFromImage(result), sitk.GetArrayFromImage(expected))
+
+    def test_indexing(self):
+        '''Voxel [x, y, z] in VTK is voxel (x, y, z) in SimpleITK'''
+        array = np.random.rand(3,4,5).astype(np.float32)
+        result = vtkImageData_to_sitk(numpy_to_vtkImageData(array))
+        self.assertEqual(result.GetSize(), (3,4,5))
+        self.assertEqual(result[1,2,3], array[1,2,3])
+
+
+if __name__ == '__main__':
+    unittest.main()